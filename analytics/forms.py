@@ -0,0 +1,32 @@
+from django import forms
+
+from shop.models import Category
+
+
+class DashboardForm(forms.Form):
+    """
+    Form for choosing the days and the category shown by the sales
+    dashboard.
+
+    Both days are included. The whole shop is shown when no category is
+    chosen.
+    """
+    start = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    end = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    category = forms.ModelChoiceField(
+        queryset=Category.objects.all(),
+        required=False,
+        to_field_name='slug',
+        empty_label='All categories',
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if start and end and start > end:
+            raise forms.ValidationError('The start must not be after the end.')
+        return cleaned_data
@@ -0,0 +1,159 @@
+# Generated by Django 5.0.9 on 2026-10-19 11:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import DateField, OuterRef, Subquery, Sum
+from django.db.models.functions import Trunc
+
+
+def fill_rollups(apps, schema_editor):
+    # rows recorded before the column existed get the current category of
+    # their product, as a rebuild would
+    DailyProductSales = apps.get_model('analytics', 'DailyProductSales')
+    Product = apps.get_model('shop', 'Product')
+    DailyProductSales.objects.update(
+        category_id=Subquery(
+            Product.objects.filter(id=OuterRef('product_id')).values(
+                'category_id'
+            )[:1]
+        )
+    )
+    # same as analytics.rollups.roll_up_months
+    for name, fields in (
+        ('ProductSales', ('product_id', 'category_id')),
+        ('CategorySales', ('category_id',)),
+        ('CouponSales', ('coupon_id',)),
+    ):
+        daily = apps.get_model('analytics', f'Daily{name}')
+        monthly = apps.get_model('analytics', f'Monthly{name}')
+        rows = (
+            daily.objects.values(
+                *fields, month=Trunc('date', 'month', output_field=DateField())
+            )
+            .annotate(
+                paid_orders=Sum('orders'),
+                units=Sum('quantity'),
+                gross=Sum('revenue'),
+                discounts=Sum('discount'),
+            )
+            .order_by()
+        )
+        monthly.objects.bulk_create(
+            (
+                monthly(
+                    date=row['month'],
+                    **{field: row[field] for field in fields},
+                    orders=row['paid_orders'],
+                    quantity=row['units'],
+                    revenue=row['gross'],
+                    discount=row['discounts'],
+                )
+                for row in rows.iterator()
+            ),
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0001_initial'),
+        ('coupons', '0003_redemption_limits'),
+        ('shop', '0004_stockreservation_oversold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyCategorySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('discount', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+            ],
+            options={
+                'verbose_name_plural': 'monthly category sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='MonthlyCouponSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('discount', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+            ],
+            options={
+                'verbose_name_plural': 'monthly coupon sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='MonthlyProductSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('discount', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+            ],
+            options={
+                'verbose_name_plural': 'monthly product sales',
+            },
+        ),
+        migrations.RemoveConstraint(
+            model_name='dailyproductsales',
+            name='unique_daily_product_sales',
+        ),
+        migrations.AddField(
+            model_name='dailyproductsales',
+            name='category',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_product_sales', to='shop.category'),
+        ),
+        migrations.AddField(
+            model_name='monthlycategorysales',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_sales', to='shop.category'),
+        ),
+        migrations.AddField(
+            model_name='monthlycouponsales',
+            name='coupon',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_sales', to='coupons.coupon'),
+        ),
+        migrations.AddField(
+            model_name='monthlyproductsales',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_product_sales', to='shop.category'),
+        ),
+        migrations.AddField(
+            model_name='monthlyproductsales',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_sales', to='shop.product'),
+        ),
+        migrations.AddConstraint(
+            model_name='monthlycategorysales',
+            constraint=models.UniqueConstraint(fields=('date', 'category'), name='unique_monthly_category_sales'),
+        ),
+        migrations.AddConstraint(
+            model_name='monthlycouponsales',
+            constraint=models.UniqueConstraint(fields=('date', 'coupon'), name='unique_monthly_coupon_sales'),
+        ),
+        migrations.AddConstraint(
+            model_name='monthlyproductsales',
+            constraint=models.UniqueConstraint(fields=('date', 'product', 'category'), name='unique_monthly_product_sales'),
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='dailyproductsales',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_product_sales', to='shop.category'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyproductsales',
+            constraint=models.UniqueConstraint(fields=('date', 'product', 'category'), name='unique_daily_product_sales'),
+        ),
+    ]
@@ -0,0 +1,212 @@
+from django.db import models
+
+
+class SalesRollup(models.Model):
+    """Sales of one day or month, as counted when orders are paid.
+
+    Orders count on the day they were placed, so a day can be rebuilt from
+    the orders placed on it, and a month from its days (see
+    ``analytics/rollups.py``).
+
+    Attributes:
+        date (DateField): The day the orders were placed, or the first day
+            of their month for monthly rollups.
+        orders (PositiveIntegerField): Paid orders.
+        quantity (PositiveIntegerField): Units sold.
+        revenue (DecimalField): Value of the items sold, before discounts.
+        discount (DecimalField): Value of the coupon discounts, kept with
+            four decimals so the sums do not drift from a rebuild.
+    """
+    date = models.DateField()
+    orders = models.PositiveIntegerField(default=0)
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=16, decimal_places=4, default=0)
+
+    class Meta:
+        abstract = True
+
+    def get_net_revenue(self):
+        """Returns the revenue after discounts."""
+        return self.revenue - self.discount
+
+
+class DailySales(SalesRollup):
+    """Sales of the whole shop per day."""
+
+    class Meta:
+        verbose_name_plural = 'daily sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date'], name='unique_daily_sales'
+            ),
+        ]
+
+    def __str__(self):
+        return f'Sales of {self.date}'
+
+
+class DailyProductSales(SalesRollup):
+    """Sales of a product per day.
+
+    A product moved to another category that day has a row per category.
+
+    Attributes:
+        product (ForeignKey): The product sold.
+        category (ForeignKey): The category of the product when it was
+            sold, as counted in :class:`DailyCategorySales`.
+    """
+    product = models.ForeignKey(
+        'shop.Product',
+        related_name='daily_sales',
+        on_delete=models.CASCADE,
+    )
+    category = models.ForeignKey(
+        'shop.Category',
+        related_name='daily_product_sales',
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        verbose_name_plural = 'daily product sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'product', 'category'],
+                name='unique_daily_product_sales',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Sales of product {self.product_id} on {self.date}'
+
+
+class DailyCategorySales(SalesRollup):
+    """Sales of the products of a category per day.
+
+    Attributes:
+        category (ForeignKey): The category of the products sold.
+    """
+    category = models.ForeignKey(
+        'shop.Category',
+        related_name='daily_sales',
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        verbose_name_plural = 'daily category sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'category'],
+                name='unique_daily_category_sales',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Sales of category {self.category_id} on {self.date}'
+
+
+class DailyCouponSales(SalesRollup):
+    """Sales of the orders that used a coupon, per day.
+
+    Attributes:
+        coupon (ForeignKey): The coupon applied to the orders.
+    """
+    coupon = models.ForeignKey(
+        'coupons.Coupon',
+        related_name='daily_sales',
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        verbose_name_plural = 'daily coupon sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'coupon'],
+                name='unique_daily_coupon_sales',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Sales of coupon {self.coupon_id} on {self.date}'
+
+
+class MonthlyProductSales(SalesRollup):
+    """Sales of a product per month, so ranges of years do not group a row
+    per product and day.
+
+    Attributes:
+        product (ForeignKey): The product sold.
+        category (ForeignKey): The category of the product when it was sold.
+    """
+    product = models.ForeignKey(
+        'shop.Product',
+        related_name='monthly_sales',
+        on_delete=models.CASCADE,
+    )
+    category = models.ForeignKey(
+        'shop.Category',
+        related_name='monthly_product_sales',
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        verbose_name_plural = 'monthly product sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'product', 'category'],
+                name='unique_monthly_product_sales',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Sales of product {self.product_id} in {self.date:%Y-%m}'
+
+
+class MonthlyCategorySales(SalesRollup):
+    """Sales of the products of a category per month.
+
+    Attributes:
+        category (ForeignKey): The category of the products sold.
+    """
+    category = models.ForeignKey(
+        'shop.Category',
+        related_name='monthly_sales',
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        verbose_name_plural = 'monthly category sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'category'],
+                name='unique_monthly_category_sales',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Sales of category {self.category_id} in {self.date:%Y-%m}'
+
+
+class MonthlyCouponSales(SalesRollup):
+    """Sales of the orders that used a coupon, per month.
+
+    Attributes:
+        coupon (ForeignKey): The coupon applied to the orders.
+    """
+    coupon = models.ForeignKey(
+        'coupons.Coupon',
+        related_name='monthly_sales',
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        verbose_name_plural = 'monthly coupon sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'coupon'],
+                name='unique_monthly_coupon_sales',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Sales of coupon {self.coupon_id} in {self.date:%Y-%m}'
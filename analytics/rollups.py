@@ -0,0 +1,331 @@
+"""
+Daily and monthly sales rollups.
+
+The tables of ``analytics/models.py`` hold the sales of each day for the
+whole shop and per product, category and coupon, so reports never group
+the order items themselves. The product, category and coupon sales are
+also kept per month, so reports over years do not group a row per day
+either. Products are counted in the category they had when they were sold,
+in the product rollups as in the category rollups.
+
+:func:`record_sales` adds orders to the rollups in the transaction that
+marks them as paid (see ``payment/events.py``). An order is therefore
+counted exactly once, whether its payment comes through the webhook view or
+a batch of queued events, and never if the payment is rolled back. The
+missing rows of each table are inserted, conflicts ignored, and the rows
+are then incremented with a single ``UPDATE``, so a batch of payments runs
+the same queries as one. Every payment locks the row of its day in
+:class:`DailySales` first, so concurrent payments queue there rather than
+deadlock on the other tables.
+
+:func:`backfill` rebuilds the rollups from the paid orders, one chunk of
+days per transaction, for instance after the first deployment. The
+monthly rollups of the months a chunk touches are then added up again from
+the daily rollups.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from functools import reduce
+from operator import or_
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DateField, F, Q, Sum, Value, When
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from orders.models import Order, OrderItem
+
+from .models import (
+    DailyCategorySales,
+    DailyCouponSales,
+    DailyProductSales,
+    DailySales,
+    MonthlyCategorySales,
+    MonthlyCouponSales,
+    MonthlyProductSales,
+)
+
+logger = logging.getLogger(__name__)
+
+# the daily rollup models and the fields that key their rows besides the
+# date
+DAILY_ROLLUPS = (
+    (DailySales, ()),
+    (DailyProductSales, ('product_id', 'category_id')),
+    (DailyCategorySales, ('category_id',)),
+    (DailyCouponSales, ('coupon_id',)),
+)
+# the monthly rollup models, the daily ones they add up and their key fields
+MONTHLY_ROLLUPS = (
+    (MonthlyProductSales, DailyProductSales, ('product_id', 'category_id')),
+    (MonthlyCategorySales, DailyCategorySales, ('category_id',)),
+    (MonthlyCouponSales, DailyCouponSales, ('coupon_id',)),
+)
+# every rollup, DailySales first so payments lock its row before the others
+ROLLUPS = DAILY_ROLLUPS + tuple(
+    (monthly, fields) for monthly, _, fields in MONTHLY_ROLLUPS
+)
+
+ITEM_FIELDS = (
+    'order_id',
+    'order__created',
+    'order__discount',
+    'order__coupon_id',
+    'product_id',
+    'product__category_id',
+    'price',
+    'quantity',
+)
+
+# attempts to rebuild a chunk that a payment added a row to meanwhile
+REBUILD_ATTEMPTS = 3
+
+
+class Sales:
+    """The sales counted by one rollup row."""
+
+    __slots__ = ('orders', 'quantity', 'revenue', 'discount')
+
+    def __init__(self):
+        self.orders = set()
+        self.quantity = 0
+        self.revenue = Decimal(0)
+        self.discount = Decimal(0)
+
+    def get_values(self):
+        return {
+            'orders': len(self.orders),
+            'quantity': self.quantity,
+            'revenue': self.revenue,
+            'discount': self.discount,
+        }
+
+
+def summarize(items):
+    """Add up order items per rollup row.
+
+    Args:
+        items (iterable): The ``ITEM_FIELDS`` values of order items.
+
+    Returns:
+        dict: Per rollup model, the :class:`Sales` of its rows keyed by
+        the date, or the first day of the month, and the values of its key
+        fields.
+    """
+    sales = {model: defaultdict(Sales) for model, _ in ROLLUPS}
+    for (
+        order_id, created, percent, coupon_id, product_id, category_id,
+        price, quantity,
+    ) in items:
+        day = timezone.localdate(created)
+        month = day.replace(day=1)
+        revenue = price * quantity
+        discount = revenue * percent / 100
+        rows = [
+            sales[DailySales][(day,)],
+            sales[DailyProductSales][(day, product_id, category_id)],
+            sales[DailyCategorySales][(day, category_id)],
+            sales[MonthlyProductSales][(month, product_id, category_id)],
+            sales[MonthlyCategorySales][(month, category_id)],
+        ]
+        if coupon_id is not None:
+            rows.append(sales[DailyCouponSales][(day, coupon_id)])
+            rows.append(sales[MonthlyCouponSales][(month, coupon_id)])
+        for row in rows:
+            row.orders.add(order_id)
+            row.quantity += quantity
+            row.revenue += revenue
+            row.discount += discount
+    return sales
+
+
+def increment(model, fields, sales):
+    """Add sales to the rows of a rollup table, creating them if needed.
+
+    Args:
+        model (type): The rollup model.
+        fields (tuple): The fields that key its rows besides the date.
+        sales (dict): The :class:`Sales` to add, keyed like the result of
+            :func:`summarize`.
+    """
+    lookups = [
+        (Q(date=key[0], **dict(zip(fields, key[1:]))), row)
+        for key, row in sorted(sales.items())
+    ]
+    if not lookups:
+        return
+    # rows created by a concurrent payment are incremented below
+    model.objects.bulk_create(
+        [
+            model(date=key[0], **dict(zip(fields, key[1:])))
+            for key in sorted(sales)
+        ],
+        ignore_conflicts=True,
+    )
+    changes = {}
+    for name in Sales.__slots__:
+        field = model._meta.get_field(name)
+        changes[name] = F(name) + Case(
+            *[
+                When(lookup, then=Value(row.get_values()[name]))
+                for lookup, row in lookups
+            ],
+            default=Value(0),
+            output_field=field,
+        )
+    model.objects.filter(
+        reduce(or_, [lookup for lookup, _ in lookups])
+    ).update(**changes)
+
+
+def record_sales(order_ids):
+    """Add paid orders to the rollups.
+
+    Must be called in the transaction that marks the orders as paid, and
+    only for the orders it changed.
+
+    Args:
+        order_ids (iterable): The IDs of the orders.
+    """
+    items = OrderItem.objects.filter(order_id__in=order_ids).values_list(
+        *ITEM_FIELDS
+    )
+    sales = summarize(items)
+    for model, fields in ROLLUPS:
+        increment(model, fields, sales[model])
+
+
+def get_day_start(day):
+    """Return the aware datetime at which a day starts."""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def roll_up_months(start, end):
+    """Recompute the monthly rollups of the months of a range of days from
+    the daily rollups.
+
+    Args:
+        start (date): The first day.
+        end (date): The day after the last one.
+    """
+    first = start.replace(day=1)
+    last = (end - timedelta(days=1)).replace(day=1)
+    after = (last + timedelta(days=31)).replace(day=1)
+    for monthly, daily, fields in MONTHLY_ROLLUPS:
+        monthly.objects.filter(date__gte=first, date__lt=after).delete()
+        rows = (
+            daily.objects.filter(date__gte=first, date__lt=after)
+            .values(
+                *fields, month=Trunc('date', 'month', output_field=DateField())
+            )
+            .annotate(
+                paid_orders=Sum('orders'),
+                units=Sum('quantity'),
+                gross=Sum('revenue'),
+                discounts=Sum('discount'),
+            )
+            .order_by()
+        )
+        monthly.objects.bulk_create(
+            (
+                monthly(
+                    date=row['month'],
+                    **{field: row[field] for field in fields},
+                    orders=row['paid_orders'],
+                    quantity=row['units'],
+                    revenue=row['gross'],
+                    discount=row['discounts'],
+                )
+                for row in rows.iterator()
+            ),
+            batch_size=1000,
+        )
+
+
+def rebuild(start, end):
+    """Recompute the rollups of a range of days from the paid orders.
+
+    The monthly rollups of the months the range touches are recomputed too,
+    from the daily rollups.
+
+    Args:
+        start (date): The first day.
+        end (date): The day after the last one.
+
+    Returns:
+        int: The number of orders counted.
+
+    Raises:
+        IntegrityError: If a payment created a row of the range while it
+            was rebuilt. The range can be rebuilt again.
+    """
+    with transaction.atomic():
+        for model, _ in DAILY_ROLLUPS:
+            model.objects.filter(date__gte=start, date__lt=end).delete()
+        items = OrderItem.objects.filter(
+            order__paid=True,
+            order__created__gte=get_day_start(start),
+            order__created__lt=get_day_start(end),
+        ).values_list(*ITEM_FIELDS)
+        sales = summarize(items.iterator(chunk_size=5000))
+        for model, fields in DAILY_ROLLUPS:
+            model.objects.bulk_create(
+                (
+                    model(
+                        date=key[0],
+                        **dict(zip(fields, key[1:])),
+                        **row.get_values(),
+                    )
+                    for key, row in sales[model].items()
+                ),
+                batch_size=1000,
+            )
+        roll_up_months(start, end)
+    return sum(len(row.orders) for row in sales[DailySales].values())
+
+
+def backfill(start=None, end=None, days=30, progress=None):
+    """Rebuild the rollups of a range of days, one chunk per transaction.
+
+    Args:
+        start (date): The first day, by default the day of the first paid
+            order.
+        end (date): The day after the last one, by default tomorrow.
+        days (int): The number of days rebuilt per transaction.
+        progress (callable): Called with the first day, the day after the
+            last one and the number of orders of every chunk rebuilt.
+
+    Returns:
+        int: The number of orders counted.
+    """
+    if start is None:
+        first = (
+            Order.objects.filter(paid=True)
+            .order_by('created')
+            .values_list('created', flat=True)
+            .first()
+        )
+        if first is None:
+            return 0
+        start = timezone.localdate(first)
+    if end is None:
+        end = timezone.localdate() + timedelta(days=1)
+    total = 0
+    while start < end:
+        stop = min(start + timedelta(days=days), end)
+        for attempt in range(1, REBUILD_ATTEMPTS + 1):
+            try:
+                orders = rebuild(start, stop)
+                break
+            except IntegrityError:
+                if attempt == REBUILD_ATTEMPTS:
+                    raise
+                logger.info('Rebuilding %s to %s again', start, stop)
+        total += orders
+        if progress:
+            progress(start, stop, orders)
+        start = stop
+    return total
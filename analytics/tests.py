@@ -0,0 +1,364 @@
+import io
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from coupons.models import Coupon
+from orders.models import Order, OrderItem
+from payment.events import mark_order_paid, mark_orders_paid
+from shop.models import Category, Product
+
+from .models import (
+    DailyCategorySales,
+    DailyCouponSales,
+    DailyProductSales,
+    DailySales,
+    MonthlyCategorySales,
+    MonthlyProductSales,
+)
+from .rollups import ROLLUPS, backfill, rebuild, roll_up_months
+
+DAY = datetime(2024, 3, 1, 12, tzinfo=dt_timezone.utc)
+
+
+def create_order(created, items, coupon=None, paid=False):
+    order = Order.objects.create(
+        first_name='Ada',
+        last_name='Lovelace',
+        email='ada@example.com',
+        address='1 Main St',
+        postal_code='1000',
+        city='London',
+        coupon=coupon,
+        discount=coupon.discount if coupon else 0,
+        paid=paid,
+    )
+    Order.objects.filter(id=order.id).update(created=created)
+    for product, quantity in items:
+        OrderItem.objects.create(
+            order=order, product=product, price=product.price,
+            quantity=quantity,
+        )
+    return order
+
+
+def get_rollups():
+    """All rollup rows, as comparable tuples."""
+    rows = {}
+    for model, fields in ROLLUPS:
+        rows[model.__name__] = sorted(
+            model.objects.values_list(
+                'date', *fields, 'orders', 'quantity', 'revenue', 'discount'
+            )
+        )
+    return rows
+
+
+@override_settings(COUPON_BLOOM_FILTER=False)
+class SalesRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.tea = Category.objects.create(name='Tea', slug='tea')
+        cls.cups = Category.objects.create(name='Cups', slug='cups')
+        cls.green = Product.objects.create(
+            category=cls.tea, name='Green', slug='green', price='4.50'
+        )
+        cls.black = Product.objects.create(
+            category=cls.tea, name='Black', slug='black', price='3.00'
+        )
+        cls.cup = Product.objects.create(
+            category=cls.cups, name='Cup', slug='cup', price='12.00'
+        )
+        cls.coupon = Coupon.objects.create(
+            code='SPRING', valid_from=DAY - timedelta(days=30),
+            valid_to=DAY + timedelta(days=30), discount=15, active=True,
+        )
+
+    def setUp(self):
+        side_effects = mock.patch('payment.events.order_paid')
+        side_effects.start()
+        self.addCleanup(side_effects.stop)
+
+    def test_paid_order_is_added_to_the_rollups(self):
+        order = create_order(
+            DAY, [(self.green, 2), (self.cup, 1)], coupon=self.coupon
+        )
+        with transaction.atomic():
+            self.assertTrue(mark_order_paid(order.id, 'pi_1'))
+        day = DAY.date()
+        sales = DailySales.objects.get(date=day)
+        self.assertEqual(
+            (sales.orders, sales.quantity, sales.revenue),
+            (1, 3, Decimal('21.00')),
+        )
+        self.assertEqual(sales.discount, Decimal('3.15'))
+        self.assertEqual(sales.get_net_revenue(), Decimal('17.85'))
+        tea = DailyCategorySales.objects.get(date=day, category=self.tea)
+        self.assertEqual((tea.quantity, tea.revenue), (2, Decimal('9.00')))
+        self.assertEqual(
+            DailyProductSales.objects.get(date=day, product=self.cup).revenue,
+            Decimal('12.00'),
+        )
+        coupon = DailyCouponSales.objects.get(date=day, coupon=self.coupon)
+        self.assertEqual(
+            (coupon.orders, coupon.discount), (1, Decimal('3.15'))
+        )
+
+    def test_products_are_counted_in_the_category_they_were_sold_in(self):
+        with transaction.atomic():
+            mark_order_paid(create_order(DAY, [(self.green, 1)]).id, 'pi_1')
+        Product.objects.filter(id=self.green.id).update(category=self.cups)
+        order = create_order(DAY + timedelta(days=1), [(self.green, 2)])
+        with transaction.atomic():
+            mark_order_paid(order.id, 'pi_2')
+        self.assertEqual(
+            sorted(
+                MonthlyProductSales.objects.filter(
+                    date=DAY.date(), product=self.green
+                ).values_list('category__name', 'orders', 'quantity')
+            ),
+            [('Cups', 1, 2), ('Tea', 1, 1)],
+        )
+        self.assertEqual(
+            MonthlyCategorySales.objects.get(
+                date=DAY.date(), category=self.tea
+            ).quantity,
+            1,
+        )
+
+    def test_order_paid_twice_is_counted_once(self):
+        order = create_order(DAY, [(self.black, 1)])
+        with transaction.atomic():
+            mark_order_paid(order.id, 'pi_1')
+        with transaction.atomic():
+            self.assertFalse(mark_order_paid(order.id, 'pi_2'))
+        self.assertEqual(DailySales.objects.get().orders, 1)
+
+    def test_rolled_back_payment_is_not_counted(self):
+        order = create_order(DAY, [(self.black, 1)])
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                mark_order_paid(order.id, 'pi_1')
+                raise RuntimeError
+        self.assertFalse(DailySales.objects.exists())
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        orders = [
+            create_order(DAY, [(self.green, 1), (self.black, 3)]),
+            create_order(DAY, [(self.green, 2)], coupon=self.coupon),
+            create_order(DAY + timedelta(days=1), [(self.cup, 1)]),
+            create_order(
+                DAY + timedelta(days=40), [(self.cup, 2), (self.black, 1)],
+                coupon=self.coupon,
+            ),
+        ]
+        # not paid, so never counted
+        create_order(DAY, [(self.cup, 5)])
+        with transaction.atomic():
+            mark_order_paid(orders[0].id, 'pi_0')
+        with transaction.atomic():
+            mark_orders_paid({order.id: 'pi' for order in orders[1:]})
+        incremental = get_rollups()
+        self.assertEqual(len(incremental['DailySales']), 3)
+
+        self.assertEqual(backfill(days=7), 4)
+        self.assertEqual(get_rollups(), incremental)
+
+    def test_backfill_rebuilds_in_chunks(self):
+        for n in range(5):
+            create_order(
+                DAY + timedelta(days=n), [(self.black, 1)], paid=True
+            )
+        # a stale row that the rebuild replaces
+        DailySales.objects.create(date=DAY.date(), orders=9)
+        chunks = []
+        total = backfill(
+            DAY.date(), DAY.date() + timedelta(days=5), days=2,
+            progress=lambda start, stop, orders: chunks.append(orders),
+        )
+        self.assertEqual(total, 5)
+        self.assertEqual(chunks, [2, 2, 1])
+        self.assertEqual(
+            list(DailySales.objects.order_by('date').values_list(
+                'orders', flat=True
+            )),
+            [1, 1, 1, 1, 1],
+        )
+
+    def test_rebuild_leaves_other_days_alone(self):
+        create_order(DAY, [(self.black, 1)], paid=True)
+        other = DailySales.objects.create(
+            date=DAY.date() - timedelta(days=1), orders=3
+        )
+        rebuild(DAY.date(), DAY.date() + timedelta(days=1))
+        other.refresh_from_db()
+        self.assertEqual(other.orders, 3)
+
+    def test_backfill_command(self):
+        create_order(DAY, [(self.cup, 1)], paid=True)
+        out = io.StringIO()
+        call_command('backfill_sales', '--days', '90', stdout=out)
+        self.assertIn('Counted 1 paid orders', out.getvalue())
+        self.assertEqual(DailySales.objects.get().revenue, Decimal('12.00'))
+
+
+class SalesDashboardTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.tea = Category.objects.create(name='Tea', slug='tea')
+        cls.cups = Category.objects.create(name='Cups', slug='cups')
+        cls.green = Product.objects.create(
+            category=cls.tea, name='Green', slug='green', price='4.50'
+        )
+        cls.cup = Product.objects.create(
+            category=cls.cups, name='Cup', slug='cup', price='12.00'
+        )
+        today = timezone.localdate()
+        for n in range(3 * 365):
+            day = today - timedelta(days=n)
+            DailySales.objects.create(
+                date=day, orders=2, quantity=3, revenue=Decimal('21.00')
+            )
+            DailyCategorySales.objects.create(
+                date=day, category=cls.tea, orders=1, quantity=2,
+                revenue=Decimal('9.00'),
+            )
+            DailyCategorySales.objects.create(
+                date=day, category=cls.cups, orders=1, quantity=1,
+                revenue=Decimal('12.00'),
+            )
+            DailyProductSales.objects.create(
+                date=day, product=cls.green, category=cls.tea, orders=1,
+                quantity=2, revenue=Decimal('9.00'),
+            )
+            DailyProductSales.objects.create(
+                date=day, product=cls.cup, category=cls.cups, orders=1,
+                quantity=1, revenue=Decimal('12.00'),
+            )
+        # Green was moved to the cups and sold there once today
+        DailyProductSales.objects.create(
+            date=today, product=cls.green, category=cls.cups, orders=1,
+            quantity=5, revenue=Decimal('22.50'),
+        )
+        DailyCategorySales.objects.filter(
+            date=today, category=cls.cups
+        ).update(orders=2, quantity=6, revenue=Decimal('34.50'))
+        DailySales.objects.filter(date=today).update(
+            orders=3, quantity=8, revenue=Decimal('43.50')
+        )
+        roll_up_months(
+            today - timedelta(days=3 * 365), today + timedelta(days=1)
+        )
+        cls.staff = User.objects.create_user(
+            'staff', 'staff@example.com', 'secret', is_staff=True
+        )
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+        self.url = reverse('analytics:sales_dashboard')
+
+    def test_multi_year_range_reads_only_the_rollups(self):
+        end = timezone.localdate()
+        start = end - timedelta(days=3 * 365 - 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                self.url, {'start': start, 'end': end}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['kind'], 'month')
+        totals = response.context['totals']
+        self.assertEqual(totals['paid_orders'], 2 * 3 * 365 + 1)
+        self.assertEqual(
+            totals['net'], Decimal('21.00') * 3 * 365 + Decimal('22.50')
+        )
+        self.assertEqual(
+            [row['category__name'] for row in response.context['categories']],
+            ['Cups', 'Tea'],
+        )
+        self.assertEqual(
+            [
+                (row['product__name'], row['units'])
+                for row in response.context['products']
+            ],
+            [('Cup', 3 * 365), ('Green', 2 * 3 * 365 + 5)],
+        )
+        # products, categories and coupons are read per month
+        for query in queries.captured_queries:
+            self.assertNotIn('orders_order', query['sql'])
+            self.assertNotIn('analytics_dailyproductsales', query['sql'])
+            self.assertNotIn('analytics_dailycategorysales', query['sql'])
+            self.assertNotIn('analytics_dailycouponsales', query['sql'])
+
+    def test_long_ranges_are_widened_to_whole_months(self):
+        response = self.client.get(
+            self.url, {'start': '2024-01-15', 'end': '2024-06-10'}
+        )
+        self.assertEqual(response.context['kind'], 'month')
+        self.assertEqual(
+            (response.context['start'], response.context['end']),
+            (date(2024, 1, 1), date(2024, 6, 30)),
+        )
+
+    def test_category_lists_the_products_sold_in_it(self):
+        end = timezone.localdate()
+        for start in (end, end - timedelta(days=365)):
+            with self.subTest(kind='day' if start == end else 'month'):
+                response = self.client.get(
+                    self.url, {'start': start, 'end': end, 'category': 'tea'}
+                )
+                products = response.context['products']
+                self.assertEqual(
+                    [row['product__name'] for row in products], ['Green']
+                )
+                response = self.client.get(
+                    self.url, {'start': start, 'end': end, 'category': 'cups'}
+                )
+                units = {
+                    row['product__name']: row['units']
+                    for row in response.context['products']
+                }
+                self.assertEqual(units['Green'], 5)
+
+    def test_last_thirty_days_by_default(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['kind'], 'day')
+        self.assertEqual(len(response.context['series']), 30)
+        self.assertEqual(response.context['series'][-1]['width'], 100)
+
+    def test_category_and_export(self):
+        end = timezone.localdate()
+        params = {
+            'start': end - timedelta(days=1), 'end': end, 'category': 'tea',
+        }
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.context['totals']['gross'], Decimal('18'))
+        self.assertEqual(
+            [row['product__name'] for row in response.context['products']],
+            ['Green'],
+        )
+        response = self.client.get(self.url, {**params, 'format': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = response.content.decode().splitlines()
+        self.assertEqual(
+            lines[0], 'day,category,orders,quantity,revenue,discount,net'
+        )
+        self.assertEqual(
+            lines[1:],
+            [
+                f'{end - timedelta(days=1)},Tea,1,2,9.00,0.00,9.00',
+                f'{end},Tea,1,2,9.00,0.00,9.00',
+            ],
+        )
+
+    def test_staff_only(self):
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
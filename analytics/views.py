@@ -0,0 +1,211 @@
+import csv
+from datetime import timedelta
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import DateField, Sum
+from django.db.models.functions import Trunc
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.utils import timezone
+
+from myshop.replicas import replica_reads
+
+from .forms import DashboardForm
+from .models import (
+    DailyCategorySales,
+    DailyCouponSales,
+    DailyProductSales,
+    DailySales,
+    MonthlyCategorySales,
+    MonthlyCouponSales,
+    MonthlyProductSales,
+)
+
+# days shown when no range is chosen
+DEFAULT_DAYS = 30
+# longer ranges are shown per month instead of per day
+MAX_DAILY_PERIODS = 92
+# the rollups of products, categories and coupons read per period
+PERIOD_ROLLUPS = {
+    'day': (DailyProductSales, DailyCategorySales, DailyCouponSales),
+    'month': (MonthlyProductSales, MonthlyCategorySales, MonthlyCouponSales),
+}
+TOP_PRODUCTS = 10
+
+
+def get_sums():
+    """Return the aggregates of rollup rows, named apart from their
+    fields."""
+    return {
+        'paid_orders': Sum('orders'),
+        'units': Sum('quantity'),
+        'gross': Sum('revenue'),
+        'discounts': Sum('discount'),
+    }
+
+
+def add_net(row):
+    """Fill in the missing sums of a row with zeros and add its revenue
+    after discounts."""
+    for name in get_sums():
+        if row[name] is None:
+            row[name] = 0
+    row['net'] = row['gross'] - row['discounts']
+    return row
+
+
+def get_range(form):
+    """Get the first and last day and the category chosen in the form.
+
+    Returns:
+        tuple: The first and last day, both included, and the category or
+        None. Invalid choices fall back to the last ``DEFAULT_DAYS`` days
+        of the whole shop.
+    """
+    end = timezone.localdate()
+    start = end - timedelta(days=DEFAULT_DAYS - 1)
+    if not form.is_valid():
+        return start, end, None
+    end = form.cleaned_data['end'] or end
+    start = form.cleaned_data['start']
+    if start is None:
+        start = end - timedelta(days=DEFAULT_DAYS - 1)
+    return start, max(start, end), form.cleaned_data['category']
+
+
+def get_whole_months(start, end):
+    """Widen a range of days to the whole months it touches.
+
+    Returns:
+        tuple: The first day of the month of ``start`` and the last day of
+        the month of ``end``.
+    """
+    after = (end.replace(day=1) + timedelta(days=31)).replace(day=1)
+    return start.replace(day=1), after - timedelta(days=1)
+
+
+def export_sales(rows, kind):
+    """Write the sales per period and category as CSV.
+
+    Args:
+        rows (QuerySet): The category rollup rows to export.
+        kind (str): The period, ``'day'`` or ``'month'``.
+
+    Returns:
+        HttpResponse: The CSV file.
+    """
+    response = HttpResponse(content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=sales.csv'
+    writer = csv.writer(response)
+    writer.writerow(
+        [kind, 'category', 'orders', 'quantity', 'revenue', 'discount', 'net']
+    )
+    rows = (
+        rows.values(
+            'category__name',
+            period=Trunc('date', kind, output_field=DateField()),
+        )
+        .annotate(**get_sums())
+        .order_by('period', 'category__name')
+    )
+    for row in rows:
+        add_net(row)
+        writer.writerow([
+            row['period'].isoformat(),
+            row['category__name'],
+            row['paid_orders'],
+            row['units'],
+            f"{row['gross']:.2f}",
+            f"{row['discounts']:.2f}",
+            f"{row['net']:.2f}",
+        ])
+    return response
+
+
+@staff_member_required
+@replica_reads
+def sales_dashboard(request):
+    """
+    Show the sales of a range of days, per period, category, product and
+    coupon.
+
+    Only the rollups are read (see ``analytics/rollups.py``). Ranges
+    longer than ``MAX_DAILY_PERIODS`` days are widened to whole months and
+    shown per month, reading the monthly rollups of products, categories
+    and coupons, so the page takes about as long for a range of years as
+    for a few months. Products are listed under the category they were
+    sold in, as in the category rollups. With ``?format=csv`` the sales per
+    period and category are downloaded instead.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: Renders the dashboard, or the CSV file.
+    """
+    form = DashboardForm(request.GET)
+    start, end, category = get_range(form)
+    kind = 'day' if (end - start).days < MAX_DAILY_PERIODS else 'month'
+    if kind == 'month':
+        start, end = get_whole_months(start, end)
+    product_model, category_model, coupon_model = PERIOD_ROLLUPS[kind]
+    days = {'date__range': (start, end)}
+    category_rows = category_model.objects.filter(**days)
+    product_rows = product_model.objects.filter(**days)
+    if category:
+        category_rows = category_rows.filter(category=category)
+        product_rows = product_rows.filter(category=category)
+        rows = category_rows
+    else:
+        rows = DailySales.objects.filter(**days)
+    if request.GET.get('format') == 'csv':
+        return export_sales(category_rows, kind)
+
+    totals = add_net(rows.aggregate(**get_sums()))
+    series = [
+        add_net(row)
+        for row in rows.values(
+            period=Trunc('date', kind, output_field=DateField())
+        )
+        .annotate(**get_sums())
+        .order_by('period')
+    ]
+    highest = max((row['net'] for row in series), default=0)
+    for row in series:
+        row['width'] = row['net'] * 100 / highest if highest > 0 else 0
+    categories = [
+        add_net(row)
+        for row in category_model.objects.filter(**days)
+        .values('category_id', 'category__name')
+        .annotate(**get_sums())
+        .order_by('-gross')
+    ]
+    products = [
+        add_net(row)
+        for row in product_rows.values('product_id', 'product__name')
+        .annotate(**get_sums())
+        .order_by('-gross')[:TOP_PRODUCTS]
+    ]
+    coupons = [
+        add_net(row)
+        for row in coupon_model.objects.filter(**days)
+        .values('coupon_id', 'coupon__code')
+        .annotate(**get_sums())
+        .order_by('-gross')
+    ]
+    return render(
+        request,
+        'analytics/dashboard.html',
+        {
+            'form': form,
+            'start': start,
+            'end': end,
+            'category': category,
+            'kind': kind,
+            'totals': totals,
+            'series': series,
+            'categories': categories,
+            'products': products,
+            'coupons': coupons,
+        },
+    )
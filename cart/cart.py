@@ -1,9 +1,13 @@
 from decimal import Decimal
 
-from coupons.models import Coupon
+from coupons.cache import get_coupon
 from django.conf import settings
+from shop.catalog import get_catalog_version
 from shop.models import Product
 
+# session key of the catalog version the cart prices were read at
+CART_VERSION_SESSION_ID = 'cart_catalog_version'
+
 
 class Cart:
     def __init__(self, request):
@@ -21,24 +25,91 @@ class Cart:
         self.cart = cart
         # store current applied coupon
         self.coupon_id = self.session.get('coupon_id')
+        self._items = None
+        self._catalog_version = None
+
+    @property
+    def catalog_version(self):
+        """
+        Get the current catalog version, read once per cart.
+
+        Returns:
+            int: The catalog version.
+        """
+        if self._catalog_version is None:
+            self._catalog_version = get_catalog_version()
+        return self._catalog_version
+
+    def is_priced(self):
+        """
+        Check whether the prices in the session are still current.
+
+        Returns:
+            bool: True if the catalog has not changed since the prices were
+            read.
+        """
+        return (
+            self.session.get(CART_VERSION_SESSION_ID) == self.catalog_version
+        )
+
+    def reprice(self, products):
+        """
+        Update the prices in the session to the current product prices.
+
+        Items are always charged at the current price of their product. The
+        old price of a changed item is kept as ``previous_price`` on the
+        items of this cart, so the page showing them can tell the customer.
+
+        Args:
+            products (iterable): The products in the cart.
+
+        Returns:
+            dict: The previous prices of the changed items, keyed by product ID.
+        """
+        changed = {}
+        for product in products:
+            item = self.cart[str(product.id)]
+            if Decimal(item['price']) != product.price:
+                changed[str(product.id)] = Decimal(item['price'])
+                item['price'] = str(product.price)
+        self.session[CART_VERSION_SESSION_ID] = self.catalog_version
+        self.session.modified = True
+        return changed
 
     def __iter__(self):
         """
         Iterate over the items in the cart and get the products from the database.
 
+        The items are built once per cart from copies of the session data, so
+        iterating again does not query the products again and the session
+        never holds product objects or decimals. If the catalog changed since
+        the cart was last priced, the items are repriced to the current
+        product prices first (see :meth:`reprice`).
+
         Yields:
             dict: A dictionary containing product details, price, quantity, and total price.
         """
-        product_ids = self.cart.keys()
-        # get the product objects and add them to the cart
-        products = Product.objects.filter(id__in=product_ids)
-        cart = self.cart.copy()
-        for product in products:
-            cart[str(product.id)]['product'] = product
-        for item in cart.values():
-            item['price'] = Decimal(item['price'])
-            item['total_price'] = item['price'] * item['quantity']
-            yield item
+        if self._items is None:
+            product_ids = self.cart.keys()
+            # read the version before the prices, so prices changed in
+            # between are picked up on the next iteration
+            priced = self.is_priced()
+            # get the product objects and add them to the cart
+            products = list(Product.objects.filter(id__in=product_ids))
+            changed = {} if priced else self.reprice(products)
+            cart = {
+                product_id: item.copy()
+                for product_id, item in self.cart.items()
+            }
+            for product in products:
+                cart[str(product.id)]['product'] = product
+            for product_id, price in changed.items():
+                cart[product_id]['previous_price'] = price
+            for item in cart.values():
+                item['price'] = Decimal(item['price'])
+                item['total_price'] = item['price'] * item['quantity']
+            self._items = list(cart.values())
+        yield from self._items
 
     def __len__(self):
         """
@@ -75,6 +146,7 @@ class Cart:
         Mark the session as "modified" to ensure it is saved.
         """
         self.session.modified = True
+        self._items = None
 
     def remove(self, product):
         """
@@ -99,9 +171,14 @@ class Cart:
         """
         Calculate the total price of all items in the cart.
 
+        The cart is repriced first if the catalog has changed, so the total
+        always matches the prices shown for the items.
+
         Returns:
             Decimal: The total price of the cart.
         """
+        if self.cart and not self.is_priced():
+            list(self)
         return sum(
             Decimal(item['price']) * item['quantity']
             for item in self.cart.values()
@@ -112,15 +189,17 @@ class Cart:
         """
         Get the currently applied coupon.
 
+        The coupon is read from the coupon cache once per cart, and only
+        returned while it is active and within its validity window.
+
         Returns:
             Coupon or None: The applied coupon object, or None if no coupon is applied.
         """
-        if self.coupon_id:
-            try:
-                return Coupon.objects.get(id=self.coupon_id)
-            except Coupon.DoesNotExist:
-                pass
-        return None
+        if not hasattr(self, '_coupon'):
+            self._coupon = (
+                get_coupon(self.coupon_id) if self.coupon_id else None
+            )
+        return self._coupon
 
     def get_discount(self):
         """
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
@@ -12,10 +13,20 @@ Routes:
     - '' (cart_detail): View the details of the current cart.
     - 'add/<int:product_id>/' (cart_add): Add a product to the cart by product ID.
     - 'remove/<int:product_id>/' (cart_remove): Remove a product from the cart by product ID.
+
+With `ASYNC_VIEWS` enabled the async version of `cart_detail` is used.
 """
 
 urlpatterns = [
-    path('', views.cart_detail, name='cart_detail'),
+    path(
+        '',
+        (
+            views.cart_detail_async
+            if settings.ASYNC_VIEWS
+            else views.cart_detail
+        ),
+        name='cart_detail',
+    ),
     path('add/<int:product_id>/', views.cart_add, name='cart_add'),
     path('remove/<int:product_id>/', views.cart_remove, name='cart_remove'),
 ]
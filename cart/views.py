@@ -1,3 +1,4 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.http import require_POST
 
@@ -58,6 +59,26 @@ def cart_remove(request, product_id):
     return redirect('cart:cart_detail')
 
 
+def get_cart_with_forms(request):
+    """
+    Load the cart and attach a quantity update form to each item.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        tuple: The cart and the list of products it contains.
+    """
+    cart = Cart(request)
+    cart_products = []
+    for item in cart:
+        item['update_quantity_form'] = CartAddProductForm(
+            initial={'quantity': item['quantity'], 'override': True}
+        )
+        cart_products.append(item['product'])
+    return cart, cart_products
+
+
 def cart_detail(request):
     """
     Display the details of the cart.
@@ -72,15 +93,10 @@ def cart_detail(request):
         HttpResponse: Renders the cart detail page with the cart contents, coupon form, 
                       and recommended products.
     """
-    cart = Cart(request)
-    for item in cart:
-        item['update_quantity_form'] = CartAddProductForm(
-            initial={'quantity': item['quantity'], 'override': True}
-        )
+    cart, cart_products = get_cart_with_forms(request)
     coupon_apply_form = CouponApplyForm()
 
     r = Recommender()
-    cart_products = [item['product'] for item in cart]
     if cart_products:
         recommended_products = r.suggest_products_for(
             cart_products, max_results=4
@@ -97,3 +113,40 @@ def cart_detail(request):
             'recommended_products': recommended_products,
         },
     )
+
+
+async def cart_detail_async(request):
+    """
+    Display the details of the cart (async version).
+
+    Same as :func:`cart_detail`, but recommendations are fetched with the
+    asyncio Redis client, so the wait on Redis does not hold a worker
+    thread when the shop is served over ASGI.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: Renders the cart detail page.
+    """
+    # the cart lives in the session, which is only accessible synchronously
+    cart, cart_products = await sync_to_async(get_cart_with_forms)(request)
+    coupon_apply_form = CouponApplyForm()
+
+    r = Recommender()
+    if cart_products:
+        recommended_products = await r.asuggest_products_for(
+            cart_products, max_results=4
+        )
+    else:
+        recommended_products = []
+
+    return await sync_to_async(render)(
+        request,
+        'cart/detail.html',
+        {
+            'cart': cart,
+            'coupon_apply_form': coupon_apply_form,
+            'recommended_products': recommended_products,
+        },
+    )
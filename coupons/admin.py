@@ -1,5 +1,50 @@
 from django.contrib import admin
+from django.shortcuts import render
+
+from .forms import CouponGenerateForm
 from .models import Coupon
+from .tasks import generate_campaign_coupons
+
+
+def generate_codes(modeladmin, request, queryset):
+    """Generate single-use coupons modelled on the selected coupons.
+
+    Shows a form asking for the number of codes, then launches a
+    background task per selected coupon that creates the codes in batches.
+
+    Args:
+        modeladmin (ModelAdmin): The model admin class.
+        request (HttpRequest): The HTTP request object.
+        queryset (QuerySet): The selected coupons, used as templates.
+
+    Returns:
+        HttpResponse: The form, or None to go back to the coupon list.
+    """
+    if 'apply' in request.POST:
+        form = CouponGenerateForm(request.POST)
+        if form.is_valid():
+            for coupon in queryset:
+                generate_campaign_coupons.delay(
+                    coupon.id,
+                    form.cleaned_data['count'],
+                    prefix=form.cleaned_data['prefix'],
+                    length=form.cleaned_data['length'],
+                )
+            modeladmin.message_user(
+                request,
+                f"Generating {form.cleaned_data['count']} codes for each of "
+                f'{len(queryset)} coupons in the background.',
+            )
+            return None
+    else:
+        form = CouponGenerateForm()
+    return render(
+        request,
+        'admin/coupons/coupon/generate_codes.html',
+        {'form': form, 'coupons': queryset},
+    )
+
+generate_codes.short_description = 'Generate single-use codes'
 
 
 @admin.register(Coupon)
@@ -17,11 +62,14 @@ class CouponAdmin(admin.ModelAdmin):
         'valid_to',
         'discount',
         'active',
+        'max_redemptions',
+        'max_redemptions_per_customer',
     ]
     """
     list_display: Specifies the fields to display on the Coupon list view in 
     the admin interface. The fields shown are the coupon code, validity range, 
-    discount percentage, and whether the coupon is currently active.
+    discount percentage, whether the coupon is currently active and its
+    redemption caps.
     """
 
     list_filter = ['active', 'valid_from', 'valid_to']
@@ -36,3 +84,9 @@ class CouponAdmin(admin.ModelAdmin):
     search_fields: Enables a search box in the Coupon list view, allowing admins 
     to search for coupons by their 'code' field.
     """
+
+    actions = [generate_codes]
+    """
+    actions: Lets admins generate single-use codes modelled on the selected
+    coupons.
+    """
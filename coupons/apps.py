@@ -11,4 +11,9 @@ class CouponsConfig(AppConfig):
     """
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'coupons'
-   
\ No newline at end of file
+
+    def ready(self):
+        """
+        Connect the signal handlers that keep the coupon cache up to date.
+        """
+        from . import signals  # noqa: F401
@@ -0,0 +1,172 @@
+"""
+Bloom filter of coupon codes.
+
+Checkout validates coupon codes against this filter before looking at the
+cache or the database. A code that is not in the filter cannot be a
+coupon, so guessed or mistyped codes are rejected without touching the
+``Coupon`` table. A code in the filter is still looked up, since the
+filter has a small rate of false positives (``COUPON_BLOOM_ERROR_RATE``).
+
+The filter is a bitmap stored in Redis and shared by all processes. Codes
+are added as coupons are saved or generated. Bits are never cleared, so
+adding codes concurrently is safe and a rebuild never loses a code. The
+filter is only consulted once it has been fully built with the
+``rebuild_coupon_filter`` command. Until then, and whenever Redis cannot
+be reached, every code is looked up as before.
+"""
+import hashlib
+import logging
+import math
+
+import redis
+from django.conf import settings
+from myshop.metrics import RedisConnection
+
+logger = logging.getLogger(__name__)
+
+# Connect to Redis
+r = redis.Redis(
+    connection_pool=redis.ConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        connection_class=RedisConnection,
+    )
+)
+
+
+class BloomFilter:
+    """A Bloom filter stored as a Redis bitmap.
+
+    Args:
+        key (str): The prefix of the Redis keys of the filter.
+        capacity (int): The number of items the filter is sized for.
+        error_rate (float): The false positive rate at full capacity.
+    """
+
+    def __init__(self, key, capacity, error_rate):
+        # standard sizing: m = -n ln(p) / ln(2)^2, k = m / n ln(2)
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        # a change of size gets a new bitmap, built from scratch
+        self.key = f'{key}:{self.size}:{self.hashes}'
+        self.ready_key = f'{self.key}:ready'
+
+    def get_positions(self, item):
+        """Return the bits set for an item.
+
+        Uses double hashing over one 128-bit BLAKE2 digest.
+
+        Args:
+            item (str): The item.
+
+        Returns:
+            list: The bit offsets.
+        """
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + n * h2) % self.size for n in range(self.hashes)]
+
+    def add(self, items, chunk_size=10000):
+        """Add items to the filter.
+
+        Args:
+            items (iterable): The items to add.
+            chunk_size (int): Items sent to Redis per round trip.
+
+        Returns:
+            int: The number of items added.
+        """
+        added = 0
+        pipe = r.pipeline(transaction=False)
+        for item in items:
+            for position in self.get_positions(item):
+                pipe.setbit(self.key, position, 1)
+            added += 1
+            if added % chunk_size == 0:
+                pipe.execute()
+        pipe.execute()
+        return added
+
+    def might_contain(self, item):
+        """Check if an item may have been added to the filter.
+
+        Args:
+            item (str): The item.
+
+        Returns:
+            bool: False if the item was never added, True if it may have
+            been, or None if the filter has not been built yet.
+        """
+        pipe = r.pipeline(transaction=False)
+        pipe.exists(self.ready_key)
+        for position in self.get_positions(item):
+            pipe.getbit(self.key, position)
+        ready, *bits = pipe.execute()
+        if not ready:
+            return None
+        return all(bits)
+
+    def mark_ready(self):
+        """Start using the filter for lookups."""
+        r.set(self.ready_key, 1)
+
+    def reset(self):
+        """Clear the filter. Lookups ignore it until it is built again."""
+        r.delete(self.ready_key, self.key)
+
+
+def get_filter():
+    """Return the coupon code filter configured in the settings.
+
+    Returns:
+        BloomFilter: The filter.
+    """
+    return BloomFilter(
+        settings.COUPON_BLOOM_KEY,
+        settings.COUPON_BLOOM_CAPACITY,
+        settings.COUPON_BLOOM_ERROR_RATE,
+    )
+
+
+def might_be_coupon(code):
+    """Check if a normalized code may belong to a coupon.
+
+    Args:
+        code (str): The normalized coupon code.
+
+    Returns:
+        bool: False only if the code is certainly not a coupon.
+    """
+    if not settings.COUPON_BLOOM_FILTER:
+        return True
+    try:
+        return get_filter().might_contain(code) is not False
+    except redis.RedisError:
+        # without the filter every code is looked up
+        return True
+
+
+def add_codes(codes):
+    """Add normalized coupon codes to the filter.
+
+    If Redis fails, the filter is disabled so it cannot reject the codes
+    that were not added. Run ``rebuild_coupon_filter`` to enable it again.
+
+    Args:
+        codes (iterable): The normalized codes.
+    """
+    if not settings.COUPON_BLOOM_FILTER:
+        return
+    bloom = get_filter()
+    try:
+        bloom.add(codes)
+    except redis.RedisError as e:
+        logger.warning('Could not add coupon codes to the filter: %s', e)
+        try:
+            r.delete(bloom.ready_key)
+        except redis.RedisError:
+            logger.error('Could not disable the coupon code filter')
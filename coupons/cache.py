@@ -0,0 +1,155 @@
+"""
+Cache of coupon lookups.
+
+Coupons are looked up by code when a customer applies one and by ID every
+time a cart is rendered. Both lookups go through the two-tier cache (see
+``myshop/cache.py``), so they do not hit the database. Codes missing from
+its in-process tier are checked against the coupon code filter (see
+``coupons/bloom.py``) before Redis.
+
+Entries for a coupon that can be used now expire at its ``valid_to``, and
+the validity window is checked again on every read, so an expired coupon
+is never returned from the cache. Saving or deleting a coupon clears its
+entries (see ``coupons/signals.py``), in every process.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .bloom import might_be_coupon
+from .models import Coupon, normalize_code
+
+
+def get_code_key(code):
+    """Get the cache key mapping a normalized code to a coupon ID.
+
+    Args:
+        code (str): The normalized coupon code.
+
+    Returns:
+        str: The cache key.
+    """
+    return f'coupons:code:{code}'
+
+
+def get_id_key(coupon_id):
+    """Get the cache key of a coupon.
+
+    Args:
+        coupon_id (int): The ID of the coupon.
+
+    Returns:
+        str: The cache key.
+    """
+    return f'coupons:id:{coupon_id}'
+
+
+def is_valid(coupon, now=None):
+    """Check if a coupon can be used at the given time.
+
+    Args:
+        coupon (Coupon): The coupon.
+        now (datetime, optional): The time to check. Defaults to now.
+
+    Returns:
+        bool: True if the coupon is active and within its validity window.
+    """
+    now = now or timezone.now()
+    return coupon.active and coupon.valid_from <= now <= coupon.valid_to
+
+
+def get_timeout(coupon, now=None):
+    """Return how long a lookup result can be cached, in seconds.
+
+    Args:
+        coupon (Coupon): The coupon found, or None if there is none.
+        now (datetime, optional): The current time. Defaults to now.
+
+    Returns:
+        int: The cache timeout.
+    """
+    now = now or timezone.now()
+    if coupon is None:
+        return settings.COUPON_NEGATIVE_CACHE_TIMEOUT
+    if coupon.active and now < coupon.valid_from:
+        # cache until the coupon becomes valid
+        until = coupon.valid_from
+    elif is_valid(coupon, now):
+        # cache until the coupon expires
+        until = coupon.valid_to
+    else:
+        return settings.COUPON_CACHE_TIMEOUT
+    seconds = int((until - now).total_seconds())
+    return max(1, min(seconds, settings.COUPON_CACHE_TIMEOUT))
+
+
+def get_coupon(coupon_id):
+    """Return a coupon by ID if it can be used now.
+
+    Args:
+        coupon_id (int): The ID of the coupon.
+
+    Returns:
+        Coupon or None: The coupon, or None if it does not exist or is not
+        active or not within its validity window.
+    """
+    key = get_id_key(coupon_id)
+    coupon = cache.get(key)
+    if coupon is None:
+        coupon = Coupon.objects.filter(id=coupon_id).first()
+        # False marks a coupon known not to exist
+        cache.set(key, coupon or False, get_timeout(coupon))
+    if coupon and is_valid(coupon):
+        return coupon
+    return None
+
+
+def get_active_coupon(code):
+    """Return the coupon with the given code if it can be used now.
+
+    Args:
+        code (str): The code entered by the customer, in any case.
+
+    Returns:
+        Coupon or None: The coupon, or None if there is no usable coupon with
+        this code.
+    """
+    code = normalize_code(code)
+    key = get_code_key(code)
+    coupon_id = cache.get_local(key)
+    if coupon_id is None:
+        if not might_be_coupon(code):
+            return None
+        coupon_id = cache.get(key)
+    if coupon_id is None:
+        coupon = Coupon.objects.filter(normalized_code=code).first()
+        if coupon is None:
+            # 0 marks a code known not to exist
+            cache.set(key, 0, get_timeout(None))
+            return None
+        cache.set(key, coupon.id, settings.COUPON_CACHE_TIMEOUT)
+        cache.set(get_id_key(coupon.id), coupon, get_timeout(coupon))
+        coupon_id = coupon.id
+    if not coupon_id:
+        return None
+    coupon = get_coupon(coupon_id)
+    if coupon is None or coupon.normalized_code != code:
+        # the coupon's code was changed after the mapping was cached
+        return None
+    return coupon
+
+
+def invalidate(coupon):
+    """Remove the cached lookups of a coupon.
+
+    Args:
+        coupon (Coupon): The coupon that was saved or deleted.
+    """
+    cache.delete_many(
+        [get_id_key(coupon.id), get_code_key(coupon.normalized_code)]
+    )
+
+
+def clear_local():
+    """Drop the in-process entries. Redis is left untouched."""
+    cache.clear_local()
@@ -9,4 +9,20 @@ class CouponApplyForm(forms.Form):
     to apply a discount during the purchase process.
     """
     code = forms.CharField()
-    
\ No newline at end of file
+
+
+class CouponGenerateForm(forms.Form):
+    """
+    Form for generating single-use coupons from the admin.
+
+    The generated coupons copy the discount and validity window of the
+    coupons selected in the admin.
+    """
+    count = forms.IntegerField(min_value=1, max_value=1000000)
+    prefix = forms.CharField(max_length=20, required=False)
+    length = forms.IntegerField(
+        min_value=6,
+        max_value=30,
+        initial=10,
+        help_text='Number of random characters per code',
+    )
@@ -0,0 +1,115 @@
+"""
+Bulk generation of coupon codes for campaigns.
+
+Codes are generated in batches. Each batch is checked against the
+existing codes with one query and inserted with ``bulk_create``, together
+with the redemption counters of the new coupons. The new codes are then
+added to the coupon code filter (see ``coupons/bloom.py``).
+"""
+import secrets
+
+from django.db import IntegrityError, transaction
+
+from .bloom import add_codes
+from .models import Coupon, CouponRedemptionShard, normalize_code
+from .redemptions import build_shards
+
+# uppercase letters and digits, without the easily confused 0, O, 1 and I
+ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+
+
+def random_code(prefix='', length=10):
+    """Return a random coupon code.
+
+    Args:
+        prefix (str): Text put in front of the random part.
+        length (int): The number of random characters.
+
+    Returns:
+        str: The code.
+    """
+    return prefix + ''.join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+def generate_coupons(
+    count,
+    discount,
+    valid_from,
+    valid_to,
+    prefix='',
+    length=10,
+    max_redemptions=1,
+    max_redemptions_per_customer=None,
+    batch_size=1000,
+    progress=None,
+):
+    """Create coupons with unique random codes.
+
+    Args:
+        count (int): The number of coupons to create.
+        discount (int): The discount percentage of the coupons.
+        valid_from (datetime): When the coupons become valid.
+        valid_to (datetime): When the coupons expire.
+        prefix (str): Text put in front of every code.
+        length (int): The number of random characters of every code.
+        max_redemptions (int, optional): The redemption cap of each coupon.
+            Defaults to 1 (single-use codes).
+        max_redemptions_per_customer (int, optional): The cap per customer.
+        batch_size (int): Coupons created per query.
+        progress (callable, optional): Called with the number of coupons
+            created so far after each batch.
+
+    Returns:
+        tuple: The number of coupons created and the number of generated
+        codes that collided with existing ones and were replaced.
+    """
+    if len(prefix) + length > Coupon._meta.get_field('code').max_length:
+        raise ValueError('The codes would be longer than the code field.')
+    created = 0
+    collisions = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        codes = {}
+        while len(codes) < size:
+            code = random_code(prefix, length)
+            codes[normalize_code(code)] = code
+        existing = set(
+            Coupon.objects.filter(normalized_code__in=codes).values_list(
+                'normalized_code', flat=True
+            )
+        )
+        collisions += len(existing)
+        coupons = [
+            Coupon(
+                code=code,
+                normalized_code=normalized,
+                valid_from=valid_from,
+                valid_to=valid_to,
+                discount=discount,
+                active=True,
+                max_redemptions=max_redemptions,
+                max_redemptions_per_customer=max_redemptions_per_customer,
+            )
+            for normalized, code in codes.items()
+            if normalized not in existing
+        ]
+        try:
+            with transaction.atomic():
+                coupons = Coupon.objects.bulk_create(coupons)
+                if max_redemptions is not None:
+                    CouponRedemptionShard.objects.bulk_create(
+                        [
+                            shard
+                            for coupon in coupons
+                            for shard in build_shards(coupon)
+                        ]
+                    )
+        except IntegrityError:
+            # a concurrent run took one of the codes, generate a new batch
+            collisions += 1
+            continue
+        add_codes(coupon.normalized_code for coupon in coupons)
+        created += len(coupons)
+        if progress:
+            progress(created)
+    return created, collisions
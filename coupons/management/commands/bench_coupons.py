@@ -0,0 +1,105 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+import redis
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from coupons import cache as coupon_cache
+from coupons.bloom import get_filter
+from coupons.generation import generate_coupons, random_code
+from coupons.models import Coupon, normalize_code
+
+
+class Command(BaseCommand):
+    """
+    Benchmark bulk coupon generation and coupon code validation.
+
+    Generates a batch of throwaway coupons and reports the generation
+    throughput. It then validates valid and unknown codes with cold caches,
+    with and without the coupon code filter, and reports the latency and
+    the database queries per lookup. The coupons are deleted at the end
+    unless ``--keep`` is given.
+    """
+    help = 'Benchmark coupon generation throughput and validation latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000)
+        parser.add_argument('--lookups', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the generated coupons.',
+        )
+
+    def validate(self, label, codes):
+        keys = [coupon_cache.get_code_key(code) for code in codes]
+        cache.delete_many(keys)
+        coupon_cache.clear_local()
+        latencies = []
+        with CaptureQueriesContext(connection) as queries:
+            for code in codes:
+                start = time.perf_counter()
+                coupon_cache.get_active_coupon(code)
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+        self.stdout.write(
+            f'{label:<18} p50 {statistics.median(latencies) * 1e6:8.0f} us   '
+            f'p95 {p95 * 1e6:8.0f} us   '
+            f'{len(queries) / len(codes):.2f} queries/lookup'
+        )
+
+    def handle(self, *args, **options):
+        prefix = f'BENCH{random_code(length=4)}-'
+        now = timezone.now()
+        start = time.monotonic()
+        created, collisions = generate_coupons(
+            options['count'],
+            discount=10,
+            valid_from=now - timedelta(minutes=1),
+            valid_to=now + timedelta(days=1),
+            prefix=prefix,
+            batch_size=options['batch_size'],
+        )
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f'generation: {created} coupons in {elapsed:.2f}s '
+            f'({created / elapsed if elapsed else 0:.0f} coupons/s, '
+            f'{collisions} collisions)'
+        )
+        try:
+            codes = list(
+                Coupon.objects.filter(code__startswith=prefix).values_list(
+                    'normalized_code', flat=True
+                )
+            )
+            lookups = min(options['lookups'], len(codes))
+            valid = random.sample(codes, lookups)
+            unknown = [
+                normalize_code(random_code(prefix)) for _ in range(lookups)
+            ]
+            try:
+                bloom_ready = get_filter().might_contain(valid[0]) is not None
+            except redis.RedisError:
+                bloom_ready = False
+            modes = [('database', False)]
+            if bloom_ready:
+                modes.append(('filter', True))
+            else:
+                self.stdout.write(
+                    'The coupon code filter is not built, run '
+                    'rebuild_coupon_filter to benchmark it.'
+                )
+            for mode, enabled in modes:
+                with override_settings(COUPON_BLOOM_FILTER=enabled):
+                    self.validate(f'{mode} valid', valid)
+                    self.validate(f'{mode} unknown', unknown)
+        finally:
+            if not options['keep']:
+                Coupon.objects.filter(code__startswith=prefix).delete()
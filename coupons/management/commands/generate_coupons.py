@@ -0,0 +1,74 @@
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from coupons.generation import generate_coupons
+
+
+class Command(BaseCommand):
+    """
+    Generate coupons with unique random codes for a campaign.
+
+    Codes are created in batches with ``bulk_create``, after checking each
+    batch for collisions with existing codes.
+    """
+    help = 'Generate coupons with unique random codes in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int)
+        parser.add_argument(
+            '--discount', type=int, required=True,
+            help='Discount percentage (0 to 100).',
+        )
+        parser.add_argument(
+            '--valid-from', type=datetime.fromisoformat,
+            help='Start of the validity window (ISO 8601). Defaults to now.',
+        )
+        parser.add_argument(
+            '--valid-days', type=int, default=30,
+            help='Length of the validity window in days.',
+        )
+        parser.add_argument('--prefix', default='')
+        parser.add_argument(
+            '--length', type=int, default=10,
+            help='Number of random characters per code.',
+        )
+        parser.add_argument(
+            '--max-redemptions', type=int, default=1,
+            help='Redemptions allowed per code.',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not 0 <= options['discount'] <= 100:
+            raise CommandError('The discount must be between 0 and 100.')
+        valid_from = options['valid_from'] or timezone.now()
+        if timezone.is_naive(valid_from):
+            valid_from = timezone.make_aware(valid_from)
+        start = time.monotonic()
+
+        def progress(created):
+            self.stdout.write(f'{created}/{options["count"]} coupons created')
+
+        try:
+            created, collisions = generate_coupons(
+                options['count'],
+                discount=options['discount'],
+                valid_from=valid_from,
+                valid_to=valid_from + timedelta(days=options['valid_days']),
+                prefix=options['prefix'],
+                length=options['length'],
+                max_redemptions=options['max_redemptions'],
+                batch_size=options['batch_size'],
+                progress=progress if options['verbosity'] > 1 else None,
+            )
+        except ValueError as e:
+            raise CommandError(e)
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f'Created {created} coupons in {elapsed:.2f}s '
+            f'({created / elapsed if elapsed else 0:.0f} coupons/s, '
+            f'{collisions} collisions)'
+        )
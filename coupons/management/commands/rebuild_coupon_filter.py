@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from coupons.bloom import get_filter
+from coupons.models import Coupon
+
+
+class Command(BaseCommand):
+    """
+    Build the coupon code filter from the codes in the database.
+
+    Checkout only starts using the filter once it has been built. Without
+    ``--reset`` the codes are added to the current filter, which is safe
+    while the shop is running. ``--reset`` starts from an empty filter,
+    dropping the codes of deleted coupons. Lookups ignore the filter until
+    the rebuild is done.
+    """
+    help = 'Build the Bloom filter of coupon codes used at checkout.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Clear the filter before adding the codes.',
+        )
+
+    def handle(self, *args, **options):
+        bloom = get_filter()
+        if options['reset']:
+            bloom.reset()
+        start = time.monotonic()
+        codes = Coupon.objects.values_list(
+            'normalized_code', flat=True
+        ).iterator(chunk_size=10000)
+        added = bloom.add(codes)
+        bloom.mark_ready()
+        self.stdout.write(
+            f'Added {added} codes to a filter of {bloom.size} bits '
+            f'with {bloom.hashes} hashes in '
+            f'{time.monotonic() - start:.2f}s'
+        )
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.9 on 2026-10-19 10:12
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def set_normalized_code(apps, schema_editor):
+    # same normalization as coupons.models.normalize_code
+    Coupon = apps.get_model('coupons', 'Coupon')
+    coupons = list(Coupon.objects.only('id', 'code'))
+    for coupon in coupons:
+        coupon.normalized_code = coupon.code.strip().lower()
+    Coupon.objects.bulk_update(coupons, ['normalized_code'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coupons', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='coupon',
+            name='discount',
+            field=models.IntegerField(help_text='Percentage value (0 to 100)', validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='normalized_code',
+            field=models.CharField(editable=False, max_length=50, null=True),
+        ),
+        migrations.RunPython(set_normalized_code, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='normalized_code',
+            field=models.CharField(editable=False, max_length=50, unique=True),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.0.9 on 2026-10-19 09:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coupons', '0002_coupon_normalized_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='max_redemptions',
+            field=models.PositiveIntegerField(blank=True, help_text='Leave empty for unlimited redemptions', null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_redemptions_per_customer',
+            field=models.PositiveIntegerField(blank=True, help_text='Leave empty for unlimited redemptions per customer', null=True),
+        ),
+        migrations.CreateModel(
+            name='CouponCustomerRedemptions',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer', models.CharField(max_length=254)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='customer_redemptions', to='coupons.coupon')),
+            ],
+            options={
+                'verbose_name_plural': 'coupon customer redemptions',
+            },
+        ),
+        migrations.CreateModel(
+            name='CouponRedemptionShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('limit', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemption_shards', to='coupons.coupon')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='couponcustomerredemptions',
+            constraint=models.UniqueConstraint(fields=('coupon', 'customer'), name='unique_coupon_customer_redemptions'),
+        ),
+        migrations.AddConstraint(
+            model_name='couponredemptionshard',
+            constraint=models.UniqueConstraint(fields=('coupon', 'shard'), name='unique_coupon_redemption_shard'),
+        ),
+    ]
@@ -1,20 +1,43 @@
+from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 
 
+def normalize_code(code):
+    """
+    Normalize a coupon code for case-insensitive lookups.
+
+    Args:
+        code (str): The coupon code as typed by an admin or a customer.
+
+    Returns:
+        str: The code without surrounding spaces, in lowercase.
+    """
+    return code.strip().lower()
+
+
 class Coupon(models.Model):
     """
     Represents a discount coupon that can be applied to a purchase.
 
     Attributes:
         code (str): The unique code for the coupon.
+        normalized_code (str): The code as returned by ``normalize_code``,
+            indexed so codes can be looked up regardless of case.
         valid_from (datetime): The date and time when the coupon becomes valid.
         valid_to (datetime): The date and time when the coupon expires.
         discount (int): The discount percentage applied by the coupon (0-100).
         active (bool): Indicates whether the coupon is currently active.
+        max_redemptions (int): How many orders can use the coupon in total,
+            or None for no limit.
+        max_redemptions_per_customer (int): How many orders each customer
+            can place with the coupon, or None for no limit.
     """
 
     code = models.CharField(max_length=50, unique=True)
+    normalized_code = models.CharField(
+        max_length=50, unique=True, editable=False
+    )
     valid_from = models.DateTimeField()
     valid_to = models.DateTimeField()
     discount = models.IntegerField(
@@ -22,8 +45,43 @@ class Coupon(models.Model):
         help_text='Percentage value (0 to 100)',
     )
     active = models.BooleanField()
-   
-   
+    max_redemptions = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='Leave empty for unlimited redemptions',
+    )
+    max_redemptions_per_customer = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='Leave empty for unlimited redemptions per customer',
+    )
+
+    def clean(self):
+        """
+        Reject codes that only differ in case from an existing coupon.
+
+        Raises:
+            ValidationError: If another coupon has the same normalized code.
+        """
+        super().clean()
+        if self.code and (
+            Coupon.objects.exclude(pk=self.pk)
+            .filter(normalized_code=normalize_code(self.code))
+            .exists()
+        ):
+            raise ValidationError(
+                {'code': 'A coupon with this code already exists.'}
+            )
+
+    def save(self, *args, **kwargs):
+        """
+        Save the coupon, keeping ``normalized_code`` in sync with ``code``.
+        """
+        self.normalized_code = normalize_code(self.code)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'code' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'normalized_code'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         """
@@ -33,3 +91,68 @@ class Coupon(models.Model):
             str: The coupon code.
         """
         return self.code
+
+
+class CouponRedemptionShard(models.Model):
+    """
+    One slice of the redemption counter of a limited coupon.
+
+    The ``max_redemptions`` of a coupon is split across several shards, each
+    with its own counter and limit. A redemption increments one shard with a
+    conditional ``UPDATE``, so concurrent checkouts lock different rows
+    instead of queuing on a single counter, and the limits of the shards
+    add up to the cap of the coupon so it can never be exceeded.
+
+    Attributes:
+        coupon (Coupon): The coupon the shard belongs to.
+        shard (int): The number of the shard.
+        count (int): Redemptions counted by this shard.
+        limit (int): Redemptions this shard may count.
+    """
+    coupon = models.ForeignKey(
+        Coupon, related_name='redemption_shards', on_delete=models.CASCADE
+    )
+    shard = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+    limit = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['coupon', 'shard'],
+                name='unique_coupon_redemption_shard',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.coupon} #{self.shard} ({self.count}/{self.limit})'
+
+
+class CouponCustomerRedemptions(models.Model):
+    """
+    Number of redemptions of a coupon by one customer.
+
+    Customers are identified by the e-mail address of their orders.
+
+    Attributes:
+        coupon (Coupon): The coupon redeemed.
+        customer (str): The normalized e-mail address of the customer.
+        count (int): How many orders of the customer used the coupon.
+    """
+    coupon = models.ForeignKey(
+        Coupon, related_name='customer_redemptions', on_delete=models.CASCADE
+    )
+    customer = models.CharField(max_length=254)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'coupon customer redemptions'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['coupon', 'customer'],
+                name='unique_coupon_customer_redemptions',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.coupon} by {self.customer} ({self.count})'
@@ -0,0 +1,231 @@
+"""
+Redemption limits of coupons.
+
+The total cap of a coupon (``max_redemptions``) is enforced with sharded
+counters: the cap is split across up to ``COUPON_REDEMPTION_SHARDS`` rows
+of :class:`CouponRedemptionShard` and each redemption increments one of them
+with a conditional ``UPDATE ... WHERE count < limit``. Concurrent checkouts
+start at a random shard, so they rarely wait on the same row, and because
+the shard limits add up to the cap it can never be overshot.
+
+The cap per customer is enforced the same way, with one counter row per
+coupon and customer.
+
+:func:`redeem` must run in the transaction that creates the order, so a
+failed checkout does not consume a redemption. When the stock of an unpaid
+order is released, because its payment was canceled or its reservation
+expired, :func:`give_back` returns its redemption (see
+``shop/inventory.py``), so abandoned checkouts do not use up the caps.
+"""
+import random
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Subquery, Sum
+
+from .models import CouponCustomerRedemptions, CouponRedemptionShard
+
+
+class RedemptionLimitReached(Exception):
+    """Raised when a coupon cannot be redeemed any more."""
+
+
+def split_limit(total, shards):
+    """Split a number of redemptions as evenly as possible across shards.
+
+    Args:
+        total (int): The number of redemptions to split.
+        shards (int): The number of shards.
+
+    Returns:
+        list: The share of each shard.
+    """
+    share, extra = divmod(total, shards)
+    return [share + (1 if n < extra else 0) for n in range(shards)]
+
+
+def get_shard_count(coupon):
+    """Return how many counter shards a limited coupon uses.
+
+    There is no point in more shards than redemptions, so single-use
+    coupons get a single counter row.
+
+    Args:
+        coupon (Coupon): The coupon, with ``max_redemptions`` set.
+
+    Returns:
+        int: The number of shards.
+    """
+    shards = min(settings.COUPON_REDEMPTION_SHARDS, coupon.max_redemptions)
+    return max(shards, 1)
+
+
+def build_shards(coupon):
+    """Build the counter shards of a new limited coupon without saving them.
+
+    Used to create the shards of many coupons at once with ``bulk_create``.
+
+    Args:
+        coupon (Coupon): A saved coupon, with ``max_redemptions`` set.
+
+    Returns:
+        list: Unsaved ``CouponRedemptionShard`` instances.
+    """
+    shares = split_limit(coupon.max_redemptions, get_shard_count(coupon))
+    return [
+        CouponRedemptionShard(coupon=coupon, shard=n, limit=share)
+        for n, share in enumerate(shares)
+    ]
+
+
+def sync_shards(coupon):
+    """Create or resize the redemption shards of a coupon.
+
+    Called whenever a coupon is saved. Redemptions counted so far are kept
+    and the rest of ``max_redemptions`` is split across the shards in use.
+    Shards left over from a larger cap keep their counts but accept no new
+    redemptions. If the cap was lowered below the redemptions already
+    counted, no shard accepts new redemptions.
+
+    Args:
+        coupon (Coupon): The coupon.
+    """
+    if coupon.max_redemptions is None:
+        CouponRedemptionShard.objects.filter(coupon=coupon).delete()
+        return
+    with transaction.atomic():
+        shards = {
+            shard.shard: shard
+            for shard in CouponRedemptionShard.objects.select_for_update()
+            .filter(coupon=coupon)
+        }
+        in_use = get_shard_count(coupon)
+        for n in range(in_use):
+            if n not in shards:
+                shards[n] = CouponRedemptionShard(coupon=coupon, shard=n)
+        used = sum(shard.count for shard in shards.values())
+        remaining = max(coupon.max_redemptions - used, 0)
+        shares = split_limit(remaining, in_use)
+        for n, shard in shards.items():
+            shard.limit = shard.count + (shares[n] if n < in_use else 0)
+        CouponRedemptionShard.objects.bulk_create(
+            [shard for shard in shards.values() if shard.pk is None]
+        )
+        CouponRedemptionShard.objects.bulk_update(
+            [shard for shard in shards.values() if shard.pk is not None],
+            ['limit'],
+        )
+
+
+def get_redemption_count(coupon):
+    """Return how many times a limited coupon has been redeemed.
+
+    Args:
+        coupon (Coupon): The coupon.
+
+    Returns:
+        int: The number of redemptions, or 0 for a coupon without a cap.
+    """
+    total = CouponRedemptionShard.objects.filter(coupon=coupon).aggregate(
+        total=Sum('count')
+    )['total']
+    return total or 0
+
+
+def redeem_total(coupon):
+    """Count one redemption against the total cap of a coupon.
+
+    Args:
+        coupon (Coupon): The coupon, with ``max_redemptions`` set.
+
+    Raises:
+        RedemptionLimitReached: If every shard is at its limit.
+    """
+    shards = get_shard_count(coupon)
+    start = random.randrange(shards)
+    for n in range(shards):
+        updated = CouponRedemptionShard.objects.filter(
+            coupon=coupon,
+            shard=(start + n) % shards,
+            count__lt=F('limit'),
+        ).update(count=F('count') + 1)
+        if updated:
+            return
+    raise RedemptionLimitReached('This coupon has been fully redeemed.')
+
+
+def redeem_for_customer(coupon, customer):
+    """Count one redemption against the cap of a customer.
+
+    Args:
+        coupon (Coupon): The coupon, with ``max_redemptions_per_customer``
+            set.
+        customer (str): The normalized e-mail address of the customer.
+
+    Raises:
+        RedemptionLimitReached: If the customer has reached the cap.
+    """
+    counter = CouponCustomerRedemptions.objects.filter(
+        coupon=coupon, customer=customer
+    )
+    limit = coupon.max_redemptions_per_customer
+    if counter.filter(count__lt=limit).update(count=F('count') + 1):
+        return
+    if limit > 0:
+        try:
+            with transaction.atomic():
+                CouponCustomerRedemptions.objects.create(
+                    coupon=coupon, customer=customer, count=1
+                )
+            return
+        except IntegrityError:
+            # the counter exists, created now by a concurrent checkout
+            if counter.filter(count__lt=limit).update(count=F('count') + 1):
+                return
+    raise RedemptionLimitReached('You have already used this coupon.')
+
+
+def redeem(coupon, email):
+    """Count a redemption of a coupon by a customer.
+
+    Must be called inside the transaction that creates the order, so the
+    counters are rolled back with the order if the checkout fails.
+
+    Args:
+        coupon (Coupon): The coupon applied to the order.
+        email (str): The e-mail address of the customer.
+
+    Raises:
+        RedemptionLimitReached: If the coupon or the customer has reached
+        the redemption cap.
+    """
+    if coupon.max_redemptions_per_customer is not None:
+        redeem_for_customer(coupon, email.strip().lower())
+    if coupon.max_redemptions is not None:
+        redeem_total(coupon)
+
+
+def give_back(coupon, email):
+    """Return a redemption of a coupon, counted for an abandoned order.
+
+    Must be called in the transaction that releases the order.
+
+    Args:
+        coupon (Coupon): The coupon applied to the order.
+        email (str): The e-mail address of the customer.
+    """
+    if coupon.max_redemptions_per_customer is not None:
+        CouponCustomerRedemptions.objects.filter(
+            coupon=coupon, customer=email.strip().lower(), count__gt=0
+        ).update(count=F('count') - 1)
+    if coupon.max_redemptions is None:
+        return
+    shards = CouponRedemptionShard.objects.filter(coupon=coupon, count__gt=0)
+    # the first shard with redemptions, in one statement; a concurrent
+    # release can empty it first, then the next one is tried
+    for _ in range(get_shard_count(coupon)):
+        first = shards.order_by('shard').values('id')[:1]
+        if shards.filter(id__in=Subquery(first)).update(
+            count=F('count') - 1
+        ):
+            return
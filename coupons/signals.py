@@ -0,0 +1,53 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .bloom import add_codes
+from .cache import invalidate
+from .models import Coupon
+from .redemptions import sync_shards
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def invalidate_coupon_cache(sender, instance, **kwargs):
+    """
+    Clear the cached lookups of a coupon when it is saved or deleted.
+
+    The cache is cleared once the transaction commits, so a concurrent
+    request cannot cache the old version again in between.
+
+    Args:
+        sender (type): The model class that sent the signal.
+        instance (Coupon): The coupon that was saved or deleted.
+    """
+    transaction.on_commit(lambda: invalidate(instance))
+
+
+@receiver(post_save, sender=Coupon)
+def add_code_to_filter(sender, instance, **kwargs):
+    """
+    Add the code of a saved coupon to the coupon code filter.
+
+    The code is added right away rather than on commit: a code in the
+    filter that is not a coupon yet is only looked up in the database.
+
+    Args:
+        sender (type): The model class that sent the signal.
+        instance (Coupon): The coupon that was saved.
+    """
+    add_codes([instance.normalized_code])
+
+
+@receiver(post_save, sender=Coupon)
+def sync_redemption_shards(sender, instance, raw=False, **kwargs):
+    """
+    Split the redemption cap of a saved coupon across its counter shards.
+
+    Args:
+        sender (type): The model class that sent the signal.
+        instance (Coupon): The coupon that was saved.
+        raw (bool): True when loading fixtures, where shards are not synced.
+    """
+    if not raw:
+        sync_shards(instance)
@@ -0,0 +1,35 @@
+from celery import shared_task
+
+from .generation import generate_coupons
+from .models import Coupon
+
+
+@shared_task
+def generate_campaign_coupons(template_id, count, prefix='', length=10):
+    """
+    Task to generate single-use coupons for a campaign.
+
+    The new coupons copy the discount and validity window of a template
+    coupon.
+
+    Args:
+        template_id (int): The ID of the coupon used as template.
+        count (int): The number of coupons to generate.
+        prefix (str): Text put in front of every code.
+        length (int): The number of random characters of every code.
+
+    Returns:
+        int: The number of coupons created.
+    """
+    template = Coupon.objects.get(id=template_id)
+    created, _ = generate_coupons(
+        count,
+        discount=template.discount,
+        valid_from=template.valid_from,
+        valid_to=template.valid_to,
+        prefix=prefix,
+        length=length,
+        max_redemptions=1,
+        max_redemptions_per_customer=template.max_redemptions_per_customer,
+    )
+    return created
@@ -1,2 +1,577 @@
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from cart.cart import Cart
+from orders.models import Order, OrderItem
+from payment.events import mark_order_paid
+from shop.inventory import release_stock, renew_reservation, reserve_stock
+from shop.models import Category, Product
+
+from . import bloom
+from . import cache as coupon_cache
+from .generation import ALPHABET, generate_coupons
+from .models import Coupon, CouponRedemptionShard
+from .redemptions import (
+    RedemptionLimitReached,
+    get_redemption_count,
+    redeem,
+    split_limit,
+)
+
+
+def create_coupon(code='Summer10', discount=10, days=7, **kwargs):
+    now = timezone.now()
+    return Coupon.objects.create(
+        code=code,
+        max_redemptions=kwargs.pop('max_redemptions', None),
+        max_redemptions_per_customer=kwargs.pop(
+            'max_redemptions_per_customer', None
+        ),
+        valid_from=kwargs.pop('valid_from', now - timedelta(days=1)),
+        valid_to=kwargs.pop('valid_to', now + timedelta(days=days)),
+        discount=discount,
+        active=kwargs.pop('active', True),
+    )
+
+
+class FakeRedis:
+    """In-memory replacement for the Redis commands of the Bloom filter and
+    the cache."""
+
+    def __init__(self):
+        self.keys = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def setbit(self, key, offset, value):
+        bits = self.keys.setdefault(key, set())
+        old = int(offset in bits)
+        (bits.add if value else bits.discard)(offset)
+        return old
+
+    def getbit(self, key, offset):
+        return int(offset in self.keys.get(key, ()))
+
+    def exists(self, key):
+        return int(key in self.keys)
+
+    def get(self, key):
+        return self.keys.get(key)
+
+    def mget(self, keys):
+        return [self.keys.get(key) for key in keys]
+
+    def set(self, key, value, px=None, nx=False):
+        # expiry is not simulated
+        if nx and key in self.keys:
+            return None
+        if isinstance(value, (int, str)):
+            value = str(value).encode()
+        self.keys[key] = value
+        return True
+
+    def delete(self, *keys):
+        return sum(self.keys.pop(key, None) is not None for key in keys)
+
+    def publish(self, channel, message):
+        return 0
+
+    def flushdb(self):
+        self.keys.clear()
+        return True
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    def execute(self):
+        self.redis.round_trips += 1
+        results = [
+            getattr(self.redis, name)(*args, **kwargs)
+            for name, args, kwargs in self.commands
+        ]
+        self.commands = []
+        return results
+
+
+class CouponTestMixin:
+    """Starts every test with empty coupon caches and filter."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.multiple(
+            cache.tiers, client=FakeRedis(), available=True, down_until=0
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        self.addCleanup(coupon_cache.clear_local)
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(bloom, 'r', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class CouponCacheTests(CouponTestMixin, TestCase):
+
+    def test_code_is_normalized_on_save(self):
+        coupon = create_coupon(code='  Summer10 ')
+        self.assertEqual(coupon.normalized_code, 'summer10')
+
+    def test_codes_differing_in_case_are_rejected(self):
+        create_coupon(code='Summer10')
+        duplicate = Coupon(
+            code='SUMMER10',
+            valid_from=timezone.now(),
+            valid_to=timezone.now(),
+            discount=5,
+            active=True,
+        )
+        with self.assertRaises(ValidationError):
+            duplicate.full_clean()
+
+    def test_lookup_is_case_insensitive_and_cached(self):
+        coupon = create_coupon()
+        with self.assertNumQueries(1):
+            self.assertEqual(coupon_cache.get_active_coupon('SUMMER10'), coupon)
+        with self.assertNumQueries(0):
+            self.assertEqual(coupon_cache.get_active_coupon('summer10'), coupon)
+            self.assertEqual(coupon_cache.get_coupon(coupon.id), coupon)
+
+    def test_shared_cache_serves_other_processes(self):
+        coupon = create_coupon()
+        coupon_cache.get_active_coupon('summer10')
+        # a process with an empty in-process cache
+        coupon_cache.clear_local()
+        with self.assertNumQueries(0):
+            self.assertEqual(coupon_cache.get_active_coupon('summer10'), coupon)
+
+    def test_unknown_code_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(coupon_cache.get_active_coupon('nope'))
+            self.assertIsNone(coupon_cache.get_active_coupon('nope'))
+
+    def test_inactive_and_expired_coupons_are_not_returned(self):
+        create_coupon(code='off', active=False)
+        create_coupon(
+            code='old', valid_to=timezone.now() - timedelta(minutes=1)
+        )
+        self.assertIsNone(coupon_cache.get_active_coupon('off'))
+        self.assertIsNone(coupon_cache.get_active_coupon('old'))
+
+    def test_cached_coupon_expires_at_valid_to(self):
+        coupon = create_coupon(valid_to=timezone.now() + timedelta(seconds=90))
+        self.assertTrue(80 <= coupon_cache.get_timeout(coupon) <= 90)
+        coupon_cache.get_active_coupon('summer10')
+        later = timezone.now() + timedelta(minutes=2)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            with self.assertNumQueries(0):
+                self.assertIsNone(coupon_cache.get_active_coupon('summer10'))
+
+    def test_saving_a_coupon_invalidates_its_entries(self):
+        coupon = create_coupon()
+        coupon_cache.get_active_coupon('summer10')
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon.discount = 25
+            coupon.save()
+        self.assertEqual(coupon_cache.get_coupon(coupon.id).discount, 25)
+
+    def test_renamed_code_no_longer_matches(self):
+        coupon = create_coupon()
+        coupon_cache.get_active_coupon('summer10')
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon.code = 'Winter10'
+            coupon.save()
+        self.assertIsNone(coupon_cache.get_active_coupon('summer10'))
+        self.assertEqual(coupon_cache.get_active_coupon('winter10'), coupon)
+
+    def test_deleting_a_coupon_invalidates_its_entries(self):
+        coupon = create_coupon()
+        coupon_cache.get_active_coupon('summer10')
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon.delete()
+        self.assertIsNone(coupon_cache.get_active_coupon('summer10'))
+
+    def test_admin_changes_invalidate_the_cache(self):
+        admin = User.objects.create_superuser('admin', 'a@example.com', 'pw')
+        self.client.force_login(admin)
+        coupon = create_coupon()
+        coupon_cache.get_active_coupon('summer10')
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('admin:coupons_coupon_change', args=[coupon.id]),
+                {
+                    'code': 'Summer10',
+                    'valid_from_0': now.strftime('%Y-%m-%d'),
+                    'valid_from_1': '00:00:00',
+                    'valid_to_0': (now + timedelta(days=7)).strftime(
+                        '%Y-%m-%d'
+                    ),
+                    'valid_to_1': '00:00:00',
+                    'discount': 50,
+                    'active': 'on',
+                },
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            coupon_cache.get_active_coupon('summer10').discount, 50
+        )
+
+
+class CouponApplyTests(CouponTestMixin, TestCase):
+
+    def test_apply_stores_coupon_in_session(self):
+        coupon = create_coupon()
+        self.client.post(reverse('coupons:apply'), {'code': 'summer10'})
+        self.assertEqual(self.client.session['coupon_id'], coupon.id)
+        self.client.post(reverse('coupons:apply'), {'code': 'nope'})
+        self.assertIsNone(self.client.session['coupon_id'])
+
+    def test_cart_coupon_does_not_query_the_database(self):
+        coupon = create_coupon()
+        coupon_cache.get_coupon(coupon.id)
+        request = mock.Mock(session={'coupon_id': coupon.id})
+        cart = Cart(request)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.coupon, coupon)
+            self.assertEqual(cart.get_discount(), 0)
+
+
+@override_settings(COUPON_REDEMPTION_SHARDS=4)
+class RedemptionLimitTests(CouponTestMixin, TestCase):
+
+    def limits(self, coupon):
+        return list(
+            CouponRedemptionShard.objects.filter(coupon=coupon)
+            .order_by('shard')
+            .values_list('count', 'limit')
+        )
+
+    def test_split_limit(self):
+        self.assertEqual(split_limit(10, 4), [3, 3, 2, 2])
+        self.assertEqual(split_limit(2, 4), [1, 1, 0, 0])
+
+    def test_cap_is_split_across_shards(self):
+        coupon = create_coupon(max_redemptions=10)
+        self.assertEqual(self.limits(coupon), [(0, 3), (0, 3), (0, 2), (0, 2)])
+
+    def test_unlimited_coupon_has_no_shards(self):
+        coupon = create_coupon()
+        with self.assertNumQueries(0):
+            redeem(coupon, 'ada@example.com')
+        self.assertEqual(self.limits(coupon), [])
+
+    def test_total_cap(self):
+        coupon = create_coupon(max_redemptions=5)
+        for n in range(5):
+            redeem(coupon, f'c{n}@example.com')
+        with self.assertRaises(RedemptionLimitReached):
+            redeem(coupon, 'late@example.com')
+        self.assertEqual(get_redemption_count(coupon), 5)
+
+    def test_resizing_keeps_redemptions_counted(self):
+        coupon = create_coupon(max_redemptions=5)
+        for n in range(3):
+            redeem(coupon, f'c{n}@example.com')
+        coupon.max_redemptions = 4
+        coupon.save()
+        self.assertEqual(sum(limit for _, limit in self.limits(coupon)), 4)
+        redeem(coupon, 'c3@example.com')
+        with self.assertRaises(RedemptionLimitReached):
+            redeem(coupon, 'c4@example.com')
+        coupon.max_redemptions = 2
+        coupon.save()
+        self.assertEqual(get_redemption_count(coupon), 4)
+        with self.assertRaises(RedemptionLimitReached):
+            redeem(coupon, 'c5@example.com')
+
+    def test_customer_cap(self):
+        coupon = create_coupon(max_redemptions_per_customer=2)
+        redeem(coupon, 'ada@example.com')
+        redeem(coupon, ' ADA@example.com')
+        with self.assertRaises(RedemptionLimitReached):
+            redeem(coupon, 'ada@example.com')
+        redeem(coupon, 'bob@example.com')
+
+    def place_order(self, coupon, email):
+        category, _ = Category.objects.get_or_create(name='Tea', slug='tea')
+        product, _ = Product.objects.get_or_create(
+            category=category, name='Tea', slug='tea', price='5.00',
+            stock=10,
+        )
+        order = Order.objects.create(
+            first_name='Ada', last_name='Lovelace', email=email,
+            address='1 Main St', postal_code='1000', city='London',
+            coupon=coupon, discount=coupon.discount,
+        )
+        OrderItem.objects.create(
+            order=order, product=product, price='5.00', quantity=1
+        )
+        redeem(coupon, email)
+        reserve_stock(order)
+        return order
+
+    def test_released_orders_give_back_their_redemption(self):
+        coupon = create_coupon(
+            max_redemptions=1, max_redemptions_per_customer=1
+        )
+        order = self.place_order(coupon, 'ada@example.com')
+        self.assertTrue(release_stock(order.id))
+        self.assertEqual(get_redemption_count(coupon), 0)
+        # the customer can use the coupon again
+        redeem(coupon, 'ADA@example.com')
+        # and paying the released order again needs a redemption
+        order = Order.objects.select_related('coupon').get(id=order.id)
+        with self.assertRaises(RedemptionLimitReached):
+            renew_reservation(order)
+        self.assertIsNotNone(order.stock_reservation.released)
+        self.assertEqual(Product.objects.get().stock, 10)
+
+    def test_renewed_order_redeems_again(self):
+        coupon = create_coupon(max_redemptions=2)
+        order = self.place_order(coupon, 'ada@example.com')
+        release_stock(order.id)
+        renew_reservation(Order.objects.get(id=order.id))
+        self.assertEqual(get_redemption_count(coupon), 1)
+        self.assertEqual(Product.objects.get().stock, 9)
+
+    def test_late_payment_counts_the_redemption_again(self):
+        coupon = create_coupon(max_redemptions=1)
+        order = self.place_order(coupon, 'ada@example.com')
+        release_stock(order.id)
+        with mock.patch('payment.events.order_paid'):
+            mark_order_paid(order.id, 'pi_1')
+        self.assertEqual(get_redemption_count(coupon), 1)
+
+    def test_order_create_rejects_fully_redeemed_coupon(self):
+        coupon = create_coupon(max_redemptions=1)
+        redeem(coupon, 'first@example.com')
+        category = Category.objects.create(name='Tea', slug='tea')
+        product = Product.objects.create(
+            category=category, name='Tea', slug='tea', price='5.00'
+        )
+        self.client.post(
+            reverse('cart:cart_add', args=[product.id]),
+            {'quantity': 1, 'override': False},
+        )
+        self.client.post(reverse('coupons:apply'), {'code': 'summer10'})
+        data = {
+            'first_name': 'Ada',
+            'last_name': 'Lovelace',
+            'email': 'ada@example.com',
+            'address': '1 Main St',
+            'postal_code': '1000',
+            'city': 'London',
+        }
+        with mock.patch('orders.views.order_created'):
+            response = self.client.post(reverse('orders:order_create'), data)
+            self.assertContains(response, 'fully redeemed')
+            self.assertFalse(Order.objects.exists())
+            self.assertIsNone(self.client.session['coupon_id'])
+            # placing the order again goes through without the coupon
+            response = self.client.post(reverse('orders:order_create'), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(Order.objects.get().coupon)
+
+
+@override_settings(COUPON_REDEMPTION_SHARDS=8)
+class RedemptionConcurrencyTests(CouponTestMixin, TransactionTestCase):
+    def redeem_concurrently(self, coupon, emails):
+        results = []
+        barrier = threading.Barrier(len(emails))
+
+        def checkout(email):
+            barrier.wait()
+            try:
+                with transaction.atomic():
+                    redeem(coupon, email)
+                results.append(True)
+            except RedemptionLimitReached:
+                results.append(False)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=checkout, args=[email])
+            for email in emails
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_total_cap_is_never_overshot(self):
+        coupon = create_coupon(max_redemptions=25)
+        results = self.redeem_concurrently(
+            coupon, [f'c{n}@example.com' for n in range(60)]
+        )
+        self.assertEqual(results.count(True), 25)
+        self.assertEqual(get_redemption_count(coupon), 25)
+
+    def test_customer_cap_is_never_overshot(self):
+        coupon = create_coupon(max_redemptions_per_customer=2)
+        results = self.redeem_concurrently(coupon, ['ada@example.com'] * 20)
+        self.assertEqual(results.count(True), 2)
+
+
+class CouponFilterTests(CouponTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.bloom = bloom.get_filter()
+
+    def test_filter_sizing(self):
+        small = bloom.BloomFilter('test', capacity=1000, error_rate=0.01)
+        self.assertEqual((small.size, small.hashes), (9586, 7))
+
+    def test_false_positive_rate(self):
+        small = bloom.BloomFilter('test', capacity=2000, error_rate=0.01)
+        small.add(f'code-{n}' for n in range(2000))
+        small.mark_ready()
+        self.assertTrue(all(
+            small.might_contain(f'code-{n}') for n in range(2000)
+        ))
+        false_positives = sum(
+            small.might_contain(f'other-{n}') for n in range(5000)
+        )
+        self.assertLess(false_positives / 5000, 0.02)
+
+    def test_filter_is_ignored_until_built(self):
+        create_coupon()
+        self.assertIsNone(self.bloom.might_contain('unknown'))
+        with self.assertNumQueries(1):
+            self.assertIsNone(coupon_cache.get_active_coupon('unknown'))
+
+    def test_unknown_codes_are_rejected_without_queries(self):
+        coupon = create_coupon()
+        call_command('rebuild_coupon_filter', stdout=mock.MagicMock())
+        with self.assertNumQueries(0):
+            self.assertIsNone(coupon_cache.get_active_coupon('unknown'))
+        with self.assertNumQueries(1):
+            self.assertEqual(coupon_cache.get_active_coupon('summer10'), coupon)
+
+    def test_saved_coupons_are_added_to_the_filter(self):
+        self.bloom.mark_ready()
+        coupon = create_coupon(code='Later5')
+        self.assertTrue(self.bloom.might_contain('later5'))
+        self.assertEqual(coupon_cache.get_active_coupon('LATER5'), coupon)
+
+    def test_redis_failure_disables_the_filter(self):
+        self.bloom.mark_ready()
+        with mock.patch.object(
+            self.redis, 'pipeline', side_effect=bloom.redis.ConnectionError
+        ), self.assertLogs('coupons.bloom', 'WARNING'):
+            create_coupon()
+            self.assertTrue(bloom.might_be_coupon('summer10'))
+        self.assertIsNone(self.bloom.might_contain('summer10'))
+
+
+class CouponGenerationTests(CouponTestMixin, TestCase):
+    def generate(self, count, **kwargs):
+        now = timezone.now()
+        return generate_coupons(
+            count,
+            discount=kwargs.pop('discount', 20),
+            valid_from=now - timedelta(days=1),
+            valid_to=now + timedelta(days=1),
+            **kwargs,
+        )
+
+    def test_codes_are_unique_single_use_and_in_the_filter(self):
+        bloom.get_filter().mark_ready()
+        created, _ = self.generate(250, prefix='SPRING-', batch_size=100)
+        self.assertEqual(created, 250)
+        codes = list(Coupon.objects.values_list('code', flat=True))
+        self.assertEqual(len(set(codes)), 250)
+        self.assertTrue(all(
+            code.startswith('SPRING-') and set(code[7:]) <= set(ALPHABET)
+            for code in codes
+        ))
+        self.assertEqual(CouponRedemptionShard.objects.count(), 250)
+        coupon = coupon_cache.get_active_coupon(codes[0])
+        redeem(coupon, 'ada@example.com')
+        with self.assertRaises(RedemptionLimitReached):
+            redeem(coupon, 'bob@example.com')
+
+    def test_batches_use_a_constant_number_of_queries(self):
+        # collision check, savepoint, coupons, counters, release
+        with self.assertNumQueries(5 * 3):
+            self.generate(300, batch_size=100)
+
+    def test_collisions_are_replaced(self):
+        create_coupon(code='AAAA')
+        codes = iter(['AAAA', 'BBBB', 'CCCC'])
+        with mock.patch(
+            'coupons.generation.random_code', side_effect=lambda *a: next(codes)
+        ):
+            created, collisions = self.generate(2, batch_size=2, length=4)
+        self.assertEqual((created, collisions), (2, 1))
+        self.assertEqual(
+            sorted(Coupon.objects.values_list('code', flat=True)),
+            ['AAAA', 'BBBB', 'CCCC'],
+        )
+
+    def test_codes_longer_than_the_field_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.generate(1, prefix='X' * 45, length=10)
+
+    def test_admin_action_launches_generation_task(self):
+        admin = User.objects.create_superuser('admin', 'a@example.com', 'pw')
+        self.client.force_login(admin)
+        template = create_coupon(discount=15)
+        url = reverse('admin:coupons_coupon_changelist')
+        data = {'action': 'generate_codes', '_selected_action': [template.id]}
+        response = self.client.post(url, data)
+        self.assertContains(response, 'Generate single-use coupon codes')
+        with mock.patch(
+            'coupons.admin.generate_campaign_coupons.delay'
+        ) as delay:
+            response = self.client.post(
+                url, {**data, 'apply': '1', 'count': 500, 'length': 8},
+            )
+        self.assertEqual(response.status_code, 302)
+        delay.assert_called_once_with(template.id, 500, prefix='', length=8)
+
+    def test_generation_task_copies_the_template(self):
+        from .tasks import generate_campaign_coupons
+        template = create_coupon(discount=15)
+        self.assertEqual(generate_campaign_coupons(template.id, 5), 5)
+        generated = Coupon.objects.exclude(id=template.id)
+        self.assertEqual(
+            set(generated.values_list('discount', 'max_redemptions')),
+            {(15, 1)},
+        )
+
+    def test_generate_and_bench_commands(self):
+        stdout = mock.MagicMock()
+        call_command(
+            'generate_coupons', 20, discount=10, prefix='CMD-', stdout=stdout
+        )
+        self.assertEqual(Coupon.objects.count(), 20)
+        call_command('rebuild_coupon_filter', stdout=stdout)
+        call_command('bench_coupons', count=50, lookups=10, stdout=stdout)
+        output = ''.join(call.args[0] for call in stdout.write.call_args_list)
+        self.assertIn('generation: 50 coupons', output)
+        self.assertIn('filter unknown', output)
+        # the benchmark coupons are deleted
+        self.assertEqual(Coupon.objects.count(), 20)
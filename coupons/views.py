@@ -1,9 +1,8 @@
 from django.shortcuts import redirect
-from django.utils import timezone
 from django.views.decorators.http import require_POST
 
+from .cache import get_active_coupon
 from .forms import CouponApplyForm
-from .models import Coupon
 
 
 @require_POST
@@ -13,6 +12,7 @@ def coupon_apply(request):
     This view function handles the POST request for applying a coupon code. 
     It validates the provided code and checks if the coupon is active and within its valid date range. 
     If valid, the coupon ID is stored in the session; otherwise, it sets the coupon ID to None.
+    Coupons are looked up through the coupon cache by their normalized code.
 
     Args:
         request: The HTTP request object containing the form data.
@@ -20,18 +20,9 @@ def coupon_apply(request):
     Returns:
         HttpResponse: Redirects the user to the cart detail page after processing the coupon.
     """
-    now = timezone.now()
     form = CouponApplyForm(request.POST)
     if form.is_valid():
         code = form.cleaned_data['code']
-        try:
-            coupon = Coupon.objects.get(
-                code__iexact=code,
-                valid_from__lte=now,
-                valid_to__gte=now,
-                active=True,
-            )
-            request.session['coupon_id'] = coupon.id
-        except Coupon.DoesNotExist:
-            request.session['coupon_id'] = None
+        coupon = get_active_coupon(code)
+        request.session['coupon_id'] = coupon.id if coupon else None
     return redirect('cart:cart_detail')
@@ -0,0 +1,675 @@
+"""
+Query budgets and latency benchmarks of the views of the shop.
+
+Every view of the storefront, cart, coupons, orders and payment apps is
+described by a :class:`Scenario`: how to request it, the response it should
+give and its query budget, the most database queries one request may run.
+:func:`seed` fills the database with a synthetic catalog, orders and
+coupons, and :func:`run` drives each scenario through the test client,
+with Stripe, Redis and WeasyPrint replaced by in-memory stand-ins (see
+:func:`stubbed`), so the PDF views are measured without rendering PDFs.
+Requests are counted after a warm-up request, so the budgets hold for warm
+caches. The numbers of queries do not depend on the size of the catalog,
+so a budget exceeded means a new query per request, like a missing
+``select_related`` in a loop.
+
+The budgets are checked by the test suite on a small catalog, and by the
+``bench_views`` command on a large one, which also records the latency
+percentiles of every view in a JSON baseline to compare later runs with.
+"""
+import hashlib
+import hmac
+import json
+import math
+import os
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from itertools import count
+from types import SimpleNamespace
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from analytics import rollups
+from coupons.models import Coupon, normalize_code
+from orders.models import Order, OrderItem
+from shop import recommender
+from shop.models import Category, Product
+
+BENCH_EMAIL = 'bench@example.com'
+BENCH_COUPON = 'BENCH-10'
+ITEMS_PER_CART = 5
+ITEMS_PER_ORDER = 5
+PRODUCTS_PER_CATEGORY = 50
+# the seeded orders were placed over this many days
+SALES_DAYS = 3 * 365
+
+ORDER_DATA = {
+    'first_name': 'Bench',
+    'last_name': 'Mark',
+    'email': BENCH_EMAIL,
+    'address': '1 Main St',
+    'postal_code': '1000',
+    'city': 'London',
+}
+
+# transaction control statements, which depend on the transaction the
+# request runs in rather than on the view
+TRANSACTION_STATEMENTS = (
+    'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT',
+)
+
+
+class BenchmarkError(Exception):
+    """Raised when a view does not give the expected response."""
+
+
+class Scenario:
+    """A request to a view and its query budget.
+
+    Args:
+        name (str): The URL name of the view.
+        budget (int): The most database queries one request may run.
+        request (callable): Called with the client and the seed, sends the
+            request and returns the response.
+        status (int): The expected status code of the response.
+        prepare (callable): Called with the client and the seed before
+            every request, outside the measurement.
+        login (bool): Log in as a superuser first.
+    """
+
+    def __init__(
+        self, name, budget, request, status=200, prepare=None, login=False
+    ):
+        self.name = name
+        self.budget = budget
+        self.request = request
+        self.status = status
+        self.prepare = prepare
+        self.login = login
+
+
+SCENARIOS = []
+
+
+def scenario(name, budget, **kwargs):
+    """Register the decorated function as the request of a scenario."""
+    def decorator(request):
+        SCENARIOS.append(Scenario(name, budget, request, **kwargs))
+        return request
+    return decorator
+
+
+def fill_cart(client, seed):
+    """Put ``ITEMS_PER_CART`` products and the benchmark coupon in the
+    cart."""
+    for product in seed.products[:ITEMS_PER_CART]:
+        client.post(
+            reverse('cart:cart_add', args=[product.id]),
+            {'quantity': 2, 'override': False},
+        )
+    client.post(reverse('coupons:apply'), {'code': BENCH_COUPON})
+
+
+def place_order(client, seed):
+    """Fill the cart and place the order, so the next request can pay it."""
+    fill_cart(client, seed)
+    response = client.post(reverse('orders:order_create'), ORDER_DATA)
+    if response.status_code != 302:
+        raise BenchmarkError('Could not place an order to pay.')
+
+
+def add_unpaid_order(client, seed):
+    """Add an unpaid order for the next webhook delivery to pay."""
+    order = Order.objects.create(**ORDER_DATA)
+    OrderItem.objects.create(
+        order=order, product=seed.products[0], price=Decimal('10.00')
+    )
+    seed.unpaid_order = order
+
+
+@scenario('shop:product_list', budget=2)
+def product_list(client, seed):
+    return client.get(reverse('shop:product_list'))
+
+
+@scenario('shop:product_list_by_category', budget=2)
+def product_list_by_category(client, seed):
+    return client.get(seed.category.get_absolute_url())
+
+
+@scenario('shop:product_detail', budget=3)
+def product_detail(client, seed):
+    return client.get(seed.products[0].get_absolute_url())
+
+
+@scenario('cart:cart_add', budget=3, status=302)
+def cart_add(client, seed):
+    return client.post(
+        reverse('cart:cart_add', args=[seed.products[0].id]),
+        {'quantity': 1, 'override': True},
+    )
+
+
+@scenario('cart:cart_remove', budget=3, status=302, prepare=fill_cart)
+def cart_remove(client, seed):
+    return client.post(
+        reverse('cart:cart_remove', args=[seed.products[0].id])
+    )
+
+
+@scenario('cart:cart_detail', budget=3, prepare=fill_cart)
+def cart_detail(client, seed):
+    return client.get(reverse('cart:cart_detail'))
+
+
+@scenario('coupons:apply', budget=2, status=302)
+def coupon_apply(client, seed):
+    return client.post(reverse('coupons:apply'), {'code': BENCH_COUPON})
+
+
+@scenario('orders:order_create', budget=2, prepare=fill_cart)
+def order_form(client, seed):
+    return client.get(reverse('orders:order_create'))
+
+
+@scenario(
+    'orders:order_create[POST]', budget=14, status=302, prepare=fill_cart
+)
+def order_create(client, seed):
+    return client.post(reverse('orders:order_create'), ORDER_DATA)
+
+
+@scenario('orders:admin_order_detail', budget=5, login=True)
+def admin_order_detail(client, seed):
+    return client.get(
+        reverse('orders:admin_order_detail', args=[seed.order.id])
+    )
+
+
+@scenario('orders:admin_order_pdf', budget=4, login=True)
+def admin_order_pdf(client, seed):
+    return client.get(
+        reverse('orders:admin_order_pdf', args=[seed.order.id])
+    )
+
+
+@scenario('admin:orders_order_changelist', budget=7, login=True)
+def order_changelist(client, seed):
+    return client.get(reverse('admin:orders_order_changelist'))
+
+
+@scenario('analytics:sales_dashboard', budget=9, login=True)
+def sales_dashboard(client, seed):
+    end = timezone.localdate()
+    return client.get(
+        reverse('analytics:sales_dashboard'),
+        {'start': end - timedelta(days=SALES_DAYS), 'end': end},
+    )
+
+
+@scenario('payment:process', budget=4, prepare=place_order)
+def payment_form(client, seed):
+    return client.get(reverse('payment:process'))
+
+
+@scenario(
+    'payment:process[POST]', budget=5, status=302, prepare=place_order
+)
+def payment_process(client, seed):
+    return client.post(reverse('payment:process'))
+
+
+@scenario('payment:completed', budget=2)
+def payment_completed(client, seed):
+    return client.get(reverse('payment:completed'))
+
+
+@scenario('payment:canceled', budget=9, prepare=place_order)
+def payment_canceled(client, seed):
+    return client.get(reverse('payment:canceled'))
+
+
+@scenario('payment:stripe-webhook', budget=14, prepare=add_unpaid_order)
+def stripe_webhook(client, seed):
+    payload, signature = sign_event(seed.unpaid_order)
+    return client.post(
+        reverse('payment:stripe-webhook'),
+        payload,
+        content_type='application/json',
+        HTTP_STRIPE_SIGNATURE=signature,
+    )
+
+
+def sign_event(order, secret=None):
+    """Build a signed ``checkout.session.completed`` delivery for an order.
+
+    Args:
+        order (Order): The paid order.
+        secret (str): The webhook secret, ``STRIPE_WEBHOOK_SECRET`` by
+            default.
+
+    Returns:
+        tuple: The payload and the ``Stripe-Signature`` header.
+    """
+    payload = json.dumps({
+        'id': f'evt_bench_{order.id}',
+        'object': 'event',
+        'type': 'checkout.session.completed',
+        'data': {
+            'object': {
+                'object': 'checkout.session',
+                'mode': 'payment',
+                'payment_status': 'paid',
+                'client_reference_id': str(order.id),
+                'payment_intent': f'pi_bench_{order.id}',
+            },
+        },
+    })
+    timestamp = int(time.time())
+    signature = hmac.new(
+        (secret or settings.STRIPE_WEBHOOK_SECRET).encode(),
+        f'{timestamp}.{payload}'.encode(),
+        hashlib.sha256,
+    ).hexdigest()
+    return payload, f't={timestamp},v1={signature}'
+
+
+def seed(products=1000, orders=1000, coupons=1000):
+    """Fill the database with a synthetic catalog, orders and coupons.
+
+    Args:
+        products (int): The number of products, at least ``ITEMS_PER_CART``.
+        orders (int): The number of paid orders, each with
+            ``ITEMS_PER_ORDER`` items, placed over the last ``SALES_DAYS``
+            days. One in four used the benchmark coupon.
+        coupons (int): The number of coupons besides the benchmark coupon.
+
+    Returns:
+        SimpleNamespace: The objects the scenarios request: ``category``,
+        ``products``, ``order`` and ``staff``.
+    """
+    Category.objects.bulk_create(
+        Category(name=f'Category {i}', slug=f'bench-category-{i}')
+        for i in range(math.ceil(products / PRODUCTS_PER_CATEGORY))
+    )
+    categories = list(
+        Category.objects.filter(slug__startswith='bench-category-')
+        .order_by('id')
+    )
+    Product.objects.bulk_create(
+        (
+            Product(
+                category=categories[i // PRODUCTS_PER_CATEGORY],
+                name=f'Product {i}',
+                slug=f'product-{i}',
+                sku=f'BENCH-{i}',
+                price=Decimal(10 + i % 90),
+                available=True,
+            )
+            for i in range(products)
+        ),
+        batch_size=500,
+    )
+    catalog = list(
+        Product.objects.filter(sku__startswith='BENCH-').order_by('id')
+    )
+    Order.objects.bulk_create(
+        (Order(**ORDER_DATA, paid=True) for _ in range(orders)),
+        batch_size=500,
+    )
+    order_ids = list(
+        Order.objects.filter(email=BENCH_EMAIL)
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+    OrderItem.objects.bulk_create(
+        (
+            OrderItem(
+                order_id=order_id,
+                product=catalog[(n * ITEMS_PER_ORDER + i) % len(catalog)],
+                price=Decimal('10.00'),
+                quantity=1 + i,
+            )
+            for n, order_id in enumerate(order_ids)
+            for i in range(ITEMS_PER_ORDER)
+        ),
+        batch_size=1000,
+    )
+    now = timezone.now()
+    Coupon.objects.bulk_create(
+        (
+            Coupon(
+                code=f'BENCH-{i:06d}',
+                normalized_code=normalize_code(f'BENCH-{i:06d}'),
+                valid_from=now - timedelta(days=1),
+                valid_to=now + timedelta(days=30),
+                discount=5,
+                active=True,
+            )
+            for i in range(coupons)
+        ),
+        batch_size=1000,
+    )
+    # the code filter in Redis is shared with the shop
+    with override_settings(COUPON_BLOOM_FILTER=False):
+        coupon = Coupon.objects.create(
+            code=BENCH_COUPON,
+            valid_from=now - timedelta(days=1),
+            valid_to=now + timedelta(days=30),
+            discount=10,
+            active=True,
+            max_redemptions=10 ** 9,
+            max_redemptions_per_customer=10 ** 9,
+        )
+    placed = list(
+        Order.objects.filter(id__in=order_ids).only(
+            'id', 'created', 'coupon', 'discount'
+        )
+    )
+    for n, order in enumerate(placed):
+        order.created = now - timedelta(days=n % SALES_DAYS)
+        if n % 4 == 0:
+            order.coupon = coupon
+            order.discount = coupon.discount
+    Order.objects.bulk_update(
+        placed, ['created', 'coupon', 'discount'], batch_size=500
+    )
+    rollups.backfill()
+    staff = User.objects.create_superuser(
+        'bench-staff', BENCH_EMAIL, 'bench'
+    )
+    return SimpleNamespace(
+        category=categories[0],
+        products=catalog[:PRODUCTS_PER_CATEGORY],
+        order=Order.objects.get(id=order_ids[0]) if order_ids else None,
+        staff=staff,
+    )
+
+
+class StubRedis:
+    """In-memory stand-in for the recommendation store.
+
+    Every product was bought together with the given products, so the
+    views load a full set of recommendations.
+    """
+
+    def __init__(self, product_ids):
+        self.suggestions = [str(id).encode() for id in product_ids]
+
+    def zrange(self, *args, **kwargs):
+        return list(self.suggestions)
+
+    def zincrby(self, *args, **kwargs):
+        return 1
+
+    def zunionstore(self, *args, **kwargs):
+        return len(self.suggestions)
+
+    def zrem(self, *args, **kwargs):
+        return 0
+
+    def delete(self, *args, **kwargs):
+        return 0
+
+
+class AsyncStubPipeline:
+    """asyncio pipeline of :class:`AsyncStubRedis`."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, name):
+        method = getattr(self.redis.redis, name)
+        return lambda *args, **kwargs: self.calls.append(
+            method(*args, **kwargs)
+        )
+
+    async def execute(self):
+        calls, self.calls = self.calls, []
+        return calls
+
+
+class AsyncStubRedis:
+    """asyncio version of :class:`StubRedis`."""
+
+    def __init__(self, product_ids):
+        self.redis = StubRedis(product_ids)
+
+    async def zrange(self, *args, **kwargs):
+        return self.redis.zrange(*args, **kwargs)
+
+    def pipeline(self, transaction=True):
+        return AsyncStubPipeline(self)
+
+
+class StubStripeObjects:
+    """Stand-in for a Stripe API resource, creating objects locally."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ids = count(1)
+
+    def create(self, params=None, options=None):
+        n = next(self.ids)
+        return SimpleNamespace(
+            id=f'{self.prefix}_{n}',
+            url=f'https://checkout.test/{n}',
+            expires_at=int(time.time()) + 3600,
+        )
+
+
+class StubStripeClient:
+    """Stand-in for the shared Stripe client (see
+    ``payment/stripe_client.py``)."""
+
+    def __init__(self):
+        self.checkout = SimpleNamespace(
+            sessions=StubStripeObjects('cs_bench')
+        )
+        self.coupons = StubStripeObjects('coupon_bench')
+
+
+class StubHTML:
+    """Stand-in for ``weasyprint.HTML``, writing a fixed PDF."""
+
+    pdf = b'%PDF-1.4\n%%EOF\n'
+
+    def __init__(self, string=None, **kwargs):
+        self.string = string
+
+    def write_pdf(self, target=None, stylesheets=None, **kwargs):
+        if target is None:
+            return self.pdf
+        target.write(self.pdf)
+
+
+class StubCSS:
+    """Stand-in for ``weasyprint.CSS``."""
+
+    def __init__(self, filename=None, **kwargs):
+        self.filename = filename
+
+
+@contextmanager
+def stub_module(name, module):
+    """Make ``import name`` give a stand-in in the enclosed block.
+
+    Unlike ``mock.patch.dict(sys.modules)``, the modules imported in the
+    block stay imported.
+    """
+    saved = sys.modules.get(name)
+    sys.modules[name] = module
+    try:
+        yield
+    finally:
+        if saved is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = saved
+
+
+@contextmanager
+def stubbed(product_ids=()):
+    """Replace Stripe, Redis, WeasyPrint and the Celery tasks for the
+    enclosed block.
+
+    The shared tier of the cache is marked unavailable, so the cache only
+    uses its local tier, and the coupon code filter is disabled. Tasks are
+    not queued.
+
+    Args:
+        product_ids (list): The IDs of the products to recommend.
+    """
+    stripe_client = StubStripeClient()
+    with ExitStack() as stack:
+        stack.enter_context(override_settings(COUPON_BLOOM_FILTER=False))
+        stack.enter_context(mock.patch.multiple(
+            cache.tiers,
+            available=False,
+            down_until=math.inf,
+            listener_pid=os.getpid(),
+        ))
+        stack.enter_context(
+            mock.patch.object(recommender, 'r', StubRedis(product_ids))
+        )
+        stack.enter_context(
+            mock.patch.object(recommender, 'ar', AsyncStubRedis(product_ids))
+        )
+        for target in ('payment.views', 'payment.stripe_coupons'):
+            stack.enter_context(
+                mock.patch(f'{target}.get_client', return_value=stripe_client)
+            )
+        # imported by the PDF views when called, so swapped in sys.modules
+        stack.enter_context(stub_module(
+            'weasyprint', SimpleNamespace(HTML=StubHTML, CSS=StubCSS)
+        ))
+        stack.enter_context(mock.patch('orders.views.order_created'))
+        stack.enter_context(mock.patch('payment.events.payment_completed'))
+        yield
+
+
+def count_queries(queries):
+    """Count the captured queries, leaving out transaction control."""
+    return sum(
+        1 for query in queries
+        if not query['sql'].upper().startswith(TRANSACTION_STATEMENTS)
+    )
+
+
+def percentile(values, q):
+    """Get the nearest-rank percentile ``q`` (0-100) of sorted values."""
+    return values[max(math.ceil(len(values) * q / 100) - 1, 0)]
+
+
+def run_scenario(scenario, seed, requests=20):
+    """Send a warm-up request and then ``requests`` measured ones.
+
+    Args:
+        scenario (Scenario): The scenario.
+        seed (SimpleNamespace): The seeded objects.
+        requests (int): The number of measured requests.
+
+    Returns:
+        dict: The most queries of a request, the budget, and the latency
+        percentiles in milliseconds.
+
+    Raises:
+        BenchmarkError: If a response has an unexpected status code.
+    """
+    client = Client()
+    if scenario.login:
+        client.force_login(seed.staff)
+    queries = 0
+    latencies = []
+    for i in range(requests + 1):
+        if scenario.prepare:
+            scenario.prepare(client, seed)
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = scenario.request(client, seed)
+            elapsed = time.perf_counter() - start
+        if response.status_code != scenario.status:
+            raise BenchmarkError(
+                f'{scenario.name} responded {response.status_code}, '
+                f'expected {scenario.status}.'
+            )
+        if i:
+            # the first request warms up the caches
+            queries = max(queries, count_queries(captured.captured_queries))
+            latencies.append(elapsed * 1000)
+    latencies.sort()
+    return {
+        'queries': queries,
+        'budget': scenario.budget,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def run(seed, requests=20, scenarios=None):
+    """Run scenarios with Stripe and Redis stubbed.
+
+    Args:
+        seed (SimpleNamespace): The objects returned by :func:`seed`.
+        requests (int): The number of measured requests per scenario.
+        scenarios (list): The scenarios, all of them by default.
+
+    Returns:
+        dict: The results of :func:`run_scenario` by scenario name.
+    """
+    results = {}
+    with stubbed([product.id for product in seed.products]):
+        for scenario in scenarios or SCENARIOS:
+            results[scenario.name] = run_scenario(scenario, seed, requests)
+    return results
+
+
+def over_budget(results):
+    """List the scenarios that ran more queries than their budget."""
+    return [
+        f"{name}: {result['queries']} queries, budget {result['budget']}"
+        for name, result in results.items()
+        if result['queries'] > result['budget']
+    ]
+
+
+def slower_than(results, baseline, max_slowdown):
+    """List the scenarios whose p95 latency regressed against a baseline.
+
+    Args:
+        results (dict): The results of :func:`run`.
+        baseline (dict): The results of an earlier run.
+        max_slowdown (float): The allowed ratio of the p95 latency to the
+            one of the baseline.
+
+    Returns:
+        list: A description of each regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before and result['p95'] > before['p95'] * max_slowdown:
+            regressions.append(
+                f"{name}: p95 {result['p95']:.1f} ms, baseline "
+                f"{before['p95']:.1f} ms"
+            )
+    return regressions
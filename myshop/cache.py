@@ -0,0 +1,694 @@
+"""
+Two-tier cache backend: a small in-process LRU in front of Redis.
+
+Most reads of the shop's caches (the catalog version, product, category
+and coupon lookups) are of a few hot keys. :class:`TieredCache` keeps the
+most recently used entries in the memory of each process, for at most
+``LOCAL_TIMEOUT`` seconds, and every entry in Redis, where all processes
+share it. Reads try the local tier, then Redis, and keep what they find in
+Redis in the local tier. Values in the local tier are shared by the threads
+of a process and must not be modified.
+
+Writes go to both tiers and are announced on a Redis pub/sub channel. Every
+process listens to the channel in a background thread and drops its local
+copies of the keys written by other processes, so a change reaches all
+processes within milliseconds. ``LOCAL_TIMEOUT`` bounds how long a copy can
+be stale when a message is lost.
+
+:meth:`TieredCache.get_or_set` protects values that are expensive to
+compute from stampedes:
+
+* callers missing the same key wait for one computation, coalesced by a
+  lock within the process and by a short-lived Redis lock across
+  processes;
+* shortly before a value expires, one caller computes it again, with a
+  probability that rises as the expiry gets closer (the "XFetch" algorithm
+  of Vattani et al., Optimal Probabilistic Cache Stampede Prevention),
+  while the other callers keep reading the current value.
+
+If Redis cannot be reached the cache keeps working with the local tier
+alone, and tries Redis again after ``RETRY_AFTER`` seconds.
+
+Lookups are counted per tier and result in ``myshop_cache_requests_total``,
+and ``myshop_cache_hit_ratio`` exports the hit ratio of each tier since
+the process started.
+
+Options:
+
+* ``LOCAL_MAX_ENTRIES``: entries kept in the local tier (1000).
+* ``LOCAL_TIMEOUT``: seconds an entry stays in the local tier (10).
+* ``LOCK_TIMEOUT``: seconds a computation holds its Redis lock, and the
+  longest other callers wait for it (10).
+* ``BETA``: how early values are computed again, 0 to disable (1.0).
+* ``RETRY_AFTER``: seconds without Redis after a failed call (5).
+* ``SOCKET_TIMEOUT``: connect and read timeout of Redis calls (1.0).
+"""
+import json
+import logging
+import math
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+import redis
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from prometheus_client import Counter, Gauge
+
+from .metrics import RedisConnection
+
+logger = logging.getLogger(__name__)
+
+CACHE_REQUESTS = Counter(
+    'myshop_cache_requests_total',
+    'Cache lookups by tier and result.',
+    ['tier', 'result'],
+)
+CACHE_HIT_RATIO = Gauge(
+    'myshop_cache_hit_ratio',
+    'Share of the lookups of a cache tier that were hits.',
+    ['tier'],
+)
+CACHE_RECOMPUTES = Counter(
+    'myshop_cache_recomputes_total',
+    'Values computed by get_or_set, on a miss or before their expiry.',
+    ['reason'],
+)
+CACHE_INVALIDATIONS = Counter(
+    'myshop_cache_invalidations_total',
+    'Local cache keys dropped on a message from another process.',
+)
+CACHE_SHARED_ERRORS = Counter(
+    'myshop_cache_shared_errors_total',
+    'Failed calls to the shared cache tier.',
+)
+
+TIERS = ('local', 'shared')
+
+# lookups per tier and result in this process
+_lookups = {(tier, result): 0 for tier in TIERS for result in ('hit', 'miss')}
+_lookup_counters = {
+    key: CACHE_REQUESTS.labels(*key) for key in _lookups
+}
+
+# tiers by location, shared by the cache instances of all threads
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+# number of locks coalescing the computations of a process
+LOCK_STRIPES = 64
+# seconds between two checks for a value computed by another process
+LOCK_POLL_INTERVAL = 0.05
+# longest wait before subscribing again after a pub/sub error
+MAX_LISTEN_BACKOFF = 30
+
+# marks a call to Redis that was not made
+UNAVAILABLE = object()
+
+# a cached value, with its expiry as a timestamp (None for never) and the
+# seconds it took to compute (0 if unknown)
+Entry = namedtuple('Entry', ['value', 'expires', 'delta'])
+
+
+def record_lookup(tier, hit):
+    """Count a lookup in one tier."""
+    key = (tier, 'hit' if hit else 'miss')
+    _lookups[key] += 1
+    _lookup_counters[key].inc()
+
+
+def get_hit_ratios():
+    """Get the hit ratio of each tier since the process started.
+
+    Returns:
+        dict: The ratio, between 0 and 1, by tier.
+    """
+    ratios = {}
+    for tier in TIERS:
+        hits = _lookups[tier, 'hit']
+        total = hits + _lookups[tier, 'miss']
+        ratios[tier] = hits / total if total else 0.0
+    return ratios
+
+
+for _tier in TIERS:
+    CACHE_HIT_RATIO.labels(_tier).set_function(
+        lambda tier=_tier: get_hit_ratios()[tier]
+    )
+
+
+def dumps(entry):
+    """Serialize an entry for Redis.
+
+    Integers are stored as such, so that Redis can increment them.
+    """
+    if type(entry.value) is int:
+        return entry.value
+    return pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+
+
+def loads(data):
+    """Deserialize an entry read from Redis."""
+    try:
+        return Entry(int(data), None, 0)
+    except ValueError:
+        return pickle.loads(data)
+
+
+class LocalCache:
+    """A bounded, thread-safe LRU of cache entries.
+
+    Args:
+        max_entries (int): The number of entries kept.
+        timeout (float): The longest an entry is kept, in seconds.
+    """
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        # key -> (entry, expiry as time.monotonic())
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # changes whenever entries are dropped, see set()
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Get an entry, or None if it is missing or expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            entry, expires = item
+            if expires <= time.monotonic() or (
+                entry.expires is not None and entry.expires <= time.time()
+            ):
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, generation=None):
+        """Store an entry, evicting the least recently used ones.
+
+        Args:
+            key (str): The key.
+            entry (Entry): The entry.
+            generation (int, optional): The generation the entry was read
+                at. The entry is not stored if entries were dropped since,
+                as it may be one of them.
+        """
+        timeout = self.timeout
+        if entry.expires is not None:
+            timeout = min(timeout, entry.expires - time.time())
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if timeout <= 0:
+                self._data.pop(key, None)
+                return
+            self._data[key] = (entry, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Drop an entry.
+
+        Returns:
+            bool: True if the entry was cached.
+        """
+        with self._lock:
+            self.generation += 1
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+
+class Tiers:
+    """The tiers of a cache location, shared by all threads of a process.
+
+    Args:
+        location (str): The Redis URL.
+        options (dict): The ``OPTIONS`` of the cache.
+    """
+
+    def __init__(self, location, options):
+        self.location = location
+        self.local = LocalCache(
+            options.get('LOCAL_MAX_ENTRIES', 1000),
+            options.get('LOCAL_TIMEOUT', 10),
+        )
+        self.socket_timeout = options.get('SOCKET_TIMEOUT', 1.0)
+        self.client = redis.Redis.from_url(
+            location,
+            socket_connect_timeout=self.socket_timeout,
+            socket_timeout=self.socket_timeout,
+            connection_class=RedisConnection,
+        )
+        # blocks reading messages, so without a read timeout
+        self.listener_client = redis.Redis.from_url(
+            location,
+            socket_connect_timeout=self.socket_timeout,
+            socket_keepalive=True,
+            health_check_interval=30,
+        )
+        self.channel = options.get('CHANNEL', 'cache:invalidations')
+        self.retry_after = options.get('RETRY_AFTER', 5)
+        self.instance_id = uuid.uuid4().hex
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.available = True
+        self.down_until = 0
+        self.listener_pid = None
+        self._lock = threading.Lock()
+
+    def shared(self, call, default=UNAVAILABLE):
+        """Call Redis, unless it failed less than ``RETRY_AFTER`` ago.
+
+        Args:
+            call (callable): Called with the Redis client.
+            default: Returned if Redis cannot be reached.
+
+        Returns:
+            The result of the call, or ``default``.
+        """
+        if self.listener_pid != os.getpid():
+            self.start_listener()
+        if not self.available and time.monotonic() < self.down_until:
+            return default
+        try:
+            result = call(self.client)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            CACHE_SHARED_ERRORS.inc()
+            if self.available:
+                logger.warning(
+                    'Shared cache unavailable, using the local cache '
+                    'only: %s', e,
+                )
+            self.available = False
+            self.down_until = time.monotonic() + self.retry_after
+            return default
+        if not self.available:
+            logger.info('Shared cache available again')
+            self.available = True
+        return result
+
+    def key_lock(self, key):
+        """Get the lock coalescing the computations of a key."""
+        return self.locks[hash(key) % LOCK_STRIPES]
+
+    def publish(self, pipe, keys):
+        """Add the announcement of changed keys to a pipeline.
+
+        Args:
+            pipe (Pipeline): The pipeline writing the keys.
+            keys (list): The keys, or None if the cache was cleared.
+        """
+        pipe.publish(
+            self.channel,
+            json.dumps({'sender': self.instance_id, 'keys': keys}),
+        )
+
+    def start_listener(self):
+        """Start listening for changes, once per process."""
+        with self._lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.listener_pid = os.getpid()
+            threading.Thread(
+                target=self.listen,
+                args=(self.listener_client,),
+                name='cache-invalidations',
+                daemon=True,
+            ).start()
+
+    def listen(self, client):
+        """Drop the local copies of keys changed by other processes.
+
+        Runs forever, subscribing again after errors.
+
+        Args:
+            client (Redis): The client to subscribe with.
+        """
+        backoff = 1
+        while True:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            subscribed = False
+            try:
+                pubsub.subscribe(self.channel)
+                subscribed = True
+                # changes announced while not subscribed were missed
+                self.local.clear()
+                backoff = 1
+                for message in pubsub.listen():
+                    self.handle_message(message['data'])
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                if subscribed:
+                    logger.warning('Cache invalidations interrupted: %s', e)
+            finally:
+                pubsub.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_LISTEN_BACKOFF)
+
+    def handle_message(self, data):
+        """Drop the local copies of the keys listed in a message."""
+        try:
+            message = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        if message.get('sender') == self.instance_id:
+            return
+        keys = message.get('keys')
+        if keys is None:
+            self.local.clear()
+            return
+        for key in keys:
+            self.local.delete(key)
+        CACHE_INVALIDATIONS.inc(len(keys))
+
+
+def get_tiers(location, options):
+    """Get the tiers of a location, creating them on first use."""
+    tiers = _tiers.get(location)
+    if tiers is None:
+        with _tiers_lock:
+            tiers = _tiers.get(location)
+            if tiers is None:
+                tiers = _tiers[location] = Tiers(location, options)
+    return tiers
+
+
+class TieredCache(BaseCache):
+    """Django cache backend with a local LRU in front of Redis.
+
+    Args:
+        server (str): The Redis URL.
+        params (dict): The cache settings.
+    """
+
+    def __init__(self, server, params):
+        super().__init__(params)
+        if not isinstance(server, str):
+            server = server[0]
+        options = params.get('OPTIONS', {})
+        self.tiers = get_tiers(server, options)
+        self.lock_timeout = options.get('LOCK_TIMEOUT', 10)
+        self.beta = options.get('BETA', 1.0)
+
+    def get_local(self, key, default=None, version=None):
+        """Get a value from the local tier only.
+
+        Lets callers check something cheaper than Redis, like a Bloom
+        filter, before a lookup in Redis.
+        """
+        key = self.make_and_validate_key(key, version=version)
+        entry = self.tiers.local.get(key)
+        record_lookup('local', entry is not None)
+        return default if entry is None else entry.value
+
+    def clear_local(self):
+        """Drop the local tier of this process. Redis is left untouched."""
+        self.tiers.local.clear()
+
+    def _get_entry(self, key):
+        entry = self.tiers.local.get(key)
+        record_lookup('local', entry is not None)
+        if entry is not None:
+            return entry
+        generation = self.tiers.local.generation
+        data = self.tiers.shared(lambda client: client.get(key))
+        if data is UNAVAILABLE:
+            return None
+        record_lookup('shared', data is not None)
+        if data is None:
+            return None
+        entry = loads(data)
+        self.tiers.local.set(key, entry, generation)
+        return entry
+
+    def _store(self, key, entry, nx=False):
+        if entry.expires is not None and entry.expires <= time.time():
+            self._delete([key])
+            return True
+        if nx and self.tiers.local.get(key) is not None:
+            return False
+        px = None
+        if entry.expires is not None:
+            px = max(1, int((entry.expires - time.time()) * 1000))
+
+        def write(client):
+            pipe = client.pipeline(transaction=False)
+            pipe.set(key, dumps(entry), px=px, nx=nx)
+            self.tiers.publish(pipe, [key])
+            return pipe.execute()[0]
+
+        stored = self.tiers.shared(write)
+        if stored is UNAVAILABLE or stored:
+            self.tiers.local.set(key, entry)
+            return True
+        return False
+
+    def _delete(self, keys):
+        def delete(client):
+            pipe = client.pipeline(transaction=False)
+            pipe.delete(*keys)
+            self.tiers.publish(pipe, keys)
+            return pipe.execute()[0]
+
+        deleted = self.tiers.shared(delete)
+        deleted_locally = sum(self.tiers.local.delete(key) for key in keys)
+        if deleted is UNAVAILABLE:
+            return deleted_locally
+        return deleted
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        entry = self._get_entry(key)
+        return default if entry is None else entry.value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._store(key, Entry(value, self.get_backend_timeout(timeout), 0))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._store(
+            key, Entry(value, self.get_backend_timeout(timeout), 0), nx=True
+        )
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        expires = self.get_backend_timeout(timeout)
+        entry = self._get_entry(key)
+        if entry is None:
+            return False
+        # rewrite the entry, so the expiry it carries changes too
+        return self._store(key, entry._replace(expires=expires))
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return bool(self._delete([key]))
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._get_entry(key) is not None
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+
+        def incr(client):
+            if not client.exists(key):
+                return None
+            pipe = client.pipeline(transaction=False)
+            pipe.incrby(key, delta)
+            self.tiers.publish(pipe, [key])
+            return pipe.execute()[0]
+
+        value = self.tiers.shared(incr)
+        if value is UNAVAILABLE:
+            entry = self.tiers.local.get(key)
+            if entry is None:
+                raise ValueError(f"Key '{key}' not found.")
+            value = entry.value + delta
+            self.tiers.local.set(key, entry._replace(value=value))
+            return value
+        if value is None:
+            self.tiers.local.delete(key)
+            raise ValueError(f"Key '{key}' not found.")
+        self.tiers.local.set(key, Entry(value, None, 0))
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = {
+            self.make_and_validate_key(key, version=version): key
+            for key in keys
+        }
+        found = {}
+        missing = []
+        for key, original in keys.items():
+            entry = self.tiers.local.get(key)
+            record_lookup('local', entry is not None)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[original] = entry.value
+        if not missing:
+            return found
+        generation = self.tiers.local.generation
+        values = self.tiers.shared(lambda client: client.mget(missing))
+        if values is UNAVAILABLE:
+            return found
+        for key, data in zip(missing, values):
+            record_lookup('shared', data is not None)
+            if data is not None:
+                entry = loads(data)
+                self.tiers.local.set(key, entry, generation)
+                found[keys[key]] = entry.value
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        entries = {
+            self.make_and_validate_key(key, version=version): Entry(
+                value, expires, 0
+            )
+            for key, value in data.items()
+        }
+        if expires is not None and expires <= time.time():
+            self._delete(list(entries))
+            return []
+        px = None
+        if expires is not None:
+            px = max(1, int((expires - time.time()) * 1000))
+
+        def write(client):
+            pipe = client.pipeline(transaction=False)
+            for key, entry in entries.items():
+                pipe.set(key, dumps(entry), px=px)
+            self.tiers.publish(pipe, list(entries))
+            return pipe.execute()
+
+        self.tiers.shared(write)
+        for key, entry in entries.items():
+            self.tiers.local.set(key, entry)
+        return []
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        if keys:
+            self._delete(keys)
+
+    def clear(self):
+        def clear(client):
+            pipe = client.pipeline(transaction=False)
+            pipe.flushdb()
+            self.tiers.publish(pipe, None)
+            return pipe.execute()
+
+        self.tiers.shared(clear)
+        self.tiers.local.clear()
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        """Get a value, computing and caching it if it is missing.
+
+        If ``default`` is a callable, computations are coalesced and values
+        are computed again shortly before they expire, see the module
+        documentation. Unlike other backends, a computed None is cached.
+        """
+        if not callable(default):
+            return super().get_or_set(key, default, timeout, version)
+        key = self.make_and_validate_key(key, version=version)
+        entry = self._get_entry(key)
+        if entry is not None:
+            if not self._expires_soon(entry):
+                return entry.value
+            return self._refresh(key, entry, default, timeout)
+        with self.tiers.key_lock(key):
+            # another thread may have computed it meanwhile
+            entry = self._get_entry(key)
+            if entry is not None:
+                return entry.value
+            token = self._lock(key)
+            deadline = time.monotonic() + self.lock_timeout
+            while token is None and time.monotonic() < deadline:
+                # another process is computing it
+                time.sleep(LOCK_POLL_INTERVAL)
+                entry = self._get_entry(key)
+                if entry is not None:
+                    return entry.value
+                token = self._lock(key)
+            try:
+                return self._compute(key, default, timeout, 'miss')
+            finally:
+                self._unlock(key, token)
+
+    def _expires_soon(self, entry):
+        # XFetch: recompute when now - delta * beta * ln(rand) >= expiry
+        if entry.expires is None or not entry.delta or not self.beta:
+            return False
+        gap = -entry.delta * self.beta * math.log(1 - random.random())
+        return time.time() + gap >= entry.expires
+
+    def _refresh(self, key, entry, default, timeout):
+        # computed by one caller, the others keep the current value
+        lock = self.tiers.key_lock(key)
+        if not lock.acquire(blocking=False):
+            return entry.value
+        try:
+            token = self._lock(key)
+            if token is None:
+                return entry.value
+            try:
+                return self._compute(key, default, timeout, 'early')
+            finally:
+                self._unlock(key, token)
+        finally:
+            lock.release()
+
+    def _compute(self, key, default, timeout, reason):
+        start = time.monotonic()
+        value = default()
+        delta = time.monotonic() - start
+        CACHE_RECOMPUTES.labels(reason).inc()
+        self._store(key, Entry(value, self.get_backend_timeout(timeout), delta))
+        return value
+
+    def _lock(self, key):
+        """Take the Redis lock computing a key.
+
+        Returns:
+            str: The token of the lock, or None if another process holds
+            it. Without Redis, computations are only coalesced within the
+            process.
+        """
+        token = uuid.uuid4().hex
+        acquired = self.tiers.shared(
+            lambda client: client.set(
+                f'lock:{key}',
+                token,
+                nx=True,
+                px=int(self.lock_timeout * 1000),
+            )
+        )
+        return token if acquired else None
+
+    def _unlock(self, key, token):
+        if token is None:
+            return
+
+        def unlock(client):
+            # only release our own lock, it may have expired and been
+            # taken by another process
+            if client.get(f'lock:{key}') == token.encode():
+                client.delete(f'lock:{key}')
+
+        self.tiers.shared(unlock)
@@ -9,3 +9,6 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myshop.settings')
 app = Celery('myshop')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
+
+# correlation ids and task metrics (connects the Celery signals)
+from . import tracing  # noqa: E402,F401
@@ -0,0 +1,332 @@
+"""
+Synthetic checkout traffic.
+
+Each virtual user browses and buys like a customer: it opens the product
+list, opens one of the products, adds it to the cart, applies a coupon,
+places the order and starts the payment. Stripe then reports the payment
+with a ``checkout.session.completed`` webhook delivery, signed with the
+webhook secret of the shop. Every step is timed, and a failed step ends the
+flow of its user. An unexpected error, in a request or in the work between
+requests, is logged and counted against the step it happened in.
+
+Users arrive as a Poisson process at a given rate, or all at once, and at
+most ``concurrency`` flows run at the same time. Users that arrive while all
+slots are busy wait for one, as they would for a saturated server.
+
+Traffic goes either to a running shop over HTTP (:class:`HTTPSession`) or
+through the Django test client in this process (:class:`ClientSession`).
+Placed orders are found through the database by the e-mail address of
+their user, which is unique per user, so the database must be the one the
+shop uses.
+"""
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.db import close_old_connections, connections
+from django.test import Client
+from django.urls import reverse
+
+from orders.models import Order
+
+from .benchmarks import percentile, sign_event
+
+STEPS = (
+    'product_list',
+    'product_detail',
+    'cart_add',
+    'coupon_apply',
+    'order_create',
+    'payment_process',
+    'webhook',
+)
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_LINK = re.compile(r'href="(/(\d+)/[-\w]+/)"')
+
+
+class StepFailed(Exception):
+    """Raised when a step gets an unexpected response."""
+
+
+class HTTPSession:
+    """A customer browsing a running shop, with its own cookies.
+
+    Args:
+        base_url (str): The URL of the shop, like ``http://localhost:8000``.
+        timeout (float): Seconds to wait for a response.
+    """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None, headers=None):
+        headers = dict(headers or {})
+        token = self.session.cookies.get('csrftoken')
+        if token:
+            headers['X-CSRFToken'] = token
+        response = self.session.request(
+            method,
+            self.base_url + path,
+            data=data,
+            headers=headers,
+            allow_redirects=False,
+            timeout=self.timeout,
+        )
+        return response.status_code, response.text
+
+
+class ClientSession:
+    """A customer browsing the shop in this process through the test
+    client.
+
+    Args:
+        host (str): The host to send in requests, one of ``ALLOWED_HOSTS``.
+    """
+
+    def __init__(self, host='testserver'):
+        self.client = Client(HTTP_HOST=host, raise_request_exception=False)
+
+    def request(self, method, path, data=None, headers=None):
+        headers = dict(headers or {})
+        # close connections around requests, as the request signals of a
+        # server would
+        close_old_connections()
+        try:
+            if method == 'GET':
+                response = self.client.get(path, headers=headers)
+            elif 'Content-Type' in headers:
+                response = self.client.post(
+                    path,
+                    data,
+                    content_type=headers.pop('Content-Type'),
+                    headers=headers,
+                )
+            else:
+                response = self.client.post(path, data, headers=headers)
+        finally:
+            close_old_connections()
+        return response.status_code, response.content.decode()
+
+
+class Recorder:
+    """Collects the latency of every step, across threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+        self.completed = 0
+        self.local = threading.local()
+
+    def prepare(self, name):
+        """Mark the start of a step in the current thread.
+
+        Errors raised before the request of the step has been recorded are
+        counted against it by :meth:`fail`.
+        """
+        self.local.step = name
+
+    def fail(self):
+        """Count an error against the current step of this thread."""
+        with self.lock:
+            self.errors[self.local.step] += 1
+
+    def step(self, session, name, method, path, expected, **kwargs):
+        """Send the request of a step and record its latency.
+
+        Returns:
+            str: The response body.
+
+        Raises:
+            StepFailed: If the response status is not in ``expected``.
+        """
+        self.prepare(name)
+        start = time.perf_counter()
+        try:
+            status, body = session.request(method, path, **kwargs)
+        except requests.RequestException as e:
+            status, body = None, str(e)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            if status in expected:
+                self.latencies[name].append(elapsed)
+            else:
+                self.errors[name] += 1
+        if status not in expected:
+            raise StepFailed(f'{name}: {status}')
+        return body
+
+    def report(self, elapsed):
+        """Summarize the run.
+
+        Args:
+            elapsed (float): The duration of the run in seconds.
+
+        Returns:
+            list: Per step, a dict with the ``step`` name, the number of
+            ``requests`` and ``errors``, the ``throughput`` in requests per
+            second and the ``p50``, ``p95`` and ``p99`` latencies in
+            milliseconds.
+        """
+        rows = []
+        for step in STEPS:
+            latencies = sorted(self.latencies[step])
+            row = {
+                'step': step,
+                'requests': len(latencies),
+                'errors': self.errors[step],
+                'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            }
+            for q in (50, 95, 99):
+                row[f'p{q}'] = (
+                    percentile(latencies, q) * 1000 if latencies else None
+                )
+            rows.append(row)
+        return rows
+
+
+def checkout_flow(
+    session, recorder, user, coupon=None, email_domain='example.com',
+    webhook_secret=None,
+):
+    """Browse, buy and pay as one customer.
+
+    Args:
+        session (HTTPSession or ClientSession): The customer's session.
+        recorder (Recorder): Records the steps.
+        user (int): The number of the user, which makes its e-mail address
+            unique.
+        coupon (str): The coupon code to apply, if any.
+        email_domain (str): The domain of the user's e-mail address.
+        webhook_secret (str): The secret the webhook delivery is signed
+            with, ``STRIPE_WEBHOOK_SECRET`` by default.
+    """
+    body = recorder.step(
+        session, 'product_list', 'GET', reverse('shop:product_list'), {200}
+    )
+    links = PRODUCT_LINK.findall(body)
+    if not links:
+        raise StepFailed('product_list: no products')
+    path, product_id = random.choice(links)
+    recorder.step(session, 'product_detail', 'GET', path, {200})
+    recorder.step(
+        session,
+        'cart_add',
+        'POST',
+        reverse('cart:cart_add', args=[product_id]),
+        {302},
+        data={'quantity': random.randint(1, 3), 'override': False},
+    )
+    if coupon:
+        recorder.step(
+            session,
+            'coupon_apply',
+            'POST',
+            reverse('coupons:apply'),
+            {302},
+            data={'code': coupon},
+        )
+    email = f'load-{user}-{random.randrange(10 ** 9)}@{email_domain}'
+    recorder.step(
+        session,
+        'order_create',
+        'POST',
+        reverse('orders:order_create'),
+        {302},
+        data={
+            'first_name': 'Load',
+            'last_name': f'User {user}',
+            'email': email,
+            'address': '1 Main St',
+            'postal_code': '1000',
+            'city': 'London',
+        },
+    )
+    recorder.step(
+        session, 'payment_process', 'POST', reverse('payment:process'),
+        {302, 303},
+    )
+    recorder.prepare('webhook')
+    order = Order.objects.filter(email=email).order_by('-id').first()
+    close_old_connections()
+    if order is None:
+        raise StepFailed('webhook: order not found in the database')
+    payload, signature = sign_event(order, webhook_secret)
+    recorder.step(
+        session,
+        'webhook',
+        'POST',
+        reverse('payment:stripe-webhook'),
+        {200},
+        data=payload,
+        headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': signature,
+        },
+    )
+    with recorder.lock:
+        recorder.completed += 1
+
+
+def run(
+    make_session,
+    users,
+    concurrency=10,
+    rate=None,
+    coupon=None,
+    email_domain='example.com',
+    webhook_secret=None,
+):
+    """Run checkout flows for a number of users.
+
+    Args:
+        make_session (callable): Returns a new session for each user.
+        users (int): The number of users.
+        concurrency (int): The most flows running at the same time.
+        rate (float): Arrivals per second, or None for all at once.
+        coupon (str): The coupon code users apply, if any.
+        email_domain (str): The domain of the users' e-mail addresses.
+        webhook_secret (str): The secret webhook deliveries are signed
+            with, ``STRIPE_WEBHOOK_SECRET`` by default.
+
+    Returns:
+        tuple: The :class:`Recorder` and the duration of the run in seconds.
+    """
+    recorder = Recorder()
+
+    def flow(user):
+        recorder.prepare(STEPS[0])
+        try:
+            checkout_flow(
+                make_session(),
+                recorder,
+                user,
+                coupon,
+                email_domain,
+                webhook_secret,
+            )
+        except StepFailed:
+            pass
+        except Exception:
+            logger.exception('Checkout flow of user %d failed', user)
+            recorder.fail()
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        arrival = start
+        for user in range(users):
+            if rate:
+                arrival += random.expovariate(rate)
+                time.sleep(max(0.0, arrival - time.perf_counter()))
+            pool.submit(flow, user)
+    return recorder, time.perf_counter() - start
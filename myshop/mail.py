@@ -0,0 +1,440 @@
+"""
+Batched e-mail delivery for order notifications.
+
+Notification tasks hand their messages to :func:`deliver`. When
+``MAIL_BATCHING`` is enabled the message is serialized into a Redis list
+(the outbox) and a periodic Celery task drains it with
+:func:`flush_outbox`, sending each batch over a single SMTP connection.
+Messages that fail are pushed back to the outbox and retried on the next
+flush, up to ``MAIL_MAX_ATTEMPTS`` times, after which they are moved to a
+dead-letter list for inspection. Messages that can never be sent, such as
+ones with an invalid header, are dead-lettered on their first attempt.
+
+A flush moves each batch from the outbox to a processing list and deletes
+it from there only once the batch has been sent, so a worker that dies in
+the middle of a batch does not lose its messages: the next flush puts them
+back at the head of the outbox first. Such messages may be sent twice, but
+none are dropped. A Redis lock lets only one flush run at a time, so one
+flush never requeues the batch another one is still sending.
+
+Queued messages keep the correlation id of the request or task that queued
+them (see ``myshop/tracing.py``) and the time they were queued. The flush
+records how long each message waited in the outbox and how long SMTP took
+to send it, and logs both with the correlation id, so a late invoice can be
+followed from the payment to its delivery.
+"""
+import base64
+import json
+import logging
+import smtplib
+import time
+
+import redis
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from prometheus_client import Counter, Gauge, Histogram
+
+from .metrics import RedisConnection, phase
+from .tracing import get_correlation_id
+
+logger = logging.getLogger(__name__)
+
+# seconds the flush lock is held for each batch; the lock of a flush that
+# died is freed after this
+FLUSH_LOCK_TIMEOUT = 600
+
+# Connect to Redis
+r = redis.Redis(
+    connection_pool=redis.ConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        connection_class=RedisConnection,
+    )
+)
+
+MAIL_MESSAGES = Counter(
+    'myshop_mail_messages_total',
+    'Notification e-mails by delivery outcome.',
+    ['outcome'],
+)
+MAIL_BATCH_SIZE = Histogram(
+    'myshop_mail_batch_size',
+    'Number of messages sent per SMTP connection.',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+MAIL_BATCH_SECONDS = Histogram(
+    'myshop_mail_batch_duration_seconds',
+    'Time spent delivering one batch of messages.',
+)
+MAIL_OUTBOX_WAIT = Histogram(
+    'myshop_mail_outbox_wait_seconds',
+    'Time notification e-mails waited in the outbox before a flush picked '
+    'them up, from when they were first queued.',
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600),
+)
+MAIL_SEND_SECONDS = Histogram(
+    'myshop_mail_send_duration_seconds',
+    'Time SMTP took to send one notification e-mail.',
+)
+MAIL_BATCH_THROUGHPUT = Gauge(
+    'myshop_mail_batch_throughput',
+    'Messages per second delivered by the most recent batch.',
+)
+
+
+def serialize_message(
+    message, attempts=0, correlation_id=None, queued_at=None
+):
+    """Serialize an e-mail message so it can be stored in the outbox.
+
+    Args:
+        message (EmailMessage): The message to serialize.
+        attempts (int): Number of delivery attempts made so far.
+        correlation_id (str, optional): The correlation id of the request or
+            task that queued the message.
+        queued_at (float, optional): When the message was first queued, as a
+            Unix timestamp. Defaults to now.
+
+    Returns:
+        str: A JSON document describing the message.
+    """
+    return json.dumps({
+        'subject': message.subject,
+        'body': message.body,
+        'from_email': message.from_email,
+        'to': list(message.to),
+        'cc': list(message.cc),
+        'bcc': list(message.bcc),
+        'reply_to': list(message.reply_to),
+        'headers': message.extra_headers,
+        'attachments': [
+            [
+                filename,
+                base64.b64encode(content).decode('ascii'),
+                mimetype,
+            ]
+            for filename, content, mimetype in message.attachments
+        ],
+        'attempts': attempts,
+        'correlation_id': correlation_id,
+        'queued_at': time.time() if queued_at is None else queued_at,
+    })
+
+
+def deserialize_message(data):
+    """Rebuild an e-mail message stored in the outbox.
+
+    Args:
+        data (bytes or str): A document produced by :func:`serialize_message`.
+
+    Returns:
+        tuple: The ``EmailMessage`` and a dict with the number of
+        ``attempts`` made so far, the ``correlation_id`` and the
+        ``queued_at`` timestamp of the message.
+    """
+    payload = json.loads(data)
+    message = EmailMessage(
+        payload['subject'],
+        payload['body'],
+        payload['from_email'],
+        payload['to'],
+        cc=payload.get('cc'),
+        bcc=payload.get('bcc'),
+        reply_to=payload.get('reply_to'),
+        headers=payload.get('headers'),
+    )
+    for filename, content, mimetype in payload['attachments']:
+        message.attach(filename, base64.b64decode(content), mimetype)
+    return message, {
+        'attempts': payload['attempts'],
+        # messages queued before these were serialized have neither
+        'correlation_id': payload.get('correlation_id'),
+        'queued_at': payload.get('queued_at'),
+    }
+
+
+def send_batch(messages, connection=None, timings=None, rejected=None):
+    """Send several messages reusing one SMTP connection.
+
+    A failing message does not abort the batch: the connection is reopened
+    and delivery continues with the next message. If the connection cannot
+    be reopened, the remaining messages are reported as failed. Messages
+    that fail with anything other than an SMTP or network error, such as a
+    header that cannot be encoded, are reported as failed and rejected.
+
+    Args:
+        messages (list): The ``EmailMessage`` instances to send.
+        connection: An e-mail backend instance. A new one is created from
+            ``EMAIL_BACKEND`` if not given.
+        timings (dict, optional): Filled with the seconds SMTP took to send
+            each message that was sent, by ``id()`` of the message.
+        rejected (set, optional): Filled with the ``id()`` of the failed
+            messages that can never be sent and should not be retried.
+
+    Returns:
+        tuple: The number of messages sent and the list of failed messages.
+    """
+    if not messages:
+        return 0, []
+    connection = connection or get_connection(fail_silently=False)
+    sent = 0
+    failed = []
+    start = time.monotonic()
+    with phase('smtp'):
+        try:
+            connection.open()
+            for index, message in enumerate(messages):
+                message_start = time.monotonic()
+                try:
+                    sent += connection.send_messages([message])
+                except Exception as e:
+                    if isinstance(e, (smtplib.SMTPException, OSError)):
+                        logger.warning(
+                            'Failed to send e-mail to %s: %s', message.to, e
+                        )
+                    else:
+                        logger.exception(
+                            'Rejected e-mail to %s that cannot be sent',
+                            message.to,
+                        )
+                        if rejected is not None:
+                            rejected.add(id(message))
+                    failed.append(message)
+                    connection.close()
+                    try:
+                        connection.open()
+                    except (smtplib.SMTPException, OSError):
+                        failed.extend(messages[index + 1:])
+                        break
+                else:
+                    seconds = time.monotonic() - message_start
+                    MAIL_SEND_SECONDS.observe(seconds)
+                    if timings is not None:
+                        timings[id(message)] = seconds
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning('Could not open the e-mail connection: %s', e)
+            failed = list(messages)
+        finally:
+            connection.close()
+    elapsed = time.monotonic() - start
+    MAIL_BATCH_SIZE.observe(len(messages))
+    MAIL_BATCH_SECONDS.observe(elapsed)
+    if elapsed > 0:
+        MAIL_BATCH_THROUGHPUT.set(sent / elapsed)
+    MAIL_MESSAGES.labels('sent').inc(sent)
+    return sent, failed
+
+
+def deliver(message):
+    """Deliver a notification e-mail.
+
+    The message is queued in the outbox when ``MAIL_BATCHING`` is enabled,
+    otherwise it is sent right away.
+
+    Args:
+        message (EmailMessage): The message to deliver.
+
+    Returns:
+        int: The number of messages queued or sent.
+    """
+    if settings.MAIL_BATCHING:
+        r.rpush(
+            settings.MAIL_OUTBOX_KEY,
+            serialize_message(message, correlation_id=get_correlation_id()),
+        )
+        MAIL_MESSAGES.labels('queued').inc()
+        return 1
+    sent, failed = send_batch([message])
+    if failed:
+        raise smtplib.SMTPException(f'Could not send e-mail to {message.to}')
+    return sent
+
+
+def log_delivery(message, info, picked_up_at, smtp_seconds):
+    """Log the delivery of a queued message with its correlation id."""
+    if info['queued_at'] is None:
+        waited = 'an unknown time'
+    else:
+        waited = f'{max(0.0, picked_up_at - info["queued_at"]):.3f}s'
+    logger.info(
+        'Sent e-mail to %s for %s after %s in the outbox '
+        '(attempt %d, smtp %.3fs)',
+        message.to,
+        info['correlation_id'],
+        waited,
+        info['attempts'] + 1,
+        smtp_seconds,
+    )
+
+
+def requeue_processing():
+    """Put the messages of an interrupted flush back at the head of the
+    outbox.
+
+    Returns:
+        int: The number of messages put back.
+    """
+    count = 0
+    while r.lmove(
+        settings.MAIL_PROCESSING_KEY, settings.MAIL_OUTBOX_KEY, 'RIGHT', 'LEFT'
+    ):
+        count += 1
+    if count:
+        logger.warning(
+            'Requeued %d e-mails of an interrupted outbox flush', count
+        )
+    return count
+
+
+def take_batch(batch_size):
+    """Move the oldest messages of the outbox to the processing list.
+
+    Args:
+        batch_size (int): The maximum number of messages to take.
+
+    Returns:
+        list: The serialized messages, oldest first.
+    """
+    pipe = r.pipeline()
+    for _ in range(batch_size):
+        pipe.lmove(
+            settings.MAIL_OUTBOX_KEY,
+            settings.MAIL_PROCESSING_KEY,
+            'LEFT',
+            'RIGHT',
+        )
+    return [item for item in pipe.execute() if item is not None]
+
+
+def flush_batches(batch_size, max_batches, stats, lock):
+    """Send batches from the outbox while holding the flush lock.
+
+    Args:
+        batch_size (int): Messages per batch.
+        max_batches (int): Stop after this many batches.
+        stats (dict): The statistics of the flush, updated in place.
+        lock (Lock): The flush lock, extended after every batch.
+    """
+    while stats['batches'] < max_batches:
+        items = take_batch(batch_size)
+        if not items:
+            break
+        # requeued and dead-lettered messages are pushed in the same
+        # transaction that empties the processing list
+        pipe = r.pipeline()
+        entries = []
+        for item in items:
+            try:
+                entries.append(deserialize_message(item))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error('Dead-lettering malformed queued e-mail: %s', e)
+                pipe.rpush(settings.MAIL_DEAD_LETTER_KEY, item)
+                stats['failed'] += 1
+                MAIL_MESSAGES.labels('failed').inc()
+        infos = {id(message): info for message, info in entries}
+        now = time.time()
+        for _, info in entries:
+            if info['queued_at'] is not None:
+                MAIL_OUTBOX_WAIT.observe(max(0.0, now - info['queued_at']))
+        timings = {}
+        rejected = set()
+        sent, failed = send_batch(
+            [message for message, _ in entries],
+            timings=timings,
+            rejected=rejected,
+        )
+        stats['batches'] += 1
+        stats['sent'] += sent
+        for message, info in entries:
+            if id(message) in timings:
+                log_delivery(message, info, now, timings[id(message)])
+        for message in failed:
+            info = infos[id(message)]
+            attempt = info['attempts'] + 1
+            if (
+                attempt >= settings.MAIL_MAX_ATTEMPTS
+                or id(message) in rejected
+            ):
+                key = settings.MAIL_DEAD_LETTER_KEY
+                stats['failed'] += 1
+                MAIL_MESSAGES.labels('failed').inc()
+            else:
+                key = settings.MAIL_OUTBOX_KEY
+                stats['retried'] += 1
+                MAIL_MESSAGES.labels('retried').inc()
+            logger.warning(
+                'E-mail to %s for %s failed on attempt %d',
+                message.to,
+                info['correlation_id'],
+                attempt,
+            )
+            pipe.rpush(
+                key,
+                serialize_message(
+                    message,
+                    attempt,
+                    info['correlation_id'],
+                    info['queued_at'],
+                ),
+            )
+        pipe.delete(settings.MAIL_PROCESSING_KEY)
+        pipe.execute()
+        lock.reacquire()
+        if len(failed) > len(rejected):
+            # retry on the next flush instead of hammering the server
+            break
+
+
+def flush_outbox(batch_size=None, max_batches=None):
+    """Send queued messages in batches, one SMTP connection per batch.
+
+    Messages stay in the processing list until their batch has been sent
+    and the failed ones have been queued again. Nothing is sent if another
+    flush is running.
+
+    Args:
+        batch_size (int, optional): Messages per batch. Defaults to
+            ``MAIL_BATCH_SIZE``.
+        max_batches (int, optional): Stop after this many batches even if the
+            outbox is not empty. Defaults to ``MAIL_FLUSH_MAX_BATCHES``.
+
+    Returns:
+        dict: Delivery statistics for this flush.
+    """
+    batch_size = batch_size or settings.MAIL_BATCH_SIZE
+    max_batches = max_batches or settings.MAIL_FLUSH_MAX_BATCHES
+    stats = {
+        'batches': 0,
+        'sent': 0,
+        'retried': 0,
+        'failed': 0,
+        'seconds': 0.0,
+    }
+    start = time.monotonic()
+    lock = r.lock(settings.MAIL_FLUSH_LOCK_KEY, timeout=FLUSH_LOCK_TIMEOUT)
+    if lock.acquire(blocking=False):
+        try:
+            requeue_processing()
+            flush_batches(batch_size, max_batches, stats, lock)
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                # the lock expired, another flush may have started
+                pass
+    else:
+        logger.info('Mail outbox flush already running, skipping')
+    stats['seconds'] = time.monotonic() - start
+    if stats['seconds'] > 0:
+        stats['rate'] = stats['sent'] / stats['seconds']
+    else:
+        stats['rate'] = 0.0
+    if stats['batches']:
+        logger.info(
+            'Mail outbox flushed: %(sent)d sent, %(retried)d retried, '
+            '%(failed)d failed in %(batches)d batches (%(rate).1f msg/s)',
+            stats,
+        )
+    return stats
+
@@ -0,0 +1,394 @@
+"""
+Per-request performance metrics, exported for Prometheus.
+
+:func:`metrics_middleware` times every request and records, per URL name
+(``shop:product_detail``, ``payment:webhook``, ...):
+
+* the response time, by method and status class,
+* the number of database queries and the time spent in them,
+* the number of Redis round trips and the time spent in them,
+* the time spent rendering templates.
+
+The work of a request is added up in a :class:`Stats` object held in a
+context variable, so it also covers the threads an async view runs its
+sync code in. Queries are timed by a database execute wrapper, Redis
+round trips by the connection class of the Redis clients
+(:class:`RedisConnection` and :class:`AsyncRedisConnection`) and templates
+by the :class:`DjangoTemplates` backend. Outside of a request they only
+check the context variable, and inside one they add a couple of clock
+reads per call, so the metrics can stay on in production.
+
+:func:`metrics_view` serves all metrics of the process to the addresses in
+``METRICS_ALLOWED_IPS``. With ``PROMETHEUS_MULTIPROC_DIR`` set, it serves
+the metrics of all worker processes instead (see the ``prometheus_client``
+documentation on multiprocess mode).
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import redis
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template import TemplateDoesNotExist
+from django.template.backends import django as django_backend
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from redis.asyncio import connection as async_connection
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+REQUEST_SECONDS = Histogram(
+    'myshop_http_request_duration_seconds',
+    'Time to respond to a request, by view.',
+    ['view', 'method', 'status'],
+)
+REQUEST_DB_QUERIES = Histogram(
+    'myshop_http_db_queries',
+    'Database queries per request, by view.',
+    ['view'],
+    buckets=COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    'myshop_http_db_duration_seconds',
+    'Time spent in database queries per request, by view.',
+    ['view'],
+)
+REQUEST_REDIS_CALLS = Histogram(
+    'myshop_http_redis_calls',
+    'Redis round trips per request, by view.',
+    ['view'],
+    buckets=COUNT_BUCKETS,
+)
+REQUEST_REDIS_SECONDS = Histogram(
+    'myshop_http_redis_duration_seconds',
+    'Time spent waiting on Redis per request, by view.',
+    ['view'],
+)
+REQUEST_TEMPLATE_SECONDS = Histogram(
+    'myshop_http_template_duration_seconds',
+    'Time spent rendering templates per request, by view.',
+    ['view'],
+)
+
+# view label of requests that did not match a URL pattern
+UNRESOLVED = '<unresolved>'
+
+_stats = ContextVar('metrics_stats', default=None)
+
+
+class Stats:
+    """The work done by a request, or by any block run in :func:`tracking`.
+    """
+
+    __slots__ = (
+        'db_queries',
+        'db_seconds',
+        'redis_calls',
+        'redis_seconds',
+        'template_seconds',
+        'rendering',
+        'phases',
+        'log',
+    )
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.redis_calls = 0
+        self.redis_seconds = 0.0
+        self.template_seconds = 0.0
+        # templates rendered by templates are timed with their parent
+        self.rendering = False
+        # seconds spent in other named phases, see phase()
+        self.phases = {}
+        # [kind, statement, seconds] of every query and Redis round trip,
+        # when a profiler asks for them (see myshop/profiling.py)
+        self.log = None
+
+
+def get_stats():
+    """Get the stats of the current request, or None outside of one."""
+    return _stats.get()
+
+
+@contextmanager
+def tracking():
+    """Add up the queries, Redis calls and renders of the enclosed block.
+
+    Yields:
+        Stats: The stats of the block.
+    """
+    stats = Stats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the enclosed block to a named phase of the
+    current request or task, like ``pdf`` or ``smtp``."""
+    stats = _stats.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[name] = (
+            stats.phases.get(name, 0.0) + time.perf_counter() - start
+        )
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper timing the queries of a request."""
+    stats = _stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        stats.db_queries += 1
+        stats.db_seconds += seconds
+        if stats.log is not None:
+            stats.log.append(['sql', sql, seconds])
+
+
+def add_query_wrapper(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def connection_created_handler(sender, connection, **kwargs):
+    """Time the queries of every new database connection."""
+    add_query_wrapper(connection)
+
+
+def install_query_wrappers():
+    """Time the queries of the connections of this thread, including the
+    ones opened before this module was imported."""
+    for connection in connections.all(initialized_only=True):
+        add_query_wrapper(connection)
+
+
+def log_response(stats, seconds):
+    """Add the time waiting for a Redis response to its command in the log.
+    """
+    if stats.log:
+        for entry in reversed(stats.log):
+            if entry[0] == 'redis':
+                entry[2] += seconds
+                break
+
+
+def describe_command(packed, max_args=2, max_length=60):
+    """Describe packed Redis commands, like ``GET myshop:1:key``.
+
+    Args:
+        packed (bytes or list): Commands in the Redis protocol, as sent by
+            a connection.
+        max_args (int): The most arguments to show per command.
+        max_length (int): The most characters to show per argument.
+
+    Returns:
+        str: The commands, separated by ``; ``.
+    """
+    if not isinstance(packed, (bytes, bytearray)):
+        packed = b''.join(bytes(chunk) for chunk in packed)
+    commands = []
+    pos = 0
+    try:
+        while pos < len(packed):
+            end = packed.index(b'\r\n', pos)
+            count = int(packed[pos + 1:end])
+            pos = end + 2
+            args = []
+            for _ in range(count):
+                end = packed.index(b'\r\n', pos)
+                length = int(packed[pos + 1:end])
+                pos = end + 2
+                args.append(packed[pos:pos + length])
+                pos += length + 2
+            commands.append(' '.join(
+                arg[:max_length].decode(errors='replace')
+                for arg in args[:max_args + 1]
+            ))
+    except ValueError:
+        commands.append('...')
+    return '; '.join(commands)
+
+
+class RedisConnection(redis.Connection):
+    """Redis connection counting round trips of the current request.
+
+    A pipeline is one round trip.
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        stats = _stats.get()
+        if stats is None:
+            return super().send_packed_command(command, check_health)
+        start = time.perf_counter()
+        try:
+            return super().send_packed_command(command, check_health)
+        finally:
+            seconds = time.perf_counter() - start
+            stats.redis_calls += 1
+            stats.redis_seconds += seconds
+            if stats.log is not None:
+                # described when the log is saved, see describe_command()
+                stats.log.append(['redis', command, seconds])
+
+    def read_response(self, *args, **kwargs):
+        stats = _stats.get()
+        if stats is None:
+            return super().read_response(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().read_response(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            stats.redis_seconds += seconds
+            log_response(stats, seconds)
+
+
+class AsyncRedisConnection(async_connection.Connection):
+    """asyncio version of :class:`RedisConnection`."""
+
+    async def send_packed_command(self, command, check_health=True):
+        stats = _stats.get()
+        if stats is None:
+            return await super().send_packed_command(command, check_health)
+        start = time.perf_counter()
+        try:
+            return await super().send_packed_command(command, check_health)
+        finally:
+            seconds = time.perf_counter() - start
+            stats.redis_calls += 1
+            stats.redis_seconds += seconds
+            if stats.log is not None:
+                # described when the log is saved, see describe_command()
+                stats.log.append(['redis', command, seconds])
+
+    async def read_response(self, *args, **kwargs):
+        stats = _stats.get()
+        if stats is None:
+            return await super().read_response(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await super().read_response(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            stats.redis_seconds += seconds
+            log_response(stats, seconds)
+
+
+class Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        stats = _stats.get()
+        if stats is None or stats.rendering:
+            return super().render(context, request)
+        stats.rendering = True
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            stats.template_seconds += time.perf_counter() - start
+            stats.rendering = False
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing renders of the current request.
+    """
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+def observe(request, response, stats, seconds):
+    """Record the metrics of a finished request."""
+    match = request.resolver_match
+    view = match.view_name if match else UNRESOLVED
+    status = f'{response.status_code // 100}xx'
+    REQUEST_SECONDS.labels(view, request.method, status).observe(seconds)
+    REQUEST_DB_QUERIES.labels(view).observe(stats.db_queries)
+    REQUEST_DB_SECONDS.labels(view).observe(stats.db_seconds)
+    REQUEST_REDIS_CALLS.labels(view).observe(stats.redis_calls)
+    REQUEST_REDIS_SECONDS.labels(view).observe(stats.redis_seconds)
+    REQUEST_TEMPLATE_SECONDS.labels(view).observe(stats.template_seconds)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record the performance metrics of every request.
+
+    Should come first in ``MIDDLEWARE``, so the time spent in the other
+    middleware is included.
+
+    Args:
+        get_response (callable): The next middleware or view.
+
+    Returns:
+        callable: The middleware.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            with tracking() as stats:
+                response = await get_response(request)
+            observe(request, response, stats, time.perf_counter() - start)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            install_query_wrappers()
+            with tracking() as stats:
+                response = get_response(request)
+            observe(request, response, stats, time.perf_counter() - start)
+            return response
+    return middleware
+
+
+def metrics_view(request):
+    """Serve the metrics in the Prometheus text format.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: The metrics, or a 403 response for addresses not in
+        ``METRICS_ALLOWED_IPS``.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,90 @@
+"""
+Estimated row counts for the admin of large tables.
+
+Django's paginator counts the rows of a changelist with ``COUNT(*)`` to
+number its pages, which reads the whole table, or every row the filters
+match, on each page load. :class:`EstimatedCountPaginator` takes the number
+of rows from the statistics the database keeps for its query planner
+instead:
+
+* on PostgreSQL, the number of rows the planner expects the query to
+  return, read with ``EXPLAIN``, with or without filters;
+* on SQLite, the number of rows of the table recorded by ``ANALYZE`` in
+  ``sqlite_stat1``, for unfiltered lists only.
+
+Estimates below ``ADMIN_COUNT_ESTIMATE_THRESHOLD`` rows, and lists that
+cannot be estimated, are counted exactly, so small tables and narrow
+filters still show exact numbers. Estimates are as fresh as the planner
+statistics: the last page can be short or empty, and going past it
+redirects to the first page as for any invalid page number.
+"""
+import json
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils.functional import cached_property
+
+
+def explain_rows(queryset):
+    """Return the number of rows PostgreSQL expects a queryset to return."""
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def analyzed_rows(queryset):
+    """Return the number of rows of a table recorded by SQLite's
+    ``ANALYZE``, or None if it has not been analyzed."""
+    table = queryset.model._meta.db_table
+    try:
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(
+                'SELECT stat FROM sqlite_stat1 WHERE tbl = %s', [table]
+            )
+            rows = [int(stat.split()[0]) for stat, in cursor.fetchall()]
+    except DatabaseError:
+        # no table has been analyzed yet
+        return None
+    return max(rows, default=None)
+
+
+def estimate_count(queryset):
+    """Estimate the number of objects of a queryset.
+
+    Args:
+        queryset (QuerySet): The queryset to estimate.
+
+    Returns:
+        int: The estimate, or None if the database cannot estimate it.
+    """
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        return explain_rows(queryset)
+    if vendor == 'sqlite' and not queryset.query.where:
+        return analyzed_rows(queryset)
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that estimates the number of objects of large querysets.
+
+    Used by the changelists of tables with millions of rows, together with
+    ``show_full_result_count = False`` so the admin does not count the
+    unfiltered table either.
+    """
+
+    @cached_property
+    def count(self):
+        """Return the estimated number of objects, or the exact number if
+        the estimate is below ``ADMIN_COUNT_ESTIMATE_THRESHOLD``."""
+        if hasattr(self.object_list, 'query'):
+            estimate = estimate_count(self.object_list)
+            threshold = settings.ADMIN_COUNT_ESTIMATE_THRESHOLD
+            if estimate is not None and estimate >= threshold:
+                return estimate
+        return super().count
@@ -0,0 +1,384 @@
+"""
+Sampling profiles of slow requests.
+
+:func:`profiling_middleware` keeps a profile of a random
+``PROFILE_SAMPLE_RATE`` fraction of requests, and of every request that
+takes ``PROFILE_SLOW_SECONDS`` or more. With both settings at 0, the
+default, the middleware removes itself and costs nothing.
+
+While a request runs, a background thread records the stack of the thread
+handling it every ``PROFILE_INTERVAL`` seconds, and the SQL statements and
+Redis commands of the request are logged with their timings (see
+``Stats.log`` in ``myshop/metrics.py``). When the request finishes, the
+profile is kept or dropped. Since the decision is taken at the end, slow
+requests are profiled from their first line. Async views are sampled on
+the thread of the event loop, so a sample may belong to another request
+running on the same loop.
+
+Profiles are JSON files in ``PROFILE_DIR``, which keeps the newest
+``PROFILE_MAX_FILES`` of them. Staff members can browse them at
+``/admin/profiles/``, as flame graphs, or download their stacks in the
+folded format of ``flamegraph.pl`` and speedscope.
+"""
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+from django.utils import timezone
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# deepest stack recorded, from the innermost frame
+MAX_DEPTH = 128
+# most queries and Redis commands kept per profile
+MAX_STATEMENTS = 1000
+# narrowest frame drawn in the flame graph, in % of the samples
+MIN_WIDTH = 0.2
+
+PROFILE_ID = re.compile(r'^\d{13}-[0-9a-f]{8}$')
+
+
+class Profile:
+    """The samples of one request."""
+
+    def __init__(self, thread_id, sampled):
+        self.thread_id = thread_id
+        # kept whatever the duration of the request
+        self.sampled = sampled
+        self.stacks = Counter()
+        self.start = time.perf_counter()
+
+
+def get_frame_name(frame):
+    """Name a frame ``function (path:line)``, with paths relative to the
+    project or to site-packages."""
+    code = frame.f_code
+    filename = code.co_filename
+    base_dir = str(settings.BASE_DIR)
+    if filename.startswith(base_dir):
+        filename = filename[len(base_dir) + 1:]
+    elif 'site-packages' in filename:
+        filename = filename.split('site-packages', 1)[1].lstrip(os.sep)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'
+
+
+def fold(frame):
+    """Get the stack of a frame in the folded format, outermost first."""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """Records the stacks of the threads running profiled requests.
+
+    The sampling thread is started with the first profile and sleeps while
+    there is none.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.wakeup = threading.Event()
+        self.pid = None
+
+    def add(self, profile):
+        with self.lock:
+            if self.pid != os.getpid():
+                # first profile in this process
+                self.pid = os.getpid()
+                thread = threading.Thread(
+                    target=self.run, name='profiler', daemon=True
+                )
+                thread.start()
+            self.profiles[id(profile)] = profile
+            self.wakeup.set()
+
+    def remove(self, profile):
+        with self.lock:
+            self.profiles.pop(id(profile), None)
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            frames = sys._current_frames()
+            # under the lock, so removed profiles are not changed any more
+            with self.lock:
+                if not self.profiles:
+                    self.wakeup.clear()
+                for profile in self.profiles.values():
+                    frame = frames.get(profile.thread_id)
+                    if frame is not None:
+                        profile.stacks[fold(frame)] += 1
+            del frames
+            time.sleep(settings.PROFILE_INTERVAL)
+
+
+sampler = Sampler()
+
+
+def get_profile_dir():
+    path = Path(settings.PROFILE_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def save_profile(data):
+    """Write a profile and drop the oldest ones beyond
+    ``PROFILE_MAX_FILES``.
+
+    Returns:
+        str: The ID of the profile.
+    """
+    profile_dir = get_profile_dir()
+    profile_id = f'{time.time_ns() // 1_000_000:013d}-{uuid.uuid4().hex[:8]}'
+    data['id'] = profile_id
+    tmp = profile_dir / f'.{profile_id}.tmp'
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, profile_dir / f'{profile_id}.json')
+    for old in sorted(profile_dir.glob('*.json'))[:-settings.PROFILE_MAX_FILES]:
+        # another process may have removed it first
+        old.unlink(missing_ok=True)
+    return profile_id
+
+
+def load_profile(profile_id):
+    """Read a profile, or return None if it does not exist (any more)."""
+    if not PROFILE_ID.match(profile_id):
+        return None
+    try:
+        return json.loads(
+            (get_profile_dir() / f'{profile_id}.json').read_text()
+        )
+    except FileNotFoundError:
+        return None
+
+
+def list_profiles():
+    """Get the saved profiles, newest first."""
+    profiles = []
+    for path in sorted(get_profile_dir().glob('*.json'), reverse=True):
+        profile = load_profile(path.stem)
+        if profile is not None:
+            profiles.append(profile)
+    return profiles
+
+
+def begin(request):
+    """Start profiling a request.
+
+    Returns:
+        Profile: The profile of the request.
+    """
+    profile = Profile(
+        threading.get_ident(),
+        random.random() < settings.PROFILE_SAMPLE_RATE,
+    )
+    stats = metrics.get_stats()
+    if stats is not None:
+        stats.log = []
+    sampler.add(profile)
+    return profile
+
+
+def finish(profile, request, response):
+    """Stop profiling a request, and save the profile if the request was
+    sampled or slow."""
+    sampler.remove(profile)
+    seconds = time.perf_counter() - profile.start
+    slow = settings.PROFILE_SLOW_SECONDS
+    if profile.sampled:
+        reason = 'sampled'
+    elif slow and seconds >= slow:
+        reason = 'slow'
+    else:
+        return
+    stats = metrics.get_stats()
+    log = (stats.log or []) if stats is not None else []
+    match = request.resolver_match
+    data = {
+        'time': timezone.now().isoformat(),
+        'method': request.method,
+        'path': request.get_full_path(),
+        'view': match.view_name if match else metrics.UNRESOLVED,
+        'status': response.status_code,
+        'seconds': seconds,
+        'reason': reason,
+        'interval': settings.PROFILE_INTERVAL,
+        'stacks': dict(profile.stacks),
+        'sql': [
+            [statement, elapsed]
+            for kind, statement, elapsed in log[:MAX_STATEMENTS]
+            if kind == 'sql'
+        ],
+        'redis': [
+            [metrics.describe_command(statement), elapsed]
+            for kind, statement, elapsed in log[:MAX_STATEMENTS]
+            if kind == 'redis'
+        ],
+    }
+    try:
+        save_profile(data)
+    except OSError as e:
+        logger.warning('Could not save the profile of %s: %s', data['path'], e)
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """Profile a sample of the requests and the slow ones.
+
+    Should come right after the metrics middleware, whose stats log the
+    queries and Redis commands of the request.
+
+    Args:
+        get_response (callable): The next middleware or view.
+
+    Returns:
+        callable: The middleware.
+
+    Raises:
+        MiddlewareNotUsed: If profiling is disabled.
+    """
+    if not settings.PROFILE_SAMPLE_RATE and not settings.PROFILE_SLOW_SECONDS:
+        raise MiddlewareNotUsed
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            profile = begin(request)
+            try:
+                response = await get_response(request)
+            except BaseException:
+                sampler.remove(profile)
+                raise
+            finish(profile, request, response)
+            return response
+    else:
+        def middleware(request):
+            profile = begin(request)
+            try:
+                response = get_response(request)
+            except BaseException:
+                sampler.remove(profile)
+                raise
+            finish(profile, request, response)
+            return response
+    return middleware
+
+
+def get_flame_graph(stacks):
+    """Lay out folded stacks as the rectangles of a flame graph.
+
+    Args:
+        stacks (dict): Sample counts by folded stack.
+
+    Returns:
+        tuple: The rectangles, as dicts with the frame ``name``, its
+        ``depth``, its ``left`` offset and ``width`` in % and its
+        ``samples``, and the depth of the deepest stack.
+    """
+    total = sum(stacks.values())
+    root = {'children': {}, 'samples': 0}
+    for stack, samples in stacks.items():
+        node = root
+        for name in stack.split(';'):
+            node = node['children'].setdefault(
+                name, {'children': {}, 'samples': 0}
+            )
+            node['samples'] += samples
+    rects = []
+    depth = 0
+    pending = [(root['children'], 0, 0.0)]
+    while pending:
+        children, level, left = pending.pop()
+        for name, node in sorted(children.items()):
+            width = node['samples'] * 100 / total
+            if width >= MIN_WIDTH:
+                rects.append({
+                    'name': name,
+                    'depth': level,
+                    'left': left,
+                    'width': width,
+                    'samples': node['samples'],
+                })
+                depth = max(depth, level + 1)
+                pending.append((node['children'], level + 1, left))
+            left += width
+    return rects, depth
+
+
+@staff_member_required
+def profile_list(request):
+    """
+    List the saved request profiles.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: Renders the profile list.
+    """
+    return render(
+        request,
+        'admin/profiles/list.html',
+        {'profiles': list_profiles()},
+    )
+
+
+@staff_member_required
+def profile_detail(request, profile_id):
+    """
+    Show a request profile as a flame graph, with its SQL statements and
+    Redis commands.
+
+    With ``?format=folded`` the stacks are returned in the folded format,
+    one stack and its sample count per line.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        profile_id (str): The ID of the profile.
+
+    Returns:
+        HttpResponse: Renders the profile, or the folded stacks.
+    """
+    profile = load_profile(profile_id)
+    if profile is None:
+        raise Http404('Profile not found.')
+    if request.GET.get('format') == 'folded':
+        return HttpResponse(
+            ''.join(
+                f'{stack} {samples}\n'
+                for stack, samples in profile['stacks'].items()
+            ),
+            content_type='text/plain; charset=utf-8',
+        )
+    rects, depth = get_flame_graph(profile['stacks'])
+    return render(
+        request,
+        'admin/profiles/detail.html',
+        {
+            'profile': profile,
+            'rects': rects,
+            'height': depth * 18,
+            'samples': sum(profile['stacks'].values()),
+            'sql_seconds': sum(seconds for _, seconds in profile['sql']),
+            'redis_seconds': sum(seconds for _, seconds in profile['redis']),
+        },
+    )
@@ -0,0 +1,165 @@
+"""
+Routing of read queries to read replicas.
+
+Reads go to the primary database unless they run inside
+:func:`reading_from_replicas`, which the read-only storefront views and the
+admin reports opt into with the :func:`replica_reads` decorator. Even
+there, reads stay on the primary when:
+
+* the primary has an open transaction, whose writes the replicas have not
+  seen yet,
+* the current request has written to the database, or
+* the client wrote to the database less than ``DB_REPLICA_PIN_SECONDS``
+  ago. :func:`pin_primary_middleware` remembers this in a cookie, so for
+  example the payment page reads the order created by the previous request
+  from the primary.
+
+Replicas are the database aliases listed in ``DATABASE_REPLICAS``. With no
+replicas configured every query goes to the primary.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.decorators import sync_and_async_middleware
+
+PIN_COOKIE = 'db_pin'
+
+# apps whose writes do not pin reads to the primary
+UNPINNED_APPS = {'sessions'}
+
+_replica_reads = ContextVar('replica_reads', default=False)
+# {'pinned': bool, 'wrote': bool} for the current request
+_request_state = ContextVar('db_request_state', default=None)
+
+
+@contextmanager
+def reading_from_replicas():
+    """Let the reads of the enclosed block go to a replica."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_reads(view):
+    """Decorate a read-only view so its reads may go to a replica.
+
+    Works with sync and async views. The response is rendered inside the
+    block, so lazy querysets evaluated by templates are covered too.
+
+    Args:
+        view (callable): The view function.
+
+    Returns:
+        callable: The decorated view.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            with reading_from_replicas():
+                return await view(*args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with reading_from_replicas():
+                response = view(*args, **kwargs)
+                if hasattr(response, 'render'):
+                    response.render()
+                return response
+    return wrapper
+
+
+class ReplicaRouter:
+    """Send reads to a random replica where allowed, everything else to the
+    primary."""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas or not _replica_reads.get():
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        state = _request_state.get()
+        if state and (state['pinned'] or state['wrote']):
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None and model._meta.app_label not in UNPINNED_APPS:
+            state['wrote'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas are migrated by replication
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+def begin_request(request):
+    """Start tracking the writes of a request.
+
+    Returns:
+        tuple: The request state and the token to reset it.
+    """
+    state = {'pinned': PIN_COOKIE in request.COOKIES, 'wrote': False}
+    return state, _request_state.set(state)
+
+
+def finish_request(state, token, response):
+    """Stop tracking writes and pin the client if the request wrote."""
+    _request_state.reset(token)
+    if state['wrote'] and settings.DATABASE_REPLICAS:
+        response.set_cookie(
+            PIN_COOKIE,
+            '1',
+            max_age=settings.DB_REPLICA_PIN_SECONDS,
+            httponly=True,
+            samesite='Lax',
+        )
+    return response
+
+
+@sync_and_async_middleware
+def pin_primary_middleware(get_response):
+    """Keep the reads of a client on the primary for a while after a write.
+
+    Args:
+        get_response (callable): The next middleware or view.
+
+    Returns:
+        callable: The middleware.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            state, token = begin_request(request)
+            try:
+                response = await get_response(request)
+            except BaseException:
+                _request_state.reset(token)
+                raise
+            return finish_request(state, token, response)
+    else:
+        def middleware(request):
+            state, token = begin_request(request)
+            try:
+                response = get_response(request)
+            except BaseException:
+                _request_state.reset(token)
+                raise
+            return finish_request(state, token, response)
+    return middleware
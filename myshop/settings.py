@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,11 +44,16 @@ INSTALLED_APPS = [
     'orders.apps.OrdersConfig',
     'payment.apps.PaymentConfig',
      'coupons.apps.CouponsConfig',
+    'analytics.apps.AnalyticsConfig',
     
 ]
 
 MIDDLEWARE = [
+    "myshop.metrics.metrics_middleware",
+    "myshop.profiling.profiling_middleware",
+    "myshop.tracing.correlation_middleware",
     "django.middleware.security.SecurityMiddleware",
+    "myshop.replicas.pin_primary_middleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -61,7 +66,8 @@ ROOT_URLCONF = "myshop.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # times renders for the request metrics (see myshop/metrics.py)
+        "BACKEND": "myshop.metrics.DjangoTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -78,16 +84,110 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "myshop.wsgi.application"
 
+# Serve the storefront and payment views that wait on Redis and Stripe with
+# their async versions. Only useful when running under ASGI (myshop.asgi).
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)
+
+# Addresses allowed to scrape /metrics (see myshop/metrics.py)
+METRICS_ALLOWED_IPS = config(
+    'METRICS_ALLOWED_IPS', default='127.0.0.1,::1', cast=Csv()
+)
+
+# Sampling profiles of requests (see myshop/profiling.py), off while both
+# the sample rate and the slow request threshold are 0
+PROFILE_SAMPLE_RATE = config('PROFILE_SAMPLE_RATE', default=0.0, cast=float)
+PROFILE_SLOW_SECONDS = config('PROFILE_SLOW_SECONDS', default=0.0, cast=float)
+PROFILE_INTERVAL = config('PROFILE_INTERVAL', default=0.005, cast=float)
+PROFILE_DIR = config('PROFILE_DIR', default=str(BASE_DIR / 'profiles'))
+PROFILE_MAX_FILES = config('PROFILE_MAX_FILES', default=200, cast=int)
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# SQLite by default for development. For production set DB_ENGINE to
+# django.db.backends.postgresql and the DB_* connection variables. Set
+# DB_PGBOUNCER=True when connecting through PgBouncer in transaction
+# pooling mode (see docker-compose.yml).
+DB_ENGINE = config('DB_ENGINE', default='myshop.backends.sqlite3')
+
+if DB_ENGINE.endswith('sqlite3'):
+    DATABASES = {
+        "default": {
+            "ENGINE": DB_ENGINE,
+            "NAME": config('DB_NAME', default=str(BASE_DIR / "db.sqlite3")),
+            "OPTIONS": {
+                # seconds to wait for the write lock before failing
+                "timeout": config('DB_SQLITE_TIMEOUT', default=20, cast=float),
+            },
+            # a file, so tests running several threads share the test database
+            "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+        }
     }
-}
+    if DB_ENGINE == 'myshop.backends.sqlite3':
+        # WAL journal and BEGIN IMMEDIATE (see myshop/backends/sqlite3)
+        DATABASES["default"]["OPTIONS"].update({
+            "journal_mode": config('DB_SQLITE_JOURNAL_MODE', default='wal'),
+            "synchronous": config('DB_SQLITE_SYNCHRONOUS', default='normal'),
+            "transaction_mode": config(
+                'DB_SQLITE_TRANSACTION_MODE', default='IMMEDIATE'
+            ),
+        })
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": DB_ENGINE,
+            "NAME": config('DB_NAME', default='myshop'),
+            "USER": config('DB_USER', default='myshop'),
+            "PASSWORD": config('DB_PASSWORD', default=''),
+            "HOST": config('DB_HOST', default='localhost'),
+            "PORT": config('DB_PORT', default=''),
+            # PgBouncer in transaction mode cannot keep server-side cursors
+            # open between transactions
+            "DISABLE_SERVER_SIDE_CURSORS": config(
+                'DB_PGBOUNCER', default=False, cast=bool
+            ),
+        }
+    }
+
+# Keep connections open between requests for this many seconds (None for
+# no limit, 0 to close them after each request). Under ASGI use 0 and rely
+# on PgBouncer, as persistent connections are not reused across requests.
+DATABASES["default"]["CONN_MAX_AGE"] = config(
+    'DB_CONN_MAX_AGE',
+    default='60',
+    cast=lambda value: None if value.lower() == 'none' else int(value),
+)
+# check persistent connections before reusing them in a new request
+DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+
+# Read replicas for the storefront and admin reports (see
+# myshop/replicas.py): comma-separated hosts for PostgreSQL, or database
+# files for SQLite. Tests run them against the default test database.
+DATABASE_REPLICAS = []
+for n, replica in enumerate(config('DB_REPLICAS', default='', cast=Csv()), 1):
+    alias = f'replica{n}'
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "OPTIONS": dict(DATABASES["default"].get("OPTIONS", {})),
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASES[alias]["NAME" if DB_ENGINE.endswith('sqlite3') else "HOST"] = (
+        replica
+    )
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['myshop.replicas.ReplicaRouter']
+
+# Seconds a client keeps reading from the primary after a write, longer
+# than the replication lag
+DB_REPLICA_PIN_SECONDS = config('DB_REPLICA_PIN_SECONDS', default=5, cast=int)
+
+# Admin lists estimated to hold more rows show estimated counts (see
+# myshop/pagination.py)
+ADMIN_COUNT_ESTIMATE_THRESHOLD = config(
+    'ADMIN_COUNT_ESTIMATE_THRESHOLD', default=100000, cast=int
+)
 
 
 # Password validation
@@ -140,15 +240,130 @@ MEDIA_ROOT = BASE_DIR / 'media'
 CART_SESSION_ID = 'cart'
 
 
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+EMAIL_BACKEND = config(
+    'EMAIL_BACKEND',
+    default='django.core.mail.backends.console.EmailBackend',
+)
+EMAIL_HOST = config('EMAIL_HOST', default='localhost')
+EMAIL_PORT = config('EMAIL_PORT', default=25, cast=int)
+EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='')
+EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
+EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=False, cast=bool)
+EMAIL_TIMEOUT = config('EMAIL_TIMEOUT', default=10, cast=int)
+
+# Batched notification delivery (see myshop/mail.py)
+MAIL_BATCHING = config('MAIL_BATCHING', default=True, cast=bool)
+MAIL_BATCH_SIZE = config('MAIL_BATCH_SIZE', default=100, cast=int)
+MAIL_FLUSH_INTERVAL = config('MAIL_FLUSH_INTERVAL', default=10.0, cast=float)
+MAIL_FLUSH_MAX_BATCHES = config('MAIL_FLUSH_MAX_BATCHES', default=50, cast=int)
+MAIL_MAX_ATTEMPTS = config('MAIL_MAX_ATTEMPTS', default=5, cast=int)
+MAIL_OUTBOX_KEY = 'mail:outbox'
+MAIL_DEAD_LETTER_KEY = 'mail:dead'
+MAIL_PROCESSING_KEY = 'mail:processing'
+MAIL_FLUSH_LOCK_KEY = 'mail:flush-lock'
+
+# Seconds stock is held for an unpaid order (see shop/inventory.py).
+# Stripe checkout sessions expire 5 to 6 minutes earlier and must last at
+# least 30 minutes, so keep this above 36 minutes.
+STOCK_RESERVATION_TIMEOUT = config(
+    'STOCK_RESERVATION_TIMEOUT', default=3600, cast=int
+)
+
+# Rendered product listings, also refreshed whenever the catalog changes
+# (see shop/catalog.py)
+PRODUCT_LIST_CACHE_TIMEOUT = config(
+    'PRODUCT_LIST_CACHE_TIMEOUT', default=600, cast=int
+)
+# Product and category lookups, kept per catalog version (see shop/catalog.py)
+PRODUCT_CACHE_TIMEOUT = config('PRODUCT_CACHE_TIMEOUT', default=600, cast=int)
+
+# Images of products imported from catalog feeds (see shop/images.py)
+PRODUCT_IMAGE_TIMEOUT = config('PRODUCT_IMAGE_TIMEOUT', default=10, cast=int)
+PRODUCT_IMAGE_MAX_BYTES = config(
+    'PRODUCT_IMAGE_MAX_BYTES', default=5 * 1024 * 1024, cast=int
+)
+PRODUCT_THUMBNAIL_SIZE = config('PRODUCT_THUMBNAIL_SIZE', default=300, cast=int)
+
+# Coupon lookup cache (see coupons/cache.py)
+COUPON_CACHE_TIMEOUT = config('COUPON_CACHE_TIMEOUT', default=300, cast=int)
+COUPON_NEGATIVE_CACHE_TIMEOUT = config(
+    'COUPON_NEGATIVE_CACHE_TIMEOUT', default=30, cast=int
+)
+# Counter rows the redemption cap of a coupon is split across
+COUPON_REDEMPTION_SHARDS = config(
+    'COUPON_REDEMPTION_SHARDS', default=16, cast=int
+)
+# Bloom filter rejecting unknown codes (see coupons/bloom.py)
+COUPON_BLOOM_FILTER = config('COUPON_BLOOM_FILTER', default=True, cast=bool)
+COUPON_BLOOM_KEY = 'coupons:bloom'
+COUPON_BLOOM_CAPACITY = config(
+    'COUPON_BLOOM_CAPACITY', default=1000000, cast=int
+)
+COUPON_BLOOM_ERROR_RATE = config(
+    'COUPON_BLOOM_ERROR_RATE', default=0.001, cast=float
+)
+
+# Task events for Flower (celery -A myshop flower)
+CELERY_WORKER_SEND_TASK_EVENTS = True
+CELERY_TASK_SEND_SENT_EVENT = True
+# Port the workers serve their Prometheus metrics on, 0 to disable (see
+# myshop/tracing.py)
+CELERY_METRICS_PORT = config('CELERY_METRICS_PORT', default=9808, cast=int)
+
+# Celery beat schedule
+CELERY_BEAT_SCHEDULE = {
+    'flush-mail-outbox': {
+        'task': 'orders.tasks.flush_mail_outbox',
+        'schedule': MAIL_FLUSH_INTERVAL,
+    },
+    'process-webhook-events': {
+        'task': 'payment.tasks.process_webhook_events',
+        'schedule': 1.0,
+    },
+    'release-expired-reservations': {
+        'task': 'shop.tasks.release_expired_reservations',
+        'schedule': 60.0,
+    },
+}
 
 
 STRIPE_PUBLISHABLE_KEY = config('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY')
 STRIPE_API_VERSION = '2024-04-10'
 STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET')
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='https://api.stripe.com')
+STRIPE_CONNECT_TIMEOUT = config('STRIPE_CONNECT_TIMEOUT', default=3.0, cast=float)
+STRIPE_READ_TIMEOUT = config('STRIPE_READ_TIMEOUT', default=10.0, cast=float)
+STRIPE_MAX_NETWORK_RETRIES = config(
+    'STRIPE_MAX_NETWORK_RETRIES', default=2, cast=int
+)
+STRIPE_POOL_SIZE = config('STRIPE_POOL_SIZE', default=10, cast=int)
+
+# Store webhook events and process them in batches (see payment/events.py)
+STRIPE_WEBHOOK_QUEUE = config('STRIPE_WEBHOOK_QUEUE', default=False, cast=bool)
+STRIPE_WEBHOOK_BATCH_SIZE = config(
+    'STRIPE_WEBHOOK_BATCH_SIZE', default=100, cast=int
+)
 
 # Redis settings
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
-REDIS_DB = 1
\ No newline at end of file
+REDIS_DB = 1
+
+# Two-tier cache: an in-process LRU in front of Redis, with its own Redis
+# database since clearing the cache flushes it (see myshop/cache.py)
+CACHES = {
+    'default': {
+        'BACKEND': 'myshop.cache.TieredCache',
+        'LOCATION': config(
+            'CACHE_URL', default=f'redis://{REDIS_HOST}:{REDIS_PORT}/2'
+        ),
+        'KEY_PREFIX': 'myshop',
+        'OPTIONS': {
+            'LOCAL_MAX_ENTRIES': config(
+                'CACHE_LOCAL_MAX_ENTRIES', default=1000, cast=int
+            ),
+            'LOCAL_TIMEOUT': config('CACHE_LOCAL_TIMEOUT', default=10, cast=int),
+        },
+    },
+}
@@ -0,0 +1,211 @@
+"""
+Cold start time of the management commands, the web and the Celery workers.
+
+Each entry point of :data:`ENTRY_POINTS` is started in a fresh Python
+interpreter, as an autoscaled worker would be, and timed from the launch of
+the interpreter until the entry point is ready:
+
+- ``manage.py``: ``manage.py check``, which loads the apps and the URLconf.
+- ``wsgi``: the WSGI application, with its URLconf loaded, as before its
+  first request.
+- ``celery``: the Celery app with its task modules imported, as the worker
+  does before it consumes.
+
+:data:`LAZY_MODULES` are only needed by a few views and tasks, and must not
+be imported by any entry point. ``-X importtime`` reports which modules
+took the longest to import.
+"""
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+
+ENTRY_POINTS = {
+    'manage.py': (
+        "import runpy, sys\n"
+        "sys.argv = ['manage.py', 'check']\n"
+        "runpy.run_path('manage.py', run_name='__main__')\n"
+    ),
+    'wsgi': (
+        "from myshop.wsgi import application\n"
+        "from django.urls import get_resolver\n"
+        "get_resolver().url_patterns\n"
+    ),
+    'celery': (
+        "from myshop.celery import app\n"
+        "app.loader.import_default_modules()\n"
+        "app.finalize()\n"
+    ),
+}
+
+# seconds from launch to ready, with headroom for slower machines
+BUDGETS = {
+    'manage.py': 0.6,
+    'wsgi': 0.5,
+    'celery': 0.6,
+}
+
+# imported by the code that needs them: Stripe calls, PDF invoices
+LAZY_MODULES = ('stripe', 'weasyprint')
+
+# printed by the child after the entry point, followed by its modules
+MARKER = '--startup-modules--'
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| *(\S+)$')
+
+
+class Startup:
+    """One cold start of an entry point.
+
+    Attributes:
+        entry_point (str): The name of the entry point.
+        seconds (float): The time from launch to ready.
+        modules (list): The names of the imported modules.
+        import_times (list): With ``importtime``, a tuple per module of its
+            name, its own import time and its cumulative import time, in
+            seconds.
+    """
+
+    def __init__(self, entry_point, seconds, modules, import_times=()):
+        self.entry_point = entry_point
+        self.seconds = seconds
+        self.modules = modules
+        self.import_times = list(import_times)
+
+    @property
+    def lazy_modules(self):
+        """The :data:`LAZY_MODULES` that were imported anyway."""
+        return [
+            name for name in LAZY_MODULES
+            if name in self.modules or any(
+                module.startswith(f'{name}.') for module in self.modules
+            )
+        ]
+
+
+def parse_import_times(stderr):
+    """Parse the report of ``python -X importtime``.
+
+    Returns:
+        list: A tuple per module of its name, its own import time and its
+        cumulative import time, in seconds.
+    """
+    times = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            own, cumulative, name = match.groups()
+            times.append((name, int(own) / 1e6, int(cumulative) / 1e6))
+    return times
+
+
+def measure(entry_point, importtime=False):
+    """Start an entry point in a new interpreter.
+
+    Args:
+        entry_point (str): A key of :data:`ENTRY_POINTS`.
+        importtime (bool): Whether to record the import time of each module,
+            which slows the start down a little.
+
+    Returns:
+        Startup: The measured start.
+
+    Raises:
+        RuntimeError: If the entry point fails to start.
+    """
+    code = ENTRY_POINTS[entry_point] + (
+        'import sys\n'
+        f'print({MARKER!r})\n'
+        "print(' '.join(sorted(sys.modules)))\n"
+    )
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', code]
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'myshop.settings')
+    start = time.perf_counter()
+    process = subprocess.run(
+        command,
+        cwd=settings.BASE_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+    if process.returncode or MARKER not in process.stdout:
+        raise RuntimeError(
+            f'{entry_point} failed to start:\n{process.stderr[-2000:]}'
+        )
+    modules = process.stdout.split(MARKER, 1)[1].split()
+    return Startup(
+        entry_point,
+        seconds,
+        modules,
+        parse_import_times(process.stderr) if importtime else (),
+    )
+
+
+def run(entry_points=None, runs=5):
+    """Start each entry point a number of times.
+
+    Args:
+        entry_points (list): Keys of :data:`ENTRY_POINTS`, all by default.
+        runs (int): The number of starts of each entry point.
+
+    Returns:
+        dict: Per entry point, a dict with the ``median``, ``min`` and
+        ``max`` start time in seconds, its ``budget`` and the
+        ``lazy_modules`` that were imported.
+    """
+    results = {}
+    for name in entry_points or ENTRY_POINTS:
+        starts = [measure(name) for _ in range(runs)]
+        seconds = [start.seconds for start in starts]
+        results[name] = {
+            'median': statistics.median(seconds),
+            'min': min(seconds),
+            'max': max(seconds),
+            'budget': BUDGETS[name],
+            'lazy_modules': starts[0].lazy_modules,
+        }
+    return results
+
+
+def over_budget(results):
+    """List the entry points slower than their budget or importing lazy
+    modules."""
+    failures = []
+    for name, result in results.items():
+        if result['median'] > result['budget']:
+            failures.append(
+                f"{name}: {result['median']:.3f} s over the budget of "
+                f"{result['budget']:.3f} s"
+            )
+        if result['lazy_modules']:
+            failures.append(
+                f"{name}: imports {', '.join(result['lazy_modules'])} at start"
+            )
+    return failures
+
+
+def top_level_imports(startup, count=15):
+    """Get the packages that took the longest to import.
+
+    Args:
+        startup (Startup): A start measured with ``importtime``.
+        count (int): The number of packages.
+
+    Returns:
+        list: A tuple per top-level package of its name and the time spent
+        importing its modules, in seconds, slowest first.
+    """
+    totals = {}
+    for name, own, _ in startup.import_times:
+        package = name.split('.', 1)[0]
+        totals[package] = totals.get(package, 0.0) + own
+    return sorted(totals.items(), key=lambda t: t[1], reverse=True)[:count]
@@ -0,0 +1,1088 @@
+import io
+import json
+import os
+import queue
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+import redis
+from prometheus_client import REGISTRY
+
+from orders.models import Order
+from orders.tasks import order_created
+from shop.models import Category, Product
+
+from . import (
+    benchmarks,
+    cache as tiered_cache,
+    loadgen,
+    mail,
+    metrics,
+    profiling,
+    replicas,
+    startup,
+    tracing,
+)
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue, enough for ``smtplib`` to deliver messages."""
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost ESMTP stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 localhost')
+            elif command.startswith(('MAIL', 'RCPT', 'RSET', 'NOOP')):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Local SMTP server counting connections and delivered messages."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.messages = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class FakePipeline:
+    """Records pipeline commands and runs them on ``FakeRedis``."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    def execute(self):
+        return [
+            getattr(self.redis, name)(*args, **kwargs)
+            for name, args, kwargs in self.commands
+        ]
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.messages = queue.Queue()
+
+    def subscribe(self, channel):
+        self.redis.subscribers.append(self.messages)
+
+    def listen(self):
+        while (message := self.messages.get()) is not None:
+            yield message
+
+    def close(self):
+        if self.messages in self.redis.subscribers:
+            self.redis.subscribers.remove(self.messages)
+        self.messages.put(None)
+
+
+class FakeRedis:
+    """In-memory replacement for the Redis commands of the cache, with one
+    pub/sub channel. Expiry is not simulated."""
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    def publish(self, channel, message):
+        for messages in list(self.subscribers):
+            messages.put({'type': 'message', 'data': message.encode()})
+        return len(self.subscribers)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and key in self.data:
+            return None
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        self.data[key] = value
+        return True
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def incrby(self, key, delta):
+        value = int(self.data[key]) + delta
+        self.data[key] = str(value).encode()
+        return value
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def flushdb(self):
+        self.data.clear()
+        return True
+
+
+class FakeOutbox:
+    """In-memory replacement for the Redis list commands used by the outbox."""
+
+    def __init__(self):
+        self.lists = {}
+        self.locks = set()
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(
+            v.encode() if isinstance(v, str) else v for v in values
+        )
+        return len(self.lists[key])
+
+    def lpop(self, key, count=None):
+        items = self.lists.get(key, [])
+        popped, self.lists[key] = items[:count], items[count:]
+        return popped or None
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def lmove(self, source, destination, src, dest):
+        items = self.lists.get(source, [])
+        if not items:
+            return None
+        item = items.pop(0 if src == 'LEFT' else -1)
+        target = self.lists.setdefault(destination, [])
+        target.insert(0 if dest == 'LEFT' else len(target), item)
+        return item
+
+    def delete(self, key):
+        return int(bool(self.lists.pop(key, None)))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def lock(self, name, timeout=None):
+        return FakeLock(self, name)
+
+
+class FakeLock:
+    def __init__(self, outbox, name):
+        self.locks = outbox.locks
+        self.name = name
+
+    def acquire(self, blocking=True):
+        if self.name in self.locks:
+            return False
+        self.locks.add(self.name)
+        return True
+
+    def reacquire(self):
+        pass
+
+    def release(self):
+        self.locks.discard(self.name)
+
+
+def make_message(n):
+    message = EmailMessage(
+        f'Order nr. {n}', 'Thanks!', 'admin@myshop.com', [f'c{n}@example.com'],
+        cc=['cc@example.com'], bcc=['bcc@example.com'],
+        reply_to=['orders@myshop.com'], headers={'X-Order': str(n)},
+    )
+    message.attach(f'order_{n}.pdf', b'%PDF-1.4', 'application/pdf')
+    return message
+
+
+class MailDeliveryTests(SimpleTestCase):
+    def setUp(self):
+        self.server = SMTPStandIn()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        smtp = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.server.port,
+            EMAIL_USE_TLS=False,
+            EMAIL_HOST_USER='',
+            MAIL_MAX_ATTEMPTS=2,
+        )
+        smtp.enable()
+        self.addCleanup(smtp.disable)
+        self.outbox = FakeOutbox()
+        patcher = mock.patch.object(mail, 'r', self.outbox)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_send_batch_reuses_one_connection(self):
+        sent, failed = mail.send_batch([make_message(n) for n in range(5)])
+        self.assertEqual((sent, failed), (5, []))
+        self.assertEqual(self.server.messages, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_serialization_round_trip(self):
+        message, info = mail.deserialize_message(
+            mail.serialize_message(
+                make_message(1), 3, 'req-1', queued_at=1000.0
+            )
+        )
+        self.assertEqual(
+            info,
+            {'attempts': 3, 'correlation_id': 'req-1', 'queued_at': 1000.0},
+        )
+        self.assertEqual(message.to, ['c1@example.com'])
+        self.assertEqual(message.cc, ['cc@example.com'])
+        self.assertEqual(message.bcc, ['bcc@example.com'])
+        self.assertEqual(message.reply_to, ['orders@myshop.com'])
+        self.assertEqual(message.extra_headers, {'X-Order': '1'})
+        self.assertEqual(
+            message.attachments,
+            [('order_1.pdf', b'%PDF-1.4', 'application/pdf')],
+        )
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_flush_outbox_coalesces_queued_messages(self):
+        for n in range(7):
+            mail.deliver(make_message(n))
+        self.assertEqual(self.server.messages, 0)
+        stats = mail.flush_outbox(batch_size=5)
+        self.assertEqual(stats['sent'], 7)
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.outbox.llen('mail:outbox'), 0)
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_failed_messages_are_retried_then_dead_lettered(self):
+        mail.deliver(make_message(1))
+        with override_settings(EMAIL_PORT=1):
+            stats = mail.flush_outbox()
+            self.assertEqual((stats['sent'], stats['retried']), (0, 1))
+            self.assertEqual(self.outbox.llen('mail:outbox'), 1)
+            stats = mail.flush_outbox()
+            self.assertEqual(stats['failed'], 1)
+        self.assertEqual(self.outbox.llen('mail:outbox'), 0)
+        self.assertEqual(self.outbox.llen('mail:dead'), 1)
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_retried_message_is_delivered_once_server_recovers(self):
+        mail.deliver(make_message(1))
+        with override_settings(EMAIL_PORT=1):
+            mail.flush_outbox()
+        stats = mail.flush_outbox()
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual(self.server.messages, 1)
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_batch_interrupted_by_a_crash_is_sent_by_the_next_flush(self):
+        for n in range(3):
+            mail.deliver(make_message(n))
+        with mock.patch.object(mail, 'send_batch', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                mail.flush_outbox(batch_size=2)
+        self.assertEqual(self.outbox.llen('mail:processing'), 2)
+        with self.assertLogs('myshop.mail', 'WARNING'):
+            stats = mail.flush_outbox()
+        self.assertEqual(stats['sent'], 3)
+        self.assertEqual(self.server.messages, 3)
+        self.assertEqual(self.outbox.llen('mail:processing'), 0)
+        self.assertEqual(self.outbox.llen('mail:outbox'), 0)
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_flush_is_skipped_while_another_one_runs(self):
+        mail.deliver(make_message(1))
+        self.outbox.locks.add('mail:flush-lock')
+        self.assertEqual(mail.flush_outbox()['batches'], 0)
+        self.assertEqual(self.outbox.llen('mail:outbox'), 1)
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_malformed_message_is_dead_lettered(self):
+        self.outbox.rpush('mail:outbox', 'not json')
+        mail.deliver(make_message(1))
+        with self.assertLogs('myshop.mail', 'ERROR'):
+            stats = mail.flush_outbox()
+        self.assertEqual((stats['sent'], stats['failed']), (1, 1))
+        self.assertEqual(self.outbox.lists['mail:dead'], [b'not json'])
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_message_with_invalid_header_is_dead_lettered_at_once(self):
+        message = make_message(1)
+        message.subject = 'Order\nBcc: everyone@example.com'
+        mail.deliver(message)
+        for n in range(2, 4):
+            mail.deliver(make_message(n))
+        with self.assertLogs('myshop.mail', 'ERROR'):
+            stats = mail.flush_outbox(batch_size=2)
+        self.assertEqual((stats['sent'], stats['failed']), (2, 1))
+        self.assertEqual(stats['retried'], 0)
+        self.assertEqual(self.server.messages, 2)
+        self.assertEqual(self.outbox.llen('mail:outbox'), 0)
+        self.assertEqual(self.outbox.llen('mail:processing'), 0)
+        self.assertEqual(self.outbox.llen('mail:dead'), 1)
+
+    @override_settings(MAIL_BATCHING=True)
+    def test_flush_logs_outbox_wait_and_smtp_time_per_correlation_id(self):
+        with tracing.correlation('req-1'):
+            mail.deliver(make_message(1))
+        queued = json.loads(self.outbox.lists['mail:outbox'][0])
+        with override_settings(EMAIL_PORT=1):
+            with self.assertLogs('myshop.mail', 'WARNING') as logs:
+                mail.flush_outbox()
+        self.assertIn('for req-1 failed on attempt 1', logs.output[-1])
+        # the retry keeps the id and the time the message was first queued
+        retried = json.loads(self.outbox.lists['mail:outbox'][0])
+        self.assertEqual(retried['correlation_id'], 'req-1')
+        self.assertEqual(retried['queued_at'], queued['queued_at'])
+        with self.assertLogs('myshop.mail', 'INFO') as logs:
+            mail.flush_outbox()
+        self.assertRegex(
+            logs.output[0],
+            r"Sent e-mail to \['c1@example.com'\] for req-1 after "
+            r'[0-9.]+s in the outbox \(attempt 2, smtp [0-9.]+s\)',
+        )
+
+    @override_settings(MAIL_BATCHING=False)
+    def test_deliver_sends_immediately_without_batching(self):
+        self.assertEqual(mail.deliver(make_message(1)), 1)
+        self.assertEqual(self.server.messages, 1)
+        self.assertEqual(self.outbox.llen('mail:outbox'), 0)
+
+
+class TieredCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def make_cache(self, listen=False, **options):
+        """Create a cache with its own tiers, as another process would."""
+        location = f'redis://cache-{len(tiered_cache._tiers)}:6379/0'
+        self.addCleanup(tiered_cache._tiers.pop, location)
+        cache = tiered_cache.TieredCache(location, {'OPTIONS': options})
+        cache.tiers.client = cache.tiers.listener_client = self.redis
+        if listen:
+            cache.tiers.start_listener()
+        else:
+            cache.tiers.listener_pid = os.getpid()
+        return cache
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'Timed out')
+            time.sleep(0.01)
+
+    def test_local_tier_keeps_recently_used_entries(self):
+        cache = self.make_cache(LOCAL_MAX_ENTRIES=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache.tiers.local), 2)
+        self.assertEqual(cache.get_local('a'), 1)
+        self.assertIsNone(cache.get_local('b'))
+        # evicted entries are still in Redis
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2, 'c': 3})
+
+    def test_lookups_are_counted_per_tier(self):
+        def count(tier, result):
+            return REGISTRY.get_sample_value(
+                'myshop_cache_requests_total', {'tier': tier, 'result': result}
+            ) or 0
+
+        cache = self.make_cache()
+        other = self.make_cache()
+        cache.set('key', {'value': 1})
+        before = {
+            (tier, result): count(tier, result)
+            for tier in ('local', 'shared')
+            for result in ('hit', 'miss')
+        }
+        self.assertEqual(other.get('key'), {'value': 1})
+        self.assertEqual(other.get('key'), {'value': 1})
+        self.assertIsNone(other.get('missing'))
+        self.assertEqual(count('local', 'hit'), before['local', 'hit'] + 1)
+        self.assertEqual(count('local', 'miss'), before['local', 'miss'] + 2)
+        self.assertEqual(count('shared', 'hit'), before['shared', 'hit'] + 1)
+        self.assertEqual(count('shared', 'miss'), before['shared', 'miss'] + 1)
+        ratio = REGISTRY.get_sample_value(
+            'myshop_cache_hit_ratio', {'tier': 'local'}
+        )
+        self.assertEqual(ratio, tiered_cache.get_hit_ratios()['local'])
+
+    def test_writes_drop_local_copies_in_other_processes(self):
+        cache = self.make_cache(listen=True)
+        other = self.make_cache(listen=True)
+        self.wait_for(lambda: len(self.redis.subscribers) == 2)
+        cache.set('key', 'old')
+        self.assertEqual(other.get('key'), 'old')
+        cache.set('key', 'new')
+        self.wait_for(lambda: other.get_local('key') is None)
+        self.assertEqual(other.get('key'), 'new')
+        # the writer keeps its own copy
+        self.assertEqual(cache.get_local('key'), 'new')
+        other.get('key')
+        cache.delete('key')
+        self.wait_for(lambda: other.get_local('key') is None)
+        other.set('key', 'again')
+        cache.clear()
+        self.wait_for(lambda: len(other.tiers.local) == 0)
+
+    def test_concurrent_misses_are_computed_once(self):
+        cache = self.make_cache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(cache.get_or_set('key', compute))
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_miss_waits_for_other_process_computing(self):
+        cache = self.make_cache()
+        key = cache.make_key('key')
+        self.redis.set(f'lock:{key}', 'other process')
+        timer = threading.Timer(0.1, cache.set, ['key', 'computed elsewhere'])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        compute = mock.Mock(return_value='computed here')
+        self.assertEqual(cache.get_or_set('key', compute), 'computed elsewhere')
+        compute.assert_not_called()
+
+    def test_values_are_computed_again_before_they_expire(self):
+        cache = self.make_cache()
+        key = cache.make_key('key')
+        # took 2s to compute and expires in 1s
+        cache.tiers.local.set(
+            key, tiered_cache.Entry('old', time.time() + 1, 2)
+        )
+        with mock.patch.object(tiered_cache.random, 'random', return_value=0):
+            self.assertEqual(cache.get_or_set('key', lambda: 'new'), 'old')
+        with mock.patch.object(
+            tiered_cache.random, 'random', return_value=0.9
+        ):
+            self.assertEqual(cache.get_or_set('key', lambda: 'new'), 'new')
+        self.assertEqual(cache.get('key'), 'new')
+
+    def test_early_refresh_keeps_value_while_locked(self):
+        cache = self.make_cache()
+        key = cache.make_key('key')
+        cache.tiers.local.set(
+            key, tiered_cache.Entry('old', time.time() + 1, 2)
+        )
+        self.redis.set(f'lock:{key}', 'other process')
+        with mock.patch.object(
+            tiered_cache.random, 'random', return_value=0.9
+        ):
+            self.assertEqual(cache.get_or_set('key', lambda: 'new'), 'old')
+
+    def test_local_tier_is_used_without_redis(self):
+        cache = self.make_cache()
+        with mock.patch.object(
+            self.redis, 'pipeline', side_effect=redis.ConnectionError
+        ), self.assertLogs('myshop.cache', 'WARNING') as logs:
+            cache.set('count', 1)
+            self.assertEqual(cache.incr('count'), 2)
+            self.assertEqual(cache.get('count'), 2)
+            self.assertEqual(cache.get_or_set('key', lambda: None), None)
+            with self.assertRaises(ValueError):
+                cache.incr('missing')
+        self.assertEqual(len(logs.output), 1)
+        # Redis is not tried again right away
+        self.assertIsNone(self.redis.get(cache.make_key('count')))
+        cache.set('count', 5)
+        self.assertIsNone(self.redis.get(cache.make_key('count')))
+
+
+class SQLiteBackendTests(TransactionTestCase):
+    def test_connection_uses_wal_and_busy_timeout(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+
+    def test_atomic_takes_the_write_lock_up_front(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                Order.objects.exists()
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+    def test_bench_order_create(self):
+        output = io.StringIO()
+        call_command(
+            'bench_order_create', '--requests=6', '--threads=2',
+            stdout=output,
+        )
+        lines = output.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines],
+                         ['stock', 'configured'])
+        self.assertIn(' 0 failed', lines[1])
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Product.objects.exists())
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """Routing against a second connection to the test database."""
+
+    def setUp(self):
+        # a second connection standing in for a replica of the database
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict,
+            'TEST': {'MIRROR': 'default'},
+        }
+        self.addCleanup(connections.settings.pop, 'replica')
+        self.addCleanup(connections.__delitem__, 'replica')
+        self.addCleanup(lambda: connections['replica'].close())
+        replica_settings = override_settings(DATABASE_REPLICAS=['replica'])
+        replica_settings.enable()
+        self.addCleanup(replica_settings.disable)
+        patcher = mock.patch(
+            'shop.views.Recommender.suggest_products_for', return_value=[]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        category = Category.objects.create(name='Tea', slug='tea')
+        self.product = Product.objects.create(
+            category=category, name='Green Tea', slug='green-tea',
+            price='4.50', stock=10,
+        )
+
+    def queries(self, alias, function):
+        with CaptureQueriesContext(connections[alias]) as queries:
+            response = function()
+        return response, [query['sql'] for query in queries]
+
+    def get_product(self):
+        return self.client.get(self.product.get_absolute_url())
+
+    def get_list(self):
+        return self.client.get(reverse('shop:product_list'))
+
+    def test_storefront_reads_from_replica(self):
+        cache.clear()
+        response, queries = self.queries('replica', self.get_list)
+        self.assertContains(response, 'Green Tea')
+        self.assertTrue(any('shop_product' in sql for sql in queries))
+        response, queries = self.queries('default', self.get_list)
+        self.assertFalse(any('shop_product' in sql for sql in queries))
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+    def test_cached_catalog_lookups_read_from_primary(self):
+        cache.clear()
+        response, queries = self.queries('replica', self.get_product)
+        self.assertContains(response, 'Green Tea')
+        self.assertFalse(any('shop_product' in sql for sql in queries))
+        _, queries = self.queries(
+            'default',
+            lambda: self.client.get(
+                reverse('shop:product_list_by_category', args=['tea'])
+            ),
+        )
+        self.assertTrue(any('shop_category' in sql for sql in queries))
+
+    def test_reads_after_a_write_stay_on_primary(self):
+        self.client.post(
+            reverse('cart:cart_add', args=[self.product.id]),
+            {'quantity': 1, 'override': False},
+        )
+        with mock.patch('orders.views.order_created'):
+            response = self.client.post(
+                reverse('orders:order_create'),
+                {
+                    'first_name': 'Ada',
+                    'last_name': 'Lovelace',
+                    'email': 'ada@example.com',
+                    'address': '1 Main St',
+                    'postal_code': '1000',
+                    'city': 'London',
+                },
+            )
+        self.assertRedirects(
+            response, reverse('payment:process'), fetch_redirect_response=False
+        )
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+
+        response, queries = self.queries(
+            'default', lambda: self.client.get(reverse('payment:process'))
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(any('orders_order' in sql for sql in queries))
+        # the storefront stays on the primary while the client is pinned
+        _, queries = self.queries('replica', self.get_product)
+        self.assertEqual(queries, [])
+
+    def test_reads_in_a_transaction_stay_on_primary(self):
+        with transaction.atomic():
+            _, queries = self.queries(
+                'replica',
+                lambda: read_from_replicas(Product.objects.count),
+            )
+        self.assertEqual(queries, [])
+        _, queries = self.queries(
+            'replica', lambda: read_from_replicas(Product.objects.count)
+        )
+        self.assertEqual(len(queries), 1)
+
+    def test_admin_export_reads_from_replica(self):
+        self.client.force_login(
+            User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        )
+        order = Order.objects.create(
+            first_name='Ada', last_name='Lovelace', email='ada@example.com',
+            address='1 Main St', postal_code='1000', city='London',
+        )
+        response, queries = self.queries(
+            'replica',
+            lambda: self.client.post(
+                reverse('admin:orders_order_changelist'),
+                {'action': 'export_to_csv', '_selected_action': [order.id]},
+            ),
+        )
+        self.assertContains(response, 'Lovelace')
+        self.assertTrue(any('orders_order' in sql for sql in queries))
+        _, queries = self.queries(
+            'replica',
+            lambda: self.client.get(reverse('admin:orders_order_changelist')),
+        )
+        self.assertTrue(any('orders_order' in sql for sql in queries))
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Category.objects.create(name='Tea', slug='tea')
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_metrics_are_recorded_per_view(self):
+        view = {'view': 'shop:product_list'}
+        count = self.sample(
+            'myshop_http_request_duration_seconds_count',
+            method='GET', status='2xx', **view,
+        )
+        queries = self.sample('myshop_http_db_queries_sum', **view)
+        render = self.sample(
+            'myshop_http_template_duration_seconds_sum', **view
+        )
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get(reverse('shop:product_list'))
+        self.assertEqual(
+            self.sample(
+                'myshop_http_request_duration_seconds_count',
+                method='GET', status='2xx', **view,
+            ),
+            count + 1,
+        )
+        self.assertEqual(
+            self.sample('myshop_http_db_queries_sum', **view),
+            queries + len(captured),
+        )
+        self.assertGreater(
+            self.sample('myshop_http_template_duration_seconds_sum', **view),
+            render,
+        )
+
+    def test_unresolved_requests_share_a_label(self):
+        labels = {'view': metrics.UNRESOLVED, 'method': 'GET', 'status': '4xx'}
+        count = self.sample(
+            'myshop_http_request_duration_seconds_count', **labels
+        )
+        self.client.get('/no/such/page/')
+        self.assertEqual(
+            self.sample('myshop_http_request_duration_seconds_count', **labels),
+            count + 1,
+        )
+
+    def test_redis_round_trips_are_counted(self):
+        connection = metrics.RedisConnection()
+        with mock.patch.object(
+            redis.Connection, 'send_packed_command'
+        ), mock.patch.object(redis.Connection, 'read_response'):
+            connection.send_packed_command(b'PING')
+            with metrics.tracking() as stats:
+                connection.send_packed_command(b'PING')
+                connection.read_response()
+                connection.read_response()
+        self.assertEqual(stats.redis_calls, 1)
+        self.assertGreater(stats.redis_seconds, 0)
+
+    def test_metrics_endpoint_is_restricted(self):
+        self.client.get(reverse('shop:product_list'))
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'myshop_http_request_duration_seconds')
+        self.assertEqual(
+            self.client.get(
+                reverse('metrics'), REMOTE_ADDR='203.0.113.5'
+            ).status_code,
+            403,
+        )
+
+
+@override_settings(MAIL_BATCHING=False)
+class TaskTracingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.order = Order.objects.create(
+            first_name='Ada',
+            last_name='Lovelace',
+            email='ada@example.com',
+            address='1 Main St',
+            postal_code='1000',
+            city='London',
+        )
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_get_a_correlation_id(self):
+        url = reverse('shop:product_list')
+        response = self.client.get(url, HTTP_X_REQUEST_ID='lb-1234')
+        self.assertEqual(response['X-Request-ID'], 'lb-1234')
+        response = self.client.get(url, HTTP_X_REQUEST_ID='bad id\n')
+        self.assertRegex(response['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+    def test_queued_tasks_carry_the_correlation_id(self):
+        headers = {}
+        with tracing.correlation('req-1'):
+            tracing.add_task_headers(headers=headers)
+        self.assertEqual(headers['correlation_id'], 'req-1')
+        self.assertAlmostEqual(headers['published_at'], time.time(), delta=5)
+
+    def test_task_runs_are_measured_and_correlated(self):
+        task = 'orders.tasks.order_created'
+        wait = self.sample('myshop_task_queue_wait_seconds_sum', task=task)
+        runs = self.sample('myshop_task_runs_total', task=task, state='success')
+        db = self.sample(
+            'myshop_task_phase_duration_seconds_count', task=task, phase='db'
+        )
+        smtp = self.sample(
+            'myshop_task_phase_duration_seconds_sum', task=task, phase='smtp'
+        )
+        correlation_ids = []
+
+        def deliver(message):
+            correlation_ids.append(tracing.get_correlation_id())
+            return mail.send_batch([message])[0]
+
+        with mock.patch.object(mail, 'deliver', side_effect=deliver), \
+                self.assertLogs('myshop.tracing', 'INFO') as logs:
+            result = order_created.apply(
+                args=[self.order.id],
+                headers={
+                    'correlation_id': 'req-1',
+                    'published_at': time.time() - 2,
+                },
+            )
+        self.assertEqual(result.get(), 1)
+        self.assertEqual(correlation_ids, ['req-1'])
+        self.assertIsNone(tracing.get_correlation_id())
+        self.assertGreaterEqual(
+            self.sample('myshop_task_queue_wait_seconds_sum', task=task),
+            wait + 2,
+        )
+        self.assertEqual(
+            self.sample('myshop_task_runs_total', task=task, state='success'),
+            runs + 1,
+        )
+        self.assertEqual(
+            self.sample(
+                'myshop_task_phase_duration_seconds_count',
+                task=task,
+                phase='db',
+            ),
+            db + 1,
+        )
+        self.assertGreater(
+            self.sample(
+                'myshop_task_phase_duration_seconds_sum',
+                task=task,
+                phase='smtp',
+            ),
+            smtp,
+        )
+        self.assertIn('for req-1 (1 queries', logs.output[0])
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Category.objects.create(name='Tea', slug='tea')
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        overrides = override_settings(
+            PROFILE_DIR=profile_dir.name,
+            PROFILE_SAMPLE_RATE=1.0,
+            PROFILE_INTERVAL=0.001,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_sampled_requests_are_saved_with_their_queries(self):
+        self.client.get(reverse('shop:product_list'))
+        (profile,) = profiling.list_profiles()
+        self.assertEqual(profile['view'], 'shop:product_list')
+        self.assertEqual(profile['status'], 200)
+        self.assertEqual(profile['reason'], 'sampled')
+        self.assertTrue(
+            any('shop_category' in sql for sql, _ in profile['sql'])
+        )
+
+    def test_slow_requests_are_saved_with_their_stacks(self):
+        from shop import views
+
+        render = views.render
+
+        def slow_render(*args, **kwargs):
+            time.sleep(0.1)
+            return render(*args, **kwargs)
+
+        with override_settings(
+            PROFILE_SAMPLE_RATE=0, PROFILE_SLOW_SECONDS=0.05
+        ):
+            self.client.get(reverse('shop:product_list'))
+            self.assertEqual(profiling.list_profiles(), [])
+            with mock.patch.object(views, 'render', slow_render):
+                self.client.get(reverse('shop:product_list'))
+        (profile,) = profiling.list_profiles()
+        self.assertEqual(profile['reason'], 'slow')
+        self.assertGreaterEqual(profile['seconds'], 0.1)
+        self.assertTrue(
+            any('slow_render' in stack for stack in profile['stacks'])
+        )
+
+    def test_only_the_newest_profiles_are_kept(self):
+        with override_settings(PROFILE_MAX_FILES=3):
+            for _ in range(5):
+                self.client.get(reverse('shop:product_list'))
+        self.assertEqual(len(profiling.list_profiles()), 3)
+
+    def test_profiler_is_removed_when_disabled(self):
+        with override_settings(PROFILE_SAMPLE_RATE=0, PROFILE_SLOW_SECONDS=0):
+            with self.assertRaises(MiddlewareNotUsed):
+                profiling.profiling_middleware(lambda request: None)
+
+    def test_redis_commands_are_described(self):
+        packed = redis.Connection().pack_commands([
+            ('SET', 'myshop:1:key', b'a\r\nb', 'PX', 1000),
+            ('GET', 'myshop:1:key'),
+        ])
+        self.assertEqual(
+            metrics.describe_command(packed),
+            'SET myshop:1:key a\r\nb; GET myshop:1:key',
+        )
+
+    def test_profiles_are_shown_to_staff(self):
+        self.client.get(reverse('shop:product_list'))
+        (profile,) = profiling.list_profiles()
+        list_url = reverse('profile_list')
+        detail_url = reverse('profile_detail', args=[profile['id']])
+        response = self.client.get(list_url)
+        self.assertEqual(response.status_code, 302)
+
+        staff = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(list_url)
+        self.assertContains(response, detail_url)
+        response = self.client.get(detail_url)
+        self.assertContains(response, 'Flame graph')
+        self.assertContains(response, 'shop_category')
+        response = self.client.get(detail_url, {'format': 'folded'})
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        for line in response.content.decode().splitlines():
+            self.assertRegex(line, r' \d+$')
+        response = self.client.get(
+            reverse('profile_detail', args=['..%2Fsettings'])
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_flame_graph_layout(self):
+        rects, depth = profiling.get_flame_graph(
+            {'main;load': 3, 'main;render': 1}
+        )
+        self.assertEqual(depth, 2)
+        self.assertEqual(
+            [(r['name'], r['depth'], r['left'], r['width']) for r in rects],
+            [
+                ('main', 0, 0.0, 100.0),
+                ('load', 1, 0.0, 75.0),
+                ('render', 1, 75.0, 25.0),
+            ],
+        )
+
+
+class ViewQueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        with benchmarks.stubbed():
+            cls.seed = benchmarks.seed(products=60, orders=5, coupons=5)
+
+    def test_views_stay_within_their_query_budgets(self):
+        results = benchmarks.run(self.seed, requests=2)
+        self.assertEqual(
+            set(results), {s.name for s in benchmarks.SCENARIOS}
+        )
+        self.assertEqual(benchmarks.over_budget(results), [])
+
+    def test_regressions_are_reported(self):
+        scenario = benchmarks.Scenario(
+            'cart:cart_detail',
+            budget=1,
+            request=benchmarks.cart_detail,
+            prepare=benchmarks.fill_cart,
+        )
+        results = benchmarks.run(self.seed, requests=2, scenarios=[scenario])
+        self.assertEqual(
+            benchmarks.over_budget(results),
+            ['cart:cart_detail: 3 queries, budget 1'],
+        )
+        baseline = {'cart:cart_detail': {'p95': 0.0001}}
+        self.assertEqual(
+            len(benchmarks.slower_than(results, baseline, 1.5)), 1
+        )
+        self.assertEqual(benchmarks.slower_than(results, {}, 1.5), [])
+
+
+class LoadGeneratorTests(TransactionTestCase):
+    def test_concurrent_checkouts_are_timed_per_step(self):
+        category = Category.objects.create(name='Tea', slug='tea')
+        products = [
+            Product.objects.create(
+                category=category, name=f'Tea {n}', slug=f'tea-{n}', price=5
+            )
+            for n in range(3)
+        ]
+        with benchmarks.stubbed([product.id for product in products]):
+            recorder, elapsed = loadgen.run(
+                loadgen.ClientSession, users=4, concurrency=2, rate=100
+            )
+        self.assertEqual(recorder.completed, 4)
+        report = {row['step']: row for row in recorder.report(elapsed)}
+        self.assertEqual(report['order_create']['requests'], 4)
+        self.assertEqual(report['webhook']['errors'], 0)
+        self.assertEqual(report['coupon_apply']['requests'], 0)
+        self.assertLessEqual(
+            report['webhook']['p50'], report['webhook']['p99']
+        )
+        self.assertEqual(Order.objects.filter(paid=True).count(), 4)
+
+    def test_unexpected_errors_are_counted_against_their_step(self):
+        category = Category.objects.create(name='Tea', slug='tea')
+        product = Product.objects.create(
+            category=category, name='Tea', slug='tea', price=5
+        )
+        with benchmarks.stubbed([product.id]), mock.patch.object(
+            loadgen, 'sign_event', side_effect=ValueError('no secret')
+        ), self.assertLogs('myshop.loadgen', 'ERROR') as logs:
+            recorder, elapsed = loadgen.run(
+                loadgen.ClientSession, users=2, concurrency=2
+            )
+        self.assertEqual(recorder.completed, 0)
+        report = {row['step']: row for row in recorder.report(elapsed)}
+        self.assertEqual(report['payment_process']['errors'], 0)
+        self.assertEqual(report['webhook']['errors'], 2)
+        self.assertEqual(len(logs.records), 2)
+
+
+class StartupTests(SimpleTestCase):
+    def test_entry_points_start_without_lazy_modules(self):
+        # the time budgets are checked by bench_startup, over several runs
+        for name in startup.ENTRY_POINTS:
+            with self.subTest(entry_point=name):
+                measured = startup.measure(name)
+                self.assertIn('django', measured.modules)
+                self.assertEqual(measured.lazy_modules, [])
+
+    def test_over_budget_reports_slow_starts_and_lazy_imports(self):
+        results = {
+            'wsgi': {'median': 0.1, 'budget': 0.5, 'lazy_modules': []},
+            'celery': {
+                'median': 0.9, 'budget': 0.6, 'lazy_modules': ['stripe'],
+            },
+        }
+        self.assertEqual(
+            startup.over_budget(results),
+            [
+                'celery: 0.900 s over the budget of 0.600 s',
+                'celery: imports stripe at start',
+            ],
+        )
+
+    def test_import_times_are_grouped_by_package(self):
+        measured = startup.Startup('wsgi', 0.2, [], startup.parse_import_times(
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       300 |        300 |     stripe.error\n'
+            'import time:       200 |        500 |   stripe\n'
+            'import time:       100 |        100 | django\n'
+        ))
+        self.assertEqual(
+            startup.top_level_imports(measured),
+            [('stripe', 0.0005), ('django', 0.0001)],
+        )
+
+
+def read_from_replicas(function):
+    with replicas.reading_from_replicas():
+        return function()
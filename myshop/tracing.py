@@ -0,0 +1,246 @@
+"""
+Correlation ids and metrics of Celery tasks.
+
+Every HTTP request gets a correlation id, returned in the ``X-Request-ID``
+response header. It is the ``X-Request-ID`` header set by the proxy in
+front of the shop if there is a valid one, and a new random id otherwise.
+Stripe webhook events use the ID of the event instead (see
+``payment/events.py``). Tasks queued while handling a request or an event
+carry its correlation id in a message header and run with it, so the tasks
+they queue carry it in turn. The line logged when a task finishes names
+it.
+
+The workers record, per task:
+
+* ``myshop_task_queue_wait_seconds``: the time between queuing the task,
+  or its ETA, and the start of its run,
+* ``myshop_task_duration_seconds``: the runtime, by final state,
+* ``myshop_task_phase_duration_seconds``: the runtime split into database
+  queries (``db``), Redis calls (``redis``), template rendering
+  (``template``), PDF rendering (``pdf``), SMTP (``smtp``) and the rest
+  (``other``),
+* ``myshop_task_runs_total``: the runs, by final state (``success``,
+  ``retry`` or ``failure``).
+
+Workers serve their metrics on ``CELERY_METRICS_PORT``. With the prefork
+pool, set ``PROMETHEUS_MULTIPROC_DIR`` so the metrics of the child
+processes are served too.
+"""
+import logging
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from asgiref.sync import iscoroutinefunction
+from celery.signals import (
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    worker_init,
+    worker_process_shutdown,
+)
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# accepted request ids from the proxy, anything else is replaced
+VALID_ID = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+TASK_QUEUE_WAIT = Histogram(
+    'myshop_task_queue_wait_seconds',
+    'Time tasks waited in the queue before running.',
+    ['task'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900),
+)
+TASK_SECONDS = Histogram(
+    'myshop_task_duration_seconds',
+    'Runtime of tasks, by final state.',
+    ['task', 'state'],
+)
+TASK_PHASE_SECONDS = Histogram(
+    'myshop_task_phase_duration_seconds',
+    'Runtime of tasks spent in each phase.',
+    ['task', 'phase'],
+)
+TASK_RUNS = Counter(
+    'myshop_task_runs_total',
+    'Task runs, by final state.',
+    ['task', 'state'],
+)
+
+_correlation_id = ContextVar('correlation_id', default=None)
+
+# task ID -> (correlation token, stats tracker, stats, start)
+_running = {}
+
+
+def get_correlation_id():
+    """Get the correlation id of the current request, event or task."""
+    return _correlation_id.get()
+
+
+@contextmanager
+def correlation(correlation_id):
+    """Run the enclosed block with a correlation id.
+
+    Args:
+        correlation_id (str): The id, or None to keep the current one.
+    """
+    if correlation_id is None:
+        yield
+        return
+    token = _correlation_id.set(correlation_id)
+    try:
+        yield
+    finally:
+        _correlation_id.reset(token)
+
+
+def get_request_id(request):
+    """Get the correlation id of a request."""
+    request_id = request.headers.get(REQUEST_ID_HEADER, '')
+    if VALID_ID.match(request_id):
+        return request_id
+    return uuid.uuid4().hex
+
+
+@sync_and_async_middleware
+def correlation_middleware(get_response):
+    """Give every request a correlation id.
+
+    Args:
+        get_response (callable): The next middleware or view.
+
+    Returns:
+        callable: The middleware.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            request_id = get_request_id(request)
+            with correlation(request_id):
+                response = await get_response(request)
+            response[REQUEST_ID_HEADER] = request_id
+            return response
+    else:
+        def middleware(request):
+            request_id = get_request_id(request)
+            with correlation(request_id):
+                response = get_response(request)
+            response[REQUEST_ID_HEADER] = request_id
+            return response
+    return middleware
+
+
+def get_header(task, name):
+    """Get a custom message header of the running task."""
+    value = getattr(task.request, name, None)
+    if value is None:
+        value = (task.request.headers or {}).get(name)
+    return value
+
+
+@before_task_publish.connect
+def add_task_headers(headers=None, **kwargs):
+    """Pass the correlation id and the time of queuing with a task."""
+    correlation_id = get_correlation_id()
+    if correlation_id is not None:
+        headers['correlation_id'] = correlation_id
+    headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def start_task(task_id=None, task=None, **kwargs):
+    """Record the queue wait of a task and start tracking its run."""
+    start = time.perf_counter()
+    published_at = get_header(task, 'published_at')
+    if published_at is not None:
+        eta = task.request.eta
+        if eta:
+            published_at = max(
+                published_at, datetime.fromisoformat(eta).timestamp()
+            )
+        TASK_QUEUE_WAIT.labels(task.name).observe(
+            max(0.0, time.time() - published_at)
+        )
+    correlation_id = (
+        get_header(task, 'correlation_id') or get_correlation_id() or task_id
+    )
+    token = _correlation_id.set(correlation_id)
+    tracker = metrics.tracking()
+    _running[task_id] = (token, tracker, tracker.__enter__(), start)
+
+
+@task_postrun.connect
+def finish_task(task_id=None, task=None, state=None, **kwargs):
+    """Record the runtime of a task, split into phases."""
+    running = _running.pop(task_id, None)
+    if running is None:
+        return
+    token, tracker, stats, start = running
+    seconds = time.perf_counter() - start
+    tracker.__exit__(None, None, None)
+    correlation_id = get_correlation_id()
+    _correlation_id.reset(token)
+    state = (state or 'unknown').lower()
+    phases = {
+        'db': stats.db_seconds,
+        'redis': stats.redis_seconds,
+        'template': stats.template_seconds,
+        **stats.phases,
+    }
+    phases['other'] = max(0.0, seconds - sum(phases.values()))
+    TASK_SECONDS.labels(task.name, state).observe(seconds)
+    TASK_RUNS.labels(task.name, state).inc()
+    for name, phase_seconds in phases.items():
+        TASK_PHASE_SECONDS.labels(task.name, name).observe(phase_seconds)
+    logger.info(
+        'Task %s[%s] %s in %.3fs for %s (%d queries, %s)',
+        task.name,
+        task_id,
+        state,
+        seconds,
+        correlation_id,
+        stats.db_queries,
+        ', '.join(f'{name} {value:.3f}s' for name, value in phases.items()),
+    )
+
+
+@worker_init.connect
+def serve_worker_metrics(**kwargs):
+    """Serve the metrics of the worker on ``CELERY_METRICS_PORT``."""
+    port = settings.CELERY_METRICS_PORT
+    if not port:
+        return
+    registry = None
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    try:
+        if registry is None:
+            start_http_server(port)
+        else:
+            start_http_server(port, registry=registry)
+    except OSError as e:
+        logger.warning('Could not serve worker metrics on port %s: %s', port, e)
+
+
+@worker_process_shutdown.connect
+def remove_process_metrics(pid=None, **kwargs):
+    """Drop the live gauges of a child process that exited."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -21,11 +21,22 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
+from .metrics import metrics_view
+from .profiling import profile_detail, profile_list
+
 urlpatterns = [
+    path('admin/profiles/', profile_list, name='profile_list'),
+    path(
+        'admin/profiles/<str:profile_id>/',
+        profile_detail,
+        name='profile_detail',
+    ),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('cart/', include('cart.urls', namespace='cart')),
     path('orders/', include('orders.urls', namespace='orders')),
     path('payment/', include('payment.urls', namespace='payment')),
+    path('analytics/', include('analytics.urls', namespace='analytics')),
     path('coupons/', include('coupons.urls', namespace='coupons')),
     path('', include('shop.urls', namespace='shop')),
 ]
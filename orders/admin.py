@@ -1,17 +1,23 @@
 import csv
 import datetime
+from functools import cache
 
 from django.contrib import admin
 from django.http import HttpResponse
 from django.urls import reverse
 from django.utils.safestring import mark_safe
+from myshop.pagination import EstimatedCountPaginator
+from myshop.replicas import replica_reads
 
 from .models import Order, OrderItem
 
 
+@replica_reads
 def export_to_csv(modeladmin, request, queryset):
     """Export selected orders to a CSV file.
 
+    The orders are read from a read replica when one is configured.
+
     Args:
         modeladmin (ModelAdmin): The model admin class.
         request (HttpRequest): The HTTP request object.
@@ -28,11 +34,12 @@ def export_to_csv(modeladmin, request, queryset):
     response['Content-Disposition'] = content_disposition
     writer = csv.writer(response)
     
-    # Get all fields excluding many-to-many and one-to-many fields
+    # Get the columns of the model, excluding many-to-many and reverse
+    # relations
     fields = [
         field
         for field in opts.get_fields()
-        if not field.many_to_many and not field.one_to_many
+        if field.concrete and not field.many_to_many
     ]
     
     # Write the header row
@@ -78,6 +85,44 @@ def order_payment(obj):
 order_payment.short_description = 'Stripe payment'
 
 
+def order_total(obj):
+    """Return the total cost of the order, annotated by
+    :meth:`OrderQuerySet.with_total_cost`.
+
+    Args:
+        obj (Order): The order object.
+
+    Returns:
+        str: The total cost after the discount.
+    """
+    return f'{obj.total_cost:.2f}'
+
+order_total.short_description = 'Total'
+order_total.admin_order_field = 'total_cost'
+
+
+# reversed into the order URLs in place of the order ID
+ORDER_ID_PLACEHOLDER = 2147483647
+
+
+@cache
+def get_order_url_format(name):
+    """Reverse an order URL once, with ``{}`` in place of the order ID.
+
+    The changelist links every order it shows to its detail page and
+    invoice; formatting a string is much cheaper than a ``reverse()`` per
+    link.
+
+    Args:
+        name (str): The name of a URL taking the order ID.
+
+    Returns:
+        str: The URL, to be completed with ``str.format()``.
+    """
+    url = reverse(name, args=[ORDER_ID_PLACEHOLDER])
+    return url.replace(str(ORDER_ID_PLACEHOLDER), '{}')
+
+
 def order_detail(obj):
     """Generate a link to the admin order detail view.
 
@@ -87,7 +132,7 @@ def order_detail(obj):
     Returns:
         str: A safe HTML link to the order detail view.
     """
-    url = reverse('orders:admin_order_detail', args=[obj.id])
+    url = get_order_url_format('orders:admin_order_detail').format(obj.id)
     return mark_safe(f'<a href="{url}">View</a>')
 
 
@@ -100,7 +145,7 @@ def order_pdf(obj):
     Returns:
         str: A safe HTML link to download the PDF invoice.
     """
-    url = reverse('orders:admin_order_pdf', args=[obj.id])
+    url = get_order_url_format('orders:admin_order_pdf').format(obj.id)
     return mark_safe(f'<a href="{url}">PDF</a>')
 
 order_pdf.short_description = 'Invoice'
@@ -108,22 +153,67 @@ order_pdf.short_description = 'Invoice'
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    """Admin interface for managing orders."""
+    """Admin interface for managing orders.
+
+    The order list is built for tables with millions of orders:
+
+    * the number of orders is estimated from the planner statistics (see
+      ``myshop/pagination.py``) and the unfiltered table is never counted;
+    * the dates are drilled down by ``created`` with range lookups on its
+      index, and the drill-down itself is built from the first and last
+      order of the period (see ``orders/templatetags/order_admin.py``);
+    * coupons are joined, and the total cost of each order is summed in
+      the same query, so a page runs a fixed number of queries;
+    * the links to the detail page and invoice are formatted from URLs
+      reversed once.
+    """
     list_display = [
         'id',
         'first_name',
         'last_name',
         'email',
-        'address',
-        'postal_code',
         'city',
         'paid',
         order_payment,
+        'coupon',
+        order_total,
         'created',
-        'updated',
         order_detail,
         order_pdf,
     ]
-    list_filter = ['paid', 'created', 'updated']
+    list_filter = ['paid']
+    list_select_related = ['coupon']
+    date_hierarchy = 'created'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = [OrderItemInline]
     actions = [export_to_csv]
+
+    def get_queryset(self, request):
+        """Get the orders with their total cost.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            QuerySet: The orders, annotated with ``total_cost``.
+        """
+        return super().get_queryset(request).with_total_cost()
+
+    def changelist_view(self, request, extra_context=None):
+        """Show the order list, read from a replica when just browsing.
+
+        Posted actions run on the primary, except the CSV export, which is a
+        report and uses a replica itself.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            extra_context (dict, optional): Extra template context.
+
+        Returns:
+            HttpResponse: The order list.
+        """
+        view = super().changelist_view
+        if request.method == 'GET':
+            view = replica_reads(view)
+        return view(request, extra_context)
@@ -0,0 +1,218 @@
+import logging
+import random
+import statistics
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.urls import reverse
+
+from orders import views
+from orders.models import Order
+from shop.models import Category, Product
+
+ORDER_DATA = {
+    'first_name': 'Bench',
+    'last_name': 'Mark',
+    'email': 'bench@example.com',
+    'address': '1 Main St',
+    'postal_code': '1000',
+    'city': 'London',
+}
+
+# the settings of a stock Django project: rollback journal, deferred
+# transactions, the 5 second sqlite3 timeout and a connection per request
+SQLITE_DEFAULTS = {
+    'OPTIONS': {
+        'timeout': 5,
+        'journal_mode': 'delete',
+        'synchronous': 'full',
+        'transaction_mode': 'DEFERRED',
+    },
+    'CONN_MAX_AGE': 0,
+}
+
+
+class Command(BaseCommand):
+    """
+    Benchmark concurrent checkouts against the configured database.
+
+    Worker threads play customers: each adds a product to a new cart and
+    posts the order form. Only the order form post is timed. The products
+    are few, so checkouts compete for the same stock rows. The run is
+    repeated with the database settings of a stock Django project and with
+    the configured settings, to show the effect of persistent connections
+    and, on SQLite, of WAL and immediate transactions.
+
+    The order confirmation task is not queued, since the benchmark measures
+    the database. The products and orders created are deleted at the end.
+    """
+    help = 'Benchmark concurrent order creation with different database settings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument(
+            '--products', type=int, default=5,
+            help='Number of products the orders compete for.',
+        )
+        parser.add_argument(
+            '--configured-only', action='store_true',
+            help='Skip the run with the stock Django settings.',
+        )
+
+    def post(self, client, path, data):
+        # the test client keeps connections open between requests, close
+        # them as the request signals of a server would
+        close_old_connections()
+        try:
+            return client.post(path, data)
+        finally:
+            close_old_connections()
+
+    def checkout(self, client, products):
+        product = random.choice(products)
+        self.post(
+            client,
+            reverse('cart:cart_add', args=[product.id]),
+            {'quantity': random.randint(1, 3), 'override': False},
+        )
+        start = time.perf_counter()
+        response = self.post(
+            client, reverse('orders:order_create'), ORDER_DATA
+        )
+        elapsed = time.perf_counter() - start
+        if response.status_code != 302:
+            return elapsed, None
+        return elapsed, client.session['order_id']
+
+    def get_host(self):
+        # any host accepted by ALLOWED_HOSTS, localhost is allowed in DEBUG
+        if settings.ALLOWED_HOSTS:
+            return settings.ALLOWED_HOSTS[0].lstrip('.*') or 'localhost'
+        return 'localhost'
+
+    def run(self, products, requests, threads):
+        host = self.get_host()
+        remaining = iter(range(requests))
+        lock = threading.Lock()
+        results = []
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if next(remaining, None) is None:
+                            return
+                    client = Client(
+                        HTTP_HOST=host, raise_request_exception=False
+                    )
+                    result = self.checkout(client, products)
+                    with lock:
+                        results.append(result)
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - start, results
+
+    def report(self, label, elapsed, results, opened):
+        latencies = sorted(latency for latency, _ in results)
+        failed = sum(1 for _, order_id in results if order_id is None)
+        p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+        self.stdout.write(
+            f'{label:<11} {len(results) / elapsed:8.1f} orders/s   '
+            f'p50 {statistics.median(latencies) * 1000:7.1f} ms   '
+            f'p95 {p95 * 1000:7.1f} ms   '
+            f'{failed:4d} failed   {opened:4d} connections'
+        )
+
+    def configure(self, overrides):
+        """Apply database settings for the next connections.
+
+        Returns:
+            dict: The previous settings, to restore them.
+        """
+        settings_dict = connections['default'].settings_dict
+        previous = {
+            'OPTIONS': dict(settings_dict['OPTIONS']),
+            'CONN_MAX_AGE': settings_dict['CONN_MAX_AGE'],
+        }
+        settings_dict['OPTIONS'].update(overrides.get('OPTIONS', {}))
+        settings_dict['CONN_MAX_AGE'] = overrides.get(
+            'CONN_MAX_AGE', settings_dict['CONN_MAX_AGE']
+        )
+        # reconnect now, so a journal mode change applies before the run
+        connections.close_all()
+        connections['default'].ensure_connection()
+        connections.close_all()
+        return previous
+
+    def get_configurations(self, options):
+        connection = connections['default']
+        configurations = []
+        if not options['configured_only']:
+            if connection.settings_dict['ENGINE'] == 'myshop.backends.sqlite3':
+                configurations.append(('stock', SQLITE_DEFAULTS))
+            else:
+                configurations.append(('stock', {'CONN_MAX_AGE': 0}))
+        configurations.append(('configured', {}))
+        return configurations
+
+    def handle(self, *args, **options):
+        category = Category.objects.create(
+            name='Benchmark', slug=f'bench-{random.randrange(10**9)}'
+        )
+        products = [
+            Product.objects.create(
+                category=category,
+                name=f'Benchmark {n}',
+                slug=f'benchmark-{n}',
+                price='9.99',
+                stock=options['requests'] * 3,
+            )
+            for n in range(options['products'])
+        ]
+        opened = []
+
+        def count_connection(sender, connection, **kwargs):
+            opened.append(connection.alias)
+
+        connection_created.connect(count_connection)
+        # failed requests are counted, not logged
+        request_logger = logging.getLogger('django.request')
+        level = request_logger.level
+        request_logger.setLevel(logging.CRITICAL)
+        order_ids = []
+        try:
+            with mock.patch.object(views, 'order_created'):
+                for label, overrides in self.get_configurations(options):
+                    previous = self.configure(overrides)
+                    opened.clear()
+                    try:
+                        elapsed, results = self.run(
+                            products, options['requests'], options['threads']
+                        )
+                    finally:
+                        self.configure(previous)
+                    order_ids.extend(
+                        order_id for _, order_id in results if order_id
+                    )
+                    self.report(label, elapsed, results, len(opened))
+        except OperationalError as e:
+            self.stderr.write(f'Database error: {e}')
+        finally:
+            request_logger.setLevel(level)
+            connection_created.disconnect(count_connection)
+            Order.objects.filter(id__in=order_ids).delete()
+            category.delete()
@@ -0,0 +1,108 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myshop import benchmarks, loadgen
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    """
+    Generate checkout traffic and report the latency of every step.
+
+    With ``--url`` the users browse a running shop, like the one started by
+    ``docker-compose up`` and ``runserver``, with its Redis, RabbitMQ and
+    Stripe (point ``STRIPE_API_BASE`` at a mock server such as
+    stripe-mock). The command must use the same database and webhook
+    secret as the shop. Without ``--url`` the users go through the Django
+    test client in this process, against the configured database, with
+    Stripe, Redis and the Celery tasks replaced by in-memory stand-ins.
+
+    Orders are placed for real, with e-mail addresses at
+    ``--email-domain``, so they can be found and deleted afterwards.
+    """
+    help = 'Simulate customers browsing, buying and paying, and report per-step latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument(
+            '--concurrency', type=int, default=10,
+            help='Most checkout flows running at the same time.',
+        )
+        parser.add_argument(
+            '--rate', type=float, default=0,
+            help='Users arriving per second, 0 for all at once.',
+        )
+        parser.add_argument(
+            '--url',
+            help='URL of a running shop, like http://localhost:8000.',
+        )
+        parser.add_argument('--coupon', help='Coupon code to apply.')
+        parser.add_argument('--email-domain', default='load.example.com')
+        parser.add_argument(
+            '--webhook-secret',
+            help='Secret to sign webhook deliveries with, '
+                 'STRIPE_WEBHOOK_SECRET by default.',
+        )
+
+    def report(self, recorder, elapsed):
+        self.stdout.write(
+            f'{recorder.completed} of {self.users} checkouts completed in '
+            f'{elapsed:.1f}s ({recorder.completed / elapsed:.1f}/s)'
+        )
+        self.stdout.write(
+            f"{'step':<16} {'requests':>8} {'errors':>7} {'req/s':>8} "
+            f"{'p50':>9} {'p95':>9} {'p99':>9}"
+        )
+        for row in recorder.report(elapsed):
+            latencies = ' '.join(
+                f'{row[q]:>6.1f} ms' if row[q] is not None else f"{'-':>9}"
+                for q in ('p50', 'p95', 'p99')
+            )
+            self.stdout.write(
+                f"{row['step']:<16} {row['requests']:>8} {row['errors']:>7} "
+                f"{row['throughput']:>8.1f} {latencies}"
+            )
+
+    def get_host(self):
+        # any host accepted by ALLOWED_HOSTS, localhost is allowed in DEBUG
+        if settings.ALLOWED_HOSTS:
+            return settings.ALLOWED_HOSTS[0].lstrip('.*') or 'localhost'
+        return 'localhost'
+
+    def handle(self, *args, **options):
+        self.users = options['users']
+        url = options['url']
+        kwargs = {
+            'users': self.users,
+            'concurrency': options['concurrency'],
+            'rate': options['rate'] or None,
+            'coupon': options['coupon'],
+            'email_domain': options['email_domain'],
+            'webhook_secret': options['webhook_secret'],
+        }
+        if url:
+            recorder, elapsed = loadgen.run(
+                lambda: loadgen.HTTPSession(url), **kwargs
+            )
+        else:
+            product_ids = list(
+                Product.objects.filter(available=True)
+                .values_list('id', flat=True)[:50]
+            )
+            if not product_ids:
+                raise CommandError('Add at least one available product first.')
+            # failed requests are counted, not logged
+            request_logger = logging.getLogger('django.request')
+            level = request_logger.level
+            request_logger.setLevel(logging.CRITICAL)
+            try:
+                with benchmarks.stubbed(product_ids):
+                    recorder, elapsed = loadgen.run(
+                        lambda: loadgen.ClientSession(self.get_host()),
+                        **kwargs,
+                    )
+            finally:
+                request_logger.setLevel(level)
+        self.report(recorder, elapsed)
@@ -1,9 +1,69 @@
+from datetime import timedelta
 from decimal import Decimal
 
 from coupons.models import Coupon
 from django.conf import settings
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models import (
+    DecimalField,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Prefetch,
+    Subquery,
+    Sum,
+    Value,
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+class OrderQuerySet(models.QuerySet):
+    """Custom queryset for orders."""
+
+    def with_items(self):
+        """Load orders together with their coupon, items and products.
+
+        Rendering an order (invoice, e-mails, payment summary) then runs a
+        fixed number of queries regardless of how many items it contains.
+
+        Returns:
+            QuerySet: Orders with ``coupon`` joined and ``items__product``
+            prefetched.
+        """
+        return self.select_related('coupon').prefetch_related(
+            Prefetch(
+                'items',
+                queryset=OrderItem.objects.select_related('product'),
+            )
+        )
+
+    def with_total_cost(self):
+        """Annotate orders with their total cost after the discount.
+
+        The cost of the items is summed by a correlated subquery rather than
+        a join, so the orders are not grouped and the database only sums
+        the items of the orders it returns. Lists can also be sorted by it.
+
+        Returns:
+            QuerySet: Orders with a ``total_cost`` Decimal, zero for orders
+            without items.
+        """
+        money = DecimalField(max_digits=12, decimal_places=2)
+        items = (
+            OrderItem.objects.filter(order=OuterRef('pk'))
+            .values('order')
+            .annotate(total=Sum(F('price') * F('quantity')))
+            .values('total')
+        )
+        cost = Coalesce(Subquery(items), Value(Decimal(0)), output_field=money)
+        return self.annotate(
+            total_cost=ExpressionWrapper(
+                cost * (Value(100) - F('discount')) / Value(100),
+                output_field=money,
+            )
+        )
 
 
 class Order(models.Model):
@@ -20,6 +80,9 @@ class Order(models.Model):
         updated (DateTimeField): The date and time the order was last updated.
         paid (BooleanField): Indicates if the order has been paid.
         stripe_id (CharField): The Stripe payment ID associated with the order.
+        stripe_session_id (CharField): The ID of the last Stripe checkout session.
+        stripe_session_url (TextField): The payment URL of the last checkout session.
+        stripe_session_expires (DateTimeField): When the last checkout session expires.
         coupon (ForeignKey): A coupon applied to the order (if any).
         discount (IntegerField): Discount percentage applied to the order.
 
@@ -28,6 +91,7 @@ class Order(models.Model):
         get_discount(): Returns the discount amount based on the total cost and discount percentage.
         get_total_cost(): Returns the total cost after applying the discount.
         get_stripe_url(): Returns the URL to view the payment on the Stripe dashboard.
+        has_valid_checkout_session(): Returns whether the last checkout session can be reused.
     """
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
@@ -39,6 +103,9 @@ class Order(models.Model):
     updated = models.DateTimeField(auto_now=True)
     paid = models.BooleanField(default=False)
     stripe_id = models.CharField(max_length=250, blank=True)
+    stripe_session_id = models.CharField(max_length=250, blank=True)
+    stripe_session_url = models.TextField(blank=True)
+    stripe_session_expires = models.DateTimeField(null=True, blank=True)
     coupon = models.ForeignKey(
         Coupon,
         related_name='orders',
@@ -51,6 +118,8 @@ class Order(models.Model):
         validators=[MinValueValidator(0), MaxValueValidator(100)],
     )
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created']
         indexes = [
@@ -103,6 +172,22 @@ class Order(models.Model):
             path = '/'
         return f'https://dashboard.stripe.com{path}payments/{self.stripe_id}'
 
+    def has_valid_checkout_session(self, margin=60):
+        """Checks whether the last Stripe checkout session can be reused.
+
+        Args:
+            margin (int): Seconds before expiry after which the session is no
+                longer considered valid, so customers are not sent to a page
+                that expires while they fill it in.
+
+        Returns:
+            bool: True if the session exists and is still valid.
+        """
+        if not self.stripe_session_id or not self.stripe_session_expires:
+            return False
+        limit = timezone.now() + timedelta(seconds=margin)
+        return self.stripe_session_expires > limit
+
 
 class OrderItem(models.Model):
     """Represents an item in an order.
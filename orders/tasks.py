@@ -1,5 +1,7 @@
 from celery import shared_task
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage
+
+from myshop import mail
 
 from .models import Order
 
@@ -13,20 +15,33 @@ def order_created(order_id):
         order_id (int): The ID of the created order.
 
     Returns:
-        int: The number of successfully delivered emails (1 if sent successfully, 0 otherwise).
+        int: The number of emails queued or delivered (1 on success).
 
     This task retrieves the order by its ID, constructs an email message containing the 
-    order details, and sends it to the customer. The email confirms that the order has 
-    been successfully placed.
+    order details, and hands it to the batched mail delivery layer. The email confirms
+    that the order has been successfully placed.
     """
-    order = Order.objects.get(id=order_id)
+    # only the columns needed for the notification
+    order = Order.objects.only('id', 'first_name', 'email').get(id=order_id)
     subject = f'Order nr. {order.id}'
     message = (
         f'Dear {order.first_name},\n\n'
         f'You have successfully placed an order.'
         f'Your order ID is {order.id}.'
     )
-    mail_sent = send_mail(
+    email = EmailMessage(
         subject, message, 'admin@myshop.com', [order.email]
     )
-    return mail_sent
+    return mail.deliver(email)
+
+
+@shared_task
+def flush_mail_outbox():
+    """
+    Periodic task that sends queued notification e-mails in batches.
+
+    Returns:
+        dict: Delivery statistics for the flush (messages sent, retried and
+        failed, number of batches and throughput).
+    """
+    return mail.flush_outbox()
@@ -1,2 +1,178 @@
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
 
-# Create your tests here.
+from django.core import mail as django_mail
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from coupons.models import Coupon
+from shop.models import Category, Product
+
+from .models import Order, OrderItem
+from .tasks import order_created
+
+
+@override_settings(MAIL_BATCHING=False)
+class OrderCreatedTaskTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        cls.order = Order.objects.create(
+            first_name='Ada',
+            last_name='Lovelace',
+            email='ada@example.com',
+            address='1 Main St',
+            postal_code='1000',
+            city='London',
+        )
+        for n in range(5):
+            product = Product.objects.create(
+                category=category, name=f'Shirt {n}', slug=f'shirt-{n}',
+                price='10.00',
+            )
+            OrderItem.objects.create(
+                order=cls.order, product=product, price='10.00', quantity=1
+            )
+
+    def test_order_created_runs_a_single_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(order_created(self.order.id), 1)
+        self.assertEqual(django_mail.outbox[0].to, ['ada@example.com'])
+
+    def test_with_items_query_count_is_independent_of_item_count(self):
+        with self.assertNumQueries(2):
+            order = Order.objects.with_items().get(id=self.order.id)
+            names = [item.product.name for item in order.items.all()]
+            total = order.get_total_cost()
+        self.assertEqual(len(names), 5)
+        self.assertEqual(str(total), '50.00')
+
+
+@override_settings(COUPON_BLOOM_FILTER=False)
+class OrderAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'x'
+        )
+        category = Category.objects.create(name='Tea', slug='tea')
+        cls.tea = Product.objects.create(
+            category=category, name='Green', slug='green', price='4.50'
+        )
+        cls.coupon = Coupon.objects.create(
+            code='SPRING',
+            valid_from=datetime(2020, 1, 1, tzinfo=dt_timezone.utc),
+            valid_to=datetime(2030, 1, 1, tzinfo=dt_timezone.utc),
+            discount=10,
+            active=True,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        self.url = reverse('admin:orders_order_changelist')
+
+    def create_orders(self, count, created=()):
+        orders = []
+        for n in range(count):
+            coupon = self.coupon if n % 2 else None
+            order = Order.objects.create(
+                first_name='Ada', last_name='Lovelace',
+                email='ada@example.com', address='1 Main St',
+                postal_code='1000', city='London', coupon=coupon,
+                discount=coupon.discount if coupon else 0,
+            )
+            OrderItem.objects.create(
+                order=order, product=self.tea, price='4.50', quantity=n + 1
+            )
+            orders.append(order)
+        for order, day in zip(orders, created):
+            Order.objects.filter(id=order.id).update(created=day)
+        return orders
+
+    def test_queries_do_not_grow_with_the_orders(self):
+        self.create_orders(2)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(self.url)
+        self.create_orders(20)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(self.url)
+        self.assertEqual(len(many), len(few))
+        self.assertEqual(len(response.context['cl'].result_list), 22)
+        for query in many.captured_queries:
+            self.assertNotIn('DISTINCT', query['sql'])
+
+    def test_total_cost_and_links(self):
+        order = self.create_orders(2)[1]
+        response = self.client.get(self.url)
+        totals = {
+            row.id: row.total_cost
+            for row in response.context['cl'].result_list
+        }
+        self.assertEqual(totals[order.id], Decimal('8.10'))
+        self.assertEqual(totals[order.id], order.get_total_cost())
+        self.assertContains(response, '8.10')
+        self.assertContains(
+            response,
+            f'href="{reverse("orders:admin_order_pdf", args=[order.id])}"',
+        )
+        self.assertContains(
+            response,
+            f'href="{reverse("orders:admin_order_detail", args=[order.id])}"',
+        )
+        self.assertEqual(
+            list(
+                Order.objects.with_total_cost()
+                .order_by('total_cost')
+                .values_list('total_cost', flat=True)
+            ),
+            [Decimal('4.50'), Decimal('8.10')],
+        )
+
+    def test_large_lists_show_estimated_counts(self):
+        self.create_orders(3)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        # added after the statistics were collected
+        self.create_orders(1)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['cl'].result_count, 4)
+        with self.settings(ADMIN_COUNT_ESTIMATE_THRESHOLD=2):
+            response = self.client.get(self.url)
+            cl = response.context['cl']
+            self.assertEqual(cl.result_count, 3)
+            self.assertEqual(len(cl.result_list), 4)
+            self.assertIsNone(cl.full_result_count)
+            # SQLite cannot estimate filtered lists
+            response = self.client.get(self.url, {'paid__exact': '0'})
+            self.assertEqual(response.context['cl'].result_count, 4)
+
+    def test_date_hierarchy_spans_the_first_and_last_order(self):
+        self.create_orders(3, created=[
+            datetime(2023, 5, 1, 12, tzinfo=dt_timezone.utc),
+            datetime(2025, 2, 1, 12, tzinfo=dt_timezone.utc),
+            datetime(2025, 4, 10, 12, tzinfo=dt_timezone.utc),
+        ])
+
+        def titles(**params):
+            response = self.client.get(self.url, params)
+            return [
+                choice['title'] for choice in response.context['choices']
+            ]
+
+        self.assertEqual(titles(), ['2023', '2024', '2025'])
+        self.assertEqual(
+            titles(created__year='2025'),
+            ['February 2025', 'March 2025', 'April 2025'],
+        )
+        self.assertEqual(titles(created__year='2024'), [])
+        self.assertEqual(
+            len(titles(created__year='2025', created__month='2')), 1
+        )
+        self.assertEqual(
+            titles(created__year='2025', created__month='4',
+                   created__day='10'),
+            ['April 10'],
+        )
@@ -1,11 +1,14 @@
-import weasyprint
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.staticfiles import finders
+from django.db import transaction
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 
 from cart.cart import Cart
+from coupons.redemptions import RedemptionLimitReached, redeem
+from myshop.replicas import replica_reads
+from shop.inventory import OutOfStock, reserve_stock
 from .forms import OrderCreateForm
 from .models import Order, OrderItem
 from .tasks import order_created
@@ -21,6 +24,12 @@ def order_create(request):
     launched to send a confirmation email. The order is saved in the session,
     and the user is redirected to the payment process.
 
+    The stock of the ordered products is reserved and the coupon redemption
+    is counted in the same transaction as the order. If a product is out of
+    stock, no order is created and the form is shown with an error. If the
+    coupon has reached its redemption cap, the coupon is also removed from
+    the cart.
+
     Args:
         request (HttpRequest): The HTTP request object containing user data
             and the POST data from the order form.
@@ -34,22 +43,36 @@ def order_create(request):
     if request.method == 'POST':
         form = OrderCreateForm(request.POST)
         if form.is_valid():
-            order = form.save(commit=False)
-            if cart.coupon:
-                order.coupon = cart.coupon
-                order.discount = cart.coupon.discount
-            order.save()
-            for item in cart:
-                OrderItem.objects.create(
-                    order=order,
-                    product=item['product'],
-                    price=item['price'],
-                    quantity=item['quantity'],
-                )
-            cart.clear()
-            order_created.delay(order.id)
-            request.session['order_id'] = order.id
-            return redirect('payment:process')
+            try:
+                with transaction.atomic():
+                    order = form.save(commit=False)
+                    if cart.coupon:
+                        order.coupon = cart.coupon
+                        order.discount = cart.coupon.discount
+                    order.save()
+                    for item in cart:
+                        OrderItem.objects.create(
+                            order=order,
+                            product=item['product'],
+                            price=item['price'],
+                            quantity=item['quantity'],
+                        )
+                    # stock and coupon counters are updated last, so their
+                    # rows are locked briefly
+                    reserve_stock(order)
+                    if order.coupon:
+                        redeem(order.coupon, order.email)
+            except OutOfStock as e:
+                form.add_error(None, str(e))
+            except RedemptionLimitReached as e:
+                request.session['coupon_id'] = None
+                cart = Cart(request)
+                form.add_error(None, f'{e} It has been removed from your cart.')
+            else:
+                cart.clear()
+                order_created.delay(order.id)
+                request.session['order_id'] = order.id
+                return redirect('payment:process')
     else:
         form = OrderCreateForm()
     return render(
@@ -60,6 +83,7 @@ def order_create(request):
 
 
 @staff_member_required
+@replica_reads
 def admin_order_detail(request, order_id):
     """
     Display the details of a specific order in the admin panel.
@@ -75,13 +99,14 @@ def admin_order_detail(request, order_id):
     Returns:
         HttpResponse: Renders the admin order detail template.
     """
-    order = get_object_or_404(Order, id=order_id)
+    order = get_object_or_404(Order.objects.with_items(), id=order_id)
     return render(
         request, 'admin/orders/order/detail.html', {'order': order}
     )
 
 
 @staff_member_required
+@replica_reads
 def admin_order_pdf(request, order_id):
     """
     Generate a PDF invoice for a specific order in the admin panel.
@@ -98,7 +123,10 @@ def admin_order_pdf(request, order_id):
         HttpResponse: A response object containing the generated PDF, with
         appropriate content type and headers for downloading the file.
     """
-    order = get_object_or_404(Order, id=order_id)
+    # imported here, so web workers only load WeasyPrint when asked for a PDF
+    import weasyprint
+
+    order = get_object_or_404(Order.objects.with_items(), id=order_id)
     html = render_to_string('orders/order/pdf.html', {'order': order})
     response = HttpResponse(content_type='application/pdf')
     response['Content-Disposition'] = f'filename=order_{order.id}.pdf'
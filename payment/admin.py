@@ -1,2 +1,19 @@
+from django.contrib import admin
 
-# Register your models here.
+from .models import StripeCoupon, StripeEvent
+
+
+@admin.register(StripeCoupon)
+class StripeCouponAdmin(admin.ModelAdmin):
+    """Admin interface listing the coupons created in Stripe."""
+    list_display = ['code', 'percent_off', 'stripe_id', 'created']
+    search_fields = ['code', 'stripe_id']
+    readonly_fields = ['created']
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    """Admin interface listing the processed Stripe webhook events."""
+    list_display = ['event_id', 'type', 'created']
+    list_filter = ['type']
+    search_fields = ['event_id']
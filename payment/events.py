@@ -0,0 +1,286 @@
+"""
+Processing of Stripe webhook events.
+
+Events are either handled synchronously by the webhook view or, when
+``STRIPE_WEBHOOK_QUEUE`` is enabled, stored by the view and processed in
+batches by :func:`process_pending_events`, which runs from a Celery task
+and from the ``process_webhook_events`` management command.
+"""
+import json
+import logging
+
+from analytics.rollups import record_sales
+from django.db import transaction
+from django.db.models import Case, CharField, F, Value, When
+from django.utils import timezone
+from myshop.tracing import correlation
+from orders.models import Order, OrderItem
+from prometheus_client import Counter, Gauge, Histogram
+from shop.inventory import reclaim_stock
+from shop.models import Product
+from shop.recommender import Recommender
+
+from .models import StripeEvent
+from .tasks import payment_completed
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_EVENTS_RECEIVED = Counter(
+    'myshop_stripe_webhook_events_received_total',
+    'Stripe webhook events accepted by the webhook view.',
+    ['mode'],
+)
+WEBHOOK_EVENTS_PROCESSED = Counter(
+    'myshop_stripe_webhook_events_processed_total',
+    'Queued Stripe webhook events processed by the workers.',
+    ['type'],
+)
+WEBHOOK_PROCESSING_LAG = Histogram(
+    'myshop_stripe_webhook_lag_seconds',
+    'Time between receiving a queued webhook event and processing it.',
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900),
+)
+WEBHOOK_BACKLOG = Gauge(
+    'myshop_stripe_webhook_backlog',
+    'Queued webhook events waiting to be processed.',
+)
+
+
+class InvalidEvent(ValueError):
+    """A payment event that does not identify an order of the shop."""
+
+
+def get_paid_session(event):
+    """
+    Return the order and payment of a completed checkout event.
+
+    Args:
+        event (dict): The Stripe event, as a ``stripe.Event`` or parsed JSON.
+
+    Returns:
+        tuple: The order ID and Stripe payment ID, or None if the event is
+        not a successful payment.
+
+    Raises:
+        InvalidEvent: If the session has no valid order ID, for example a
+            session created from a Payment Link or the Stripe dashboard.
+    """
+    if event['type'] != 'checkout.session.completed':
+        return None
+    session = event['data']['object']
+    # Check if the session is for a successful payment
+    if session['mode'] != 'payment' or session['payment_status'] != 'paid':
+        return None
+    reference = session.get('client_reference_id')
+    try:
+        order_id = int(reference)
+    except (TypeError, ValueError):
+        raise InvalidEvent(f'No order ID in checkout session: {reference!r}')
+    return order_id, session['payment_intent']
+
+
+def parse_event(event):
+    """
+    Return the order and payment of a queued event, or None if it does not
+    pay an order.
+
+    A malformed event is logged and skipped rather than raising, so it
+    cannot roll back the batch it is processed with and hold up the queue.
+
+    Args:
+        event (StripeEvent): The queued event.
+
+    Returns:
+        tuple: The order ID and Stripe payment ID, or None.
+    """
+    try:
+        return get_paid_session(json.loads(event.payload))
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(
+            'Skipping malformed webhook event %s: %s', event.event_id, e
+        )
+        return None
+
+
+def order_paid(order_id, event_id=None):
+    """
+    Run the side effects of an order being paid.
+
+    Records the products bought together for recommendations and launches
+    the task that sends the invoice.
+
+    Args:
+        order_id (int): The ID of the paid order.
+        event_id (str, optional): The ID of the Stripe event that paid the
+            order, passed on to the task as its correlation id.
+    """
+    # Save items bought for product recommendations
+    product_ids = OrderItem.objects.filter(order_id=order_id).values_list(
+        'product_id', flat=True
+    )
+    products = Product.objects.filter(id__in=product_ids)
+    r = Recommender()
+    r.products_bought(products)
+
+    # Launch asynchronous task to process payment completion
+    with correlation(event_id):
+        payment_completed.delay(order_id)
+
+
+def mark_order_paid(order_id, payment_intent, event_id=None):
+    """
+    Mark an order as paid if it is not paid yet.
+
+    The order is updated with a single conditional ``UPDATE`` so concurrent
+    deliveries of the same payment cannot both succeed. The side effects of
+    the payment are scheduled to run after the current transaction commits,
+    and only if this call changed the order. The order is added to the
+    sales rollups in the same transaction, and takes its stock again if
+    its reservation was released meanwhile (see ``shop/inventory.py``).
+
+    Args:
+        order_id (int): The ID of the order.
+        payment_intent (str): The Stripe payment ID to store on the order.
+        event_id (str, optional): The ID of the Stripe event that paid the
+            order.
+
+    Returns:
+        bool: True if the order was marked as paid by this call.
+
+    Raises:
+        Order.DoesNotExist: If there is no order with the given ID.
+    """
+    updated = Order.objects.filter(id=order_id, paid=False).update(
+        paid=True,
+        stripe_id=payment_intent,
+        updated=timezone.now(),
+    )
+    if not updated:
+        if not Order.objects.filter(id=order_id).exists():
+            raise Order.DoesNotExist
+        return False
+    reclaim_stock([order_id])
+    record_sales([order_id])
+    transaction.on_commit(lambda: order_paid(order_id, event_id))
+    return True
+
+
+def mark_orders_paid(payments, event_ids=None):
+    """
+    Mark several orders as paid with a single ``UPDATE``.
+
+    Must be called inside a transaction. The unpaid orders are locked first,
+    so only the orders changed by this call get their side effects
+    scheduled, are added to the sales rollups and take back released
+    stock.
+
+    Args:
+        payments (dict): Stripe payment IDs keyed by order ID.
+        event_ids (dict, optional): The IDs of the Stripe events that paid
+            the orders, keyed by order ID.
+
+    Returns:
+        set: The IDs of the orders marked as paid by this call.
+    """
+    pending = set(
+        Order.objects.select_for_update()
+        .filter(id__in=payments, paid=False)
+        .order_by()
+        .values_list('id', flat=True)
+    )
+    if not pending:
+        return pending
+    Order.objects.filter(id__in=pending, paid=False).update(
+        paid=True,
+        stripe_id=Case(
+            *[When(id=id, then=Value(payments[id])) for id in pending],
+            default=F('stripe_id'),
+            output_field=CharField(),
+        ),
+        updated=timezone.now(),
+    )
+    reclaim_stock(pending)
+    record_sales(pending)
+    event_ids = event_ids or {}
+    for order_id in pending:
+        transaction.on_commit(
+            lambda order_id=order_id: order_paid(
+                order_id, event_ids.get(order_id)
+            )
+        )
+    return pending
+
+
+def process_pending_events(batch_size=100):
+    """
+    Process one batch of queued webhook events.
+
+    The batch is claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the
+    database supports it, so several workers can drain the queue at once.
+    All orders paid by the batch are updated in the same transaction.
+    Malformed events and events for unknown orders are logged and marked
+    as processed with the rest of the batch.
+
+    Args:
+        batch_size (int): The maximum number of events to process.
+
+    Returns:
+        int: The number of events processed.
+    """
+    with transaction.atomic():
+        events = list(
+            StripeEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed__isnull=True)
+            .order_by('created')[:batch_size]
+        )
+        if not events:
+            return 0
+        payments = {}
+        event_ids = {}
+        for event in events:
+            paid_session = parse_event(event)
+            if paid_session:
+                order_id, payment_intent = paid_session
+                payments.setdefault(order_id, payment_intent)
+                event_ids.setdefault(order_id, event.event_id)
+        paid = mark_orders_paid(payments, event_ids)
+        skipped = payments.keys() - paid
+        if skipped:
+            known = Order.objects.filter(id__in=skipped).values_list(
+                'id', flat=True
+            )
+            for order_id in skipped - set(known):
+                logger.warning('Webhook event for unknown order %s', order_id)
+        now = timezone.now()
+        StripeEvent.objects.filter(
+            id__in=[event.id for event in events], processed__isnull=True
+        ).update(processed=now)
+    for event in events:
+        WEBHOOK_EVENTS_PROCESSED.labels(event.type).inc()
+        WEBHOOK_PROCESSING_LAG.observe((now - event.created).total_seconds())
+    return len(events)
+
+
+def drain(batch_size=100, max_batches=None):
+    """
+    Process queued webhook events until the queue is empty.
+
+    Args:
+        batch_size (int): The number of events per transaction.
+        max_batches (int, optional): Stop after this many batches.
+
+    Returns:
+        int: The number of events processed.
+    """
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        processed = process_pending_events(batch_size)
+        if not processed:
+            break
+        total += processed
+        batches += 1
+    WEBHOOK_BACKLOG.set(
+        StripeEvent.objects.filter(processed__isnull=True).count()
+    )
+    return total
@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from payment.events import drain
+
+
+class Command(BaseCommand):
+    """
+    Process queued Stripe webhook events with a pool of worker threads.
+
+    Each worker claims batches of events and updates all the orders paid by
+    a batch in a single transaction. With ``--loop`` the workers keep
+    polling the queue instead of exiting once it is empty.
+    """
+    help = 'Process queued Stripe webhook events in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of worker threads.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.STRIPE_WEBHOOK_BATCH_SIZE,
+            help='Events processed per transaction.',
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep polling for new events.',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait when the queue is empty (with --loop).',
+        )
+
+    def work(self, batch_size, loop, interval):
+        """Drain the queue from one worker thread."""
+        total = 0
+        try:
+            while True:
+                processed = drain(batch_size=batch_size)
+                total += processed
+                if not loop:
+                    return total
+                if not processed:
+                    time.sleep(interval)
+        finally:
+            close_old_connections()
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            futures = [
+                pool.submit(
+                    self.work,
+                    options['batch_size'],
+                    options['loop'],
+                    options['interval'],
+                )
+                for _ in range(options['workers'])
+            ]
+            total = sum(future.result() for future in futures)
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f'Processed {total} events in {elapsed:.2f}s '
+            f'({total / elapsed if elapsed else 0:.0f} events/s)'
+        )
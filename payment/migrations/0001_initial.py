@@ -0,0 +1,29 @@
+# Generated by Django 5.0.9 on 2026-10-19 09:23
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeCoupon',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=50)),
+                ('percent_off', models.IntegerField(validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(100)])),
+                ('stripe_id', models.CharField(max_length=250)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stripecoupon',
+            constraint=models.UniqueConstraint(fields=('code', 'percent_off'), name='unique_stripe_coupon'),
+        ),
+    ]
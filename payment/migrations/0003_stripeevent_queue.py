@@ -0,0 +1,39 @@
+# Generated by Django 5.0.9 on 2026-10-19 09:29
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_existing_processed(apps, schema_editor):
+    # events recorded before the queue existed were processed on receipt
+    StripeEvent = apps.get_model('payment', 'StripeEvent')
+    StripeEvent.objects.filter(processed__isnull=True).update(
+        processed=F('created')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0002_stripeevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeevent',
+            name='payload',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='processed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(
+            mark_existing_processed, migrations.RunPython.noop
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(condition=models.Q(('processed__isnull', True)), fields=['created'], name='stripe_event_pending_idx'),
+        ),
+    ]
@@ -1,2 +1,71 @@
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models
 
-# Create your models here.
+
+class StripeCoupon(models.Model):
+    """Maps a local coupon code and discount to a coupon created in Stripe.
+
+    Stripe coupons are created once per (code, discount) pair and reused
+    for every checkout session that applies the same coupon.
+
+    Attributes:
+        code (CharField): The local coupon code.
+        percent_off (IntegerField): The discount percentage of the coupon.
+        stripe_id (CharField): The ID of the coupon in Stripe.
+        created (DateTimeField): When the Stripe coupon was created.
+    """
+    code = models.CharField(max_length=50)
+    percent_off = models.IntegerField(
+        validators=[MinValueValidator(0), MaxValueValidator(100)],
+    )
+    stripe_id = models.CharField(max_length=250)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['code', 'percent_off'],
+                name='unique_stripe_coupon',
+            ),
+        ]
+
+    def __str__(self):
+        """Returns a string representation of the Stripe coupon."""
+        return f'{self.code} ({self.percent_off}% off)'
+
+
+class StripeEvent(models.Model):
+    """A Stripe webhook event received by the shop.
+
+    Stripe delivers events at least once. Recording the ID of each event
+    lets retries of the same event be acknowledged without running their
+    side effects again. Events received in queue mode keep their raw
+    payload until a worker processes them.
+
+    Attributes:
+        event_id (CharField): The unique ID of the event in Stripe.
+        type (CharField): The event type, e.g. ``checkout.session.completed``.
+        payload (TextField): The raw event body, for queued events.
+        created (DateTimeField): When the event was received.
+        processed (DateTimeField): When the event was processed, or None
+            while it is waiting in the queue.
+    """
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+        indexes = [
+            models.Index(
+                fields=['created'],
+                condition=models.Q(processed__isnull=True),
+                name='stripe_event_pending_idx',
+            ),
+        ]
+
+    def __str__(self):
+        """Returns a string representation of the event."""
+        return self.event_id
@@ -0,0 +1,87 @@
+"""
+Shared Stripe client.
+
+All Stripe API calls go through the client returned by :func:`get_client`.
+It keeps connections to Stripe alive between requests in a bounded pool,
+applies connect and read timeouts, retries network failures a bounded number
+of times and records the latency of every API call in a Prometheus
+histogram labelled by HTTP method and API path.
+
+The Stripe library takes a while to import, so it is only imported when
+the client is first needed, and web workers that never call Stripe do not
+load it.
+"""
+import re
+import threading
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from prometheus_client import Histogram
+
+STRIPE_REQUEST_SECONDS = Histogram(
+    'myshop_stripe_request_duration_seconds',
+    'Latency of Stripe API calls.',
+    ['method', 'endpoint', 'status'],
+)
+
+# Resource names are lowercase, object IDs (cs_test_a1B2, Z4OV52SU) are not
+RESOURCE_SEGMENT = re.compile(r'^[a-z_]*$')
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_endpoint(url):
+    """Return the API path of a Stripe URL with object IDs replaced.
+
+    Args:
+        url (str): The requested URL.
+
+    Returns:
+        str: The path, for example ``/v1/checkout/sessions/:id``.
+    """
+    version, *segments = urlsplit(url).path.lstrip('/').split('/')
+    segments = [
+        segment if RESOURCE_SEGMENT.match(segment) else ':id'
+        for segment in segments
+    ]
+    return '/'.join(['', version, *segments])
+
+
+def get_client():
+    """Return the shared Stripe client, creating it on first use.
+
+    Returns:
+        stripe.StripeClient: The configured client.
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import stripe
+
+                from .stripe_http import PooledRequestsClient
+
+                http_client = PooledRequestsClient(
+                    connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+                    read_timeout=settings.STRIPE_READ_TIMEOUT,
+                    pool_size=settings.STRIPE_POOL_SIZE,
+                )
+                _client = stripe.StripeClient(
+                    settings.STRIPE_SECRET_KEY,
+                    stripe_version=settings.STRIPE_API_VERSION,
+                    base_addresses={'api': settings.STRIPE_API_BASE},
+                    max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+                    http_client=http_client,
+                )
+    return _client
+
+
+def reset_client():
+    """Discard the shared client so the next call builds a new one.
+
+    Used when the Stripe settings change, for example in tests.
+    """
+    global _client
+    with _lock:
+        _client = None
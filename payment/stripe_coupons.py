@@ -0,0 +1,66 @@
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+from .models import StripeCoupon
+from .stripe_client import get_client
+
+
+def get_cache_key(code, percent_off):
+    """Get the cache key for the Stripe coupon of a code and discount.
+
+    Args:
+        code (str): The local coupon code.
+        percent_off (int): The discount percentage.
+
+    Returns:
+        str: The cache key.
+    """
+    return f'payment:stripe_coupon:{percent_off}:{code}'
+
+
+def get_stripe_coupon_id(code, percent_off):
+    """Return the ID of the Stripe coupon for a code and discount.
+
+    The ID is looked up in the cache first and then in the local
+    ``StripeCoupon`` table. The coupon is only created in Stripe when no
+    mapping exists yet. Concurrent first uses send the same idempotency key,
+    so Stripe returns the same coupon to all of them.
+
+    Args:
+        code (str): The local coupon code.
+        percent_off (int): The discount percentage.
+
+    Returns:
+        str: The ID of the coupon in Stripe.
+    """
+    key = get_cache_key(code, percent_off)
+    stripe_id = cache.get(key)
+    if stripe_id:
+        return stripe_id
+    stripe_id = (
+        StripeCoupon.objects.filter(code=code, percent_off=percent_off)
+        .values_list('stripe_id', flat=True)
+        .first()
+    )
+    if stripe_id is None:
+        stripe_coupon = get_client().coupons.create(
+            params={
+                'name': code,
+                'percent_off': percent_off,
+                'duration': 'once',
+            },
+            options={'idempotency_key': f'coupon-{percent_off}-{code}'},
+        )
+        stripe_id = stripe_coupon.id
+        try:
+            with transaction.atomic():
+                StripeCoupon.objects.create(
+                    code=code, percent_off=percent_off, stripe_id=stripe_id
+                )
+        except IntegrityError:
+            # another request stored the mapping first
+            stripe_id = StripeCoupon.objects.get(
+                code=code, percent_off=percent_off
+            ).stripe_id
+    cache.set(key, stripe_id, timeout=None)
+    return stripe_id
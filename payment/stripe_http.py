@@ -0,0 +1,71 @@
+"""
+HTTP transport of the shared Stripe client.
+
+Kept apart from ``payment/stripe_client.py`` because subclassing the
+``requests`` client of Stripe imports the Stripe library, which
+:func:`payment.stripe_client.get_client` only does on first use.
+"""
+import time
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+from .stripe_client import STRIPE_REQUEST_SECONDS, get_endpoint
+
+
+class PooledRequestsClient(stripe.RequestsClient):
+    """Stripe HTTP client with a keep-alive connection pool and metrics.
+
+    Each thread gets its own ``requests`` session with an adapter that keeps
+    up to ``pool_size`` connections open, so TLS setup is paid once per
+    connection instead of once per API call.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, pool_size, **kwargs):
+        super().__init__(timeout=(connect_timeout, read_timeout), **kwargs)
+        self.pool_size = pool_size
+
+    def get_session(self):
+        """Return the session of the current thread, creating it if needed.
+
+        Returns:
+            requests.Session: A session with a pooled HTTP adapter.
+        """
+        session = getattr(self._thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self.pool_size,
+                max_retries=0,
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._thread_local.session = session
+        return session
+
+    def request(self, method, url, headers, post_data=None):
+        """Send a request to Stripe and record its latency.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL to request.
+            headers (dict): The request headers.
+            post_data (str, optional): The encoded request body.
+
+        Returns:
+            tuple: The response body, status code and headers.
+        """
+        self.get_session()
+        status = 'error'
+        start = time.perf_counter()
+        try:
+            content, status, response_headers = super().request(
+                method, url, headers, post_data
+            )
+            return content, status, response_headers
+        finally:
+            STRIPE_REQUEST_SECONDS.labels(
+                method.lower(), get_endpoint(url), str(status)
+            ).observe(time.perf_counter() - start)
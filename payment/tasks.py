@@ -1,10 +1,12 @@
 from io import BytesIO
 
-import weasyprint
 from celery import shared_task
+from django.conf import settings
 from django.contrib.staticfiles import finders
 from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
+from myshop import mail
+from myshop.metrics import phase
 from orders.models import Order
 
 
@@ -13,8 +15,14 @@ def payment_completed(order_id):
     """
     Task to send an e-mail notification when an order is
     successfully paid.
+
+    The order is loaded with its coupon, items and products up front, so
+    rendering the invoice does not query the database once per item.
     """
-    order = Order.objects.get(id=order_id)
+    # imported here, so workers only load WeasyPrint when an invoice is due
+    import weasyprint
+
+    order = Order.objects.with_items().get(id=order_id)
     # create invoice e-mail
     subject = f'My Shop - Invoice no. {order.id}'
     message = (
@@ -26,11 +34,25 @@ def payment_completed(order_id):
     # generate PDF
     html = render_to_string('orders/order/pdf.html', {'order': order})
     out = BytesIO()
-    stylesheets = [weasyprint.CSS(finders.find('css/pdf.css'))]
-    weasyprint.HTML(string=html).write_pdf(out, stylesheets=stylesheets)
+    with phase('pdf'):
+        stylesheets = [weasyprint.CSS(finders.find('css/pdf.css'))]
+        weasyprint.HTML(string=html).write_pdf(out, stylesheets=stylesheets)
     # attach PDF file
     email.attach(
         f'order_{order.id}.pdf', out.getvalue(), 'application/pdf'
     )
     # send e-mail
-    email.send()
+    mail.deliver(email)
+
+
+@shared_task
+def process_webhook_events():
+    """
+    Periodic task that processes queued Stripe webhook events in batches.
+
+    Returns:
+        int: The number of events processed.
+    """
+    from .events import drain
+
+    return drain(batch_size=settings.STRIPE_WEBHOOK_BATCH_SIZE)
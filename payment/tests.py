@@ -1,2 +1,672 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import stripe
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.db import IntegrityError, connection
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from coupons.models import Coupon
+from myshop.benchmarks import StubCSS, StubHTML, stub_module
+from myshop.tracing import get_correlation_id
+from orders.models import Order, OrderItem
+from prometheus_client import REGISTRY
+from shop.inventory import reserve_stock
+from shop.models import Category, Product, StockReservation
+
+from .events import drain, process_pending_events
+from .models import StripeCoupon, StripeEvent
+from .stripe_client import get_client, get_endpoint, reset_client
+from .stripe_coupons import get_stripe_coupon_id
+from .tasks import payment_completed
+from .views import CHECKOUT_ERROR, payment_process_async
+
+
+class MockStripeHandler(BaseHTTPRequestHandler):
+    """Answers the Stripe API calls made by the shop with canned objects."""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        time.sleep(server.latency)
+        key = (self.path, self.headers.get('Idempotency-Key'))
+        status = 200
+        with server.lock:
+            if server.error:
+                status = 500
+                body = {'error': {'type': 'api_error', 'message': 'Down'}}
+            elif key not in server.responses:
+                server.calls.append(self.path)
+                server.keys.append(key[1])
+                server.params.append(params)
+                server.key_params[key] = params
+                server.responses[key] = server.create_object(
+                    self.path, params, len(server.calls)
+                )
+                body = server.responses[key]
+            elif server.key_params[key] != params:
+                status = 400
+                body = {
+                    'error': {
+                        'type': 'idempotency_error',
+                        'message': 'Keys for idempotent requests can only '
+                        'be used with the same parameters.',
+                    }
+                }
+            else:
+                body = server.responses[key]
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockStripeServer(ThreadingHTTPServer):
+    """Local stand-in for the Stripe API with simulated latency.
+
+    Requests repeated with the same idempotency key get the original
+    response, and are rejected if their parameters differ, as they would
+    be by Stripe. Every request fails while ``error`` is set.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, session_ttl=3600):
+        super().__init__(('127.0.0.1', 0), MockStripeHandler)
+        self.latency = latency
+        self.session_ttl = session_ttl
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.calls = []
+        self.keys = []
+        self.params = []
+        self.key_params = {}
+        self.responses = {}
+        self.error = False
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def create_object(self, path, params, n):
+        if path == '/v1/coupons':
+            return {
+                'id': f'coupon_{n}',
+                'object': 'coupon',
+                'name': params['name'][0],
+                'percent_off': int(params['percent_off'][0]),
+            }
+        return {
+            'id': f'cs_test_{n}',
+            'object': 'checkout.session',
+            'url': f'https://checkout.test/{n}',
+            'expires_at': int(time.time()) + self.session_ttl,
+        }
+
+    def handle_error(self, request, client_address):
+        # the client gave up on a slow response
+        pass
+
+
+class StripeServerMixin:
+    """Points the shared Stripe client at a local mock server."""
+    stripe_latency = 0.0
+
+    def setUp(self):
+        super().setUp()
+        self.stripe = MockStripeServer(latency=self.stripe_latency)
+        thread = threading.Thread(target=self.stripe.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.stripe.server_close)
+        self.addCleanup(self.stripe.shutdown)
+        stripe_settings = override_settings(
+            STRIPE_API_BASE=self.stripe.url,
+            STRIPE_MAX_NETWORK_RETRIES=0,
+        )
+        stripe_settings.enable()
+        self.addCleanup(stripe_settings.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+
+
+def create_order(coupon=None, items=5):
+    category, _ = Category.objects.get_or_create(name='Shirts', slug='shirts')
+    order = Order.objects.create(
+        first_name='Ada',
+        last_name='Lovelace',
+        email='ada@example.com',
+        address='1 Main St',
+        postal_code='1000',
+        city='London',
+        coupon=coupon,
+        discount=coupon.discount if coupon else 0,
+    )
+    for n in range(items):
+        product = Product.objects.create(
+            category=category, name=f'Shirt {n}', slug=f'shirt-{n}',
+            price='10.00',
+        )
+        OrderItem.objects.create(
+            order=order, product=product, price='10.00', quantity=1
+        )
+    return order
+
+
+@override_settings(MAIL_BATCHING=False, COUPON_BLOOM_FILTER=False)
+class PaymentCompletedTaskTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        coupon = Coupon.objects.create(
+            code='SUMMER',
+            valid_from='2024-01-01T00:00Z',
+            valid_to='2030-01-01T00:00Z',
+            discount=10,
+            active=True,
+        )
+        cls.order = Order.objects.create(
+            first_name='Ada',
+            last_name='Lovelace',
+            email='ada@example.com',
+            address='1 Main St',
+            postal_code='1000',
+            city='London',
+            coupon=coupon,
+            discount=10,
+        )
+        for n in range(5):
+            product = Product.objects.create(
+                category=category, name=f'Shirt {n}', slug=f'shirt-{n}',
+                price='10.00',
+            )
+            OrderItem.objects.create(
+                order=cls.order, product=product, price='10.00', quantity=1
+            )
+
+    def test_invoice_query_count_does_not_grow_with_items(self):
+        weasyprint = SimpleNamespace(HTML=StubHTML, CSS=StubCSS)
+        # one query for the order and coupon, one for the items and products
+        with stub_module('weasyprint', weasyprint):
+            with self.assertNumQueries(2):
+                payment_completed(self.order.id)
+        self.assertEqual(len(mail.outbox), 1)
+        filename, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual(filename, f'order_{self.order.id}.pdf')
+        self.assertEqual(mimetype, 'application/pdf')
+
+
+@override_settings(COUPON_BLOOM_FILTER=False)
+class StripeCouponReuseTests(StripeServerMixin, TestCase):
+    stripe_latency = 0.05
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.coupon = Coupon.objects.create(
+            code='SUMMER',
+            valid_from='2024-01-01T00:00Z',
+            valid_to='2030-01-01T00:00Z',
+            discount=10,
+            active=True,
+        )
+
+    def checkout(self, order):
+        session = self.client.session
+        session['order_id'] = order.id
+        session.save()
+        start = time.perf_counter()
+        response = self.client.post(reverse('payment:process'))
+        elapsed = time.perf_counter() - start
+        self.assertEqual(response.status_code, 302)
+        return elapsed
+
+    def test_stripe_coupon_is_created_once_per_code_and_discount(self):
+        first = self.checkout(create_order(self.coupon))
+        second = self.checkout(create_order(self.coupon))
+        self.assertEqual(
+            self.stripe.calls,
+            ['/v1/coupons', '/v1/checkout/sessions', '/v1/checkout/sessions'],
+        )
+        self.assertEqual(StripeCoupon.objects.count(), 1)
+        # the second checkout saves the coupon round-trip
+        self.assertLess(second, first - self.stripe.latency / 2)
+
+    def test_mapping_survives_cache_loss(self):
+        stripe_id = get_stripe_coupon_id('SUMMER', 10)
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_stripe_coupon_id('SUMMER', 10), stripe_id)
+        self.assertEqual(self.stripe.calls, ['/v1/coupons'])
+
+    def test_different_discount_gets_its_own_stripe_coupon(self):
+        get_stripe_coupon_id('SUMMER', 10)
+        get_stripe_coupon_id('SUMMER', 20)
+        self.assertEqual(self.stripe.calls, ['/v1/coupons', '/v1/coupons'])
+
+
+class CheckoutSessionReuseTests(StripeServerMixin, TestCase):
+
+    def post(self, order):
+        session = self.client.session
+        session['order_id'] = order.id
+        session.save()
+        return self.client.post(reverse('payment:process'))
+
+    def test_session_is_reused_on_retry(self):
+        order = create_order()
+        first = self.post(order)
+        second = self.post(order)
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(self.stripe.calls, ['/v1/checkout/sessions'])
+        order.refresh_from_db()
+        self.assertEqual(order.stripe_session_url, first['Location'])
+        self.assertTrue(order.has_valid_checkout_session())
+
+    def test_concurrent_requests_share_idempotency_key(self):
+        order = create_order()
+        self.post(order)
+        # a concurrent request that did not see the stored session yet
+        Order.objects.filter(id=order.id).update(stripe_session_id='')
+        response = self.post(order)
+        self.assertEqual(self.stripe.calls, ['/v1/checkout/sessions'])
+        self.assertEqual(response['Location'], 'https://checkout.test/1')
+
+    def test_expired_session_is_replaced(self):
+        self.stripe.session_ttl = 30
+        order = create_order()
+        self.post(order)
+        self.post(order)
+        self.assertEqual(
+            self.stripe.calls,
+            ['/v1/checkout/sessions', '/v1/checkout/sessions'],
+        )
+        self.assertEqual(
+            [key.rsplit('-', 1)[0] for key in self.stripe.keys],
+            [f'checkout-{order.id}-new', f'checkout-{order.id}-cs_test_1'],
+        )
+
+    def test_reservations_renewed_apart_do_not_fail(self):
+        order = create_order()
+        now = timezone.now().replace(second=30, microsecond=0)
+        expiries = [now + timedelta(seconds=n) for n in (0, 10, 40)]
+        with mock.patch('shop.inventory.get_expiry', side_effect=expiries):
+            first = self.post(order)
+            # concurrent requests that did not see the stored session yet,
+            # renewing the reservation in the same and in the next minute
+            Order.objects.filter(id=order.id).update(stripe_session_id='')
+            second = self.post(order)
+            Order.objects.filter(id=order.id).update(stripe_session_id='')
+            third = self.post(order)
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertNotEqual(third['Location'], first['Location'])
+        self.assertEqual(len(self.stripe.calls), 2)
+
+    def test_stripe_error_shows_the_payment_page_again(self):
+        order = create_order()
+        self.stripe.error = True
+        response = self.post(order)
+        self.assertContains(response, CHECKOUT_ERROR)
+        order.refresh_from_db()
+        self.assertEqual(order.stripe_session_id, '')
+
+    def test_query_count_does_not_grow_with_items(self):
+        counts = []
+        for items in (1, 10):
+            order = create_order(items=items)
+            session = self.client.session
+            session['order_id'] = order.id
+            session.save()
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(reverse('payment:process'))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class AsyncCheckoutSessionTests(CheckoutSessionReuseTests):
+    """Runs the checkout session tests against the async view."""
+
+    def post(self, order):
+        request = AsyncRequestFactory().post(reverse('payment:process'))
+        request.session = {'order_id': order.id}
+        return async_to_sync(payment_process_async)(request)
+
+
+@override_settings(MAIL_BATCHING=False)
+class CheckoutCancelTests(StripeServerMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.order = create_order(items=2)
+        Product.objects.update(stock=3)
+        reserve_stock(self.order)
+        session = self.client.session
+        session['order_id'] = self.order.id
+        session.save()
+
+    def stock(self):
+        return list(
+            Product.objects.order_by('id').values_list('stock', flat=True)
+        )
+
+    def test_cancel_releases_stock_and_expires_session(self):
+        self.client.post(reverse('payment:process'))
+        self.client.get(reverse('payment:canceled'))
+        self.assertEqual(self.stock(), [3, 3])
+        self.assertEqual(
+            self.stripe.calls,
+            ['/v1/checkout/sessions', '/v1/checkout/sessions/cs_test_1/expire'],
+        )
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.has_valid_checkout_session())
+
+    def test_paying_again_reserves_stock_and_creates_a_new_session(self):
+        self.client.post(reverse('payment:process'))
+        self.client.get(reverse('payment:canceled'))
+        response = self.client.post(reverse('payment:process'))
+        self.assertEqual(response['Location'], 'https://checkout.test/3')
+        self.assertEqual(self.stock(), [2, 2])
+        self.assertTrue(
+            self.stripe.keys[-1].startswith(
+                f'checkout-{self.order.id}-cs_test_1-'
+            )
+        )
+
+    def test_paying_again_fails_when_stock_ran_out(self):
+        self.client.get(reverse('payment:canceled'))
+        Product.objects.update(stock=0)
+        response = self.client.post(reverse('payment:process'))
+        self.assertContains(response, 'Not enough stock left')
+        self.assertEqual(self.stripe.calls, [])
+
+    def test_checkout_session_expires_before_the_reservation(self):
+        self.client.post(reverse('payment:process'))
+        reservation = StockReservation.objects.get(order=self.order)
+        expires_at = reservation.expires - timedelta(minutes=5)
+        expires_at = expires_at.replace(second=0, microsecond=0)
+        self.assertEqual(
+            self.stripe.params[0]['expires_at'],
+            [str(int(expires_at.timestamp()))],
+        )
+
+
+class StripeClientTests(StripeServerMixin, TestCase):
+    def create_coupon(self, name):
+        return get_client().coupons.create(
+            params={'name': name, 'percent_off': 10, 'duration': 'once'}
+        )
+
+    def test_connections_are_kept_alive(self):
+        self.create_coupon('A')
+        self.create_coupon('B')
+        self.assertEqual(len(self.stripe.calls), 2)
+        self.assertEqual(self.stripe.connections, 1)
+
+    def test_latency_is_recorded_per_endpoint(self):
+        labels = {'method': 'post', 'endpoint': '/v1/coupons', 'status': '200'}
+        metric = 'myshop_stripe_request_duration_seconds_count'
+        before = REGISTRY.get_sample_value(metric, labels) or 0
+        self.create_coupon('A')
+        self.assertEqual(REGISTRY.get_sample_value(metric, labels), before + 1)
+
+    def test_endpoint_labels_hide_object_ids(self):
+        self.assertEqual(
+            get_endpoint('https://api.stripe.com/v1/checkout/sessions/cs_test_a1'),
+            '/v1/checkout/sessions/:id',
+        )
+        self.assertEqual(
+            get_endpoint('https://api.stripe.com/v1/payment_intents'),
+            '/v1/payment_intents',
+        )
+
+    @override_settings(STRIPE_READ_TIMEOUT=0.2, STRIPE_MAX_NETWORK_RETRIES=1)
+    def test_slow_responses_time_out_after_bounded_retries(self):
+        reset_client()
+        self.stripe.latency = 1
+        start = time.perf_counter()
+        with self.assertRaises(stripe.APIConnectionError):
+            self.create_coupon('A')
+        self.assertLess(time.perf_counter() - start, 3)
+
+
+def signed_event(order, event_id='evt_1', payment_intent='pi_1'):
+    """Build a signed checkout.session.completed webhook delivery.
+
+    Without an order the session has no ``client_reference_id``, as for
+    sessions created from a Payment Link.
+    """
+    payload = json.dumps({
+        'id': event_id,
+        'object': 'event',
+        'type': 'checkout.session.completed',
+        'data': {
+            'object': {
+                'object': 'checkout.session',
+                'mode': 'payment',
+                'payment_status': 'paid',
+                'client_reference_id': str(order.id) if order else None,
+                'payment_intent': payment_intent,
+            },
+        },
+    })
+    timestamp = int(time.time())
+    signature = hmac.new(
+        settings.STRIPE_WEBHOOK_SECRET.encode(),
+        f'{timestamp}.{payload}'.encode(),
+        hashlib.sha256,
+    ).hexdigest()
+    return payload, f't={timestamp},v1={signature}'
+
+
+class StripeWebhookTests(TestCase):
+    def setUp(self):
+        self.order = create_order(items=2)
+        recommender = mock.patch('payment.events.Recommender')
+        self.recommender = recommender.start()
+        self.addCleanup(recommender.stop)
+        task = mock.patch('payment.events.payment_completed')
+        self.task = task.start()
+        self.addCleanup(task.stop)
+
+    def post(self, payload, signature):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('payment:stripe-webhook'),
+                payload,
+                content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=signature,
+            )
+
+    def process(self):
+        """Process the received events; they are handled on receipt here."""
+
+    def deliver(self, payload, signature):
+        response = self.post(payload, signature)
+        self.process()
+        return response
+
+    def test_event_marks_order_paid_and_queues_invoice(self):
+        response = self.deliver(*signed_event(self.order))
+        self.assertEqual(response.status_code, 200)
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.paid)
+        self.assertEqual(self.order.stripe_id, 'pi_1')
+        self.task.delay.assert_called_once_with(self.order.id)
+        self.recommender().products_bought.assert_called_once()
+        self.assertTrue(StripeEvent.objects.filter(event_id='evt_1').exists())
+
+    def test_retried_event_has_no_side_effects(self):
+        delivery = signed_event(self.order)
+        self.deliver(*delivery)
+        response = self.deliver(*delivery)
+        self.assertEqual(response.status_code, 200)
+        self.task.delay.assert_called_once()
+        self.assertEqual(StripeEvent.objects.count(), 1)
+
+    def test_second_event_for_paid_order_has_no_side_effects(self):
+        self.deliver(*signed_event(self.order, 'evt_1'))
+        self.deliver(*signed_event(self.order, 'evt_2', 'pi_2'))
+        self.task.delay.assert_called_once()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.stripe_id, 'pi_1')
+
+    def test_unknown_order_is_not_recorded(self):
+        delivery = signed_event(self.order)
+        self.order.delete()
+        response = self.deliver(*delivery)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(StripeEvent.objects.exists())
+        self.task.delay.assert_not_called()
+
+    def test_event_without_order_is_not_found(self):
+        response = self.deliver(*signed_event(None))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_failed_payment_is_retried(self):
+        delivery = signed_event(self.order)
+        with mock.patch(
+            'payment.events.record_sales', side_effect=IntegrityError
+        ):
+            with self.assertRaises(IntegrityError):
+                self.deliver(*delivery)
+        self.assertFalse(StripeEvent.objects.exists())
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.paid)
+        # Stripe delivers the event again
+        self.assertEqual(self.deliver(*delivery).status_code, 200)
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.paid)
+
+    def test_invalid_signature_is_rejected(self):
+        payload, _ = signed_event(self.order)
+        response = self.deliver(payload, 't=1,v1=bad')
+        self.assertEqual(response.status_code, 400)
+
+    def test_invoice_task_is_correlated_with_event(self):
+        correlation_ids = []
+        self.task.delay.side_effect = (
+            lambda order_id: correlation_ids.append(get_correlation_id())
+        )
+        self.deliver(*signed_event(self.order, 'evt_42'))
+        self.assertEqual(correlation_ids, ['evt_42'])
+
+
+@override_settings(STRIPE_WEBHOOK_QUEUE=True)
+class QueuedWebhookTests(StripeWebhookTests):
+    """Runs the webhook tests with the queue-backed intake."""
+
+    def process(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            drain()
+
+    def test_event_is_stored_and_acknowledged(self):
+        response = self.post(*signed_event(self.order))
+        self.assertEqual(response.status_code, 200)
+        event = StripeEvent.objects.get(event_id='evt_1')
+        self.assertIsNone(event.processed)
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.paid)
+        self.task.delay.assert_not_called()
+
+    def test_unknown_order_is_not_recorded(self):
+        # queued events are acknowledged before the order is looked up
+        delivery = signed_event(self.order)
+        self.order.delete()
+        self.assertEqual(self.deliver(*delivery).status_code, 200)
+        self.task.delay.assert_not_called()
+
+    def test_batch_updates_many_orders_in_one_transaction(self):
+        orders = [self.order] + [create_order(items=1) for _ in range(4)]
+        for n, order in enumerate(orders):
+            self.post(*signed_event(order, f'evt_{n}', f'pi_{n}'))
+        # a retry of an event that is still queued
+        self.post(*signed_event(orders[0], 'evt_0', 'pi_0'))
+        # a second payment event for the same order in the same batch
+        self.post(*signed_event(orders[0], 'evt_dup', 'pi_dup'))
+        # 6 for the events and orders, 1 for released stock, 11 for the
+        # daily and monthly sales rollups
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(18):
+                processed = process_pending_events(batch_size=100)
+        self.assertEqual(processed, 6)
+        self.assertEqual(
+            Order.objects.filter(paid=True).count(), len(orders)
+        )
+        self.assertEqual(self.task.delay.call_count, len(orders))
+        self.assertFalse(
+            StripeEvent.objects.filter(processed__isnull=True).exists()
+        )
+        self.assertEqual(
+            Order.objects.get(id=orders[0].id).stripe_id, 'pi_0'
+        )
+
+    def test_event_without_order_is_not_found(self):
+        # queued events are acknowledged before they are parsed
+        with self.assertLogs('payment.events', 'WARNING'):
+            response = self.deliver(*signed_event(None))
+        self.assertEqual(response.status_code, 200)
+
+    def test_failed_payment_is_retried(self):
+        delivery = signed_event(self.order)
+        self.post(*delivery)
+        with mock.patch(
+            'payment.events.record_sales', side_effect=IntegrityError
+        ):
+            with self.assertRaises(IntegrityError):
+                self.process()
+        self.assertTrue(
+            StripeEvent.objects.filter(processed__isnull=True).exists()
+        )
+        self.process()
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.paid)
+
+    def test_malformed_event_does_not_block_the_queue(self):
+        self.post(*signed_event(None, 'evt_link'))
+        self.post(*signed_event(self.order, 'evt_1'))
+        with self.assertLogs('payment.events', 'WARNING') as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(drain(batch_size=10), 2)
+        self.assertIn('evt_link', logs.output[0])
+        self.assertFalse(
+            StripeEvent.objects.filter(processed__isnull=True).exists()
+        )
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.paid)
+        self.task.delay.assert_called_once_with(self.order.id)
+
+    def test_drain_reports_lag_and_backlog(self):
+        self.post(*signed_event(self.order))
+        metric = 'myshop_stripe_webhook_lag_seconds_count'
+        before = REGISTRY.get_sample_value(metric) or 0
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(drain(batch_size=10), 1)
+        self.assertEqual(REGISTRY.get_sample_value(metric), before + 1)
+        self.assertEqual(
+            REGISTRY.get_sample_value('myshop_stripe_webhook_backlog'), 0
+        )
+        self.task.delay.assert_called_once_with(self.order.id)
@@ -1,13 +1,211 @@
+import hashlib
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
-import stripe
-from django.conf import settings
-from django.shortcuts import get_object_or_404, redirect, render
+
+from asgiref.sync import sync_to_async
+from django.shortcuts import (
+    aget_object_or_404,
+    get_object_or_404,
+    redirect,
+    render,
+)
 from django.urls import reverse
+from coupons.redemptions import RedemptionLimitReached
 from orders.models import Order
+from shop.inventory import OutOfStock, release_stock, renew_reservation
+
+from .stripe_client import get_client
+from .stripe_coupons import get_stripe_coupon_id
+
+logger = logging.getLogger(__name__)
+
+# checkout sessions expire this long before the stock reservation, so a
+# payment cannot complete after its stock has been released
+SESSION_EXPIRY_MARGIN = timedelta(minutes=5)
+# session expiry times are rounded down to this many seconds, so requests
+# that renew the reservation a moment apart send the same parameters
+SESSION_EXPIRY_STEP = 60
+
+CHECKOUT_ERROR = 'The payment could not be started. Please try again.'
+
+
+def get_checkout_session_data(request, order, reserved_until):
+    """
+    Build the parameters of the Stripe checkout session for an order.
+
+    Args:
+        request (HttpRequest): The request, used to build absolute URLs.
+        order (Order): The order, loaded with ``Order.objects.with_items()``.
+        reserved_until (datetime): When the stock reservation of the order
+            expires. The session expires a few minutes before, rounded down
+            to the minute.
+
+    Returns:
+        dict: The checkout session parameters.
+    """
+    success_url = request.build_absolute_uri(
+        reverse('payment:completed')
+    )
+    cancel_url = request.build_absolute_uri(
+        reverse('payment:canceled')
+    )
+
+    # Stripe checkout session data
+    session_data = {
+        'mode': 'payment',
+        'client_reference_id': order.id,
+        'success_url': success_url,
+        'cancel_url': cancel_url,
+        'expires_at': int(
+            (reserved_until - SESSION_EXPIRY_MARGIN).timestamp()
+        ) // SESSION_EXPIRY_STEP * SESSION_EXPIRY_STEP,
+        'line_items': [],
+    }
+
+    # Add order items to the Stripe checkout session
+    for item in order.items.all():
+        session_data['line_items'].append(
+            {
+                'price_data': {
+                    'unit_amount': int(item.price * Decimal('100')),
+                    'currency': 'usd',
+                    'product_data': {
+                        'name': item.product.name,
+                    },
+                },
+                'quantity': item.quantity,
+            }
+        )
+
+    # Stripe coupon, created once per code and discount
+    if order.coupon:
+        stripe_coupon_id = get_stripe_coupon_id(
+            order.coupon.code, order.discount
+        )
+        session_data['discounts'] = [{'coupon': stripe_coupon_id}]
+    return session_data
+
+
+def get_idempotency_key(order, session_data):
+    """
+    Return the idempotency key of a checkout session.
+
+    The key is derived from the order, its previous session and the session
+    parameters. Stripe rejects a key reused with other parameters, so
+    requests that built different parameters, for instance with expiry
+    times in different minutes, get different keys instead of an error.
+
+    Args:
+        order (Order): The order being paid.
+        session_data (dict): The checkout session parameters.
 
-# create the Stripe instance
-stripe.api_key = settings.STRIPE_SECRET_KEY
-stripe.api_version = settings.STRIPE_API_VERSION
+    Returns:
+        str: The idempotency key.
+    """
+    previous = order.stripe_session_id or 'new'
+    digest = hashlib.sha256(
+        json.dumps(session_data, sort_keys=True).encode()
+    ).hexdigest()[:16]
+    return f'checkout-{order.id}-{previous}-{digest}'
+
+
+def create_checkout_session(order, session_data):
+    """
+    Create a Stripe checkout session for an order.
+
+    Sessions are created with an idempotency key derived from the order,
+    its previous session and the parameters (see
+    :func:`get_idempotency_key`), so concurrent requests receive the same
+    session. This function only talks to Stripe and does not use the
+    database.
+
+    Args:
+        order (Order): The order being paid.
+        session_data (dict): The checkout session parameters.
+
+    Returns:
+        stripe.checkout.Session: The checkout session, or None if Stripe
+        refused the request or could not be reached.
+    """
+    import stripe
+
+    client = get_client()
+    try:
+        session = client.checkout.sessions.create(
+            params=session_data,
+            options={
+                'idempotency_key': get_idempotency_key(order, session_data)
+            },
+        )
+        if session.expires_at <= datetime.now(tz=timezone.utc).timestamp():
+            # Stripe replayed an expired session for a reused key
+            session = client.checkout.sessions.create(
+                params=session_data,
+                options={
+                    'idempotency_key': f'checkout-{order.id}-{uuid.uuid4()}'
+                },
+            )
+    except stripe.error.StripeError as e:
+        logger.warning(
+            'Could not create a checkout session for order %s: %s',
+            order.id,
+            e,
+        )
+        return None
+    return session
+
+
+def checkout_failed(request, order):
+    """
+    Respond to a payment whose checkout session could not be created.
+
+    A concurrent request may have stored a session meanwhile, in which case
+    the customer is sent to it. Otherwise the payment page is shown again
+    with an error.
+
+    Args:
+        request (HttpRequest): The request.
+        order (Order): The order being paid.
+
+    Returns:
+        HttpResponse: A redirect to the stored session or the payment page.
+    """
+    order.refresh_from_db(
+        fields=[
+            'stripe_session_id',
+            'stripe_session_url',
+            'stripe_session_expires',
+        ]
+    )
+    if order.has_valid_checkout_session():
+        return redirect(order.stripe_session_url, code=303)
+    return render(
+        request,
+        'payment/process.html',
+        {'order': order, 'error': CHECKOUT_ERROR},
+    )
+
+
+def get_checkout_session_fields(session):
+    """
+    Return the order fields that remember a checkout session.
+
+    Args:
+        session (stripe.checkout.Session): The checkout session.
+
+    Returns:
+        dict: Values for the ``stripe_session_*`` fields of the order.
+    """
+    return {
+        'stripe_session_id': session.id,
+        'stripe_session_url': session.url,
+        'stripe_session_expires': datetime.fromtimestamp(
+            session.expires_at, tz=timezone.utc
+        ),
+    }
 
 
 def payment_process(request):
@@ -18,6 +216,11 @@ def payment_process(request):
     for the order associated with the user. It redirects the user to the Stripe 
     payment form upon successful creation of the session.
 
+    The checkout session is stored on the order and reused while it is still
+    valid, so retries and double-clicks do not create new sessions. Before a
+    new session is created the stock reservation of the order is renewed,
+    and the session expires before the reservation does.
+
     Args:
         request (HttpRequest): The request object containing metadata about the request.
 
@@ -26,57 +229,98 @@ def payment_process(request):
                        if the request method is not POST.
     """
     order_id = request.session.get('order_id')
-    order = get_object_or_404(Order, id=order_id)
+    order = get_object_or_404(Order.objects.with_items(), id=order_id)
 
     if request.method == 'POST':
-        success_url = request.build_absolute_uri(
-            reverse('payment:completed')
+        # Reuse the checkout session of a previous attempt
+        if order.has_valid_checkout_session():
+            return redirect(order.stripe_session_url, code=303)
+
+        # Hold the stock while the customer pays
+        try:
+            reserved_until = renew_reservation(order)
+        except (OutOfStock, RedemptionLimitReached) as e:
+            return render(
+                request,
+                'payment/process.html',
+                {'order': order, 'error': str(e)},
+            )
+
+        # Create Stripe checkout session
+        session_data = get_checkout_session_data(
+            request, order, reserved_until
         )
-        cancel_url = request.build_absolute_uri(
-            reverse('payment:canceled')
+        session = create_checkout_session(order, session_data)
+        if session is None:
+            return checkout_failed(request, order)
+
+        # Remember the session so it can be reused
+        Order.objects.filter(id=order.id).update(
+            **get_checkout_session_fields(session)
         )
 
-        # Stripe checkout session data
-        session_data = {
-            'mode': 'payment',
-            'client_reference_id': order.id,
-            'success_url': success_url,
-            'cancel_url': cancel_url,
-            'line_items': [],
-        }
-
-        # Add order items to the Stripe checkout session
-        for item in order.items.all():
-            session_data['line_items'].append(
-                {
-                    'price_data': {
-                        'unit_amount': int(item.price * Decimal('100')),
-                        'currency': 'usd',
-                        'product_data': {
-                            'name': item.product.name,
-                        },
-                    },
-                    'quantity': item.quantity,
-                }
-            )
+        # Redirect to Stripe payment form
+        return redirect(session.url, code=303)
+
+    else:
+        return render(request, 'payment/process.html', locals())
+
+
+async def payment_process_async(request):
+    """
+    Process the payment for the order using Stripe (async version).
+
+    Same as :func:`payment_process`. The call to Stripe runs in a separate
+    thread, so the wait on Stripe blocks neither the event loop nor the
+    thread shared by the synchronous parts of the request.
 
-        # Stripe coupon
-        if order.coupon:
-            stripe_coupon = stripe.Coupon.create(
-                name=order.coupon.code,
-                percent_off=order.discount,
-                duration='once',
+    Args:
+        request (HttpRequest): The request object containing metadata about the request.
+
+    Returns:
+        HttpResponse: A redirect to the Stripe payment form or a rendered template 
+                       if the request method is not POST.
+    """
+    order_id = await sync_to_async(request.session.get)('order_id')
+    order = await aget_object_or_404(Order.objects.with_items(), id=order_id)
+
+    if request.method == 'POST':
+        # Reuse the checkout session of a previous attempt
+        if order.has_valid_checkout_session():
+            return redirect(order.stripe_session_url, code=303)
+
+        # Hold the stock while the customer pays
+        try:
+            reserved_until = await sync_to_async(renew_reservation)(order)
+        except (OutOfStock, RedemptionLimitReached) as e:
+            return await sync_to_async(render)(
+                request,
+                'payment/process.html',
+                {'order': order, 'error': str(e)},
             )
-            session_data['discounts'] = [{'coupon': stripe_coupon.id}]
 
         # Create Stripe checkout session
-        session = stripe.checkout.Session.create(**session_data)
+        session_data = await sync_to_async(get_checkout_session_data)(
+            request, order, reserved_until
+        )
+        session = await sync_to_async(
+            create_checkout_session, thread_sensitive=False
+        )(order, session_data)
+        if session is None:
+            return await sync_to_async(checkout_failed)(request, order)
+
+        # Remember the session so it can be reused
+        await Order.objects.filter(id=order.id).aupdate(
+            **get_checkout_session_fields(session)
+        )
 
         # Redirect to Stripe payment form
         return redirect(session.url, code=303)
 
     else:
-        return render(request, 'payment/process.html', locals())
+        return await sync_to_async(render)(
+            request, 'payment/process.html', {'order': order}
+        )
 
 
 def payment_completed(request):
@@ -94,11 +338,45 @@ def payment_completed(request):
     return render(request, 'payment/completed.html')
 
 
+def cancel_checkout(order_id):
+    """
+    Release the stock of an unpaid order and expire its checkout session.
+
+    The stored session is marked as expired rather than forgotten, so the
+    next payment attempt creates a new session with a new idempotency key.
+
+    Args:
+        order_id (int): The ID of the order.
+    """
+    if not release_stock(order_id):
+        return
+    order = Order.objects.filter(id=order_id).only('stripe_session_id').first()
+    if order is None or not order.stripe_session_id:
+        return
+    Order.objects.filter(id=order_id).update(
+        stripe_session_expires=datetime.now(tz=timezone.utc)
+    )
+    import stripe
+
+    try:
+        get_client().checkout.sessions.expire(order.stripe_session_id)
+    except stripe.error.StripeError as e:
+        # the session expires on its own before the reservation would have
+        logger.warning(
+            'Could not expire checkout session %s: %s',
+            order.stripe_session_id,
+            e,
+        )
+
+
 def payment_canceled(request):
     """
     Render the payment canceled page.
 
     This view displays a page indicating that the payment process was canceled.
+    The stock held for the order is released and its checkout session is
+    expired, so it cannot be paid any more. Paying again from the payment
+    page reserves the stock again.
 
     Args:
         request (HttpRequest): The request object containing metadata about the request.
@@ -106,4 +384,7 @@ def payment_canceled(request):
     Returns:
         HttpResponse: A rendered template indicating that the payment was canceled.
     """
+    order_id = request.session.get('order_id')
+    if order_id:
+        cancel_checkout(order_id)
     return render(request, 'payment/canceled.html')
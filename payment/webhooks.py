@@ -1,11 +1,17 @@
-import stripe
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from orders.models import Order
-from shop.models import Product
-from shop.recommender import Recommender
-from .tasks import payment_completed
+from .events import (
+    WEBHOOK_EVENTS_RECEIVED,
+    InvalidEvent,
+    get_paid_session,
+    mark_order_paid,
+)
+from .models import StripeEvent
+
 
 @csrf_exempt
 def stripe_webhook(request):
@@ -17,6 +23,12 @@ def stripe_webhook(request):
     it handles the `checkout.session.completed` event to update the 
     order status, store the payment ID, and trigger product recommendations.
 
+    Every processed event is recorded by its ID. Retries of an event that
+    was already processed are acknowledged without processing it again.
+
+    When ``STRIPE_WEBHOOK_QUEUE`` is enabled the verified event is only
+    stored and acknowledged; the workers process it later in batches.
+
     Args:
         request (HttpRequest): The request object containing metadata about the request.
 
@@ -25,6 +37,9 @@ def stripe_webhook(request):
                       event processing. Returns 200 for success and appropriate 
                       error codes for failure cases.
     """
+    # imported on the first delivery, so workers start without Stripe loaded
+    import stripe
+
     payload = request.body
     sig_header = request.META['HTTP_STRIPE_SIGNATURE']
     event = None
@@ -41,37 +56,48 @@ def stripe_webhook(request):
         # Invalid signature
         return HttpResponse(status=400)
 
-    # Handle the event type
-    if event.type == 'checkout.session.completed':
-        session = event.data.object
-        
-        # Check if the session is for a successful payment
-        if (
-            session.mode == 'payment'
-            and session.payment_status == 'paid'
-        ):
-            try:
-                # Retrieve the order associated with the session
-                order = Order.objects.get(
-                    id=session.client_reference_id
+    if settings.STRIPE_WEBHOOK_QUEUE:
+        # Store the event for the workers and acknowledge it right away
+        try:
+            with transaction.atomic():
+                StripeEvent.objects.create(
+                    event_id=event.id,
+                    type=event.type,
+                    payload=payload.decode(),
                 )
-            except Order.DoesNotExist:
-                return HttpResponse(status=404)
+        except IntegrityError:
+            # Event already received
+            pass
+        WEBHOOK_EVENTS_RECEIVED.labels('queued').inc()
+        return HttpResponse(status=200)
 
-            # Mark order as paid
-            order.paid = True
-
-            # Store the Stripe payment ID in the order
-            order.stripe_id = session.payment_intent
-            order.save()
+    try:
+        # Handle the event type
+        paid_session = get_paid_session(event)
+    except InvalidEvent:
+        return HttpResponse(status=404)
 
-            # Save items bought for product recommendations
-            product_ids = order.items.values_list('product_id', flat=True)
-            products = Product.objects.filter(id__in=product_ids)
-            r = Recommender()
-            r.products_bought(products)
+    try:
+        with transaction.atomic():
+            try:
+                # Record the event, failing if it was processed before. Only
+                # this insert means a duplicate: any other error rolls the
+                # payment back and Stripe retries it.
+                with transaction.atomic():
+                    StripeEvent.objects.create(
+                        event_id=event.id,
+                        type=event.type,
+                        processed=timezone.now(),
+                    )
+            except IntegrityError:
+                # Event already processed
+                return HttpResponse(status=200)
 
-            # Launch asynchronous task to process payment completion
-            payment_completed.delay(order.id)
+            if paid_session:
+                # Mark order as paid and store the Stripe payment ID
+                mark_order_paid(*paid_session, event_id=event.id)
+    except Order.DoesNotExist:
+        return HttpResponse(status=404)
 
+    WEBHOOK_EVENTS_RECEIVED.labels('sync').inc()
     return HttpResponse(status=200)
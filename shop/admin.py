@@ -1,5 +1,49 @@
 from django.contrib import admin
-from .models import Category, Product
+from django.shortcuts import render
+
+from .forms import RepriceForm
+from .models import Category, Product, StockReservation
+from .pricing import reprice
+
+
+def reprice_products(modeladmin, request, queryset):
+    """Change the price of the selected products in bulk.
+
+    Shows a form asking for a percentage or an amount, then updates the
+    prices in the database in batches. Selecting all products matching the
+    current filters reprices them without listing their IDs in the form.
+
+    Args:
+        modeladmin (ModelAdmin): The model admin class.
+        request (HttpRequest): The HTTP request object.
+        queryset (QuerySet): The selected products.
+
+    Returns:
+        HttpResponse: The form, or None to go back to the product list.
+    """
+    if 'apply' in request.POST:
+        form = RepriceForm(request.POST)
+        if form.is_valid():
+            updated = reprice(queryset, **form.get_change())
+            modeladmin.message_user(request, f'Repriced {updated} products.')
+            return None
+    else:
+        form = RepriceForm()
+    select_across = request.POST.get('select_across') == '1'
+    return render(
+        request,
+        'admin/shop/product/reprice.html',
+        {
+            'form': form,
+            'count': queryset.count(),
+            'ids': [] if select_across else queryset.values_list(
+                'pk', flat=True
+            ),
+            'select_across': select_across,
+        },
+    )
+
+reprice_products.short_description = 'Reprice selected products'
 
 
 @admin.register(Category)
@@ -23,16 +67,59 @@ class ProductAdmin(admin.ModelAdmin):
         list_filter (list): Fields to filter the list view.
         list_editable (list): Fields that can be edited directly in the list view.
         prepopulated_fields (dict): Fields that are automatically populated based on other fields.
+        actions (list): Bulk actions available on the selected products.
     """
     list_display = [
         'name',
         'slug',
         'price',
         'available',
+        'stock',
         'created',
         'updated',
     ]  # Fields to display in the list view
 
-    list_filter = ['available', 'created', 'updated']  # Filter options for the list view
-    list_editable = ['price', 'available']  # Editable fields in the list view
+    list_filter = ['available', 'category', 'created', 'updated']  # Filter options for the list view
+    list_editable = ['price', 'available', 'stock']  # Editable fields in the list view
     prepopulated_fields = {'slug': ('name',)}  # Automatically populate slug based on name
+    actions = [reprice_products]  # Bulk repricing for sales
+
+    def save_model(self, request, obj, form, change):
+        """Save a product without overwriting stock taken meanwhile.
+
+        Checkouts change the stock with their own updates. Unless the stock
+        was edited in the form, it is left out of the save so those changes
+        are not lost.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            obj (Product): The product being saved.
+            form (ModelForm): The submitted form.
+            change (bool): True when editing an existing product.
+        """
+        if change and 'stock' not in form.changed_data:
+            fields = [
+                field.name
+                for field in obj._meta.concrete_fields
+                if not field.primary_key and field.name != 'stock'
+            ]
+            obj.save(update_fields=fields)
+        else:
+            super().save_model(request, obj, form, change)
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    """Admin interface for the stock held for orders.
+
+    Filtering on ``oversold`` lists the orders paid after their stock was
+    released and sold to others, which need to be restocked or refunded.
+
+    Attributes:
+        list_display (list): Fields to display in the admin list view.
+        list_filter (list): Fields to filter the list view.
+        raw_id_fields (list): Fields edited by ID.
+    """
+    list_display = ['order', 'created', 'expires', 'released', 'oversold']
+    list_filter = ['oversold']
+    raw_id_fields = ['order']
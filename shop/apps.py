@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        """
+        Connect the signal handlers that keep the catalog version up to date.
+        """
+        from . import signals  # noqa: F401
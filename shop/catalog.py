@@ -0,0 +1,91 @@
+"""
+Catalog version used to invalidate cached product listings and cart prices.
+
+The version is a number stored in the shared Django cache. It changes
+whenever a product or category is saved or deleted (see ``shop/signals.py``)
+and after a bulk repricing (see ``shop/pricing.py``), which updates the
+products without sending signals. Cached listing fragments include the
+version in their key, and carts remember the version their prices were
+read at, so both are refreshed after any catalog change. Product and
+category lookups are cached per version the same way. They are always read
+from the primary database: a lagging replica could return a row from
+before the version change, which would then stay cached under the new
+version.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import Category, Product
+
+CATALOG_VERSION_KEY = 'shop:catalog_version'
+
+
+def get_catalog_version():
+    """Get the current catalog version.
+
+    Returns:
+        int: The version, created from the current time if not set yet so
+        that a cache flush never brings back an older version.
+    """
+    return cache.get_or_set(
+        CATALOG_VERSION_KEY, lambda: int(time.time() * 1000), timeout=None
+    )
+
+
+def bump_catalog_version():
+    """Change the catalog version after the catalog was modified.
+
+    Returns:
+        int: The new version.
+    """
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # the key was evicted, start again from the current time
+        version = int(time.time() * 1000)
+        cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+        return version
+
+
+def get_category(slug):
+    """Get a category by slug, cached until the catalog changes.
+
+    Args:
+        slug (str): The slug of the category.
+
+    Returns:
+        Category or None: The category, shared with other requests, so it
+        must not be modified.
+    """
+    return cache.get_or_set(
+        f'shop:category:{slug}:{get_catalog_version()}',
+        lambda: Category.objects.using(DEFAULT_DB_ALIAS)
+        .filter(slug=slug)
+        .first(),
+        timeout=settings.PRODUCT_CACHE_TIMEOUT,
+    )
+
+
+def get_product(product_id):
+    """Get an available product with its category, cached until the catalog
+    changes.
+
+    Args:
+        product_id (int): The ID of the product.
+
+    Returns:
+        Product or None: The product, or None if it does not exist or is not
+        available. It is shared with other requests, so it must not be
+        modified.
+    """
+    return cache.get_or_set(
+        f'shop:product:{product_id}:{get_catalog_version()}',
+        lambda: Product.objects.using(DEFAULT_DB_ALIAS)
+        .select_related('category')
+        .filter(id=product_id, available=True)
+        .first(),
+        timeout=settings.PRODUCT_CACHE_TIMEOUT,
+    )
@@ -0,0 +1,482 @@
+"""
+Import and export of catalog feeds.
+
+A feed lists one product per row, as CSV with a header row or as JSON
+lines. Products are identified by their ``sku``; the columns are:
+
+* ``sku``, ``name``, ``category`` and ``price`` (required),
+* ``id``, which identifies rows without a SKU; such rows only update the
+  existing product with that ID,
+* ``slug`` and ``category_slug`` (generated from the names if missing),
+* ``description``, ``available``, ``stock`` and ``image_url``.
+
+The optional columns are only written to existing products when the feed
+has them, so a feed of prices leaves the stock, availability and images
+alone, and the units taken by checkouts meanwhile are kept. An empty
+``available`` cell keeps the current value, while an empty ``stock`` cell
+stops tracking the stock of the product, as exported.
+
+Imports read the feed as a stream and upsert the rows in batches, each
+batch with one ``INSERT ... ON CONFLICT`` for the products in its own
+transaction, so memory use does not grow with the size of the feed.
+Missing categories are created on the way. Images are not downloaded
+during the import: the SKUs whose ``image_url`` changed are handed to the
+``fetch_product_images`` task once their batch commits.
+
+Exports stream the catalog in the same format, with the ``id`` of every
+product, so an exported feed can be imported again.
+"""
+import csv
+import json
+import logging
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .catalog import bump_catalog_version
+from .models import Category, Product
+from .tasks import fetch_product_images
+
+logger = logging.getLogger(__name__)
+
+FEED_FIELDS = [
+    'id',
+    'sku',
+    'name',
+    'slug',
+    'category',
+    'category_slug',
+    'price',
+    'description',
+    'available',
+    'stock',
+    'image_url',
+]
+
+# product fields that can be overwritten when a row updates a product
+UPDATE_FIELDS = [
+    'category',
+    'name',
+    'slug',
+    'description',
+    'price',
+    'available',
+    'stock',
+    'image_url',
+    'updated',
+]
+
+# columns that only overwrite existing products when the row has them
+OPTIONAL_FIELDS = {'slug', 'description', 'available', 'stock', 'image_url'}
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'f'}
+
+# invalid rows logged per import, the rest are only counted
+MAX_LOGGED_ERRORS = 20
+
+
+class InvalidRow(ValueError):
+    """Raised when a feed row cannot be imported."""
+
+
+def get_format(path, format=None):
+    """Get the format of a feed file.
+
+    Args:
+        path (str): The path of the feed.
+        format (str, optional): ``csv`` or ``jsonl``. Guessed from the file
+            extension if not given.
+
+    Returns:
+        str: ``csv`` or ``jsonl``.
+    """
+    if format:
+        return format
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(file, format):
+    """Read the rows of a feed one at a time.
+
+    Args:
+        file: A text file open for reading.
+        format (str): ``csv`` or ``jsonl``.
+
+    Yields:
+        tuple: The line number and the row as a dict.
+    """
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(file, 1):
+            if line.strip():
+                try:
+                    yield line_num, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_num, InvalidRow(f'Invalid JSON: {e}')
+
+
+def parse_bool(value, default=True):
+    """Parse a boolean feed value.
+
+    Args:
+        value: The value, as text or a JSON boolean.
+        default (bool): The result for an empty value.
+
+    Returns:
+        bool: The parsed value.
+    """
+    if value in (None, ''):
+        return default
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise InvalidRow(f'Invalid boolean: {value!r}')
+
+
+def parse_row(row):
+    """Validate a feed row and convert its values.
+
+    Args:
+        row (dict): The row as read from the feed.
+
+    Returns:
+        dict: The product values, with the category name and slug, the
+        product ID of rows without a SKU, and the optional columns the row
+        has as ``fields``.
+
+    Raises:
+        InvalidRow: If the row is missing a required value or has an
+            invalid one.
+    """
+    if isinstance(row, InvalidRow):
+        raise row
+    values = {
+        key: str(row.get(key) or '').strip()
+        for key in ('sku', 'name', 'category')
+    }
+    product_id = None
+    if not values['sku'] and row.get('id') not in (None, ''):
+        try:
+            product_id = int(row['id'])
+        except (TypeError, ValueError):
+            raise InvalidRow(f'Invalid id: {row["id"]!r}')
+        values.pop('sku')
+    for key, value in values.items():
+        if not value:
+            raise InvalidRow(f'Missing {key}')
+    values.setdefault('sku', '')
+    if len(values['sku']) > Product._meta.get_field('sku').max_length:
+        raise InvalidRow('SKU too long')
+    try:
+        price = Decimal(str(row.get('price'))).quantize(Decimal('0.01'))
+    except (InvalidOperation, TypeError):
+        raise InvalidRow(f'Invalid price: {row.get("price")!r}')
+    if price < 0 or price.adjusted() >= 8:
+        raise InvalidRow(f'Invalid price: {row.get("price")!r}')
+    stock = row.get('stock')
+    if stock in (None, ''):
+        stock = None
+    else:
+        try:
+            stock = int(stock)
+        except (TypeError, ValueError):
+            stock = -1
+        if stock < 0:
+            raise InvalidRow(f'Invalid stock: {row.get("stock")!r}')
+    name = values['name'][:200]
+    category = values['category'][:200]
+    category_slug = slugify(row.get('category_slug') or category)[:200]
+    if not category_slug:
+        raise InvalidRow(f'No slug for category {category!r}')
+    fields = {key for key in OPTIONAL_FIELDS if key in row}
+    for key in ('slug', 'available'):
+        if row.get(key) in (None, ''):
+            fields.discard(key)
+    return {
+        'id': product_id,
+        'sku': values['sku'],
+        'name': name,
+        'slug': slugify(row.get('slug') or name)[:200],
+        'category_name': category,
+        'category_slug': category_slug,
+        'description': row.get('description') or '',
+        'price': price,
+        'available': parse_bool(row.get('available')),
+        'stock': stock,
+        'image_url': str(row.get('image_url') or '').strip()[:500],
+        'fields': frozenset(fields),
+    }
+
+
+def get_category_ids(rows, categories):
+    """Get the IDs of the categories of a batch, creating missing ones.
+
+    Args:
+        rows (list): Parsed rows of the batch.
+        categories (dict): Category IDs by slug, shared between batches and
+            updated with the categories looked up or created.
+
+    Returns:
+        int: The number of categories created.
+    """
+    names = {
+        row['category_slug']: row['category_name']
+        for row in rows
+        if row['category_slug'] not in categories
+    }
+    if not names:
+        return 0
+    categories.update(
+        Category.objects.filter(slug__in=names)
+        .order_by()
+        .values_list('slug', 'id')
+    )
+    missing = [
+        Category(name=name, slug=slug)
+        for slug, name in names.items()
+        if slug not in categories
+    ]
+    if missing:
+        Category.objects.bulk_create(missing, ignore_conflicts=True)
+        categories.update(
+            Category.objects.filter(
+                slug__in=[category.slug for category in missing]
+            )
+            .order_by()
+            .values_list('slug', 'id')
+        )
+    return len(missing)
+
+
+def get_update_fields(fields):
+    """Return the product fields overwritten by rows with some of the
+    optional columns.
+
+    Args:
+        fields (frozenset): The optional columns of the rows.
+
+    Returns:
+        list: The fields to update.
+    """
+    return [
+        field
+        for field in UPDATE_FIELDS
+        if field not in OPTIONAL_FIELDS or field in fields
+    ]
+
+
+def make_product(row, categories, now):
+    return Product(
+        id=row['id'],
+        sku=row['sku'] or None,
+        category_id=categories[row['category_slug']],
+        name=row['name'],
+        slug=row['slug'],
+        description=row['description'],
+        price=row['price'],
+        available=row['available'],
+        stock=row['stock'],
+        image_url=row['image_url'],
+        created=now,
+        updated=now,
+    )
+
+
+def import_batch(rows, categories):
+    """Upsert one batch of parsed rows.
+
+    Rows with a SKU are upserted with one query per set of optional columns,
+    usually one for the whole batch. Rows identified by ID update the
+    existing products with a bulk update.
+
+    Args:
+        rows (list): Parsed rows, at most one per SKU or ID.
+        categories (dict): Category IDs by slug, see
+            :func:`get_category_ids`.
+
+    Returns:
+        tuple: The number of rows imported, the number of categories
+        created, and the SKUs and the IDs of the products whose image has
+        to be downloaded.
+    """
+    with transaction.atomic():
+        created = get_category_ids(rows, categories)
+        skus = [row['sku'] for row in rows if row['sku']]
+        ids = [row['id'] for row in rows if not row['sku']]
+        image_urls = {}
+        for sku, id, image_url in (
+            Product.objects.filter(Q(sku__in=skus) | Q(id__in=ids))
+            .order_by()
+            .values_list('sku', 'id', 'image_url')
+        ):
+            image_urls[sku] = image_urls[id] = image_url
+        for id in ids:
+            if id not in image_urls:
+                logger.warning('Skipping feed row of unknown product %s', id)
+        imported = [
+            row for row in rows if row['sku'] or row['id'] in image_urls
+        ]
+        now = timezone.now()
+        upserts = defaultdict(list)
+        updates = defaultdict(list)
+        for row in imported:
+            group = upserts if row['sku'] else updates
+            group[row['fields']].append(row)
+        for fields, group in upserts.items():
+            Product.objects.bulk_create(
+                [make_product(row, categories, now) for row in group],
+                update_conflicts=True,
+                unique_fields=['sku'],
+                update_fields=get_update_fields(fields),
+            )
+        for fields, group in updates.items():
+            Product.objects.bulk_update(
+                [make_product(row, categories, now) for row in group],
+                get_update_fields(fields),
+            )
+        new_images = [
+            row
+            for row in imported
+            if 'image_url' in row['fields']
+            and row['image_url']
+            and row['image_url'] != image_urls.get(row['sku'] or row['id'])
+        ]
+        transaction.on_commit(bump_catalog_version)
+    return (
+        len(imported),
+        created,
+        [row['sku'] for row in new_images if row['sku']],
+        [row['id'] for row in new_images if not row['sku']],
+    )
+
+
+def import_feed(
+    file, format='csv', batch_size=1000, fetch_images=True, progress=None
+):
+    """Import a catalog feed.
+
+    Invalid rows, and rows for unknown product IDs, are skipped and
+    counted. If a SKU appears several times in one batch, its last row
+    wins.
+
+    Args:
+        file: A text file open for reading.
+        format (str): ``csv`` or ``jsonl``.
+        batch_size (int): Rows upserted per query.
+        fetch_images (bool): Whether to queue the download of new images.
+        progress (callable, optional): Called with the statistics so far
+            after each batch.
+
+    Returns:
+        dict: The number of rows read, imported and skipped, categories
+        created and images queued.
+    """
+    stats = {
+        'rows': 0,
+        'imported': 0,
+        'skipped': 0,
+        'categories': 0,
+        'images': 0,
+    }
+    categories = {}
+    rows = read_rows(file, format)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        parsed = {}
+        for line_num, row in batch:
+            try:
+                values = parse_row(row)
+            except InvalidRow as e:
+                if stats['skipped'] < MAX_LOGGED_ERRORS:
+                    logger.warning('Skipping feed line %s: %s', line_num, e)
+                stats['skipped'] += 1
+                continue
+            parsed[values['sku'] or values['id']] = values
+        stats['rows'] += len(batch)
+        if parsed:
+            imported, created, new_skus, new_ids = import_batch(
+                list(parsed.values()), categories
+            )
+            stats['imported'] += imported
+            stats['skipped'] += len(parsed) - imported
+            stats['categories'] += created
+            if fetch_images and (new_skus or new_ids):
+                fetch_product_images.delay(new_skus, new_ids)
+                stats['images'] += len(new_skus) + len(new_ids)
+        if progress:
+            progress(stats)
+    return stats
+
+
+def export_rows(queryset=None, chunk_size=2000):
+    """Read the catalog as feed rows, a chunk of products at a time.
+
+    Args:
+        queryset (QuerySet, optional): The products to export. Defaults to
+            all products.
+        chunk_size (int): Products fetched per query.
+
+    Yields:
+        dict: One feed row per product.
+    """
+    if queryset is None:
+        queryset = Product.objects.all()
+    products = queryset.order_by('id').values_list(
+        'id',
+        'sku',
+        'name',
+        'slug',
+        'category__name',
+        'category__slug',
+        'price',
+        'description',
+        'available',
+        'stock',
+        'image_url',
+    )
+    for values in products.iterator(chunk_size=chunk_size):
+        row = dict(zip(FEED_FIELDS, values))
+        row['sku'] = row['sku'] or ''
+        row['price'] = str(row['price'])
+        yield row
+
+
+def export_feed(file, format='csv', queryset=None, chunk_size=2000):
+    """Write the catalog as a feed.
+
+    Args:
+        file: A text file open for writing.
+        format (str): ``csv`` or ``jsonl``.
+        queryset (QuerySet, optional): The products to export.
+        chunk_size (int): Products fetched per query.
+
+    Returns:
+        int: The number of products written.
+    """
+    count = 0
+    if format == 'csv':
+        writer = csv.DictWriter(file, fieldnames=FEED_FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(row):
+            file.write(json.dumps(row) + '\n')
+    for row in export_rows(queryset, chunk_size):
+        write(row)
+        count += 1
+    return count
@@ -0,0 +1,35 @@
+from django import forms
+
+
+class RepriceForm(forms.Form):
+    """
+    Form for repricing products from the admin.
+
+    The change is a percentage or an amount added to the current price of
+    each product. Use a negative value for a discount.
+    """
+    MODE_CHOICES = [
+        ('percent', 'Percentage of the current price'),
+        ('amount', 'Fixed amount'),
+    ]
+    mode = forms.ChoiceField(choices=MODE_CHOICES, initial='percent')
+    value = forms.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        help_text='For example -20 for 20% off, or 5 to add $5',
+    )
+
+    def clean_value(self):
+        value = self.cleaned_data['value']
+        if value == 0:
+            raise forms.ValidationError('The change cannot be zero.')
+        return value
+
+    def get_change(self):
+        """
+        Get the change as keyword arguments for ``shop.pricing.reprice``.
+
+        Returns:
+            dict: Either the ``percent`` or the ``amount`` argument.
+        """
+        return {self.cleaned_data['mode']: self.cleaned_data['value']}
@@ -0,0 +1,115 @@
+"""
+Download of product images referenced by catalog feeds.
+
+Imports only record the ``image_url`` of each product (see
+``shop/feeds.py``). The images are downloaded afterwards by the
+``fetch_product_images`` task, which also stores a thumbnail used by the
+product listings. A product keeps its current image if the download fails.
+"""
+import logging
+import os
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from PIL import Image, UnidentifiedImageError
+
+from .catalog import bump_catalog_version
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+
+def make_thumbnail(content, size):
+    """Make a JPEG thumbnail of an image.
+
+    Args:
+        content (bytes): The image.
+        size (int): The maximum width and height of the thumbnail.
+
+    Returns:
+        bytes: The thumbnail.
+
+    Raises:
+        PIL.UnidentifiedImageError: If the content is not an image.
+    """
+    with Image.open(BytesIO(content)) as image:
+        image.thumbnail((size, size))
+        output = BytesIO()
+        image.convert('RGB').save(output, 'JPEG', quality=85)
+    return output.getvalue()
+
+
+def download(session, url):
+    """Download an image, refusing files above ``PRODUCT_IMAGE_MAX_BYTES``.
+
+    Args:
+        session (requests.Session): The session used for the request.
+        url (str): The image URL.
+
+    Returns:
+        bytes: The image.
+
+    Raises:
+        requests.RequestException: If the download fails or is too large.
+    """
+    max_bytes = settings.PRODUCT_IMAGE_MAX_BYTES
+    with session.get(
+        url, timeout=settings.PRODUCT_IMAGE_TIMEOUT, stream=True
+    ) as response:
+        response.raise_for_status()
+        content = response.raw.read(max_bytes + 1, decode_content=True)
+    if len(content) > max_bytes:
+        raise requests.RequestException(f'Image larger than {max_bytes} bytes')
+    return content
+
+
+def fetch_images(skus, ids=()):
+    """Download the images of products and store them with a thumbnail.
+
+    Args:
+        skus (list): The SKUs of the products.
+        ids (list): The IDs of more products, for those without a SKU.
+
+    Returns:
+        int: The number of images stored.
+    """
+    products = Product.objects.filter(
+        Q(sku__in=skus) | Q(id__in=ids)
+    ).exclude(image_url='')
+    stored = 0
+    with requests.Session() as session:
+        for product in products.only('id', 'image_url'):
+            url = product.image_url
+            try:
+                content = download(session, url)
+                thumbnail = make_thumbnail(
+                    content, settings.PRODUCT_THUMBNAIL_SIZE
+                )
+            except (requests.RequestException, UnidentifiedImageError) as e:
+                logger.warning(
+                    'Could not fetch image of product %s from %s: %s',
+                    product.id, url, e,
+                )
+                continue
+            name = os.path.basename(urlsplit(url).path) or f'{product.id}.jpg'
+            stem = os.path.splitext(name)[0]
+            product.image.save(name, ContentFile(content), save=False)
+            product.thumbnail.save(
+                f'{stem}.jpg', ContentFile(thumbnail), save=False
+            )
+            # only store the files if the URL did not change meanwhile
+            updated = Product.objects.filter(
+                id=product.id, image_url=url
+            ).update(image=product.image.name, thumbnail=product.thumbnail.name)
+            if not updated:
+                product.image.delete(save=False)
+                product.thumbnail.delete(save=False)
+            stored += updated
+    if stored:
+        transaction.on_commit(bump_catalog_version)
+    return stored
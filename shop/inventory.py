@@ -0,0 +1,306 @@
+"""
+Stock reservation at checkout.
+
+The stock of an order is taken when the order is created, with a single
+conditional ``UPDATE`` covering every line of the order::
+
+    UPDATE shop_product SET stock = stock - CASE id WHEN ... END
+    WHERE id IN (...) AND (stock IS NULL OR stock >= CASE id WHEN ... END)
+
+If fewer rows are updated than the order has products, one of them did
+not have enough stock and the caller's transaction is rolled back. No row
+is read or locked beforehand, so buyers of a hot product only wait for
+each other for the duration of one statement, and the rows of an order
+are locked by one statement rather than one per line, which avoids
+deadlocks between orders listing the same products in different order.
+Products with no ``stock`` value are not tracked and never run out.
+
+The order then holds a :class:`StockReservation`. When the payment is
+canceled, or the reservation expires unpaid, :func:`release_stock` puts the
+stock back and gives back the redemption of its coupon. Expired
+reservations are released by a periodic Celery task.
+
+Stripe can still complete the payment of a released order: a webhook may
+be retried, or wait in the event queue, past the expiry of its session.
+:func:`reclaim_stock` then takes the stock again when the order is marked
+as paid, and flags the reservation as ``oversold`` for review when the
+stock was sold to others meanwhile. Either way the coupon redemption is
+counted again; if the coupon reached its cap meanwhile, the payment is
+kept and a warning logged.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, Sum, Value, When
+from django.utils import timezone
+from coupons.redemptions import RedemptionLimitReached, give_back, redeem
+from orders.models import Order, OrderItem
+
+from .models import Product, StockReservation
+
+logger = logging.getLogger(__name__)
+
+
+class OutOfStock(Exception):
+    """Raised when an order asks for more units than are in stock.
+
+    Attributes:
+        products (list): The products without enough stock.
+    """
+
+    def __init__(self, products):
+        self.products = products
+        names = ', '.join(str(product) for product in products)
+        super().__init__(f'Not enough stock left for: {names}.')
+
+
+def get_order_quantities(order_id):
+    """Return the units of each product in an order.
+
+    Args:
+        order_id (int): The ID of the order.
+
+    Returns:
+        dict: Units keyed by product ID.
+    """
+    return dict(
+        OrderItem.objects.filter(order_id=order_id)
+        .values('product_id')
+        .annotate(units=Sum('quantity'))
+        .order_by('product_id')
+        .values_list('product_id', 'units')
+    )
+
+
+def get_units(quantities):
+    # the units of each row, as an SQL expression
+    return Case(
+        *[When(id=id, then=Value(units)) for id, units in quantities.items()],
+        output_field=PositiveIntegerField(),
+    )
+
+
+def take_stock(quantities):
+    """Take units of several products from the stock, all or nothing.
+
+    Must be called inside a transaction, which has to be rolled back if
+    ``OutOfStock`` is raised.
+
+    Args:
+        quantities (dict): Units keyed by product ID.
+
+    Raises:
+        OutOfStock: If any tracked product has fewer units in stock.
+    """
+    if not quantities:
+        return
+    units = get_units(quantities)
+    updated = (
+        Product.objects.filter(id__in=quantities)
+        .filter(Q(stock__isnull=True) | Q(stock__gte=units))
+        .update(stock=F('stock') - units)
+    )
+    if updated < len(quantities):
+        raise OutOfStock(
+            list(Product.objects.filter(id__in=quantities, stock__lt=units))
+        )
+
+
+def put_back_stock(quantities):
+    """Return units of several products to the stock.
+
+    Args:
+        quantities (dict): Units keyed by product ID.
+    """
+    if quantities:
+        Product.objects.filter(
+            id__in=quantities, stock__isnull=False
+        ).update(stock=F('stock') + get_units(quantities))
+
+
+def get_expiry():
+    """Return when a reservation made now expires.
+
+    Returns:
+        datetime: The expiry time.
+    """
+    return timezone.now() + timedelta(
+        seconds=settings.STOCK_RESERVATION_TIMEOUT
+    )
+
+
+def reserve_stock(order):
+    """Take the stock of a new order and hold it until the order is paid.
+
+    Must be called inside the transaction that creates the order and its
+    items, so nothing is kept if the stock runs out.
+
+    Args:
+        order (Order): The order, with its items saved.
+
+    Returns:
+        StockReservation: The reservation.
+
+    Raises:
+        OutOfStock: If a product of the order does not have enough stock.
+    """
+    take_stock(get_order_quantities(order.id))
+    return StockReservation.objects.create(order=order, expires=get_expiry())
+
+
+def renew_reservation(order):
+    """Extend the reservation of an order about to be paid.
+
+    A reservation that was released, because the payment was canceled or
+    took too long, takes the stock and the coupon redemption again. Orders
+    created before stock was tracked get a new reservation.
+
+    Args:
+        order (Order): The order.
+
+    Returns:
+        datetime: The new expiry time of the reservation.
+
+    Raises:
+        OutOfStock: If the stock was released and is no longer available.
+        RedemptionLimitReached: If the coupon was given back and has been
+            redeemed up to its cap meanwhile.
+    """
+    expires = get_expiry()
+    reservations = StockReservation.objects.filter(order=order)
+    with transaction.atomic():
+        if reservations.filter(released__isnull=True).update(expires=expires):
+            return expires
+        # only one concurrent request can take back a released reservation
+        claimed = reservations.filter(released__isnull=False).update(
+            released=None, expires=expires
+        )
+        if not claimed:
+            StockReservation.objects.create(order=order, expires=expires)
+        take_stock(get_order_quantities(order.id))
+        if claimed and order.coupon_id:
+            # the redemption was given back with the stock
+            redeem(order.coupon, order.email)
+    return expires
+
+
+def release_stock(order_id):
+    """Put back the stock held for an unpaid order, and the redemption of
+    its coupon.
+
+    Args:
+        order_id (int): The ID of the order.
+
+    Returns:
+        bool: True if stock was put back by this call.
+    """
+    with transaction.atomic():
+        released = StockReservation.objects.filter(
+            order_id=order_id, released__isnull=True, order__paid=False
+        ).update(released=timezone.now())
+        if released:
+            put_back_stock(get_order_quantities(order_id))
+            order = (
+                Order.objects.select_related('coupon')
+                .only(
+                    'email',
+                    'coupon__max_redemptions',
+                    'coupon__max_redemptions_per_customer',
+                )
+                .get(id=order_id)
+            )
+            if order.coupon:
+                give_back(order.coupon, order.email)
+    return bool(released)
+
+
+def recount_redemptions(order_ids):
+    """Count the coupon redemptions of paid orders again.
+
+    Args:
+        order_ids (list): The IDs of orders whose redemption was given back.
+    """
+    orders = Order.objects.filter(
+        id__in=order_ids, coupon__isnull=False
+    ).select_related('coupon')
+    for order in orders:
+        try:
+            with transaction.atomic():
+                redeem(order.coupon, order.email)
+        except RedemptionLimitReached as e:
+            logger.warning(
+                'Order %s was paid beyond the cap of coupon %s: %s',
+                order.id, order.coupon.code, e,
+            )
+
+
+def reclaim_stock(order_ids):
+    """Take the stock of orders paid after their reservation was released.
+
+    Must be called in the transaction that marks the orders as paid. The
+    stock of each order is taken all or nothing; when it ran out, the
+    reservation stays released and is flagged as ``oversold``. The coupon
+    redemptions given back on release are counted again; the payment is
+    kept even if a coupon reached its cap meanwhile.
+
+    Args:
+        order_ids (iterable): The IDs of the orders just paid.
+
+    Returns:
+        list: The IDs of the orders that are oversold.
+    """
+    released = list(
+        StockReservation.objects.filter(
+            order_id__in=order_ids, released__isnull=False
+        ).values_list('order_id', flat=True)
+    )
+    reclaimed = []
+    oversold = []
+    for order_id in released:
+        try:
+            with transaction.atomic():
+                take_stock(get_order_quantities(order_id))
+        except OutOfStock as e:
+            logger.error(
+                'Order %s was paid after its stock was released: %s',
+                order_id, e,
+            )
+            oversold.append(order_id)
+        else:
+            reclaimed.append(order_id)
+    if released:
+        recount_redemptions(released)
+    if reclaimed:
+        StockReservation.objects.filter(order_id__in=reclaimed).update(
+            released=None
+        )
+    if oversold:
+        StockReservation.objects.filter(order_id__in=oversold).update(
+            oversold=True
+        )
+    return oversold
+
+
+def release_expired(batch_size=500):
+    """Release the expired reservations of unpaid orders.
+
+    Reservations of paid orders are deleted, since their stock is sold,
+    except the ones flagged as ``oversold``, which are kept for review.
+
+    Args:
+        batch_size (int): The maximum number of reservations to release.
+
+    Returns:
+        int: The number of reservations released.
+    """
+    StockReservation.objects.filter(
+        order__paid=True, oversold=False
+    ).delete()
+    order_ids = list(
+        StockReservation.objects.filter(
+            released__isnull=True, expires__lt=timezone.now()
+        ).values_list('order_id', flat=True)[:batch_size]
+    )
+    return sum(release_stock(order_id) for order_id in order_ids)
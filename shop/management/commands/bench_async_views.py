@@ -0,0 +1,136 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test import AsyncRequestFactory, RequestFactory
+
+from shop import recommender, views
+from shop.models import Product
+
+
+class SlowRedis:
+    """Redis stand-in answering recommendation lookups after a delay."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def zrange(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return []
+
+
+class SlowAsyncRedis(SlowRedis):
+    """asyncio Redis stand-in answering after a delay."""
+
+    async def zrange(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return []
+
+
+class Command(BaseCommand):
+    """
+    Compare the sync and async product detail views under concurrency.
+
+    The sync view is driven by a pool of threads, like a WSGI server with a
+    fixed number of worker threads. The async view is driven by one event
+    loop, like an ASGI server. Redis is replaced by a stand-in that answers
+    after ``--redis-latency`` seconds, so the numbers show how much of the
+    wait on Redis each mode can overlap.
+    """
+    help = 'Benchmark sync (WSGI) and async (ASGI) views with simulated Redis latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument(
+            '--threads', type=int, default=8,
+            help='Worker threads for the sync (WSGI) run.',
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=100,
+            help='Concurrent requests for the async (ASGI) run.',
+        )
+        parser.add_argument(
+            '--redis-latency', type=float, default=0.02,
+            help='Simulated Redis round-trip in seconds.',
+        )
+
+    def make_request(self, factory, path):
+        request = factory.get(path)
+        # cache sessions keep the session lookup off the database
+        request.session = SessionStore()
+        return request
+
+    def run_sync(self, product, requests, threads):
+        factory = RequestFactory()
+        path = product.get_absolute_url()
+
+        def call(_):
+            start = time.perf_counter()
+            try:
+                request = self.make_request(factory, path)
+                views.product_detail(request, product.id, product.slug)
+            finally:
+                close_old_connections()
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            start = time.perf_counter()
+            latencies = list(pool.map(call, range(requests)))
+        return time.perf_counter() - start, latencies
+
+    def run_async(self, product, requests, concurrency):
+        factory = AsyncRequestFactory()
+        path = product.get_absolute_url()
+
+        async def call(semaphore):
+            async with semaphore:
+                start = time.perf_counter()
+                request = self.make_request(factory, path)
+                await views.product_detail_async(
+                    request, product.id, product.slug
+                )
+                return time.perf_counter() - start
+
+        async def main():
+            semaphore = asyncio.Semaphore(concurrency)
+            start = time.perf_counter()
+            latencies = await asyncio.gather(
+                *[call(semaphore) for _ in range(requests)]
+            )
+            return time.perf_counter() - start, latencies
+
+        return asyncio.run(main())
+
+    def report(self, mode, elapsed, latencies):
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        self.stdout.write(
+            f'{mode:<5} {len(latencies) / elapsed:9.1f} req/s   '
+            f'p50 {statistics.median(latencies) * 1000:7.1f} ms   '
+            f'p95 {p95 * 1000:7.1f} ms'
+        )
+
+    def handle(self, *args, **options):
+        product = Product.objects.filter(available=True).first()
+        if product is None:
+            raise CommandError('Add at least one available product first.')
+        latency = options['redis_latency']
+        self.stdout.write(
+            f"{options['requests']} requests, Redis latency "
+            f'{latency * 1000:.0f} ms'
+        )
+        with mock.patch.object(recommender, 'r', SlowRedis(latency)):
+            elapsed, latencies = self.run_sync(
+                product, options['requests'], options['threads']
+            )
+        self.report('wsgi', elapsed, latencies)
+        with mock.patch.object(recommender, 'ar', SlowAsyncRedis(latency)):
+            elapsed, latencies = self.run_async(
+                product, options['requests'], options['concurrency']
+            )
+        self.report('asgi', elapsed, latencies)
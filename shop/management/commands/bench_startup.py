@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from myshop import startup
+
+
+class Command(BaseCommand):
+    """
+    Benchmark the cold start of ``manage.py``, the WSGI application and the
+    Celery worker.
+
+    Each entry point is started ``--runs`` times in a new interpreter (see
+    ``myshop/startup.py``). The run fails when the median start time of an
+    entry point exceeds its budget, or when an entry point imports one of
+    the modules that are meant to be loaded on first use. With
+    ``--importtime`` the packages that took the longest to import are
+    listed for each entry point.
+    """
+    help = 'Benchmark the start time of the web and Celery workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--runs', type=int, default=5,
+            help='Starts per entry point.',
+        )
+        parser.add_argument(
+            '--entry-point', action='append', dest='entry_points',
+            choices=list(startup.ENTRY_POINTS),
+            help='Only start this entry point. Repeatable.',
+        )
+        parser.add_argument(
+            '--importtime', action='store_true',
+            help='List the slowest packages to import.',
+        )
+        parser.add_argument(
+            '--top', type=int, default=15,
+            help='Number of packages listed with --importtime.',
+        )
+
+    def report_imports(self, entry_point, top):
+        self.stdout.write(f'\nSlowest imports of {entry_point}:')
+        measured = startup.measure(entry_point, importtime=True)
+        for package, seconds in startup.top_level_imports(measured, top):
+            self.stdout.write(f'  {package:<30} {seconds * 1000:>7.1f} ms')
+
+    def handle(self, *args, **options):
+        try:
+            results = startup.run(options['entry_points'], options['runs'])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f"{'entry point':<12} {'median':>9} {'min':>9} {'max':>9} "
+            f"{'budget':>9}"
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<12} {result['median'] * 1000:>6.0f} ms "
+                f"{result['min'] * 1000:>6.0f} ms "
+                f"{result['max'] * 1000:>6.0f} ms "
+                f"{result['budget'] * 1000:>6.0f} ms"
+            )
+        if options['importtime']:
+            for name in results:
+                self.report_imports(name, options['top'])
+        failures = startup.over_budget(results)
+        if failures:
+            raise CommandError('\n'.join(['Regressions:', *failures]))
@@ -0,0 +1,126 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+from myshop import benchmarks
+
+
+class Command(BaseCommand):
+    """
+    Check the query budgets of every view and benchmark their latency.
+
+    The run uses a throwaway test database of the configured engine, seeded
+    with a synthetic catalog, orders and coupons, so the development
+    database is left alone. Stripe, Redis and the Celery tasks are stubbed
+    (see ``myshop/benchmarks.py``).
+
+    The p50, p95 and p99 latencies are compared with the baseline file, if
+    it exists, and the run fails when a view exceeds its query budget or
+    its p95 latency grows more than ``--max-slowdown`` times. Record a new
+    baseline with ``--update-baseline``.
+    """
+    help = 'Check the query budgets of the views and benchmark their latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--orders', type=int, default=5000)
+        parser.add_argument('--coupons', type=int, default=5000)
+        parser.add_argument(
+            '--requests', type=int, default=50,
+            help='Measured requests per view.',
+        )
+        parser.add_argument(
+            '--view', action='append', dest='views',
+            help='Only run this view, by scenario name. Repeatable.',
+        )
+        parser.add_argument(
+            '--baseline', default=settings.BASE_DIR / 'bench_views.json',
+            type=Path,
+            help='JSON file with the results of an earlier run.',
+        )
+        parser.add_argument(
+            '--update-baseline', action='store_true',
+            help='Write the results to the baseline file.',
+        )
+        parser.add_argument(
+            '--max-slowdown', type=float, default=1.5,
+            help='Allowed ratio of the p95 latency to the baseline.',
+        )
+
+    def get_scenarios(self, names):
+        if not names:
+            return benchmarks.SCENARIOS
+        scenarios = [s for s in benchmarks.SCENARIOS if s.name in names]
+        unknown = set(names) - {s.name for s in scenarios}
+        if unknown:
+            raise CommandError(f"Unknown views: {', '.join(sorted(unknown))}")
+        return scenarios
+
+    def report(self, results, baseline):
+        self.stdout.write(
+            f"{'view':<32} {'queries':>9} {'p50':>9} {'p95':>9} {'p99':>9}"
+            f"   {'baseline p95':>12}"
+        )
+        for name, result in results.items():
+            before = baseline.get(name)
+            self.stdout.write(
+                f"{name:<32} {result['queries']:>4}/{result['budget']:<4} "
+                f"{result['p50']:>6.1f} ms {result['p95']:>6.1f} ms "
+                f"{result['p99']:>6.1f} ms   "
+                + (f"{before['p95']:>9.1f} ms" if before else f"{'-':>12}")
+            )
+
+    def handle(self, *args, **options):
+        scenarios = self.get_scenarios(options['views'])
+        baseline_path = options['baseline']
+        baseline = {}
+        if baseline_path.exists():
+            baseline = json.loads(baseline_path.read_text())
+
+        setup_test_environment()
+        databases = setup_databases(
+            verbosity=0, interactive=False, aliases={'default'}
+        )
+        try:
+            self.stdout.write(
+                f"Seeding {options['products']} products, "
+                f"{options['orders']} orders and {options['coupons']} "
+                'coupons...'
+            )
+            # keep the seeding off the shared cache and the code filter
+            with benchmarks.stubbed():
+                seed = benchmarks.seed(
+                    options['products'], options['orders'], options['coupons']
+                )
+            try:
+                results = benchmarks.run(
+                    seed, options['requests'], scenarios
+                )
+            except benchmarks.BenchmarkError as e:
+                raise CommandError(str(e))
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+
+        self.report(results, baseline)
+        if options['update_baseline']:
+            baseline.update(results)
+            baseline_path.write_text(
+                json.dumps(baseline, indent=2, sort_keys=True) + '\n'
+            )
+            self.stdout.write(f'Baseline written to {baseline_path}')
+        failures = benchmarks.over_budget(results)
+        if not options['update_baseline']:
+            failures += benchmarks.slower_than(
+                results, baseline, options['max_slowdown']
+            )
+        if failures:
+            raise CommandError('\n'.join(['Regressions:', *failures]))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from shop.feeds import export_feed, get_format
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    """
+    Export the catalog as a CSV or JSON lines feed.
+
+    Products are read in chunks and written as they are read, so the
+    export runs in constant memory. The feed can be imported again with
+    ``import_catalog``.
+    """
+    help = 'Export the catalog as a feed (CSV or JSON lines).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default='-',
+            help='The feed file to write. Defaults to stdout.',
+        )
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='Feed format. Guessed from the file extension by default.',
+        )
+        parser.add_argument(
+            '--category', action='append', default=[],
+            help='Only export products in the category with this slug. '
+            'Can be given several times.',
+        )
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = get_format(path, options['format'])
+        products = Product.objects.all()
+        if options['category']:
+            products = products.filter(category__slug__in=options['category'])
+        if path == '-':
+            export_feed(
+                self.stdout, format, products, options['chunk_size']
+            )
+            return
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            count = export_feed(file, format, products, options['chunk_size'])
+        self.stdout.write(f'Exported {count} products to {path}')
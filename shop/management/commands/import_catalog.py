@@ -0,0 +1,63 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.feeds import get_format, import_feed
+
+
+class Command(BaseCommand):
+    """
+    Import products and categories from a CSV or JSON lines feed.
+
+    Products are matched by SKU: existing products are updated and new
+    ones created, in batches. Images are downloaded afterwards by the
+    Celery workers. See ``shop/feeds.py`` for the feed columns.
+    """
+    help = 'Import a catalog feed (CSV or JSON lines) in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The feed file, or - for stdin.')
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='Feed format. Guessed from the file extension by default.',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--no-images', action='store_true',
+            help='Do not queue the download of product images.',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = get_format(path, options['format'])
+        start = time.monotonic()
+
+        def progress(stats):
+            elapsed = time.monotonic() - start
+            self.stdout.write(
+                f'{stats["rows"]} rows read, {stats["imported"]} imported, '
+                f'{stats["skipped"]} skipped '
+                f'({stats["rows"] / elapsed if elapsed else 0:.0f} rows/s)'
+            )
+
+        if path == '-':
+            stats = self.run(sys.stdin, format, options, progress)
+        else:
+            with open(path, newline='', encoding='utf-8') as file:
+                stats = self.run(file, format, options, progress)
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f'Imported {stats["imported"]} products in {elapsed:.2f}s: '
+            f'{stats["skipped"]} rows skipped, {stats["categories"]} '
+            f'categories created, {stats["images"]} images queued'
+        )
+
+    def run(self, file, format, options, progress):
+        return import_feed(
+            file,
+            format=format,
+            batch_size=options['batch_size'],
+            fetch_images=not options['no_images'],
+            progress=progress if options['verbosity'] > 1 else None,
+        )
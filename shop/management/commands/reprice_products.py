@@ -0,0 +1,57 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.models import Product
+from shop.pricing import reprice
+
+
+class Command(BaseCommand):
+    """
+    Change the price of many products at once, for example to run a sale.
+
+    Prices are updated in the database in batches, one ``UPDATE`` per batch.
+    Use a negative percentage or amount for a discount.
+    """
+    help = 'Reprice products in bulk by a percentage or an amount.'
+
+    def add_arguments(self, parser):
+        change = parser.add_mutually_exclusive_group(required=True)
+        change.add_argument(
+            '--percent', type=Decimal,
+            help='Percentage to add to the prices, e.g. -20 for 20%% off.',
+        )
+        change.add_argument(
+            '--amount', type=Decimal,
+            help='Amount to add to the prices, e.g. -5 for $5 off.',
+        )
+        parser.add_argument(
+            '--category', action='append', default=[],
+            help='Only reprice products in the category with this slug. '
+            'Can be given several times.',
+        )
+        parser.add_argument(
+            '--available-only', action='store_true',
+            help='Only reprice products that are available.',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options['category']:
+            products = products.filter(category__slug__in=options['category'])
+        if options['available_only']:
+            products = products.filter(available=True)
+        start = time.monotonic()
+        try:
+            updated = reprice(
+                products,
+                percent=options['percent'],
+                amount=options['amount'],
+                batch_size=options['batch_size'],
+            )
+        except ValueError as e:
+            raise CommandError(e)
+        elapsed = time.monotonic() - start
+        self.stdout.write(f'Repriced {updated} products in {elapsed:.2f}s')
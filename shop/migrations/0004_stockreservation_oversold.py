@@ -0,0 +1,18 @@
+# Generated by Django 5.0.9 on 2026-10-19 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_product_feed_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stockreservation',
+            name='oversold',
+            field=models.BooleanField(default=False),
+        ),
+    ]
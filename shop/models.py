@@ -46,10 +46,17 @@ class Product(models.Model):
         category (ForeignKey): The category this product belongs to.
         name (CharField): The name of the product.
         slug (SlugField): A slug for the product.
+        sku (CharField): Stock keeping unit, the key of the product in
+            catalog feeds (see shop/feeds.py).
         image (ImageField): The image of the product.
+        image_url (URLField): Where the image of a product imported from a
+            feed is downloaded from.
+        thumbnail (ImageField): Small version of the image for listings.
         description (TextField): Description of the product.
         price (DecimalField): Price of the product.
         available (BooleanField): Availability status of the product.
+        stock (PositiveIntegerField): Units that can still be sold, or None
+            if the stock of the product is not tracked.
         created (DateTimeField): The date the product was created.
         updated (DateTimeField): The date the product was last updated.
 
@@ -64,13 +71,33 @@ class Product(models.Model):
     )  # The category this product belongs to
     name = models.CharField(max_length=200)  # The name of the product
     slug = models.SlugField(max_length=200)  # Slug for the product
+    sku = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+    )  # Key of the product in catalog feeds
     image = models.ImageField(
         upload_to='products/%Y/%m/%d',
         blank=True
     )  # The image of the product
+    image_url = models.URLField(
+        max_length=500,
+        blank=True,
+    )  # Source of the image, downloaded by shop.tasks.fetch_product_images
+    thumbnail = models.ImageField(
+        upload_to='products/thumbnails/%Y/%m/%d',
+        blank=True,
+        editable=False,
+    )  # Thumbnail of the image for product listings
     description = models.TextField(blank=True)  # Description of the product
     price = models.DecimalField(max_digits=10, decimal_places=2)  # Price of the product
     available = models.BooleanField(default=True)  # Availability status
+    stock = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='Units in stock. Leave empty to sell without a limit.',
+    )  # Units left, reserved at checkout (see shop/inventory.py)
     created = models.DateTimeField(auto_now_add=True)  # Date created
     updated = models.DateTimeField(auto_now=True)  # Date last updated
 
@@ -93,3 +120,49 @@ class Product(models.Model):
             str: URL for the product detail page.
         """
         return reverse('shop:product_detail', args=[self.id, self.slug])
+
+
+class StockReservation(models.Model):
+    """Stock held for an order while it waits for payment.
+
+    The stock of the ordered products is taken when the order is created.
+    The reservation records until when the order may be paid. If the
+    payment is canceled or the reservation expires unpaid, the stock is put
+    back and ``released`` is set. A payment that completes after that takes
+    the stock again, or flags the order as ``oversold`` if it ran out.
+
+    Attributes:
+        order (OneToOneField): The order the stock is held for.
+        created (DateTimeField): When the stock was reserved.
+        expires (DateTimeField): When the stock is released if the order
+            has not been paid.
+        released (DateTimeField): When the stock was put back, or None.
+        oversold (BooleanField): Whether the order was paid after its stock
+            was put back and sold to others, so it needs review.
+
+    Meta:
+        indexes (list): Partial index on the reservations still held, used by
+            the sweeper.
+    """
+    order = models.OneToOneField(
+        'orders.Order',
+        related_name='stock_reservation',
+        on_delete=models.CASCADE,
+    )  # The order the stock is held for
+    created = models.DateTimeField(auto_now_add=True)  # Date reserved
+    expires = models.DateTimeField()  # Release time if unpaid
+    released = models.DateTimeField(null=True, blank=True)  # Date released
+    oversold = models.BooleanField(default=False)  # Paid without stock
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['expires'],
+                name='stock_reservation_held_idx',
+                condition=models.Q(released__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        """Return the string representation of the reservation."""
+        return f'Stock for order {self.order_id}'
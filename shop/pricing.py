@@ -0,0 +1,84 @@
+"""
+Bulk repricing of products.
+
+A repricing changes the price of every product matched by a queryset with
+one set-based ``UPDATE`` per batch of products, computing the new price in
+the database. Each batch commits on its own, so a sale across the whole
+catalog never holds row locks on more than ``batch_size`` products at a
+time. The catalog version is changed afterwards, which refreshes cached
+listings and the prices of items already in carts (see ``cart/cart.py``).
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DecimalField, F, Value
+from django.db.models.functions import Greatest, Round
+from django.utils import timezone
+
+from .catalog import bump_catalog_version
+from .models import Product
+
+
+def get_new_price(percent=None, amount=None):
+    """Build the expression computing the new price of a product.
+
+    Prices are rounded to cents and never go below zero.
+
+    Args:
+        percent (Decimal, optional): Percentage to add to the price, negative
+            for a discount.
+        amount (Decimal, optional): Amount to add to the price, negative for
+            a discount.
+
+    Returns:
+        Expression: The new price.
+
+    Raises:
+        ValueError: If not exactly one of ``percent`` and ``amount`` is given.
+    """
+    if (percent is None) == (amount is None):
+        raise ValueError('Give either a percentage or an amount.')
+    output_field = DecimalField(max_digits=10, decimal_places=2)
+    if percent is not None:
+        factor = 1 + Decimal(percent) / 100
+        price = F('price') * Value(factor, output_field=output_field)
+    else:
+        price = F('price') + Value(Decimal(amount), output_field=output_field)
+    return Greatest(
+        Round(price, 2, output_field=output_field),
+        Value(Decimal('0.00'), output_field=output_field),
+        output_field=output_field,
+    )
+
+
+def reprice(queryset, percent=None, amount=None, batch_size=1000):
+    """Change the price of the products in a queryset.
+
+    Products are updated in batches of consecutive IDs, each batch with a
+    single ``UPDATE`` in its own transaction.
+
+    Args:
+        queryset (QuerySet): The products to reprice.
+        percent (Decimal, optional): Percentage to add to the prices.
+        amount (Decimal, optional): Amount to add to the prices.
+        batch_size (int): The number of products per ``UPDATE``.
+
+    Returns:
+        int: The number of products repriced.
+    """
+    new_price = get_new_price(percent, amount)
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    last_id = 0
+    updated = 0
+    while True:
+        batch = list(ids.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        with transaction.atomic():
+            updated += Product.objects.filter(id__in=batch).update(
+                price=new_price, updated=timezone.now()
+            )
+        last_id = batch[-1]
+    if updated:
+        transaction.on_commit(bump_catalog_version)
+    return updated
@@ -1,12 +1,27 @@
 import redis
 from django.conf import settings
+from redis import asyncio as aioredis
+from myshop.metrics import AsyncRedisConnection, RedisConnection
 from .models import Product
 
 # Connect to Redis
 r = redis.Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=settings.REDIS_DB,
+    connection_pool=redis.ConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        connection_class=RedisConnection,
+    )
+)
+
+# asyncio client for the async views
+ar = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        connection_class=AsyncRedisConnection,
+    )
 )
 
 
@@ -92,6 +107,52 @@ class Recommender:
         )
         return suggested_products
 
+    async def asuggest_products_for(self, products, max_results=6):
+        """Suggest products based on the products provided, without blocking.
+
+        Async version of :meth:`suggest_products_for` for the async views. It
+        uses the asyncio Redis client and the async ORM interface, so waiting
+        on Redis does not block a worker thread.
+
+        Args:
+            products (list): A list of Product instances for which to generate recommendations.
+            max_results (int): The maximum number of suggested products to return.
+
+        Returns:
+            list: A list of Product instances recommended for the given products.
+        """
+        product_ids = [p.id for p in products]
+        if len(products) == 1:
+            # Only 1 product
+            suggestions = (
+                await ar.zrange(
+                    self.get_product_key(product_ids[0]), 0, -1, desc=True
+                )
+            )[:max_results]
+        else:
+            # Combine scores of all products in a temporary key
+            flat_ids = ''.join([str(id) for id in product_ids])
+            tmp_key = f'tmp_{flat_ids}'
+            keys = [self.get_product_key(id) for id in product_ids]
+            async with ar.pipeline(transaction=True) as pipe:
+                pipe.zunionstore(tmp_key, keys)
+                pipe.zrem(tmp_key, *product_ids)
+                pipe.zrange(tmp_key, 0, -1, desc=True)
+                pipe.delete(tmp_key)
+                _, _, suggestions, _ = await pipe.execute()
+            suggestions = suggestions[:max_results]
+        suggested_products_ids = [int(id) for id in suggestions]
+        # Get suggested products and sort by order of appearance
+        suggested_products = [
+            p async for p in Product.objects.filter(
+                id__in=suggested_products_ids
+            )
+        ]
+        suggested_products.sort(
+            key=lambda x: suggested_products_ids.index(x.id)
+        )
+        return suggested_products
+
     def clear_purchases(self):
         """Clear all purchase records from Redis for all products.
 
@@ -0,0 +1,24 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog import bump_catalog_version
+from .models import Category, Product
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog(sender, instance, **kwargs):
+    """
+    Change the catalog version when a product or category changes.
+
+    The version changes once the transaction commits, so a concurrent
+    request cannot cache the old listing again under the new version.
+
+    Args:
+        sender (type): The model class that sent the signal.
+        instance (Product or Category): The saved or deleted object.
+    """
+    transaction.on_commit(bump_catalog_version)
@@ -0,0 +1,30 @@
+from celery import shared_task
+
+from .images import fetch_images
+from .inventory import release_expired
+
+
+@shared_task
+def release_expired_reservations():
+    """
+    Task to put back the stock held for orders that were not paid in time.
+
+    Returns:
+        int: The number of reservations released.
+    """
+    return release_expired()
+
+
+@shared_task
+def fetch_product_images(skus, ids=()):
+    """
+    Task to download the images of imported products and their thumbnails.
+
+    Args:
+        skus (list): The SKUs of the products whose image URL changed.
+        ids (list): The IDs of such products without a SKU.
+
+    Returns:
+        int: The number of images stored.
+    """
+    return fetch_images(skus, ids)
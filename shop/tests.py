@@ -1,2 +1,731 @@
+import io
+import os
+import re
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from orders.models import Order, OrderItem
+from payment.events import mark_order_paid
+
+from PIL import Image
+
+from . import feeds, images, recommender, views
+from .catalog import get_catalog_version, get_product
+from .inventory import (
+    OutOfStock,
+    release_expired,
+    release_stock,
+    renew_reservation,
+    reserve_stock,
+)
+from .models import Category, Product, StockReservation
+from .pricing import reprice
+from .recommender import Recommender
+
+
+class FakeAsyncPipeline:
+    """Records pipeline commands and answers them from ``FakeAsyncRedis``."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    async def execute(self):
+        results = []
+        for name, args, kwargs in self.commands:
+            results.append(await getattr(self.redis, name)(*args, **kwargs))
+        return results
+
+
+class FakeAsyncRedis:
+    """In-memory replacement for the sorted set commands of the recommender."""
+
+    def __init__(self, sets):
+        self.sets = sets
+
+    def pipeline(self, transaction=True):
+        return FakeAsyncPipeline(self)
+
+    async def zrange(self, key, start, end, desc=False):
+        scores = self.sets.get(key, {})
+        members = sorted(scores, key=scores.get, reverse=desc)
+        return [str(member).encode() for member in members]
+
+    async def zunionstore(self, dest, keys):
+        union = {}
+        for key in keys:
+            for member, score in self.sets.get(key, {}).items():
+                union[member] = union.get(member, 0) + score
+        self.sets[dest] = union
+        return len(union)
+
+    async def zrem(self, key, *members):
+        for member in members:
+            self.sets.get(key, {}).pop(member, None)
+
+    async def delete(self, key):
+        self.sets.pop(key, None)
+
+
+class AsyncViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Tea', slug='tea')
+        cls.products = [
+            Product.objects.create(
+                category=category, name=f'Tea {n}', slug=f'tea-{n}',
+                price='5.00',
+            )
+            for n in range(4)
+        ]
+
+    def setUp(self):
+        first, second, third, fourth = [p.id for p in self.products]
+        rec = Recommender()
+        self.redis = FakeAsyncRedis({
+            rec.get_product_key(first): {second: 1, third: 3},
+            rec.get_product_key(second): {first: 1, fourth: 5},
+        })
+        patcher = mock.patch.object(recommender, 'ar', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_request(self, factory):
+        product = self.products[0]
+        request = factory.get(product.get_absolute_url())
+        request.session = SessionStore()
+        return request
+
+    async def test_asuggest_products_for_single_product(self):
+        suggested = await Recommender().asuggest_products_for(
+            [self.products[0]]
+        )
+        self.assertEqual(suggested, [self.products[2], self.products[1]])
+
+    async def test_asuggest_products_for_several_products(self):
+        suggested = await Recommender().asuggest_products_for(
+            self.products[:2], max_results=2
+        )
+        self.assertEqual(suggested, [self.products[3], self.products[2]])
+        self.assertEqual(len(self.redis.sets), 2)
+
+    async def test_async_product_detail_renders_recommendations(self):
+        product = self.products[0]
+        response = await views.product_detail_async(
+            self.make_request(AsyncRequestFactory()), product.id, product.slug
+        )
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('Tea 0', content)
+        self.assertLess(content.index('Tea 2'), content.index('Tea 1'))
+        self.assertNotIn('Tea 3', content)
+
+    def test_async_product_detail_matches_sync_view(self):
+        product = self.products[0]
+        suggested = [self.products[2], self.products[1]]
+        with mock.patch.object(
+            Recommender, 'suggest_products_for', return_value=suggested
+        ):
+            sync_response = views.product_detail(
+                self.make_request(RequestFactory()), product.id, product.slug
+            )
+        async_response = async_to_sync(views.product_detail_async)(
+            self.make_request(AsyncRequestFactory()), product.id, product.slug
+        )
+        # the CSRF token differs between requests
+        csrf = re.compile(r'name="csrfmiddlewaretoken" value="[^"]+"')
+        self.assertEqual(
+            csrf.sub('', async_response.content.decode()),
+            csrf.sub('', sync_response.content.decode()),
+        )
+
+    async def test_async_product_detail_unknown_product(self):
+        with self.assertRaises(Http404):
+            await views.product_detail_async(
+                self.make_request(AsyncRequestFactory()), 0, 'missing'
+            )
+
+
+def create_products(*stocks):
+    category, _ = Category.objects.get_or_create(name='Tea', slug='tea')
+    return [
+        Product.objects.create(
+            category=category, name=f'Tea {n}', slug=f'tea-{n}',
+            price='5.00', stock=stock,
+        )
+        for n, stock in enumerate(stocks)
+    ]
+
+
+def create_order(*lines):
+    order = Order.objects.create(
+        first_name='Ada',
+        last_name='Lovelace',
+        email='ada@example.com',
+        address='1 Main St',
+        postal_code='1000',
+        city='London',
+    )
+    for product, quantity in lines:
+        OrderItem.objects.create(
+            order=order, product=product, price='5.00', quantity=quantity
+        )
+    return order
+
+
+class StockReservationTests(TestCase):
+    def stock(self, *products):
+        return [
+            Product.objects.get(id=product.id).stock for product in products
+        ]
+
+    def test_reserve_takes_stock_of_all_lines_in_one_update(self):
+        first, second, untracked = create_products(5, 3, None)
+        order = create_order((first, 2), (second, 3), (untracked, 10))
+        with self.assertNumQueries(3):
+            reservation = reserve_stock(order)
+        self.assertEqual(self.stock(first, second, untracked), [3, 0, None])
+        self.assertIsNone(reservation.released)
+
+    def test_out_of_stock_takes_nothing(self):
+        first, second = create_products(5, 1)
+        order = create_order((first, 2), (second, 2))
+        with self.assertRaises(OutOfStock) as cm:
+            with transaction.atomic():
+                reserve_stock(order)
+        self.assertEqual(cm.exception.products, [second])
+        self.assertEqual(self.stock(first, second), [5, 1])
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release_puts_stock_back_once(self):
+        (product,) = create_products(5)
+        order = create_order((product, 2))
+        reserve_stock(order)
+        self.assertTrue(release_stock(order.id))
+        self.assertFalse(release_stock(order.id))
+        self.assertEqual(self.stock(product), [5])
+
+    def test_paid_orders_are_not_released(self):
+        (product,) = create_products(5)
+        order = create_order((product, 2))
+        reserve_stock(order)
+        Order.objects.filter(id=order.id).update(paid=True)
+        self.assertFalse(release_stock(order.id))
+        self.assertEqual(self.stock(product), [3])
+
+    def test_renew_takes_released_stock_again(self):
+        (product,) = create_products(2)
+        order = create_order((product, 2))
+        reserve_stock(order)
+        release_stock(order.id)
+        create_order((product, 1))
+        expires = renew_reservation(order)
+        self.assertEqual(self.stock(product), [0])
+        self.assertEqual(StockReservation.objects.get().expires, expires)
+        # a second release and a competing buyer
+        release_stock(order.id)
+        other = create_order((product, 1))
+        reserve_stock(other)
+        with self.assertRaises(OutOfStock):
+            renew_reservation(order)
+        self.assertIsNotNone(
+            StockReservation.objects.get(order=order).released
+        )
+
+    def test_late_payment_takes_released_stock_again(self):
+        (product,) = create_products(3)
+        order = create_order((product, 2))
+        reserve_stock(order)
+        release_stock(order.id)
+        with mock.patch('payment.events.order_paid'):
+            self.assertTrue(mark_order_paid(order.id, 'pi_1'))
+        self.assertEqual(self.stock(product), [1])
+        reservation = StockReservation.objects.get(order=order)
+        self.assertIsNone(reservation.released)
+        self.assertFalse(reservation.oversold)
+
+    def test_late_payment_of_sold_stock_is_flagged(self):
+        (product,) = create_products(2)
+        order = create_order((product, 2))
+        reserve_stock(order)
+        release_stock(order.id)
+        reserve_stock(create_order((product, 1)))
+        with mock.patch('payment.events.order_paid'):
+            with self.assertLogs('shop.inventory', 'ERROR'):
+                self.assertTrue(mark_order_paid(order.id, 'pi_1'))
+        self.assertEqual(self.stock(product), [1])
+        self.assertTrue(StockReservation.objects.get(order=order).oversold)
+        # kept for review when the paid reservations are cleaned up
+        release_expired()
+        self.assertTrue(StockReservation.objects.filter(order=order).exists())
+
+    def test_sweeper_releases_expired_unpaid_orders(self):
+        (product,) = create_products(10)
+        expired, fresh, paid = [create_order((product, 1)) for _ in range(3)]
+        for order in (expired, fresh, paid):
+            reserve_stock(order)
+        StockReservation.objects.exclude(order=fresh).update(
+            expires=timezone.now() - timedelta(minutes=1)
+        )
+        Order.objects.filter(id=paid.id).update(paid=True)
+        self.assertEqual(release_expired(), 1)
+        self.assertEqual(self.stock(product), [8])
+        self.assertFalse(StockReservation.objects.filter(order=paid).exists())
+        self.assertEqual(release_expired(), 0)
+
+    def test_order_create_shows_out_of_stock_error(self):
+        (product,) = create_products(1)
+        self.client.post(
+            reverse('cart:cart_add', args=[product.id]),
+            {'quantity': 2, 'override': False},
+        )
+        with mock.patch('orders.views.order_created'):
+            response = self.client.post(
+                reverse('orders:order_create'),
+                {
+                    'first_name': 'Ada',
+                    'last_name': 'Lovelace',
+                    'email': 'ada@example.com',
+                    'address': '1 Main St',
+                    'postal_code': '1000',
+                    'city': 'London',
+                },
+            )
+        self.assertContains(response, 'Not enough stock left for: Tea 0.')
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stock(product), [1])
+
+
+class StockConcurrencyTests(TransactionTestCase):
+    def buy_concurrently(self, orders):
+        results = []
+        barrier = threading.Barrier(len(orders))
+
+        def checkout(lines):
+            barrier.wait()
+            try:
+                with transaction.atomic():
+                    order = create_order(*lines)
+                    reserve_stock(order)
+                results.append(True)
+            except OutOfStock:
+                results.append(False)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=checkout, args=[lines]) for lines in orders
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_one_sku_is_never_oversold(self):
+        (product,) = create_products(10)
+        results = self.buy_concurrently([[(product, 1)]] * 40)
+        self.assertEqual(len(results), 40)
+        self.assertEqual(results.count(True), 10)
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(StockReservation.objects.count(), 10)
+
+    def test_orders_listing_products_in_any_order_do_not_deadlock(self):
+        first, second = create_products(15, 15)
+        orders = [
+            [(first, 1), (second, 1)] if n % 2 else [(second, 1), (first, 1)]
+            for n in range(20)
+        ]
+        results = self.buy_concurrently(orders)
+        # every thread finished, without database errors
+        self.assertEqual(len(results), 20)
+        self.assertEqual(results.count(True), 15)
+        self.assertEqual(
+            list(Product.objects.order_by('id').values_list('stock', flat=True)),
+            [0, 0],
+        )
+
+
+class RepricingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        tea = Category.objects.create(name='Tea', slug='tea')
+        coffee = Category.objects.create(name='Coffee', slug='coffee')
+        cls.teas = [
+            Product.objects.create(
+                category=tea, name=f'Tea {n}', slug=f'tea-{n}',
+                price=price,
+            )
+            for n, price in enumerate(['10.00', '4.99', '1.00'])
+        ]
+        cls.coffee = Product.objects.create(
+            category=coffee, name='Coffee', slug='coffee', price='8.00'
+        )
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(
+            Recommender, 'suggest_products_for', return_value=[]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def prices(self, products):
+        return [
+            str(Product.objects.get(id=product.id).price)
+            for product in products
+        ]
+
+    def test_percent_rounds_to_cents_in_batches(self):
+        teas = Product.objects.filter(category__slug='tea')
+        with self.captureOnCommitCallbacks(execute=True):
+            updated = reprice(teas, percent=Decimal('-15'), batch_size=2)
+        self.assertEqual(updated, 3)
+        self.assertEqual(self.prices(self.teas), ['8.50', '4.24', '0.85'])
+        self.assertEqual(self.prices([self.coffee]), ['8.00'])
+
+    def test_amount_never_goes_below_zero(self):
+        reprice(Product.objects.all(), amount=Decimal('-5'))
+        self.assertEqual(
+            self.prices([*self.teas, self.coffee]),
+            ['5.00', '0.00', '0.00', '3.00'],
+        )
+
+    def test_needs_exactly_one_change(self):
+        with self.assertRaises(ValueError):
+            reprice(Product.objects.all())
+        with self.assertRaises(ValueError):
+            reprice(Product.objects.all(), percent=10, amount=1)
+
+    def test_command_filters_by_category(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                'reprice_products', '--percent=10', '--category=coffee',
+                stdout=mock.Mock(),
+            )
+        self.assertEqual(self.prices([self.coffee]), ['8.80'])
+        self.assertEqual(self.prices(self.teas[:1]), ['10.00'])
+
+    def test_admin_action_reprices_selected_products(self):
+        self.client.force_login(
+            User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        )
+        url = reverse('admin:shop_product_changelist')
+        data = {
+            'action': 'reprice_products',
+            '_selected_action': [self.teas[0].id, self.coffee.id],
+        }
+        response = self.client.post(url, data)
+        self.assertContains(response, 'Reprice 2 products')
+        response = self.client.post(
+            url, {**data, 'apply': '1', 'mode': 'amount', 'value': '-1.50'}
+        )
+        self.assertRedirects(response, url)
+        self.assertEqual(
+            self.prices([self.teas[0], self.coffee]), ['8.50', '6.50']
+        )
+        self.assertEqual(self.prices(self.teas[1:2]), ['4.99'])
+
+    def test_listing_is_cached_until_repricing(self):
+        url = reverse('shop:product_list')
+        self.assertContains(self.client.get(url), '$10.00')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse(
+            [q for q in queries if 'shop_product' in q['sql']]
+        )
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            reprice(Product.objects.all(), percent=Decimal('-50'))
+        self.assertNotEqual(get_catalog_version(), version)
+        self.assertContains(self.client.get(url), '$5.00')
+
+    def test_cart_items_are_repriced_after_catalog_change(self):
+        product = self.teas[0]
+        self.client.post(
+            reverse('cart:cart_add', args=[product.id]),
+            {'quantity': 2, 'override': False},
+        )
+        response = self.client.get(reverse('cart:cart_detail'))
+        self.assertNotContains(response, '<del>')
+        with self.captureOnCommitCallbacks(execute=True):
+            reprice(Product.objects.all(), percent=Decimal('-20'))
+
+        response = self.client.get(reverse('cart:cart_detail'))
+        self.assertContains(response, '<del>$10.00</del>')
+        self.assertContains(response, '$16.00')
+        cart = self.client.session['cart']
+        self.assertEqual(cart[str(product.id)]['price'], '8.00')
+
+        # the old price is only shown once
+        response = self.client.get(reverse('cart:cart_detail'))
+        self.assertNotContains(response, '<del>')
+        self.assertContains(response, '$16.00')
+
+
+FEED = """sku,name,category,price,available,stock,image_url
+T-1,Green Tea,Tea,4.50,true,10,https://img.example.com/t1.png
+T-2,Black Tea,Tea,3.00,false,,
+C-1,Espresso Beans,Coffee & Beans,12.99,1,5,
+X-1,No price,Tea,,true,,
+X-2,,Tea,1.00,true,,
+"""
+
+
+class CatalogFeedTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(feeds, 'fetch_product_images')
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def import_csv(self, text, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return feeds.import_feed(io.StringIO(text), 'csv', **kwargs)
+
+    def test_import_creates_categories_and_products(self):
+        with self.assertLogs('shop.feeds', 'WARNING'):
+            stats = self.import_csv(FEED, batch_size=2)
+        self.assertEqual(
+            stats,
+            {
+                'rows': 5,
+                'imported': 3,
+                'skipped': 2,
+                'categories': 2,
+                'images': 1,
+            },
+        )
+        product = Product.objects.get(sku='C-1')
+        self.assertEqual(product.slug, 'espresso-beans')
+        self.assertEqual(product.category.slug, 'coffee-beans')
+        self.assertEqual(str(product.price), '12.99')
+        self.assertEqual(product.stock, 5)
+        black = Product.objects.get(sku='T-2')
+        self.assertFalse(black.available)
+        self.assertIsNone(black.stock)
+        self.fetch.delay.assert_called_once_with(['T-1'], [])
+
+    def test_import_updates_existing_products(self):
+        with self.assertLogs('shop.feeds', 'WARNING'):
+            self.import_csv(FEED)
+        product = Product.objects.get(sku='T-1')
+        self.fetch.reset_mock()
+        stats = self.import_csv(
+            'sku,name,category,price,image_url\n'
+            'T-1,Green Tea,Tea,3.99,https://img.example.com/t1.png\n'
+            'T-2,Black Tea,Tea,2.00,https://img.example.com/t2.png\n'
+        )
+        self.assertEqual(stats['categories'], 0)
+        self.assertEqual(Product.objects.count(), 3)
+        updated = Product.objects.get(sku='T-1')
+        self.assertEqual(updated.id, product.id)
+        self.assertEqual(updated.created, product.created)
+        self.assertEqual(str(updated.price), '3.99')
+        # columns missing from the feed are left alone
+        self.assertEqual(updated.stock, 10)
+        self.assertFalse(Product.objects.get(sku='T-2').available)
+        # only the new image is downloaded again
+        self.fetch.delay.assert_called_once_with(['T-2'], [])
+
+    def test_price_feed_keeps_stock_availability_and_images(self):
+        with self.assertLogs('shop.feeds', 'WARNING'):
+            self.import_csv(FEED)
+        self.import_csv(
+            'sku,name,category,price\n'
+            'T-1,Green Tea,Tea,3.99\n'
+            'T-2,Black Tea,Tea,2.00\n'
+            'N-1,New Tea,Tea,1.00\n'
+        )
+        green = Product.objects.get(sku='T-1')
+        self.assertEqual(
+            (green.stock, green.available, green.image_url),
+            (10, True, 'https://img.example.com/t1.png'),
+        )
+        self.assertFalse(Product.objects.get(sku='T-2').available)
+        new = Product.objects.get(sku='N-1')
+        self.assertEqual((new.stock, new.available), (None, True))
+
+    def test_products_without_sku_round_trip_by_id(self):
+        (product,) = create_products(4)
+        output = io.StringIO()
+        feeds.export_feed(output, 'csv')
+        Product.objects.filter(id=product.id).update(
+            price='1.00', name='Renamed'
+        )
+        # a product that is not in this catalog
+        feed = output.getvalue() + '999,,Gone,gone,Tea,tea,1.00,,True,,\n'
+        with self.assertLogs('shop.feeds', 'WARNING'):
+            stats = self.import_csv(feed)
+        self.assertEqual((stats['imported'], stats['skipped']), (1, 1))
+        product.refresh_from_db()
+        self.assertEqual(
+            (product.name, str(product.price)), ('Tea 0', '5.00')
+        )
+        self.assertIsNone(product.sku)
+        self.assertEqual(Product.objects.count(), 1)
+
+    def test_import_runs_a_fixed_number_of_queries_per_batch(self):
+        rows = ''.join(
+            f'S-{n},Tea {n},Tea,1.00,,,\n' for n in range(20)
+        )
+        header = 'sku,name,category,price,available,stock,image_url\n'
+        with self.assertNumQueries(11):
+            # per batch: savepoint, image URLs, upsert, release, plus the
+            # lookup, insert and IDs of the new category in the first one
+            self.import_csv(header + rows, batch_size=10)
+        self.assertEqual(Product.objects.count(), 20)
+
+    def test_jsonl_export_round_trip(self):
+        with self.assertLogs('shop.feeds', 'WARNING'):
+            self.import_csv(FEED)
+        output = io.StringIO()
+        self.assertEqual(feeds.export_feed(output, 'jsonl'), 3)
+        Product.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = feeds.import_feed(
+                io.StringIO(output.getvalue()), 'jsonl', fetch_images=False
+            )
+        self.assertEqual(stats['imported'], 3)
+        product = Product.objects.get(sku='T-2')
+        self.assertEqual(
+            (product.name, str(product.price), product.available),
+            ('Black Tea', '3.00', False),
+        )
+
+    def test_csv_export_command(self):
+        with self.assertLogs('shop.feeds', 'WARNING'):
+            self.import_csv(FEED)
+        output = io.StringIO()
+        call_command('export_catalog', '--category=tea', stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], ','.join(feeds.FEED_FIELDS))
+        self.assertEqual(len(lines), 3)
+
+    def test_fetch_images_stores_image_and_thumbnail(self):
+        self.import_csv(FEED.splitlines(True)[0] + FEED.splitlines(True)[1])
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 600), 'green').save(buffer, 'PNG')
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        with override_settings(MEDIA_ROOT=media.name), mock.patch.object(
+            images, 'download', return_value=buffer.getvalue()
+        ):
+            self.assertEqual(images.fetch_images(['T-1']), 1)
+            product = Product.objects.get(sku='T-1')
+            self.assertTrue(product.image.name.endswith('.png'))
+            with Image.open(product.thumbnail.path) as thumbnail:
+                self.assertEqual(thumbnail.size, (300, 225))
+
+    def test_fetch_images_drops_files_when_url_changed_meanwhile(self):
+        self.import_csv(FEED.splitlines(True)[0] + FEED.splitlines(True)[1])
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 600), 'green').save(buffer, 'PNG')
+
+        def download(session, url):
+            Product.objects.filter(sku='T-1').update(
+                image_url='https://img.example.com/other.png'
+            )
+            return buffer.getvalue()
+
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        with override_settings(MEDIA_ROOT=media.name), mock.patch.object(
+            images, 'download', side_effect=download
+        ):
+            self.assertEqual(images.fetch_images(['T-1']), 0)
+        self.assertEqual(Product.objects.get(sku='T-1').image.name, '')
+        self.assertEqual(
+            [files for _, _, files in os.walk(media.name) if files], []
+        )
+
+
+class CatalogCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.tea = Category.objects.create(name='Tea', slug='tea')
+        cls.product = Product.objects.create(
+            category=cls.tea, name='Green Tea', slug='green-tea', price='4.50'
+        )
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(
+            Recommender, 'suggest_products_for', return_value=[]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_product_lookup_is_cached_until_catalog_changes(self):
+        get_catalog_version()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_product(self.product.id), self.product)
+            product = get_product(self.product.id)
+        self.assertEqual(product.category, self.tea)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(id=self.product.id).update(available=False)
+            self.product.save(update_fields=['updated'])
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_product(self.product.id))
+
+    def test_cached_listing_and_detail_do_not_query_catalog(self):
+        list_url = reverse('shop:product_list_by_category', args=['tea'])
+        self.client.get(list_url)
+        self.client.get(self.product.get_absolute_url())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(list_url), 'Green Tea')
+            self.assertContains(
+                self.client.get(self.product.get_absolute_url()), 'Green Tea'
+            )
+        # only the session is read
+        self.assertFalse(
+            [query for query in queries if 'shop_' in query['sql']]
+        )
+
+    def test_unknown_category_and_wrong_slug_are_not_found(self):
+        self.assertEqual(
+            self.client.get(
+                reverse('shop:product_list_by_category', args=['coffee'])
+            ).status_code,
+            404,
+        )
+        self.assertEqual(
+            self.client.get(
+                reverse(
+                    'shop:product_detail', args=[self.product.id, 'wrong']
+                )
+            ).status_code,
+            404,
+        )
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
@@ -15,6 +16,8 @@ Available URL patterns:
 - `product_list`: Displays all products.
 - `product_list_by_category`: Displays products filtered by the specified category.
 - `product_detail`: Displays the details of a specific product.
+
+With `ASYNC_VIEWS` enabled the async version of `product_detail` is used.
 """
 
 urlpatterns = [
@@ -26,7 +29,11 @@ urlpatterns = [
     ),
     path(
         '<int:id>/<slug:slug>/',
-        views.product_detail,
+        (
+            views.product_detail_async
+            if settings.ASYNC_VIEWS
+            else views.product_detail
+        ),
         name='product_detail',
     ),
 ]
@@ -1,9 +1,15 @@
-from django.shortcuts import get_object_or_404, render
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404
+from django.shortcuts import render
 from cart.forms import CartAddProductForm
+from myshop.replicas import replica_reads
+from .catalog import get_catalog_version, get_category, get_product
 from .models import Category, Product
 from .recommender import Recommender
 
 
+@replica_reads
 def product_list(request, category_slug=None):
     """Display a list of products, optionally filtered by category.
 
@@ -11,6 +17,10 @@ def product_list(request, category_slug=None):
     is provided, it filters the products to only include those in the
     specified category.
 
+    The rendered listing and the category are cached per catalog version,
+    so the categories and products are only queried again after the
+    catalog changes or the cache entries expire.
+
     Args:
         request (HttpRequest): The HTTP request object.
         category_slug (str, optional): The slug of the category to filter products by.
@@ -23,7 +33,9 @@ def product_list(request, category_slug=None):
     categories = Category.objects.all()
     products = Product.objects.filter(available=True)
     if category_slug:
-        category = get_object_or_404(Category, slug=category_slug)
+        category = get_category(category_slug)
+        if category is None:
+            raise Http404('No category matches the given query.')
         products = products.filter(category=category)
     return render(
         request,
@@ -32,16 +44,20 @@ def product_list(request, category_slug=None):
             'category': category,
             'categories': categories,
             'products': products,
+            'catalog_version': get_catalog_version(),
+            'listing_timeout': settings.PRODUCT_LIST_CACHE_TIMEOUT,
         },
     )
 
 
+@replica_reads
 def product_detail(request, id, slug):
     """Display the details of a specific product.
 
     This view retrieves the product based on its ID and slug. If the product
     is available, it displays its details along with a form to add the product
     to the cart and suggests related products based on purchase history.
+    The product is cached until the catalog changes.
 
     Args:
         request (HttpRequest): The HTTP request object.
@@ -52,9 +68,9 @@ def product_detail(request, id, slug):
         HttpResponse: The rendered product detail template with context containing
         the product, cart product form, and recommended products.
     """
-    product = get_object_or_404(
-        Product, id=id, slug=slug, available=True
-    )
+    product = get_product(id)
+    if product is None or product.slug != slug:
+        raise Http404('No product matches the given query.')
     cart_product_form = CartAddProductForm()
     r = Recommender()
     recommended_products = r.suggest_products_for([product], 4)
@@ -67,3 +83,37 @@ def product_detail(request, id, slug):
             'recommended_products': recommended_products,
         },
     )
+
+
+@replica_reads
+async def product_detail_async(request, id, slug):
+    """Display the details of a specific product (async version).
+
+    Same as :func:`product_detail`, but recommendations are fetched with the
+    asyncio Redis client, so the wait on Redis does not hold a worker
+    thread when the shop is served over ASGI.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        id (int): The ID of the product to display.
+        slug (str): The slug of the product to verify the correct product.
+
+    Returns:
+        HttpResponse: The rendered product detail template.
+    """
+    product = await sync_to_async(get_product)(id)
+    if product is None or product.slug != slug:
+        raise Http404('No product matches the given query.')
+    cart_product_form = CartAddProductForm()
+    r = Recommender()
+    recommended_products = await r.asuggest_products_for([product], 4)
+    # rendering reads the session through the cart context processor
+    return await sync_to_async(render)(
+        request,
+        'shop/product/detail.html',
+        {
+            'product': product,
+            'cart_product_form': cart_product_form,
+            'recommended_products': recommended_products,
+        },
+    )